@@ -24,6 +24,9 @@ debug_level = 0
 [metric_streamer]
 # Exchange to push model results
 results_exchange_name = YOMP.model.results
+# Exchange to push model command results to, in addition to the model results
+# exchange, for subscribers that only need those
+command_results_exchange_name = YOMP.model.command_results
 # Max records per batch to stream to model
 chunk_size = 1440
 
@@ -59,6 +62,10 @@ metric_error_grace_period = 10800
 [metric_listener]
 # Port to listen on for plaintext protocol messages
 plaintext_port = 2003
+# Port to listen on for Carbon pickle protocol batches
+pickle_port = 2004
+# Port to listen on for msgpack columnar protocol batches
+msgpack_port = 2005
 queue_name = YOMP.metric.custom.data
 
 [security]
@@ -4,3 +4,11 @@
 # The root directory of the model checkpoint archive.
 # May use environment variables; MUST expand to absolute path
 root = ${HOME}/YOMP_model_checkpoints
+
+# Whether concurrent checkpoint saves share filesystem flushes (group commit)
+# instead of fsyncing every file and directory of each checkpoint. Flushes are
+# performed with syncfs(2), which flushes the whole filesystem of the archive,
+# so this pays off when many model slots checkpoint at the same time on a
+# filesystem that isn't busy with other writes. Falls back to fsync where
+# syncfs isn't available.
+group_commit = false
@@ -11,12 +11,26 @@ profiling = false
 # Name of the queue for model command and inference results
 results_queue = YOMP.mswapper.results
 
+# Number of partitions of the results queue. With more than one, each model's
+# results are published to the queue named "<results_queue>.<partition>" of
+# its partition, which is determined by consistent hashing of its model id, and
+# Anomaly Service consumes each partition in its own worker process. Change
+# only while the results queues are empty and their producers and consumers
+# are stopped, as models may move to other partitions.
+results_queue_partitions = 1
+
 # A model's input queue name is the concatenation of this prefix and model id
 model_input_queue_prefix = YOMP.mswapper.model.input.
 
 # Name of the Model Scheduler notification queue
 scheduler_notification_queue = YOMP.mswapper.scheduler.notification
 
+# Format of the model request and result batches published by Model Swapper
+# Interface: json or msgpack (compact, with columnar input rows and inference
+# results). Consumers decode batches in either format, so consumers must be
+# upgraded before producers are switched to a new format.
+batch_format = msgpack
+
 
 [model_runner]
 # The target number of model input request objects to be processed per
@@ -25,3 +39,64 @@ scheduler_notification_queue = YOMP.mswapper.scheduler.notification
 # batch, the actual number of requests processed before checkpointing the model
 # may be higher than this number.
 target_requests_per_checkpoint = 500
+
+# Target bound, in seconds, of the time it takes to recover a model after a
+# ModelRunner failure or preemption: replaying the input rows saved by
+# incremental checkpoints plus reprocessing the input that wasn't checkpointed
+# yet. Based on each model's measured processing and checkpoint costs,
+# ModelRunner checkpoints the model more often, and fully rather than
+# incrementally, when necessary to stay within this bound, and less often
+# otherwise (but at least every target_requests_per_checkpoint requests).
+checkpoint_max_recovery_sec = 30
+
+# Whether full model checkpoints are saved by a forked child process from a
+# copy-on-write snapshot of the model, while ModelRunner keeps processing input
+# (true), instead of pausing input processing until the checkpoint is saved
+# (false). Either way, input batches are acked only once the checkpoint that
+# covers them is durable.
+background_checkpoints = true
+
+# Whether each model slot runs its models in a persistent ModelRunner worker
+# process that is reused across models (true), instead of starting a new
+# ModelRunner process every time a model is swapped in (false). Persistent
+# workers save the ModelRunner process startup time, imports and message bus
+# connection on every swap.
+persistent_workers = false
+
+# Memory budget, in megabytes, of each persistent ModelRunner worker process
+# for keeping recently used models loaded in memory between runs, so that they
+# don't need to be reloaded from their checkpoints; least recently used models
+# are evicted while their estimated sizes (RSS growth on load) exceed the
+# budget, or while the process's RSS exceeds its baseline by more than the
+# budget and evictions still reduce it. 0 disables the warm model cache.
+# Only applies when persistent_workers is true.
+warm_model_cache_rss_budget_mb = 0
+
+
+[swap_controller]
+# Order in which models waiting for a free model slot are scheduled:
+#   fifo - in the order that their input arrived
+#   backlog_priority - by arrival time, adjusted for the depth of their pending
+#     input and the estimated cost of swapping them in; queuing a model costs
+#     a message bus round-trip to get its input depth
+scheduling_policy = backlog_priority
+
+# A running model is not preempted in favor of a waiting model until it has
+# been running for at least this many seconds
+min_residency_sec = 5
+
+# backlog_priority: seconds of waiting time credited to a model per doubling of
+# the number of its pending input batches
+backlog_priority_depth_weight_sec = 10
+
+# backlog_priority: estimated cost of swapping in a model, in seconds; amortized
+# over the model's pending input batches
+backlog_priority_swap_cost_sec = 2
+
+# Path of the journal file of the persistent registry of models with pending
+# input. At startup, SwapController checks only the registered models for
+# pending input instead of scanning the input queues of all models; it falls
+# back to the full scan if the registry wasn't closed gracefully or the
+# scheduler notification queue was lost. May use environment variables. Empty
+# disables the registry.
+pending_input_registry_path = ${HOME}/YOMP_model_swapper/pending_input_registry
@@ -18,7 +18,11 @@
 #
 # http://numenta.org/licenses/
 # ----------------------------------------------------------------------
+from collections import deque, namedtuple, OrderedDict
 import itertools
+import math
+
+import numpy
 
 from nupic.algorithms import anomaly_likelihood as algorithms
 from htmengine import repository
@@ -35,6 +39,220 @@ NUM_SKIP_RECORDS = 288 # One day of records
 
 
 
+# Likelihood thresholds of the red and yellow zones, as computed by
+# algorithms._filterLikelihoods()
+_RED_ZONE_THRESHOLD = 1.0 - 0.99999
+_YELLOW_ZONE_THRESHOLD = 1.0 - 0.999
+
+# Element-wise math.erfc; numpy doesn't provide erfc, and other
+# implementations don't necessarily match math.erfc bit-for-bit
+_erfc = numpy.frompyfunc(math.erfc, 1, 1)
+
+
+
+def _updateAnomalyLikelihoodsBatch(anomalyScores, params):
+  """ Vectorized equivalent of calling algorithms.updateAnomalyLikelihoods()
+  for each of the given raw anomaly scores in turn, passing the params returned
+  by each call to the next one. The likelihoods and params are bit-for-bit
+  identical to those of the per-score calls.
+
+  :param anomalyScores: a sequence of raw anomaly scores; at least one
+  :param params: anomaly likelihood params as returned by
+    algorithms.estimateAnomalyLikelihoods() or by this function; not modified
+
+  :returns: the tuple (likelihoods, newParams)
+    likelihoods: numpy array of the anomaly likelihoods of the scores
+    newParams: the updated anomaly likelihood params
+
+  :raises: ValueError if anomalyScores is empty or params aren't valid
+  """
+  if len(anomalyScores) == 0:
+    raise ValueError("Must have at least one anomalyScore")
+
+  if not algorithms.isValidEstimatorParams(params):
+    raise ValueError("'params' is not a valid params structure")
+
+  historicalValues = params["movingAverage"]["historicalValues"]
+  total = params["movingAverage"]["total"]
+  windowSize = params["movingAverage"]["windowSize"]
+  distribution = params["distribution"]
+
+  # For backward compatibility, as in algorithms.updateAnomalyLikelihoods()
+  historicalLikelihoods = params.get("historicalLikelihoods", [1.0])
+
+  assert len(historicalValues) <= windowSize, (len(historicalValues),
+                                               windowSize)
+
+  numScores = len(anomalyScores)
+  scores = numpy.array(anomalyScores, dtype=float)
+
+  # Compute the moving averages. Scores are added to the moving window's total
+  # without evicting older ones until the window is full; then, each score
+  # evicts the oldest one. The running totals are accumulated sequentially in
+  # the same order of operations as in MovingAverage.compute(), so they are
+  # identical to its totals.
+  numFilling = min(numScores, windowSize - len(historicalValues))
+  evictStart = len(historicalValues) + numFilling - windowSize
+  evicted = numpy.array(
+    list(historicalValues) + list(anomalyScores), dtype=float)[
+      evictStart:evictStart + numScores - numFilling]
+
+  terms = numpy.empty(1 + numFilling + 2 * (numScores - numFilling))
+  terms[0] = total
+  terms[1:1 + numFilling] = scores[:numFilling]
+  terms[1 + numFilling::2] = -evicted
+  terms[2 + numFilling::2] = scores[numFilling:]
+  runningTotals = numpy.cumsum(terms)
+
+  totals = numpy.concatenate((runningTotals[1:1 + numFilling],
+                              runningTotals[2 + numFilling::2]))
+  windowLengths = numpy.minimum(
+    numpy.arange(len(historicalValues) + 1,
+                 len(historicalValues) + numScores + 1),
+    windowSize)
+  averages = totals / windowLengths
+
+  # Compute the likelihoods of the averages per algorithms.normalProbability():
+  # the tail probability of the normal distribution, flipped around the mean
+  # for values below it
+  mean = distribution["mean"]
+  belowMean = averages < mean
+  tailValues = numpy.where(belowMean, 2 * mean - averages, averages)
+  tailProbabilities = 0.5 * _erfc(
+    (tailValues - mean) / distribution["stdev"] / 1.4142).astype(float)
+  rawLikelihoods = numpy.where(belowMean, 1.0 - tailProbabilities,
+                               tailProbabilities)
+
+  # Filter the likelihoods per algorithms._filterLikelihoods(): a red zone
+  # likelihood that follows another one is moved to the yellow zone
+  previousLikelihoods = numpy.empty(numScores)
+  previousLikelihoods[0] = (historicalLikelihoods[-1] if historicalLikelihoods
+                            else 1.0)
+  previousLikelihoods[1:] = rawLikelihoods[:-1]
+
+  likelihoods = numpy.where(
+    (rawLikelihoods <= _RED_ZONE_THRESHOLD) &
+    (previousLikelihoods <= _RED_ZONE_THRESHOLD),
+    _YELLOW_ZONE_THRESHOLD, rawLikelihoods)
+
+  newParams = {
+    "distribution": distribution,
+    "movingAverage": {
+      "historicalValues": (
+        list(historicalValues) + list(anomalyScores))[-windowSize:],
+      "total": float(runningTotals[-1]),
+      "windowSize": windowSize,
+    },
+    "historicalLikelihoods": (
+      list(historicalLikelihoods) + list(rawLikelihoods))[-windowSize:],
+  }
+
+  return likelihoods, newParams
+
+
+
+# A metric data sample with a raw anomaly score, as kept by _StatsSampleCache;
+# has the same attributes as the corresponding MetricData fields
+_StatsSample = namedtuple("_StatsSample",
+                          "rowid timestamp metric_value raw_anomaly_score")
+
+
+
+def _makeStatsSamples(metricDataRows):
+  """
+  :param metricDataRows: iterable of MetricData instances with valid
+    raw_anomaly_score
+
+  :returns: generator of the corresponding _StatsSample instances
+  """
+  return (_StatsSample(row.rowid, row.timestamp, row.metric_value,
+                       row.raw_anomaly_score)
+          for row in metricDataRows)
+
+
+
+class _StatsSampleCache(object):
+  """ LRU cache of the tails of models' metric data samples with raw anomaly
+  scores, kept across inference result batches, so that anomaly likelihood
+  params may be refreshed without reloading the samples from metric_data.
+
+  Each model's entry is a deque of up to statistics_sample_size _StatsSample
+  instances in ascending rowid order: either all of the model's processed
+  samples, or the most recent statistics_sample_size of them. The total number
+  of cached samples is capped by evicting the least recently used models.
+  """
+
+  def __init__(self, maxSamples):
+    """
+    :param int maxSamples: max total number of samples of all cached models
+    """
+    self._maxSamples = maxSamples
+
+    # Total number of samples in self._entries
+    self._numSamples = 0
+
+    # Map of metric id to deque of _StatsSample instances ordered from least to
+    # most recently used
+    self._entries = OrderedDict()
+
+
+  def __len__(self):
+    return len(self._entries)
+
+
+  def pop(self, metricID, nextRowID):
+    """ Remove the model's samples from the cache and return them, if they
+    end right before the given row id
+
+    :param metricID: unique metric id
+    :param nextRowID: row id of the first metric data row of the inference
+      result batch about to be processed
+
+    :returns: the model's deque of _StatsSample instances; None if not cached
+      or if they don't end right before nextRowID (e.g., redelivered batch or
+      re-created model)
+    """
+    samples = self._entries.pop(metricID, None)
+    if samples is None:
+      return None
+
+    self._numSamples -= len(samples)
+
+    if samples[-1].rowid + 1 != nextRowID:
+      return None
+
+    return samples
+
+
+  def put(self, metricID, samples):
+    """ Cache the model's samples as the most recently used entry, evicting
+    least recently used entries as needed
+
+    :param metricID: unique metric id
+    :param samples: non-empty deque of _StatsSample instances in ascending
+      rowid order; the cache assumes ownership of it
+    """
+    self.discard(metricID)
+
+    self._entries[metricID] = samples
+    self._numSamples += len(samples)
+
+    while self._numSamples > self._maxSamples:
+      _, evictedSamples = self._entries.popitem(last=False)
+      self._numSamples -= len(evictedSamples)
+
+
+  def discard(self, metricID):
+    """ Remove the model's samples from the cache, if any
+
+    :param metricID: unique metric id
+    """
+    samples = self._entries.pop(metricID, None)
+    if samples is not None:
+      self._numSamples -= len(samples)
+
+
+
 class AnomalyLikelihoodHelper(object):
   """ Helper class for running AnomalyLikelihood calculations in
   htmengine.runtime.anomaly_service.AnomalyService.
@@ -46,6 +264,11 @@ class AnomalyLikelihoodHelper(object):
                                               metric=metric,
                                               metricDataRows=metricDataRows)
   """
+
+  # Max total number of metric data samples kept in the statistics sample
+  # cache across all models; about 200 bytes each
+  _MAX_CACHED_STATS_SAMPLES = 1000000
+
   def __init__(self, log, config):
     """
     :param log: htmengine log
@@ -65,6 +288,21 @@ class AnomalyLikelihoodHelper(object):
     self._statisticsSampleSize = (
       config.getint("anomaly_likelihood", "statistics_sample_size"))
 
+    # Tails of models' metric data samples with raw anomaly scores as of their
+    # last processed inference result batch
+    self._statsSampleCache = _StatsSampleCache(
+      maxSamples=self._MAX_CACHED_STATS_SAMPLES)
+
+
+  def discardCachedStatsSamples(self, metricID):
+    """ Forget the model's cached statistics samples; must be called if the
+    metric data rows updated by the last updateModelAnomalyScores call for the
+    model failed to be saved.
+
+    :param metricID: the metric ID
+    """
+    self._statsSampleCache.discard(metricID)
+
 
   def _generateAnomalyParams(self, metricID, statsSampleCache,
                              defaultAnomalyParams):
@@ -73,7 +311,7 @@ class AnomalyLikelihoodHelper(object):
     cache.
 
     :param metricID: the metric ID
-    :param statsSampleCache: a sequence of MetricData instances that
+    :param statsSampleCache: a sequence of _StatsSample instances that
       comprise the cache of samples for the current inference result batch with
       valid raw_anomaly_score in the processed order (by rowid/timestamp). At
       least self._statisticsMinSampleSize samples are needed.
@@ -158,7 +396,8 @@ class AnomalyLikelihoodHelper(object):
     return int(max(self._minStatisticsRefreshInterval, batchSize * 0.1))
 
 
-  def _initAnomalyLikelihoodModel(self, engine, metricObj, metricDataRows):
+  def _initAnomalyLikelihoodModel(self, engine, metricObj, metricDataRows,
+                                  cachedSamples):
     """ Create the anomaly likelihood model for the given Metric instance.
     Assumes that the metric doesn't have anomaly params yet.
 
@@ -171,6 +410,9 @@ class AnomalyLikelihoodHelper(object):
       (ascending by rowid and timestamp) with updated raw_anomaly_score and
       zeroed out anomaly_score corresponding to the new model inference results,
       but not yet updated in the database. Will not alter this sequence.
+    :param cachedSamples: deque of the model's _StatsSample instances preceding
+      metricDataRows, as loaded by _loadStatsSamples or kept in the statistics
+      sample cache; passed to _refreshAnomalyParams
 
     :returns: the tuple (anomalyParams, statsSampleCache, startRowIndex)
       anomalyParams: None, if there are too few samples; otherwise, the anomaly
@@ -202,9 +444,9 @@ class AnomalyLikelihoodHelper(object):
     # Index into metricDataRows where processing of anomaly scores is to start
     startRowIndex = 0
 
-    with engine.connect() as conn:
-      numProcessedRows = repository.getProcessedMetricDataCount(conn,
-                                                                metricObj.uid)
+    # NOTE: cachedSamples holds either all of the processed samples, or
+    # statistics_sample_size of them, which is enough for the decisions below
+    numProcessedRows = len(cachedSamples)
 
     if numProcessedRows + len(metricDataRows) >= self._statisticsMinSampleSize:
       # We have enough samples to initialize the anomaly likelihood model
@@ -221,10 +463,11 @@ class AnomalyLikelihoodHelper(object):
         metricID=metricObj.uid,
         statsSampleCache=None,
         consumedSamples=consumedSamples,
-        defaultAnomalyParams=anomalyParams)
+        defaultAnomalyParams=anomalyParams,
+        cachedSamples=cachedSamples)
 
-      # If this assertion fails, it implies that the count retrieved by our
-      # call to MetricData.count above is no longer correct
+      # If this assertion fails, it implies that cachedSamples didn't hold all
+      # of the processed samples
       assert anomalyParams
 
       self._log.info("Generated initial anomaly params for model=%s: "
@@ -241,7 +484,8 @@ class AnomalyLikelihoodHelper(object):
 
 
   def _refreshAnomalyParams(self, engine, metricID, statsSampleCache,
-                            consumedSamples, defaultAnomalyParams):
+                            consumedSamples, defaultAnomalyParams,
+                            cachedSamples=None):
     """ Refresh anomaly likelihood parameters from the tail of
     statsSampleCache and consumedSamples up to self._statisticsSampleSize.
 
@@ -252,11 +496,12 @@ class AnomalyLikelihoodHelper(object):
     :type engine: sqlalchemy.engine.Engine
 
     :param metricID: the metric ID
-    :param statsSampleCache: A list of MetricData instances. None, if the
-      cache hasn't been initialized yet as is the case when the anomaly
-      likelihood model is being built for the first time for the model or are
-      being refreshed for the first time within a given result batch, in which
-      case it will be initialized as follows: up to the balance of
+    :param statsSampleCache: A deque of up to self._statisticsSampleSize
+      _StatsSample instances. None, if the cache hasn't been initialized yet as
+      is the case when the anomaly likelihood model is being built for the
+      first time for the model or are being refreshed for the first time within
+      a given result batch, in which case it will be initialized from
+      cachedSamples or, if None, as follows: up to the balance of
       self._statisticsSampleSize in excess of consumedSamples will be loaded
       from the metric_data table.
     :param consumedSamples: A sequence of samples that have been consumed by
@@ -264,17 +509,22 @@ class AnomalyLikelihoodHelper(object):
       appended to statsSampleCache
     :param defaultAnomalyParams: the default anomaly params value; if can't
       generate new ones, this value will be returned in the result tuple
+    :param cachedSamples: deque of the model's _StatsSample instances that
+      precede consumedSamples, as loaded by _loadStatsSamples or kept in the
+      statistics sample cache; None if not available. Used only if
+      statsSampleCache is None, in which case consumedSamples are appended to
+      it, and it becomes the returned statsSampleCache.
 
     :returns: the tuple (anomalyParams, statsSampleCache,)
 
       If statsSampleCache was None on entry, it will be initialized as follows:
-      up to the balance of self._statisticsSampleSize in excess of
+      if cachedSamples is not None, consumedSamples will be appended to it;
+      otherwise, up to the balance of self._statisticsSampleSize in excess of
       consumedSamples metric data rows with non-null raw anomaly scores will be
       loaded from the metric_data table and consumedSamples will be appended to
-      it. If statsSampleCache was not None on entry, then elements from
+      them. If statsSampleCache was not None on entry, then elements from
       consumedSamples will be appended to it. The returned statsSampleCache will
-      be a list NOTE: it may be an empty list, if there was nothing to fill it
-      with.
+      be a deque NOTE: it may be empty, if there was nothing to fill it with.
 
       If there are not enough total samples to satisfy
       self._statisticsMinSampleSize, then the given defaultAnomalyParams will be
@@ -282,21 +532,27 @@ class AnomalyLikelihoodHelper(object):
     """
     # Update the samples cache
 
-    if statsSampleCache is None:
+    if statsSampleCache is None and cachedSamples is not None:
+      # The samples preceding this inference result batch were cached
+      statsSampleCache = cachedSamples
+      statsSampleCache.extend(_makeStatsSamples(consumedSamples))
+    elif statsSampleCache is None:
       # The samples cache hasn't been initialized yet, so build it now;
       # this happens when the model is being built for the first time or when
       # anomaly params are being refreshed for the first time within an
-      # inference result batch.
+      # inference result batch, and the model's samples weren't cached.
       # TODO: unit-test this
       tail = self._tailMetricDataWithRawAnomalyScoresIter(
         engine,
         metricID,
         max(0, self._statisticsSampleSize - len(consumedSamples)))
 
-      statsSampleCache = list(itertools.chain(tail, consumedSamples))
+      statsSampleCache = deque(
+        _makeStatsSamples(itertools.chain(tail, consumedSamples)),
+        maxlen=self._statisticsSampleSize)
     else:
       # TODO: unit-test this
-      statsSampleCache.extend(consumedSamples)
+      statsSampleCache.extend(_makeStatsSamples(consumedSamples))
 
     anomalyParams = self._generateAnomalyParams(
       metricID=metricID,
@@ -333,6 +589,23 @@ class AnomalyLikelihoodHelper(object):
     return reversed(rows)
 
 
+  def _loadStatsSamples(self, engine, metricID):
+    """ Load the model's most recent samples with raw anomaly scores from the
+    metric_data table
+
+    :param engine: SQLAlchemy engine object
+    :type engine: sqlalchemy.engine.Engine
+    :param metricID: the metric ID
+
+    :returns: deque of up to self._statisticsSampleSize _StatsSample instances
+      in the processed order
+    """
+    return deque(
+      _makeStatsSamples(self._tailMetricDataWithRawAnomalyScoresIter(
+        engine, metricID, self._statisticsSampleSize)),
+      maxlen=self._statisticsSampleSize)
+
+
   def updateModelAnomalyScores(self, engine, metricObj, metricDataRows):
     """
     Calculate the anomaly scores based on the anomaly likelihoods. Update
@@ -350,6 +623,12 @@ class AnomalyLikelihoodHelper(object):
 
     :returns: new anomaly likelihood params for the model
 
+    *NOTE:*
+      the model's samples with raw anomaly scores, including metricDataRows,
+      are kept in the statistics sample cache for its next batch; if
+      metricDataRows fail to be saved, the caller must call
+      discardCachedStatsSamples()
+
     *NOTE:*
       the processing must be idempotent due to the "at least once" delivery
       semantics of the message bus
@@ -360,10 +639,14 @@ class AnomalyLikelihoodHelper(object):
       model's initial "catch-up" phase when large inference result batches are
       prevalent.
     """
-    # When populated, a cached list of MetricData instances for updating
+    # When populated, a cached deque of _StatsSample instances for updating
     # anomaly likelyhood params
     statsSampleCache = None
 
+    # Number of leading metricDataRows that have been appended to
+    # statsSampleCache
+    numCachedRows = 0
+
     # Index into metricDataRows where processing is to resume
     startRowIndex = 0
 
@@ -377,15 +660,26 @@ class AnomalyLikelihoodHelper(object):
                                     metricObj.status,
                                     metricObj.server,))
 
+    # The model's samples preceding metricDataRows that were kept since its
+    # last batch, if any
+    cachedSamples = self._statsSampleCache.pop(
+      metricObj.uid, nextRowID=metricDataRows[0].rowid)
+
     modelParams = jsonDecode(metricObj.model_params)
     anomalyParams = modelParams.get("anomalyLikelihoodParams", None)
     if not anomalyParams:
       # We don't have a likelihood model yet. Create one if we have sufficient
       # records with raw anomaly scores
+      if cachedSamples is None:
+        cachedSamples = self._loadStatsSamples(engine, metricObj.uid)
+
       (anomalyParams, statsSampleCache, startRowIndex) = (
         self._initAnomalyLikelihoodModel(engine=engine,
                                          metricObj=metricObj,
-                                         metricDataRows=metricDataRows))
+                                         metricDataRows=metricDataRows,
+                                         cachedSamples=cachedSamples))
+      if statsSampleCache is not None:
+        numCachedRows = startRowIndex
 
     # Do anomaly likelihood processing on the rest of the new samples
     # NOTE: this loop will be skipped if there are still not enough samples for
@@ -473,34 +767,53 @@ class AnomalyLikelihoodHelper(object):
         endRowID, anomalyParams["last_rowid_for_stats"],
         statisticsRefreshInterval, len(metricDataRows))
 
-      consumedSamples = []
-      for md in itertools.islice(metricDataRows, startRowIndex, limitIndex):
-        consumedSamples.append(md)
+      consumedSamples = list(
+        itertools.islice(metricDataRows, startRowIndex, limitIndex))
+
+      if consumedSamples:
+        rawAnomalyScores = [md.raw_anomaly_score for md in consumedSamples]
 
-        (likelihood,), _, anomalyParams["params"] = (
-          algorithms.updateAnomalyLikelihoods(
-            ((md.timestamp, md.metric_value, md.raw_anomaly_score),),
-            anomalyParams["params"]))
+        likelihoods, newParams = _updateAnomalyLikelihoodsBatch(
+          rawAnomalyScores, anomalyParams["params"])
 
-        # TODO: the float "cast" here seems redundant
-        md.anomaly_score = float(1.0 - likelihood)
+        anomalyScores = 1.0 - likelihoods
 
         # If anomaly score > 0.99 then we greedily update the statistics. 0.99
         # should not repeat too often, but to be safe we wait a few more
         # records before updating again, in order to avoid overloading the DB.
+        # The run ends with the first such sample once there are enough samples
+        # for the update.
         #
         # TODO: the magic 0.99 and the magic 3 value below should either
         #  be constants or config settings. Where should they be defined?
-        if (md.anomaly_score > 0.99 and
-            (anomalyParams["last_rowid_for_stats"] + 3) < md.rowid):
-          if statsSampleCache is None or (
-              len(statsSampleCache) + len(consumedSamples) >=
-              self._statisticsMinSampleSize):
-            # TODO: unit-test this
-            self._log.info("Forcing refresh of anomaly params for model=%s due "
-                           "to exceeded anomaly_score threshold in sample=%r",
-                           metricObj.uid, md)
-            break
+        refreshTriggers = (
+          (anomalyScores > 0.99) &
+          (numpy.array([md.rowid for md in consumedSamples]) >
+           anomalyParams["last_rowid_for_stats"] + 3))
+
+        if statsSampleCache is not None:
+          refreshTriggers[:max(0, self._statisticsMinSampleSize -
+                                  len(statsSampleCache) - 1)] = False
+
+        refreshTriggerIndexes = numpy.flatnonzero(refreshTriggers)
+        if len(refreshTriggerIndexes):
+          # TODO: unit-test this
+          numConsumed = refreshTriggerIndexes[0] + 1
+
+          self._log.info("Forcing refresh of anomaly params for model=%s due "
+                         "to exceeded anomaly_score threshold in sample=%r",
+                         metricObj.uid, consumedSamples[numConsumed - 1])
+
+          if numConsumed < len(consumedSamples):
+            consumedSamples = consumedSamples[:numConsumed]
+            _, newParams = _updateAnomalyLikelihoodsBatch(
+              rawAnomalyScores[:numConsumed], anomalyParams["params"])
+
+        anomalyParams["params"] = newParams
+
+        for md, anomalyScore in itertools.izip(consumedSamples, anomalyScores):
+          # TODO: the float "cast" here seems redundant
+          md.anomaly_score = float(anomalyScore)
 
       if startRowIndex + len(consumedSamples) < len(metricDataRows) or (
           consumedSamples[-1].rowid >= endRowID):
@@ -512,10 +825,25 @@ class AnomalyLikelihoodHelper(object):
           metricID=metricObj.uid,
           statsSampleCache=statsSampleCache,
           consumedSamples=consumedSamples,
-          defaultAnomalyParams=anomalyParams)
+          defaultAnomalyParams=anomalyParams,
+          cachedSamples=cachedSamples)
+        numCachedRows = startRowIndex + len(consumedSamples)
 
 
       startRowIndex += len(consumedSamples)
     # <--- while
 
+    # Keep the model's samples for its next batch. NOTE: if they weren't cached
+    # or loaded, then the preceding samples are unknown
+    if statsSampleCache is not None:
+      cachedSamples = statsSampleCache
+    elif cachedSamples is not None:
+      numCachedRows = 0
+
+    if cachedSamples is not None:
+      cachedSamples.extend(
+        _makeStatsSamples(itertools.islice(metricDataRows, numCachedRows,
+                                           None)))
+      self._statsSampleCache.put(metricObj.uid, cachedSamples)
+
     return anomalyParams
@@ -0,0 +1,275 @@
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+This module implements CheckpointChunkStore, the content-addressed store of
+compressed file chunks that ModelCheckpointMgr saves model instance trees in.
+"""
+
+from collections import namedtuple
+import errno
+import hashlib
+import os
+import tempfile
+import zlib
+
+
+
+# Result of CheckpointChunkStore.storeTree()
+#
+# manifest: JSONifiable description of the tree for restoreTree()
+# numChunks: number of chunks that the tree's files consist of
+# numNewChunks: number of those chunks that weren't in the store yet
+# newChunkBytes: compressed size of the new chunks in bytes
+StoredTree = namedtuple("StoredTree",
+                        "manifest numChunks numNewChunks newChunkBytes")
+
+
+
+def _fsyncReliably(fd):
+  """ perform fsync operation on the given file descriptor, retrying on EINTR
+  """
+  while True:
+    try:
+      os.fsync(fd)
+      break
+    except OSError as e:
+      if e.errno != errno.EINTR:
+        raise
+
+
+
+def _fsyncDirectoryOnly(dirPath):
+  dirfd = os.open(dirPath, os.O_DIRECTORY)
+  try:
+    _fsyncReliably(dirfd)
+  finally:
+    os.close(dirfd)
+
+
+
+class CheckpointChunkStore(object):
+  """ Content-addressed store of compressed file chunks.
+
+  Files are split into fixed-size chunks, and each chunk is stored
+  zlib-compressed in a file named by the SHA-1 digest of its uncompressed
+  contents. Storing a tree of files writes only the chunks that aren't in the
+  store already, so saving a model instance whose files are mostly unchanged
+  since its previous checkpoint writes only the changed chunks.
+
+  Chunks are written durably (via a temp file, fsync and rename) before
+  storeTree() returns, so a manifest may be committed by the caller as soon as
+  storeTree() returns. Alternatively, the caller may have new chunks staged in
+  a directory of its own without syncing, sync them along with its other
+  writes, and then move them into the store via publishChunks(); either way, a
+  chunk is never in the store before its contents are durable. Chunks are
+  never modified once stored; unreferenced chunks are removed by
+  removeUnreferencedChunks().
+
+  NOTE: not safe for concurrent writers
+  """
+
+  # Size of the chunks that files are split into
+  _CHUNK_SIZE = 1024 * 1024
+
+  # zlib compression level; favors checkpoint latency, since model instance
+  # files are highly compressible pickles anyway
+  _COMPRESSION_LEVEL = 1
+
+  _MANIFEST_DIRS_KEY = "dirs"
+  _MANIFEST_FILES_KEY = "files"
+
+
+  def __init__(self, storeDir, scratchDir):
+    """
+    :param storeDir: directory of the chunk files; created on demand
+    :param scratchDir: directory for temp files in the same filesystem as
+      storeDir
+    """
+    self._storeDir = storeDir
+    self._scratchDir = scratchDir
+
+
+  def _getChunkPath(self, chunkID):
+    return os.path.join(self._storeDir, chunkID)
+
+
+  def storeTree(self, treeDir, stagingDir=None):
+    """ Store the files of the given directory tree
+
+    :param treeDir: root directory of the tree; symlinks aren't supported
+    :param stagingDir: optional existing directory in the same filesystem as
+      the store. If given, new chunks are written to this directory without
+      syncing, and the caller is responsible for syncing them and passing the
+      directory to publishChunks() before committing the manifest. If None,
+      new chunks are written to the store durably.
+
+    :returns: StoredTree instance
+    """
+    if stagingDir is None and not os.path.isdir(self._storeDir):
+      os.mkdir(self._storeDir)
+      _fsyncDirectoryOnly(os.path.dirname(self._storeDir))
+
+    dirs = []
+    files = dict()
+    numChunks = numNewChunks = newChunkBytes = 0
+    newChunkIDs = set()
+
+    for parentPath, dirNames, fileNames in os.walk(treeDir):
+      relParentPath = os.path.relpath(parentPath, treeDir)
+
+      for d in dirNames:
+        dirs.append(os.path.normpath(os.path.join(relParentPath, d)))
+
+      for f in fileNames:
+        chunkIDs = []
+
+        with open(os.path.join(parentPath, f), "rb") as fileObj:
+          while True:
+            data = fileObj.read(self._CHUNK_SIZE)
+            if not data and chunkIDs:
+              break
+
+            chunkID = hashlib.sha1(data).hexdigest()
+            chunkIDs.append(chunkID)
+            numChunks += 1
+
+            if (chunkID not in newChunkIDs and
+                not os.path.exists(self._getChunkPath(chunkID))):
+              if stagingDir is None:
+                newChunkBytes += self._writeChunk(chunkID, data)
+              else:
+                newChunkBytes += self._stageChunk(chunkID, data, stagingDir)
+              newChunkIDs.add(chunkID)
+              numNewChunks += 1
+
+            if len(data) < self._CHUNK_SIZE:
+              break
+
+        files[os.path.normpath(os.path.join(relParentPath, f))] = chunkIDs
+
+    if numNewChunks and stagingDir is None:
+      _fsyncDirectoryOnly(self._storeDir)
+
+    manifest = {
+      self._MANIFEST_DIRS_KEY: sorted(dirs),
+      self._MANIFEST_FILES_KEY: files
+    }
+
+    return StoredTree(manifest=manifest, numChunks=numChunks,
+                      numNewChunks=numNewChunks, newChunkBytes=newChunkBytes)
+
+
+  def _writeChunk(self, chunkID, data):
+    """ Durably write a chunk, except for syncing the store directory
+
+    :returns: compressed size of the chunk in bytes
+    """
+    compressed = zlib.compress(data, self._COMPRESSION_LEVEL)
+
+    (tempFd, tempPath) = tempfile.mkstemp(prefix=chunkID,
+                                          dir=self._scratchDir)
+    try:
+      with os.fdopen(tempFd, "wb") as fileObj:
+        fileObj.write(compressed)
+        fileObj.flush()
+        _fsyncReliably(fileObj.fileno())
+
+      os.rename(tempPath, self._getChunkPath(chunkID))
+    except:
+      os.unlink(tempPath)
+      raise
+
+    return len(compressed)
+
+
+  def _stageChunk(self, chunkID, data, stagingDir):
+    """ Write a chunk to the staging directory without syncing it
+
+    :returns: compressed size of the chunk in bytes
+    """
+    compressed = zlib.compress(data, self._COMPRESSION_LEVEL)
+
+    with open(os.path.join(stagingDir, chunkID), "wb") as fileObj:
+      fileObj.write(compressed)
+
+    return len(compressed)
+
+
+  def publishChunks(self, stagingDir):
+    """ Move the chunks that storeTree() staged in the given directory into the
+    store. The caller must have synced the chunks beforehand, and is
+    responsible for syncing the store directory afterwards.
+
+    :param stagingDir: the staging directory that was passed to storeTree()
+    """
+    if not os.path.isdir(self._storeDir):
+      os.mkdir(self._storeDir)
+
+    for chunkID in os.listdir(stagingDir):
+      os.rename(os.path.join(stagingDir, chunkID), self._getChunkPath(chunkID))
+
+
+  def restoreTree(self, manifest, treeDir):
+    """ Recreate a tree from its manifest
+
+    :param manifest: manifest from StoredTree
+    :param treeDir: root directory of the tree to create; must not exist
+    """
+    os.mkdir(treeDir)
+
+    for d in manifest[self._MANIFEST_DIRS_KEY]:
+      os.mkdir(os.path.join(treeDir, d))
+
+    for f, chunkIDs in manifest[self._MANIFEST_FILES_KEY].iteritems():
+      with open(os.path.join(treeDir, f), "wb") as fileObj:
+        for chunkID in chunkIDs:
+          with open(self._getChunkPath(chunkID), "rb") as chunkFileObj:
+            fileObj.write(zlib.decompress(chunkFileObj.read()))
+
+
+  def removeUnreferencedChunks(self, manifests):
+    """ Remove the chunks that aren't referenced by any of the given manifests
+
+    :param manifests: sequence of manifests of all the trees in the store
+
+    :returns: number of chunks removed
+    """
+    referencedChunkIDs = set()
+    for manifest in manifests:
+      for chunkIDs in manifest[self._MANIFEST_FILES_KEY].itervalues():
+        referencedChunkIDs.update(chunkIDs)
+
+    try:
+      storedChunkIDs = os.listdir(self._storeDir)
+    except OSError as e:
+      if e.errno == errno.ENOENT:
+        return 0
+      else:
+        raise
+
+    numRemoved = 0
+    for chunkID in storedChunkIDs:
+      if chunkID not in referencedChunkIDs:
+        os.unlink(self._getChunkPath(chunkID))
+        numRemoved += 1
+
+    return numRemoved
@@ -0,0 +1,137 @@
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+This module implements GroupCommitSync, which lets concurrent processes that
+write to the same filesystem share filesystem flushes.
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import os
+import struct
+
+
+
+def _loadSyncfs():
+  """
+  :returns: libc's syncfs function; None if not available
+  """
+  libcPath = ctypes.util.find_library("c")
+  if libcPath is None:
+    return None
+
+  try:
+    return ctypes.CDLL(libcPath, use_errno=True).syncfs
+  except (OSError, AttributeError):
+    return None
+
+
+
+_syncfs = _loadSyncfs()
+
+
+
+class GroupCommitSync(object):
+  """ Group commit of filesystem writes across processes.
+
+  Instead of fsyncing each of its files and directories, a process calls sync()
+  once its writes are complete. sync() flushes the whole filesystem with
+  syncfs(2), unless another process completed a flush that started after the
+  call. Processes that call sync() while a flush is in progress wait for it to
+  finish, and then one of them flushes the writes of all of them at once.
+
+  The processes coordinate through a lock file in the filesystem: flushes are
+  performed under its exclusive flock, and it holds the count of completed
+  flushes. The lock file is opened anew by each sync() call, since flock
+  doesn't exclude users of the same open file description, such as threads or
+  forked child processes.
+
+  NOTE: syncfs(2) doesn't report writeback errors on Linux kernels older than
+  5.8.
+  """
+
+  # Format of the flush count in the lock file
+  _GENERATION_FORMAT = "!Q"
+
+
+  def __init__(self, lockFilePath):
+    """
+    :param lockFilePath: path of the lock file; created if needed. It must be
+      in the filesystem whose writes are to be flushed.
+    """
+    self._lockFilePath = lockFilePath
+
+
+  @classmethod
+  def isSupported(cls):
+    """
+    :returns: True if syncfs(2) is available
+    """
+    return _syncfs is not None
+
+
+  def sync(self):
+    """ Make all data that was written to the filesystem before this call
+    durable
+
+    :returns: True if we flushed the filesystem; False if another process did
+    """
+    fd = os.open(self._lockFilePath, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+      # Reading the generation under a shared lock ensures that no flush is in
+      # progress, so the next flush to complete starts after our writes
+      fcntl.flock(fd, fcntl.LOCK_SH)
+      startGeneration = self._readGeneration(fd)
+      fcntl.flock(fd, fcntl.LOCK_UN)
+
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      generation = self._readGeneration(fd)
+      if generation > startGeneration:
+        return False
+
+      if _syncfs(fd) != 0:
+        errorCode = ctypes.get_errno()
+        raise OSError(errorCode, "syncfs failed: %s" % (
+          os.strerror(errorCode),))
+
+      self._writeGeneration(fd, generation + 1)
+      return True
+    finally:
+      # Closing the file releases its lock
+      os.close(fd)
+
+
+  @classmethod
+  def _readGeneration(cls, fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    data = os.read(fd, struct.calcsize(cls._GENERATION_FORMAT))
+    if len(data) < struct.calcsize(cls._GENERATION_FORMAT):
+      return 0
+
+    return struct.unpack(cls._GENERATION_FORMAT, data)[0]
+
+
+  @classmethod
+  def _writeGeneration(cls, fd, generation):
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, struct.pack(cls._GENERATION_FORMAT, generation))
@@ -25,7 +25,9 @@ saving and loading models to persistent storage.
 """
 
 import errno
+import fcntl
 import json
+import mmap
 import os
 import shutil
 import tempfile
@@ -34,6 +36,9 @@ import time
 from nupic.frameworks.opf.modelfactory import ModelFactory
 
 from htmengine import htmengine_logging
+from htmengine.model_checkpoint_mgr.checkpoint_chunk_store import (
+    CheckpointChunkStore)
+from htmengine.model_checkpoint_mgr.group_commit import GroupCommitSync
 
 from nta.utils import makeDirectoryFromAbsolutePath
 from nta.utils.config import Config
@@ -98,12 +103,29 @@ class ModelCheckpointMgr(object):
 
     checkpoint_store_1389761327.552464/ (seconds since epoch as suffix)
       attributes.data
-      model_instance/ (the contents are generated by CLA model)
-        model.pkl
-        modelextradata/
-          TemporalAnomaly-network.nta/
-            R0-pkl
-            . . .
+      manifest.data
+      log.data (optional)
+
+    chunks/
+      0b4f3d9e2d1c5a6e7f8091a2b3c4d5e6f7081920
+      . . .
+
+  The model instance tree generated by the CLA model (model.pkl,
+  modelextradata/TemporalAnomaly-network.nta/R0-pkl, etc.) is stored as
+  compressed, content-addressed chunks in the model entry's chunks directory
+  (see CheckpointChunkStore); the checkpoint store's manifest.data lists the
+  chunks of each file in the tree. Since chunks are shared among checkpoints, a
+  new checkpoint only writes the chunks that changed since the previous one.
+  Chunks that are no longer referenced by the current checkpoint are removed
+  after it's committed.
+
+  The optional log.data is the checkpoint log (see writeCheckpointLog()): the
+  only file in the archive that is modified in place, which allows the model's
+  incremental checkpoints to append to it. A new checkpoint starts without one.
+
+  Checkpoint stores that were saved before the chunk store was introduced
+  contain the model instance tree itself in a model_instance directory instead
+  of manifest.data; they are still loaded as such.
   """
 
 
@@ -138,9 +160,35 @@ class ModelCheckpointMgr(object):
   _CHECKPOINT_ATTRIBUTES_FILE_NAME = "attributes.data"
 
   # Name of directory that contains the pickled model instance; located in the
-  # actual model checkpoint store directory
+  # actual model checkpoint store directory of checkpoints saved before the
+  # chunk store was introduced, and used for the temporary model instance tree
+  # otherwise
   _CHECKPOINT_INSTANCE_DIR_NAME = "model_instance"
 
+  # The JSON manifest of the model instance tree's chunks is stored in this
+  # file in the model checkpoint store directory
+  _CHECKPOINT_MANIFEST_FILE_NAME = "manifest.data"
+
+  # The checkpoint log file; located in the model checkpoint store directory
+  _CHECKPOINT_LOG_FILE_NAME = "log.data"
+
+  # Directory of the model's CheckpointChunkStore; located at top level of each
+  # model's archive
+  _CHUNK_STORE_DIR_NAME = "chunks"
+
+  # Lock file of GroupCommitSync in group commit mode; located in the root
+  # storage directory
+  _GROUP_COMMIT_LOCK_FILE_NAME = ".group_commit.lock"
+
+  # Linux FICLONE ioctl request code for cloning a file's extents (reflink)
+  _FICLONE = 0x40049409
+
+  # errno values of a failed link or reflink that call for the next fallback
+  # in _linkOrCopyFile
+  _LINK_FALLBACK_ERRNOS = frozenset([
+    errno.EMLINK, errno.EPERM, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+    errno.EINVAL])
+
 
   def __init__(self):
     self._logger = _getLogger()
@@ -157,6 +205,18 @@ class ModelCheckpointMgr(object):
     if not os.path.exists(self._scratchDir):
       makeDirectoryFromAbsolutePath(self._scratchDir)
 
+    # In group commit mode, save() shares filesystem flushes with concurrent
+    # saves instead of fsyncing each file of the checkpoint
+    self._groupCommit = None
+    if ModelCheckpointConfig().getboolean("storage", "group_commit"):
+      if GroupCommitSync.isSupported():
+        self._groupCommit = GroupCommitSync(
+          lockFilePath=os.path.join(self._storageRoot,
+                                    self._GROUP_COMMIT_LOCK_FILE_NAME))
+      else:
+        self._logger.warn("Group commit is not supported on this platform; "
+                          "falling back to fsync")
+
 
   @classmethod
   def _getStorageRoot(cls):
@@ -210,6 +270,16 @@ class ModelCheckpointMgr(object):
     return checkpointStoreDirPath
 
 
+  def _getChunkStore(self, modelEntryDirPath):
+    """ Get the chunk store of the model entry at the given path
+
+    :returns: CheckpointChunkStore instance
+    """
+    return CheckpointChunkStore(
+      storeDir=os.path.join(modelEntryDirPath, self._CHUNK_STORE_DIR_NAME),
+      scratchDir=self._scratchDir)
+
+
   @classmethod
   def _fsyncReliably(cls, fd):
     """ perform fsync operation on the given file descriptor, retrying on EINTR
@@ -270,6 +340,88 @@ class ModelCheckpointMgr(object):
     self._fsyncDirectoryOnly(rootPath)
 
 
+  @classmethod
+  def _linkOrCopyFile(cls, srcPath, destPath):
+    """ Create destPath with the contents of the file srcPath without copying
+    data, if possible: via a hard link, or else via a reflink if the filesystem
+    supports it, or else by copying the file.
+
+    NOTE: hard links are safe only because files in the model archive, except
+    for checkpoint logs, are never modified in place once created; they are
+    only ever replaced via rename. _cloneDirectoryTree copies checkpoint logs.
+
+    :param srcPath: path of the source file
+    :param destPath: path of the destination file; must not exist
+
+    :returns: "link", "reflink" or "copy", depending on how the file was created
+    """
+    try:
+      os.link(srcPath, destPath)
+      return "link"
+    except OSError as e:
+      if e.errno not in cls._LINK_FALLBACK_ERRNOS:
+        raise
+
+    with open(srcPath, "rb") as srcFileObj:
+      with open(destPath, "wb") as destFileObj:
+        try:
+          fcntl.ioctl(destFileObj.fileno(), cls._FICLONE, srcFileObj.fileno())
+          method = "reflink"
+        except IOError as e:
+          if e.errno not in cls._LINK_FALLBACK_ERRNOS:
+            raise
+          shutil.copyfileobj(srcFileObj, destFileObj)
+          method = "copy"
+
+    shutil.copystat(srcPath, destPath)
+    return method
+
+
+  def _cloneDirectoryTree(self, srcDirPath, destDirPath):
+    """ Recreate a directory tree, linking its files via _linkOrCopyFile, so
+    that the cost of cloning grows with the number of files rather than with
+    their size. Symlinks are recreated as is, and checkpoint logs, which are
+    modified in place, are copied.
+
+    :param srcDirPath: root directory of the source tree
+    :param destDirPath: root directory of the tree to create; must not exist
+
+    :returns: dict of _linkOrCopyFile return values to the number of files that
+      were created that way
+    """
+    methodCounts = dict()
+
+    os.mkdir(destDirPath)
+
+    for parentPath, dirNames, fileNames in os.walk(srcDirPath):
+      destParentPath = os.path.join(destDirPath,
+                                    os.path.relpath(parentPath, srcDirPath))
+
+      for d in list(dirNames):
+        srcPath = os.path.join(parentPath, d)
+        if os.path.islink(srcPath):
+          # os.walk doesn't descend into symlinked directories
+          os.symlink(os.readlink(srcPath), os.path.join(destParentPath, d))
+        else:
+          os.mkdir(os.path.join(destParentPath, d))
+
+      for f in fileNames:
+        srcPath = os.path.join(parentPath, f)
+        destPath = os.path.join(destParentPath, f)
+        if os.path.islink(srcPath):
+          os.symlink(os.readlink(srcPath), destPath)
+          continue
+
+        if f == self._CHECKPOINT_LOG_FILE_NAME:
+          shutil.copy2(srcPath, destPath)
+          method = "copy"
+        else:
+          method = self._linkOrCopyFile(srcPath, destPath)
+          methodCounts[method] = methodCounts.get(method, 0) + 1
+
+    return methodCounts
+
+
   def define(self, modelID, definition):
     """ Define a new model in model checkpoint archive.
 
@@ -385,14 +537,42 @@ class ModelCheckpointMgr(object):
       with open(attributesFilePath, "wb") as fileObj:
         json.dump(attributes, fileObj)
 
-      # Save the model
-      model.save(
-        saveModelDir=os.path.join(
-          tempCheckpointStoreDirPath,
-          self._CHECKPOINT_INSTANCE_DIR_NAME))
+      # Save the model to a temp tree, then store the tree's files in the
+      # model's chunk store, which writes only the chunks that changed since
+      # the previous checkpoint
+      tempModelInstanceDirPath = os.path.join(
+        tempRoot,
+        self._CHECKPOINT_INSTANCE_DIR_NAME)
+      model.save(saveModelDir=tempModelInstanceDirPath)
+
+      chunkStore = self._getChunkStore(modelEntryDirPath)
+
+      if self._groupCommit is None:
+        storedTree = chunkStore.storeTree(tempModelInstanceDirPath)
+      else:
+        # Stage the new chunks for syncing along with the checkpoint store
+        stagingDirPath = os.path.join(tempRoot, self._CHUNK_STORE_DIR_NAME)
+        os.mkdir(stagingDirPath)
+        storedTree = chunkStore.storeTree(tempModelInstanceDirPath,
+                                          stagingDir=stagingDirPath)
+
+      manifestFilePath = os.path.join(
+        tempCheckpointStoreDirPath,
+        self._CHECKPOINT_MANIFEST_FILE_NAME)
+
+      with open(manifestFilePath, "wb") as fileObj:
+        json.dump(storedTree.manifest, fileObj)
 
       # Get temp checkpoint store tree in consistent state
-      self._fsyncDirectoryTreeRecursively(tempCheckpointStoreDirPath)
+      if self._groupCommit is None:
+        self._fsyncDirectoryTreeRecursively(tempCheckpointStoreDirPath)
+      else:
+        self._groupCommit.sync()
+
+        # The chunks must be in the store before the link to the new
+        # checkpoint store can be switched
+        chunkStore.publishChunks(stagingDirPath)
+        self._groupCommit.sync()
 
       # Atomically rename the temp checkpoint store dir into model entry dir
       newCheckpointStoreDirPath = os.path.join(
@@ -430,18 +610,28 @@ class ModelCheckpointMgr(object):
       # NOTE: we do this before deleting the old checkpoint store to protect
       # current checkpoint integrity in the event of failure while deleting the
       # old one.
-      self._fsyncDirectoryOnly(modelEntryDirPath)
+      if self._groupCommit is None:
+        self._fsyncDirectoryOnly(modelEntryDirPath)
+      else:
+        self._groupCommit.sync()
 
-      # Lastly, remove the old checkpoint store dir
+      # Lastly, remove the old checkpoint store dir and the chunks that are no
+      # longer referenced
       if oldCheckpointStoreDirPath is not None:
         shutil.rmtree(oldCheckpointStoreDirPath)
+
+      numRemovedChunks = chunkStore.removeUnreferencedChunks(
+        [storedTree.manifest])
     finally:
       # Clean up
       shutil.rmtree(tempRoot)
 
     self._logger.info(
-      "{TAG:MCKPT.SAVE} Saved model=%s: duration=%ss; directory=%s",
-      modelID, time.time() - startTime, newCheckpointStoreDirPath)
+      "{TAG:MCKPT.SAVE} Saved model=%s: duration=%ss; directory=%s; "
+      "numChunks=%d; numNewChunks=%d; newChunkBytes=%d; numRemovedChunks=%d",
+      modelID, time.time() - startTime, newCheckpointStoreDirPath,
+      storedTree.numChunks, storedTree.numNewChunks, storedTree.newChunkBytes,
+      numRemovedChunks)
 
 
   def load(self, modelID):
@@ -459,10 +649,33 @@ class ModelCheckpointMgr(object):
 
     checkpointStoreDirPath = self._getCurrentCheckpointRealPath(modelID)
 
-    modelInstanceDirPath = os.path.join(checkpointStoreDirPath,
-                                        self._CHECKPOINT_INSTANCE_DIR_NAME)
+    manifestFilePath = os.path.join(checkpointStoreDirPath,
+                                    self._CHECKPOINT_MANIFEST_FILE_NAME)
 
-    model = ModelFactory.loadFromCheckpoint(modelInstanceDirPath)
+    if os.path.exists(manifestFilePath):
+      with open(manifestFilePath) as fileObj:
+        manifest = json.load(fileObj)
+
+      # Restore the model instance tree from the model's chunk store into a
+      # temp directory to load the model from
+      tempRoot = tempfile.mkdtemp(prefix=modelID, dir=self._scratchDir)
+      try:
+        modelInstanceDirPath = os.path.join(tempRoot,
+                                            self._CHECKPOINT_INSTANCE_DIR_NAME)
+
+        self._getChunkStore(
+          self._getModelDir(modelID, mustExist=True)).restoreTree(
+            manifest, modelInstanceDirPath)
+
+        model = ModelFactory.loadFromCheckpoint(modelInstanceDirPath)
+      finally:
+        shutil.rmtree(tempRoot)
+    else:
+      # Saved before the chunk store was introduced
+      modelInstanceDirPath = os.path.join(checkpointStoreDirPath,
+                                          self._CHECKPOINT_INSTANCE_DIR_NAME)
+
+      model = ModelFactory.loadFromCheckpoint(modelInstanceDirPath)
 
     self._logger.info(
       "{TAG:MCKPT.LOAD} Loaded model=%s: duration=%ss; directory=%s",
@@ -530,6 +743,68 @@ class ModelCheckpointMgr(object):
       return json.load(fileObj)
 
 
+  def writeCheckpointLog(self, modelID, offset, data):
+    """ Durably write data to the current checkpoint's log at the given offset,
+    discarding the log's contents beyond it.
+
+    The checkpoint log is a file of the current checkpoint that, unlike the rest
+    of the checkpoint, may be extended in place, so that appending to it costs
+    O(size of the appended data); the next save() starts a checkpoint without a
+    log. The log isn't updated atomically with the checkpoint attributes, so
+    callers are expected to keep its valid size in the checkpoint attributes
+    and to ignore anything beyond it.
+
+    :param modelID: unique model ID hex string
+    :param offset: byte offset to write the data at; at most the log's size
+    :param data: string of bytes to write
+
+    :raises: ModelNotFound if the model checkpoint hasn't been saved yet or if
+      this model's entry doesn't exist in the checkpoint archive
+    """
+    checkpointDirPath = self._getCurrentCheckpointRealPath(modelID)
+
+    logFilePath = os.path.join(checkpointDirPath,
+                               self._CHECKPOINT_LOG_FILE_NAME)
+
+    fd = os.open(logFilePath, os.O_RDWR | os.O_CREAT, 0644)
+    with os.fdopen(fd, "r+b") as fileObj:
+      fileObj.seek(0, os.SEEK_END)
+      assert offset <= fileObj.tell(), (offset, fileObj.tell())
+      isNewFile = fileObj.tell() == 0
+
+      fileObj.truncate(offset)
+      fileObj.seek(offset)
+      fileObj.write(data)
+      fileObj.flush()
+      self._fsyncReliably(fd)
+
+    if isNewFile:
+      # Get checkpoint directory into consistent state
+      self._fsyncDirectoryOnly(checkpointDirPath)
+
+
+  def mapCheckpointLog(self, modelID, size):
+    """ Memory-map the current checkpoint's log for reading
+
+    :param modelID: unique model ID hex string
+    :param size: number of bytes at the start of the log to map
+
+    :returns: read-only mmap.mmap object that the caller is responsible for
+      closing; None if size is 0
+
+    :raises: ModelNotFound if the model checkpoint hasn't been saved yet or if
+      this model's entry doesn't exist in the checkpoint archive
+    """
+    logFilePath = os.path.join(self._getCurrentCheckpointRealPath(modelID),
+                               self._CHECKPOINT_LOG_FILE_NAME)
+
+    if size == 0:
+      return None
+
+    with open(logFilePath, "rb") as fileObj:
+      return mmap.mmap(fileObj.fileno(), size, access=mmap.ACCESS_READ)
+
+
   def clone(self, modelID, destModelID):
     """ Clone an existing model archive
 
@@ -555,11 +830,11 @@ class ModelCheckpointMgr(object):
 
     tempRoot = tempfile.mkdtemp(prefix=destModelID, dir=self._scratchDir)
     try:
-      # Copy the source model entry to destination entry in temp tree
+      # Link the source model entry's files into the destination entry in
+      # temp tree; checkpoint stores and chunks are immutable once committed
       tempModelEntryDirPath = os.path.join(tempRoot, destModelID)
-      shutil.copytree(srcModelEntryDirPath,
-                      tempModelEntryDirPath,
-                      symlinks=True)
+      methodCounts = self._cloneDirectoryTree(srcModelEntryDirPath,
+                                              tempModelEntryDirPath)
 
       # Fix up the checkpoint store link, if present
       tempStoreSymlinkPath = os.path.join(tempModelEntryDirPath,
@@ -586,8 +861,10 @@ class ModelCheckpointMgr(object):
 
     self._logger.info(
       "{TAG:MCKPT.CLONE} "
-      "Cloned srcModel=%s to destModel=%s: duration=%ss; directory=%s",
-      modelID, destModelID, time.time() - startTime, destModelEntryDirPath)
+      "Cloned srcModel=%s to destModel=%s: duration=%ss; directory=%s; "
+      "files=%s",
+      modelID, destModelID, time.time() - startTime, destModelEntryDirPath,
+      methodCounts)
 
 
   def remove(self, modelID):
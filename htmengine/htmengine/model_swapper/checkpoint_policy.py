@@ -0,0 +1,230 @@
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+This module implements AdaptiveCheckpointPolicy, which decides how often
+ModelRunner checkpoints a model and whether each checkpoint is full or
+incremental, based on the model's measured save and processing costs.
+"""
+
+from collections import namedtuple
+
+
+
+class CheckpointDecision(namedtuple("CheckpointDecision",
+                                    "full reason numReplayRows estReplaySec")):
+  """ A checkpoint decision of AdaptiveCheckpointPolicy
+
+  full: True for a full checkpoint; False for an incremental one
+  reason: short string explaining the decision; one of the
+    AdaptiveCheckpointPolicy.REASON_* values
+  numReplayRows: number of input rows that will need to be replayed when the
+    model is loaded from the resulting checkpoint
+  estReplaySec: estimated time to replay those rows; None if not known yet
+  """
+  __slots__ = ()
+
+
+
+class AdaptiveCheckpointPolicy(object):
+  """ Per-model checkpoint policy that bounds the model's worst-case recovery
+  time while minimizing the time spent saving and loading it.
+
+  A model's recovery time consists of replaying the input rows saved by
+  incremental checkpoints since its last full checkpoint, and reprocessing the
+  input batches of the current run that weren't checkpointed (and acked) yet.
+  An incremental checkpoint appends the rows processed since the previous
+  checkpoint to the checkpoint log (see ModelCheckpointMgr.writeCheckpointLog),
+  so its cost depends only on the appended rows; the cost that accumulates
+  between full checkpoints is instead the replay of all the logged rows
+  whenever the model is loaded. The policy measures the model's processing
+  time per input row (which is also its replay cost per row) and the duration
+  of its full checkpoints, and uses them to:
+
+  * Limit the number of requests processed between checkpoints, so that the
+    rows to replay and reprocess fit in maxRecoverySec.
+
+  * Choose a full checkpoint over an incremental one when the rows to replay
+    wouldn't fit in maxRecoverySec, or when replaying them on the next load
+    would take as long as a full checkpoint, which would spare that replay on
+    every subsequent load. Thus, large models that are expensive to save and
+    cheap to replay get fewer full checkpoints, and models that are expensive
+    to replay get more.
+
+  Until the policy has timed a full checkpoint of the model, it uses the
+  conservative _MAX_UNCALIBRATED_INCREMENTAL_ROWS limit for incremental
+  checkpoints.
+
+  The measurements are kept in a JSON-serializable state (see `state`) that is
+  saved along with the model's checkpoints, so they carry over to the model's
+  next run.
+  """
+
+  REASON_INITIAL = "initial"
+  REASON_MAX_ROWS = "maxRows"
+  REASON_REPLAY_TIME = "replayTime"
+  REASON_LOAD_COST = "loadCost"
+  REASON_INCREMENTAL = "incremental"
+
+  # Max number of rows to replay from an incremental checkpoint before the
+  # policy has timed a full checkpoint of the model
+  _MAX_UNCALIBRATED_INCREMENTAL_ROWS = 100
+
+  # Absolute max number of rows to replay from an incremental checkpoint. Since
+  # logged rows are appended, this doesn't bound checkpoint I/O; it guards the
+  # load time against an underestimated replay cost per row (measured while the
+  # model is warm), and bounds the rows that ModelRunner saves in the
+  # checkpoint attributes instead when they can't be logged, which each
+  # incremental checkpoint rewrites in full
+  _MAX_INCREMENTAL_ROWS = 5000
+
+  # Weight of the latest measurement in the exponentially-weighted moving
+  # averages of the measured costs
+  _SMOOTHING_FACTOR = 0.3
+
+  _PER_ROW_SEC_KEY = "perRowSec"
+  _FULL_SAVE_SEC_KEY = "fullSaveSec"
+
+
+  def __init__(self, maxRecoverySec, state=None):
+    """
+    :param maxRecoverySec: target bound of the model's worst-case recovery
+      time, in seconds
+    :param state: optional policy state from a previous run, as returned by
+      `state`; None to start without measurements
+    """
+    self._maxRecoverySec = maxRecoverySec
+
+    state = state or dict()
+
+    # Moving average of processing time per input row; None if not measured
+    self._perRowSec = state.get(self._PER_ROW_SEC_KEY)
+
+    # Moving average of full checkpoint duration; None if not measured
+    self._fullSaveSec = state.get(self._FULL_SAVE_SEC_KEY)
+
+
+  @property
+  def state(self):
+    """ JSON-serializable policy state for saving with the model's checkpoint
+    """
+    return {
+      self._PER_ROW_SEC_KEY: self._perRowSec,
+      self._FULL_SAVE_SEC_KEY: self._fullSaveSec,
+    }
+
+
+  @property
+  def perRowSec(self):
+    """ Measured processing time per input row; None if not measured yet """
+    return self._perRowSec
+
+
+  @property
+  def fullSaveSec(self):
+    """ Measured full checkpoint duration; None if not measured yet """
+    return self._fullSaveSec
+
+
+  @classmethod
+  def _smooth(cls, average, sample):
+    if average is None:
+      return float(sample)
+
+    return (cls._SMOOTHING_FACTOR * sample +
+            (1 - cls._SMOOTHING_FACTOR) * average)
+
+
+  def recordProcessing(self, numRows, durationSec):
+    """ Record the time it took the model to process a batch of input rows
+
+    :param numRows: number of input rows in the batch
+    :param durationSec: processing duration, excluding model loading
+    """
+    if numRows > 0:
+      self._perRowSec = self._smooth(self._perRowSec,
+                                     max(durationSec, 0) / float(numRows))
+
+
+  def recordCheckpoint(self, decision, durationSec):
+    """ Record the duration of a checkpoint; only full checkpoints' durations
+    affect the decisions, since an incremental checkpoint's cost doesn't grow
+    with the rows logged since the last full checkpoint
+
+    :param decision: the CheckpointDecision that the checkpoint carried out
+    :param durationSec: checkpoint duration
+    """
+    if decision.full:
+      self._fullSaveSec = self._smooth(self._fullSaveSec, durationSec)
+
+
+  def getMaxRequestsPerCheckpoint(self, targetMaxRequests, numReplayRows):
+    """ Get the max number of requests to process before the next checkpoint
+
+    :param targetMaxRequests: configured upper bound
+    :param numReplayRows: number of input rows that would be replayed from the
+      current checkpoint
+
+    :returns: number of requests, between 1 and targetMaxRequests
+    """
+    if not self._perRowSec:
+      return targetMaxRequests
+
+    budgetRows = int(self._maxRecoverySec / self._perRowSec) - numReplayRows
+
+    return max(1, min(targetMaxRequests, budgetRows))
+
+
+  def decide(self, hasCheckpoint, numReplayRows):
+    """ Decide whether the next checkpoint should be full or incremental
+
+    :param hasCheckpoint: True if the model already has a checkpoint that an
+      incremental checkpoint could build on
+    :param numReplayRows: number of input rows since the last full checkpoint,
+      including those of the current run; an incremental checkpoint would need
+      to save all of them for replay
+
+    :returns: CheckpointDecision instance
+    """
+    estReplaySec = (numReplayRows * self._perRowSec
+                    if self._perRowSec is not None else None)
+
+    if self._fullSaveSec is None:
+      maxIncrementalRows = self._MAX_UNCALIBRATED_INCREMENTAL_ROWS
+    else:
+      maxIncrementalRows = self._MAX_INCREMENTAL_ROWS
+
+    if not hasCheckpoint:
+      reason = self.REASON_INITIAL
+    elif numReplayRows > maxIncrementalRows:
+      reason = self.REASON_MAX_ROWS
+    elif estReplaySec is not None and estReplaySec > self._maxRecoverySec:
+      reason = self.REASON_REPLAY_TIME
+    elif (estReplaySec is not None and self._fullSaveSec is not None and
+          estReplaySec >= self._fullSaveSec):
+      reason = self.REASON_LOAD_COST
+    else:
+      return CheckpointDecision(full=False, reason=self.REASON_INCREMENTAL,
+                                numReplayRows=numReplayRows,
+                                estReplaySec=estReplaySec)
+
+    return CheckpointDecision(full=True, reason=reason, numReplayRows=0,
+                              estReplaySec=0.0)
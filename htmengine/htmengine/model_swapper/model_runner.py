@@ -26,15 +26,23 @@ processes are started by the Model Scheduler service.
 """
 
 import base64
+from collections import OrderedDict
 import cPickle as pickle
+import datetime
+import gc
 import logging
 from optparse import OptionParser
+import os
 import select
 import sys
 import time
 import traceback
+import weakref
 
 
+import numpy
+import psutil
+
 from nupic.data.fieldmeta import FieldMetaInfo
 from nupic.data.record_stream import RecordStreamIface
 from nupic.frameworks.opf.modelfactory import ModelFactory
@@ -46,9 +54,11 @@ from htmengine.model_checkpoint_mgr import model_checkpoint_mgr
 from htmengine.model_checkpoint_mgr.model_checkpoint_mgr import (
     ModelCheckpointMgr)
 from htmengine.model_swapper import ModelSwapperConfig
+from htmengine.model_swapper.checkpoint_policy import AdaptiveCheckpointPolicy
 from htmengine.model_swapper.model_swapper_interface import (
     ModelCommand, ModelCommandResult,
     ModelInferenceResult, ModelInputRow, ModelSwapperInterface)
+from htmengine.model_swapper.slot_agent import ModelRunnerWorkerProtocol
 
 from nta.utils.logging_support_raw import LoggingSupport
 
@@ -83,33 +93,68 @@ class _ModelRunnerError(Exception):
 
 
 
+class _BackgroundCheckpointError(Exception):
+  """ A model checkpoint that was being saved in the background failed """
+  pass
+
+
+
 class ModelRunner(object):
 
   # How many exception traceback tail characters to include in error results
   _MAX_TRACEBACK_TAIL = 100
 
 
-  def __init__(self, modelID):
+  def __init__(self, modelID, swapperAPI=None, modelCache=None):
     """
     :param modelID: model ID; string
+    :param swapperAPI: optional ModelSwapperInterface instance to share, such
+      as across the models run by a persistent worker process; the caller
+      remains responsible for closing it. If None, ModelRunner creates and
+      closes its own.
+    :param modelCache: optional _WarmModelCache of a persistent worker process;
+      the model is taken from it, if resident, and returned to it on close
     """
     self._logger = _getLogger()
 
     self._modelID = modelID
 
-    self._swapperAPI = ModelSwapperInterface()
+    self._ownsSwapperAPI = swapperAPI is None
+    self._swapperAPI = (ModelSwapperInterface() if swapperAPI is None
+                        else swapperAPI)
+
+    self._modelCache = modelCache
+
+    modelSwapperConfig = ModelSwapperConfig()
+
+    # Target bound of the model's worst-case recovery time for its
+    # AdaptiveCheckpointPolicy
+    self._checkpointMaxRecoverySec = modelSwapperConfig.getfloat(
+      "model_runner", "checkpoint_max_recovery_sec")
 
-    self._archiver = _ModelArchiver(self._modelID)
+    self._archiver = None
+    if modelCache is not None:
+      self._archiver = modelCache.checkOut(modelID)
+    if self._archiver is None:
+      self._archiver = _ModelArchiver(
+        self._modelID, maxRecoverySec=self._checkpointMaxRecoverySec)
+
+    # True while the model has processed input that isn't checkpointed yet;
+    # such a model may not be reused, because the input will be redelivered
+    self._modelDirty = False
 
     # "deleteModel" command handler sets this flag to force our processing
     # loop to terminate
     self._done = False
 
-    modelSwapperConfig = ModelSwapperConfig()
-
     self._targetMaxRequestsPerCheckpoint = modelSwapperConfig.getint(
       "model_runner", "target_requests_per_checkpoint")
 
+    # Whether full checkpoints are saved by a forked child process while we
+    # keep processing input
+    self._backgroundCheckpoints = modelSwapperConfig.getboolean(
+      "model_runner", "background_checkpoints")
+
     self._profiling = (
       modelSwapperConfig.getboolean("debugging", "profiling") or
       self._logger.isEnabledFor(logging.DEBUG))
@@ -117,7 +162,8 @@ class ModelRunner(object):
     if self._profiling:
       self._logger.info("Profiling is turned on")
 
-      self._modelLoadSec = 0
+    # Time spent loading the model while processing the current input batch
+    self._modelLoadSec = 0
 
 
   @property
@@ -165,7 +211,10 @@ class ModelRunner(object):
   def close(self):
     """ Clean up """
     self._logger.debug("%r: Closing...", self)
-    self._swapperAPI.close()
+    if self._modelCache is not None and not self._modelDirty:
+      self._modelCache.checkIn(self._modelID, self._archiver)
+    if self._ownsSwapperAPI:
+      self._swapperAPI.close()
 
 
   @logExceptions(_getLogger)
@@ -182,21 +231,37 @@ class ModelRunner(object):
     # checkpoint
     modelCheckpointBatchIDSet = self._archiver.modelCheckpointBatchIDSet
 
-    try:
-      while not self._done:
-        currentRunBatchIDSet = set()
-        currentRunInputSamples = []
-        currentRunNumRequests = 0
-        lastRequestBatch = None
+    checkpointPolicy = self._archiver.checkpointPolicy
+
+    # The last request batch covered by the checkpoint that is being saved in
+    # the background, if any; it and all unacked batches before it are acked
+    # once that checkpoint commits
+    pendingAckBatch = None
 
-        with self._swapperAPI.consumeRequests(
-            modelID=self._modelID, blocking=False) as consumer:
+    try:
+      # NOTE: unacked batches are redelivered when their consumer is closed, so
+      # the consumer stays open until the background checkpoint, if any, has
+      # committed and the batches that it covers are acked
+      with self._swapperAPI.consumeRequests(
+          modelID=self._modelID, blocking=False) as consumer:
+        while not self._done:
+          currentRunBatchIDSet = set()
+          currentRunInputSamples = []
+          currentRunNumRequests = 0
+          lastRequestBatch = None
+
+          # Process no more requests before the next checkpoint than the model
+          # could reprocess within its recovery time bound
+          maxRequestsPerCheckpoint = (
+            checkpointPolicy.getMaxRequestsPerCheckpoint(
+              targetMaxRequests=self._targetMaxRequestsPerCheckpoint,
+              numReplayRows=self._archiver.numReplayRows))
 
           if self._profiling:
             batchStartTime = time.time()
 
-          # Process the next run of batches until
-          # self._targetMaxRequestsPerCheckpoint is reached or exceeded
+          # Process the next run of batches until maxRequestsPerCheckpoint is
+          # reached or exceeded
           for candidateBatch in consumer:
             if (candidateBatch.batchID in currentRunBatchIDSet or
                 candidateBatch.batchID in modelCheckpointBatchIDSet):
@@ -227,17 +292,22 @@ class ModelRunner(object):
               "%r: Processing input batch #%s; batch=%s, numItems=%s...",
               self, totalBatches, lastRequestBatch.batchID, numItems)
 
-            if self._profiling:
-              procStartTime = time.time()
-              self._modelLoadSec = 0
+            procStartTime = time.time()
+            self._modelLoadSec = 0
+            numRunInputSamplesBefore = len(currentRunInputSamples)
 
             # Process the input batch
+            self._modelDirty = True
             results = self._processInputBatch(inputObjects,
                                               currentRunInputSamples)
 
+            submitStartTime = time.time()
+
+            checkpointPolicy.recordProcessing(
+              numRows=len(currentRunInputSamples) - numRunInputSamplesBefore,
+              durationSec=submitStartTime - procStartTime - self._modelLoadSec)
+
             # Send results
-            if self._profiling:
-              submitStartTime = time.time()
 
             self._swapperAPI.submitResults(modelID=self._modelID,
                                            results=results)
@@ -262,12 +332,19 @@ class ModelRunner(object):
                 submitStartTime - procStartTime - self._modelLoadSec,
                 now - submitStartTime, totalBatches, totalRequests)
 
+            # Release the acks of the background checkpoint as soon as it
+            # commits
+            if (pendingAckBatch is not None and
+                self._archiver.completePendingCheckpoint(block=False)):
+              pendingAckBatch.ack(multiple=True)
+              pendingAckBatch = None
+
             if self._done:
               self._logger.debug("%r: command handler requested exit, leaving "
                                  "consumer loop", self)
               break
 
-            if currentRunNumRequests >= self._targetMaxRequestsPerCheckpoint:
+            if currentRunNumRequests >= maxRequestsPerCheckpoint:
               self._logger.debug("End of current run: currentRunNumRequests=%s",
                                  currentRunNumRequests)
               break
@@ -283,26 +360,48 @@ class ModelRunner(object):
 
             modelCheckpointBatchIDSet = currentRunBatchIDSet
 
+            # The previous checkpoint must commit before the next one is
+            # saved, and its batches acked before those of this run
+            if pendingAckBatch is not None:
+              self._archiver.completePendingCheckpoint()
+              pendingAckBatch.ack(multiple=True)
+              pendingAckBatch = None
+
             # Checkpoint the model.
             if self._model is not None:
 
               if self._profiling:
                 checkpointStartTime = time.time()
 
-              self._archiver.saveModel(
+              decision = self._archiver.saveModel(
                 currentRunBatchIDSet=currentRunBatchIDSet,
-                currentRunInputSamples=currentRunInputSamples)
+                currentRunInputSamples=currentRunInputSamples,
+                background=self._backgroundCheckpoints)
 
               if self._profiling:
                 self._logger.info(
                   "%r: {TAG:SWAP.MR.CHKPT.DONE} currentRunNumRequests=%s; "
-                  "currentRunNumBatches=%s; duration=%.4fs",
+                  "currentRunNumBatches=%s; duration=%.4fs; full=%s; "
+                  "background=%s; reason=%s; numReplayRows=%s; "
+                  "estReplaySec=%s; maxRequestsPerCheckpoint=%s; "
+                  "perRowSec=%s; fullSaveSec=%s",
                   self, currentRunNumRequests, len(currentRunBatchIDSet),
-                  time.time() - checkpointStartTime)
-
-            # Ack the last request batch and all unacked batches before it
-            # consumed during this run
-            lastRequestBatch.ack(multiple=True)
+                  time.time() - checkpointStartTime, decision.full,
+                  self._archiver.checkpointPending, decision.reason,
+                  decision.numReplayRows, decision.estReplaySec,
+                  maxRequestsPerCheckpoint, checkpointPolicy.perRowSec,
+                  checkpointPolicy.fullSaveSec)
+
+            if self._archiver.checkpointPending:
+              # Hold the acks until the checkpoint commits, while we keep
+              # processing input
+              pendingAckBatch = lastRequestBatch
+            else:
+              # Ack the last request batch and all unacked batches before it
+              # consumed during this run
+              lastRequestBatch.ack(multiple=True)
+
+              self._modelDirty = False
 
           if not self._done:
             # Check if SwapController wants to preempt us (it closes the other
@@ -312,7 +411,19 @@ class ModelRunner(object):
               self._logger.debug("%r: SwapController wants to preempt us, "
                                 "leaving", self)
               self._done = True
+
+        if pendingAckBatch is not None:
+          self._archiver.completePendingCheckpoint()
+          pendingAckBatch.ack(multiple=True)
+          pendingAckBatch = None
+
+          self._modelDirty = False
     finally:
+      if pendingAckBatch is not None:
+        # Failed; don't leave the child behind. The unacked batches will be
+        # redelivered and skipped if the checkpoint committed after all.
+        self._archiver.abandonPendingCheckpoint()
+
       if totalBatches == 0:
         self._logger.warn("%r: zero input batches were processed", self)
 
@@ -433,6 +544,9 @@ class ModelRunner(object):
 
     retval: ModelCommandResult instance
     """
+    # Clone the model's latest checkpoint
+    self._archiver.completePendingCheckpoint()
+
     try:
       self._checkpointMgr.clone(self._modelID, command.args["modelID"])
     except model_checkpoint_mgr.ModelNotFound as e:
@@ -462,6 +576,10 @@ class ModelRunner(object):
     raises _ModelRunnerError
     """
     try:
+      # The model's checkpoint is about to be deleted, so it doesn't matter
+      # whether the one being saved in the background, if any, succeeds
+      self._archiver.abandonPendingCheckpoint()
+
       # Delete the model's checkpoint
       try:
         self._checkpointMgr.remove(modelID=self._modelID)
@@ -474,7 +592,8 @@ class ModelRunner(object):
       # Clean up model's resources in ModelSwapperInterface
       self._swapperAPI.cleanUpAfterModelDeletion(self._modelID)
     finally:
-      self._archiver = _ModelArchiver(self._modelID)
+      self._archiver = _ModelArchiver(
+        self._modelID, maxRecoverySec=self._checkpointMaxRecoverySec)
       self._done = True
 
     return ModelCommandResult(commandID=command.commandID,
@@ -504,10 +623,18 @@ class ModelRunner(object):
 
       currentRunInputSamples.append(row.data)
 
+      # Pass the (timestamp, value) input of a metric model back with the
+      # result, so that the anomaly service needn't look it up in metric_data
+      timestamp = metricValue = None
+      if len(row.data) == 2 and isinstance(row.data[0], datetime.datetime):
+        timestamp, metricValue = row.data
+
       return ModelInferenceResult(
         rowID=row.rowID,
         status=0,
-        anomalyScore=r.inferences["anomalyScore"])
+        anomalyScore=r.inferences["anomalyScore"],
+        timestamp=timestamp,
+        metricValue=metricValue)
 
     except (Exception, _ModelRunnerError) as e:  # pylint: disable=W0703
       self._logger.exception("%r: Inference failed for row=%r", self, row)
@@ -522,17 +649,157 @@ class ModelRunner(object):
     """ Load the model and construct the input row encoder
 
     Side-effect: self._model and self._inputRowEncoder are loaded;
-      self._modelLoadSec is set if profiling is turned on
+      self._modelLoadSec is set
     """
     if self._model is None:
-      if self._profiling:
-        startTime = time.time()
+      startTime = time.time()
 
       # Load the model
-      self._archiver.loadModel()
+      if self._modelCache is not None:
+        self._modelCache.loadModel(self._archiver)
+      else:
+        self._archiver.loadModel()
+
+      self._modelLoadSec = time.time() - startTime
+
+
+
+class _WarmModelCache(object):
+  """ LRU cache of loaded models, as their _ModelArchiver instances, that a
+  persistent ModelRunner worker process keeps resident across model runs, so
+  that a model that gets input again soon doesn't need to be reloaded from its
+  checkpoint.
+
+  Least recently used models are evicted while the total of the cached models'
+  memory size estimates exceeds the budget. A model's estimate is the growth of
+  the process's RSS when it was loaded via loadModel(); models without one are
+  assumed to be of average size. Since the estimates may be off (e.g., a model
+  loaded into memory freed by evicted models), models are also evicted while
+  the process's RSS exceeds its baseline by more than the budget, but only as
+  long as evictions keep reducing the RSS: freed memory is often not returned
+  to the OS by the allocators.
+
+  Only models whose in-memory state matches their checkpoint are cached, so
+  evicting a model doesn't need to checkpoint it. A cached model is discarded
+  if another ModelRunner checkpointed it in the meantime.
+  """
+
+  def __init__(self, rssBudgetBytes):
+    """
+    :param rssBudgetBytes: max memory, in bytes, of the cached models
+    """
+    self._logger = _getLogger()
+
+    self._rssBudgetBytes = rssBudgetBytes
+
+    # Map of model ID to (_ModelArchiver, estimated model bytes) ordered from
+    # least to most recently used
+    self._archivers = OrderedDict()
+
+    # Sum of the estimated bytes of the cached models
+    self._cachedBytes = 0
+
+    # Map of _ModelArchiver to its model's estimated bytes, as measured by
+    # loadModel; entries go away with their archivers
+    self._modelBytes = weakref.WeakKeyDictionary()
+
+    self._process = psutil.Process(os.getpid())
+
+    # RSS of the process without cached models
+    self._baselineRSS = self._getRSS()
+
+
+  def __len__(self):
+    return len(self._archivers)
+
+
+  def __contains__(self, modelID):
+    return modelID in self._archivers
+
+
+  def loadModel(self, archiver):
+    """ Load the archiver's model, taking the growth of the process's RSS as
+    the estimate of the model's memory size
+
+    :param _ModelArchiver archiver: archiver of the model to load
+    """
+    rssBefore = self._getRSS()
+    archiver.loadModel()
+    modelBytes = self._getRSS() - rssBefore
+
+    # NOTE: RSS may not grow if the model was loaded into memory freed earlier
+    if modelBytes > 0:
+      self._modelBytes[archiver] = modelBytes
+
+
+  def checkOut(self, modelID):
+    """ Take a model out of the cache
+
+    :returns: the model's _ModelArchiver with the model loaded; None if the
+      model isn't cached or the cached model is stale
+    """
+    archiver, modelBytes = self._archivers.pop(modelID, (None, 0))
+    self._cachedBytes -= modelBytes
+    if archiver is not None and not archiver.isCheckpointCurrent():
+      self._logger.info("Discarding stale warm model=%s", modelID)
+      archiver = None
+    return archiver
+
 
-      if self._profiling:
-        self._modelLoadSec = time.time() - startTime
+  def checkIn(self, modelID, archiver):
+    """ Put a model in the cache as the most recently used one, evicting least
+    recently used models as needed to meet the budget
+
+    :param modelID: model ID
+    :param _ModelArchiver archiver: the model's archiver; ignored if its model
+      isn't loaded
+    """
+    if archiver.model is not None:
+      modelBytes = self._modelBytes.get(archiver)
+      if modelBytes is None:
+        modelBytes = self._getAverageModelBytes()
+
+      self._archivers[modelID] = (archiver, modelBytes)
+      self._cachedBytes += modelBytes
+
+    while self._archivers and self._cachedBytes > self._rssBudgetBytes:
+      self._evictLeastRecentlyUsed()
+
+    rssLimit = self._baselineRSS + self._rssBudgetBytes
+    rss = self._getRSS()
+    while self._archivers and rss > rssLimit:
+      self._evictLeastRecentlyUsed()
+      # Release the model's memory before measuring RSS again
+      gc.collect()
+
+      prevRSS, rss = rss, self._getRSS()
+      if rss >= prevRSS:
+        self._logger.debug("RSS=%d didn't drop after evicting a warm model; "
+                           "numCached=%d", rss, len(self._archivers))
+        break
+
+
+  def _evictLeastRecentlyUsed(self):
+    """ Evict the least recently used model from the cache """
+    evictedModelID, (_, modelBytes) = self._archivers.popitem(last=False)
+    self._cachedBytes -= modelBytes
+    self._logger.debug("Evicted warm model=%s; numCached=%d",
+                       evictedModelID, len(self._archivers))
+
+
+  def _getAverageModelBytes(self):
+    """
+    :returns: average of the known model size estimates; 0 if none
+    """
+    estimates = self._modelBytes.values()
+    return sum(estimates) // len(estimates) if estimates else 0
+
+
+  def _getRSS(self):
+    """
+    :returns: resident set size of the process in bytes
+    """
+    return self._process.get_memory_info().rss
 
 
 
@@ -549,17 +816,40 @@ class _ModelArchiver(object):
   # checkpoint. It contains a list of ModelInputRow objects processed since
   # the last full checkpoint for use in preparing the last incremental
   # model checkpoint for new input. The value is in pickle string format.
+  # Used only for input samples that don't fit _SAMPLE_LOG_DTYPE; see
+  # _INPUT_SAMPLE_LOG_SIZE_ATTR_NAME.
   _INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME = "incrementalInputSamples"
 
-  _MAX_INCREMENTAL_CHECKPOINT_DATA_ROWS = 100
+  # Name of the attribute that is stored as an integral component of the
+  # checkpoint. It contains the number of input samples processed since the
+  # last full checkpoint that are stored in the checkpoint log as
+  # _SAMPLE_LOG_DTYPE records, which lets incremental checkpoints append only
+  # their new input samples. Records beyond this number are left over from
+  # incomplete checkpoints and are ignored.
+  _INPUT_SAMPLE_LOG_SIZE_ATTR_NAME = "incrementalInputSampleLogSize"
+
+  # Fixed-width record of an input sample in the checkpoint log: the sample's
+  # naive UTC datetime as microseconds since the epoch, and its value
+  _SAMPLE_LOG_DTYPE = numpy.dtype([("timestamp", "<i8"), ("value", "<f8")])
+
+  _EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+  # Name of the attribute that is stored as an integral component of the
+  # checkpoint. It contains the state of the model's AdaptiveCheckpointPolicy
+  # (its cost measurements) as of the checkpoint.
+  _CHECKPOINT_POLICY_ATTR_NAME = "checkpointPolicy"
 
 
-  def __init__(self, modelID):
+  def __init__(self, modelID, maxRecoverySec):
     """
     :param modelID: model ID; string
+    :param maxRecoverySec: target bound of the model's worst-case recovery time
+      for its AdaptiveCheckpointPolicy
     """
     self._modelID = modelID
 
+    self._maxRecoverySec = maxRecoverySec
+
     # The model object from OPF ModelFactory; set up by the loadModel() method
     self._model = None
 
@@ -575,9 +865,25 @@ class _ModelArchiver(object):
 
     self._modelCheckpointBatchIDSetCache = None
 
-    # Input data samples that have accumulated since last full checkpoint
+    # Input data samples that have accumulated since last full checkpoint and
+    # are kept in the _INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME attribute
     self._inputSamplesSinceLastFullCheckpointCache = None
 
+    # Number of input data samples that have accumulated since last full
+    # checkpoint and are kept in the checkpoint log; only one of these and
+    # _inputSamplesSinceLastFullCheckpointCache may be non-empty
+    self._numLoggedInputSamplesCache = None
+
+    # AdaptiveCheckpointPolicy initialized from the checkpoint attributes
+    self._checkpointPolicyCache = None
+
+    # _BackgroundCheckpoint that is saving the model, if any
+    self._pendingCheckpoint = None
+
+    # _BackgroundCheckpointError of a failed background checkpoint; our
+    # checkpoint state no longer matches the archive after such a failure
+    self._backgroundCheckpointError = None
+
 
   @property
   def model(self):
@@ -606,6 +912,46 @@ class _ModelArchiver(object):
     return self._checkpointMgr
 
 
+  @property
+  def checkpointPolicy(self):
+    """ The model's AdaptiveCheckpointPolicy """
+    if self._checkpointPolicyCache is None:
+      self._loadCheckpointAttributes()
+    return self._checkpointPolicyCache
+
+
+  @property
+  def checkpointPending(self):
+    """ True while a checkpoint is being saved in the background """
+    return self._pendingCheckpoint is not None
+
+
+  @property
+  def numReplayRows(self):
+    """ Number of input rows that would be replayed when loading the model from
+    its current checkpoint
+    """
+    return (len(self._inputSamplesSinceLastFullCheckpoint) +
+            self._numLoggedInputSamples)
+
+
+  def isCheckpointCurrent(self):
+    """ Check whether the model's current checkpoint is the one that our state
+    corresponds to, versus one saved by another ModelRunner since
+
+    :returns: True if the current checkpoint is ours; False if it isn't or if
+      the model has no checkpoint
+    """
+    try:
+      checkpointAttributes = self._checkpointMgr.loadCheckpointAttributes(
+        self._modelID)
+    except model_checkpoint_mgr.ModelNotFound:
+      return False
+
+    return (set(checkpointAttributes[self._BATCH_IDS_CHECKPOINT_ATTR_NAME]) ==
+            self.modelCheckpointBatchIDSet)
+
+
   @property
   def _inputSamplesSinceLastFullCheckpoint(self):
     if self._inputSamplesSinceLastFullCheckpointCache is None:
@@ -618,6 +964,13 @@ class _ModelArchiver(object):
     self._inputSamplesSinceLastFullCheckpointCache = value
 
 
+  @property
+  def _numLoggedInputSamples(self):
+    if self._numLoggedInputSamplesCache is None:
+      self._loadCheckpointAttributes()
+    return self._numLoggedInputSamplesCache
+
+
   @classmethod
   def _encodeDataSamples(cls, dataSamples):
     """
@@ -641,6 +994,63 @@ class _ModelArchiver(object):
     return pickle.loads(base64.standard_b64decode(dataSamples))
 
 
+  @classmethod
+  def _canLogDataSamples(cls, dataSamples):
+    """
+    :param dataSamples: a sequence of data samples
+
+    :returns: True if all the data samples are (naive UTC datetime, number)
+      pairs that can be stored as _SAMPLE_LOG_DTYPE records
+    """
+    for sample in dataSamples:
+      if len(sample) != 2:
+        return False
+
+      timestamp, value = sample
+      if (not isinstance(timestamp, datetime.datetime) or
+          timestamp.tzinfo is not None or
+          not isinstance(value, (int, long, float)) or
+          isinstance(value, bool)):
+        return False
+
+    return True
+
+
+  @classmethod
+  def _encodeLoggedDataSamples(cls, dataSamples):
+    """
+    :param dataSamples: a sequence of data samples that satisfy
+      _canLogDataSamples()
+
+    :returns: a string of the data samples' _SAMPLE_LOG_DTYPE records
+    """
+    records = numpy.empty(len(dataSamples), dtype=cls._SAMPLE_LOG_DTYPE)
+    for i, (timestamp, value) in enumerate(dataSamples):
+      delta = timestamp - cls._EPOCH
+      records[i] = (
+        (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds,
+        value)
+
+    return records.tostring()
+
+
+  @classmethod
+  def _iterLoggedDataSamples(cls, buf, count):
+    """ Decode data samples from their _SAMPLE_LOG_DTYPE records without
+    copying the records
+
+    :param buf: a buffer of _SAMPLE_LOG_DTYPE records, such as a memory-mapped
+      checkpoint log; must remain open until the iteration completes
+    :param count: number of records to decode from the start of the buffer
+
+    :returns: a generator of data samples as [datetime, value] lists
+    """
+    for timestamp, value in numpy.frombuffer(buf, dtype=cls._SAMPLE_LOG_DTYPE,
+                                             count=count):
+      yield [cls._EPOCH + datetime.timedelta(microseconds=int(timestamp)),
+             float(value)]
+
+
   def _loadCheckpointAttributes(self):
     # Load the checkpoint attributes
     try:
@@ -649,6 +1059,9 @@ class _ModelArchiver(object):
     except model_checkpoint_mgr.ModelNotFound:
       self._modelCheckpointBatchIDSetCache = set()
       self._inputSamplesSinceLastFullCheckpoint = []
+      self._numLoggedInputSamplesCache = 0
+      self._checkpointPolicyCache = AdaptiveCheckpointPolicy(
+        maxRecoverySec=self._maxRecoverySec)
     else:
       self._modelCheckpointBatchIDSetCache = set(
         checkpointAttributes[self._BATCH_IDS_CHECKPOINT_ATTR_NAME])
@@ -661,6 +1074,13 @@ class _ModelArchiver(object):
       else:
         self._inputSamplesSinceLastFullCheckpoint = []
 
+      self._numLoggedInputSamplesCache = checkpointAttributes.get(
+        self._INPUT_SAMPLE_LOG_SIZE_ATTR_NAME, 0)
+
+      self._checkpointPolicyCache = AdaptiveCheckpointPolicy(
+        maxRecoverySec=self._maxRecoverySec,
+        state=checkpointAttributes.get(self._CHECKPOINT_POLICY_ATTR_NAME))
+
 
   def loadModel(self):
     """ Load the model and construct the input row encoder. On success,
@@ -719,53 +1139,278 @@ class _ModelArchiver(object):
 
     # If the checkpoint was incremental, feed the cached data into the model
     for inputSample in self._inputSamplesSinceLastFullCheckpoint:
-      # Convert a flat input sample into a format that is consumable by an OPF
-      # model
-      self._inputRowEncoder.appendRecord(inputSample)
+      self._replayInputSample(inputSample)
 
-      # Infer
-      self._model.run(self._inputRowEncoder.getNextRecordDict())
+    if self._numLoggedInputSamples:
+      sampleLog = self._checkpointMgr.mapCheckpointLog(
+        self._modelID,
+        size=self._numLoggedInputSamples * self._SAMPLE_LOG_DTYPE.itemsize)
+      try:
+        for inputSample in self._iterLoggedDataSamples(
+            sampleLog, count=self._numLoggedInputSamples):
+          self._replayInputSample(inputSample)
+      finally:
+        sampleLog.close()
+
+
+  def _replayInputSample(self, inputSample):
+    """ Feed an input sample saved by an incremental checkpoint into the model
+    """
+    # Convert a flat input sample into a format that is consumable by an OPF
+    # model
+    self._inputRowEncoder.appendRecord(inputSample)
+
+    # Infer
+    self._model.run(self._inputRowEncoder.getNextRecordDict())
+
+
+  def completePendingCheckpoint(self, block=True):
+    """ Complete the checkpoint that is being saved in the background, if any
+
+    :param block: if False, don't wait for the checkpoint to be saved
+
+    :returns: True if no checkpoint is pending anymore; False if block is False
+      and the checkpoint is still being saved
+
+    :raises: _BackgroundCheckpointError if the background checkpoint failed;
+      raised again on subsequent calls, since our checkpoint state no longer
+      matches the archive
+    """
+    if self._backgroundCheckpointError is not None:
+      raise self._backgroundCheckpointError
+
+    if self._pendingCheckpoint is None:
+      return True
+
+    try:
+      durationSec = self._pendingCheckpoint.wait(block=block)
+    except _BackgroundCheckpointError as e:
+      self._pendingCheckpoint = None
+      self._backgroundCheckpointError = e
+      raise
 
+    if durationSec is None:
+      return False
 
-  def saveModel(self, currentRunBatchIDSet, currentRunInputSamples):
+    self.checkpointPolicy.recordCheckpoint(self._pendingCheckpoint.decision,
+                                           durationSec=durationSec)
+    self._pendingCheckpoint = None
+    return True
+
+
+  def abandonPendingCheckpoint(self):
+    """ Wait for the checkpoint that is being saved in the background, if any,
+    to finish, regardless of its outcome
     """
+    if self._pendingCheckpoint is None:
+      return
+
+    try:
+      self._pendingCheckpoint.wait(block=True)
+    except _BackgroundCheckpointError:
+      _getLogger().warn("Abandoned background checkpoint of model=%s failed",
+                        self._modelID, exc_info=True)
+    finally:
+      self._pendingCheckpoint = None
+
+
+  def saveModel(self, currentRunBatchIDSet, currentRunInputSamples,
+                background=False):
+    """ Checkpoint the model, fully or incrementally per the model's
+    AdaptiveCheckpointPolicy. The checkpoint that is being saved in the
+    background, if any, is completed first.
+
     :param currentRunBatchIDSet: a set of batch ids to be saved in model
       checkpoint attributes
 
     :param currentRunInputSamples: a sequence of model input data sample objects
       for incremental checkpoint; will be saved in checkpoint attributes if an
       incremental checkpoint is performed.
+
+    :param background: if True, a full checkpoint is saved by a forked child
+      process from a snapshot of the model, and isn't durable until
+      completePendingCheckpoint() returns True; see `checkpointPending`.
+      Incremental checkpoints only update the checkpoint attributes, so they
+      are always saved synchronously.
+
+    :returns: the policy's CheckpointDecision; None if the model isn't loaded
+
+    :raises: _BackgroundCheckpointError if the previous background checkpoint
+      failed
     """
-    if self._model is not None:
-      self._modelCheckpointBatchIDSetCache = currentRunBatchIDSet.copy()
-
-      if (not self._hasCheckpoint or
-          (len(self._inputSamplesSinceLastFullCheckpoint) +
-           len(currentRunInputSamples)) >
-          self._MAX_INCREMENTAL_CHECKPOINT_DATA_ROWS):
-        # Perform a full checkpoint
-        self._inputSamplesSinceLastFullCheckpointCache = []
-
-        self._checkpointMgr.save(
-          modelID=self._modelID, model=self._model,
-          attributes={
-            self._BATCH_IDS_CHECKPOINT_ATTR_NAME:
-              list(self._modelCheckpointBatchIDSetCache)})
-
-        self._hasCheckpoint = True
-      else:
-        # Perform an incremental checkpoint
-        self._inputSamplesSinceLastFullCheckpoint.extend(currentRunInputSamples)
-        attributes = {
-          self._BATCH_IDS_CHECKPOINT_ATTR_NAME:
-            list(self._modelCheckpointBatchIDSetCache),
+    if self._model is None:
+      return None
+
+    self.completePendingCheckpoint()
+
+    self._modelCheckpointBatchIDSetCache = currentRunBatchIDSet.copy()
+
+    policy = self.checkpointPolicy
+
+    decision = policy.decide(
+      hasCheckpoint=self._hasCheckpoint,
+      numReplayRows=self.numReplayRows + len(currentRunInputSamples))
+
+    startTime = time.time()
+
+    # NOTE: the saved policy state doesn't include the duration of this
+    # checkpoint, which isn't known until it completes
+    if decision.full:
+      # Perform a full checkpoint
+      self._inputSamplesSinceLastFullCheckpointCache = []
+      self._numLoggedInputSamplesCache = 0
+
+      attributes = {
+        self._BATCH_IDS_CHECKPOINT_ATTR_NAME:
+          list(self._modelCheckpointBatchIDSetCache),
+
+        self._CHECKPOINT_POLICY_ATTR_NAME: policy.state
+      }
+
+      self._hasCheckpoint = True
+
+      if background:
+        self._pendingCheckpoint = _BackgroundCheckpoint(
+          decision=decision,
+          save=lambda: self._checkpointMgr.save(
+            modelID=self._modelID, model=self._model, attributes=attributes))
+
+        # The policy records the checkpoint's duration once it completes
+        return decision
+
+      self._checkpointMgr.save(modelID=self._modelID, model=self._model,
+                               attributes=attributes)
+    else:
+      # Perform an incremental checkpoint
+      attributes = {
+        self._BATCH_IDS_CHECKPOINT_ATTR_NAME:
+          list(self._modelCheckpointBatchIDSetCache),
 
-          self._INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME:
-            self._encodeDataSamples(self._inputSamplesSinceLastFullCheckpoint)
-        }
+        self._CHECKPOINT_POLICY_ATTR_NAME: policy.state
+      }
 
-        self._checkpointMgr.updateCheckpointAttributes(self._modelID,
-                                                       attributes)
+      attributes.update(self._saveIncrementalInputSamples(
+        currentRunInputSamples))
+
+      self._checkpointMgr.updateCheckpointAttributes(self._modelID,
+                                                     attributes)
+
+    policy.recordCheckpoint(decision, durationSec=time.time() - startTime)
+
+    return decision
+
+
+  def _saveIncrementalInputSamples(self, currentRunInputSamples):
+    """ Save the input samples of an incremental checkpoint: append them to the
+    checkpoint log if possible, falling back to the
+    _INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME attribute otherwise
+
+    :param currentRunInputSamples: a sequence of model input data samples
+      processed since the previous checkpoint
+
+    :returns: dict of the checkpoint attributes that describe the input samples
+      since the last full checkpoint
+    """
+    recordSize = self._SAMPLE_LOG_DTYPE.itemsize
+
+    if (self._canLogDataSamples(self._inputSamplesSinceLastFullCheckpoint) and
+        self._canLogDataSamples(currentRunInputSamples)):
+      # Append the new samples, preceded by those of a checkpoint that was
+      # saved without the log, if any
+      newSamples = (self._inputSamplesSinceLastFullCheckpoint +
+                    list(currentRunInputSamples))
+      if newSamples:
+        self._checkpointMgr.writeCheckpointLog(
+          self._modelID,
+          offset=self._numLoggedInputSamples * recordSize,
+          data=self._encodeLoggedDataSamples(newSamples))
+
+        self._numLoggedInputSamplesCache += len(newSamples)
+        self._inputSamplesSinceLastFullCheckpoint = []
+
+      return {
+        self._INPUT_SAMPLE_LOG_SIZE_ATTR_NAME: self._numLoggedInputSamples
+      }
+
+    if self._numLoggedInputSamples:
+      sampleLog = self._checkpointMgr.mapCheckpointLog(
+        self._modelID, size=self._numLoggedInputSamples * recordSize)
+      try:
+        self._inputSamplesSinceLastFullCheckpoint = list(
+          self._iterLoggedDataSamples(sampleLog,
+                                      count=self._numLoggedInputSamples))
+      finally:
+        sampleLog.close()
+
+      self._numLoggedInputSamplesCache = 0
+
+    self._inputSamplesSinceLastFullCheckpoint.extend(currentRunInputSamples)
+
+    return {
+      self._INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME:
+        self._encodeDataSamples(self._inputSamplesSinceLastFullCheckpoint)
+    }
+
+
+
+class _BackgroundCheckpoint(object):
+  """ A full model checkpoint that is being saved by a forked child process.
+
+  The child process gets a copy-on-write snapshot of the model as of the fork,
+  so the parent process may keep running the model while the child saves the
+  snapshot via ModelCheckpointMgr. The checkpoint is durable once the child
+  exits successfully.
+  """
+
+  def __init__(self, decision, save):
+    """
+    :param decision: the CheckpointDecision that the checkpoint carries out
+    :param save: function that saves the checkpoint; called in the child
+      process
+    """
+    self._logger = _getLogger()
+
+    self.decision = decision
+
+    self._startTime = time.time()
+
+    self._pid = os.fork()
+
+    if self._pid == 0:
+      # Child process
+      exitStatus = 1
+      try:
+        save()
+        exitStatus = 0
+      except Exception:  # pylint: disable=W0703
+        self._logger.exception("{TAG:SWAP.MR.CHKPT.BG.FAILED}")
+      finally:
+        # Exit without running the parent's clean-up handlers, which would
+        # interfere with the parent's message bus connection, etc.
+        os._exit(exitStatus)  # pylint: disable=W0212
+
+
+  def wait(self, block=True):
+    """ Wait for the child process to finish saving the checkpoint
+
+    :param block: if False, don't wait if the child process is still running
+
+    :returns: checkpoint duration in seconds; None if block is False and the
+      child process is still running
+
+    :raises: _BackgroundCheckpointError if the child process failed
+    """
+    pid, status = os.waitpid(self._pid, 0 if block else os.WNOHANG)
+
+    if pid == 0:
+      return None
+
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+      raise _BackgroundCheckpointError(
+        "Background checkpoint process pid=%s failed with status=%s" % (
+          self._pid, status))
+
+    return time.time() - self._startTime
 
 
 
@@ -848,6 +1493,77 @@ class _InputRowEncoder(RecordStreamIface):
 
 
 
+def _readControlLine(fd):
+  """ Read one line from the given file descriptor without read-ahead, so that
+  `select` on the descriptor keeps reflecting unread commands (see
+  ModelRunner.run's preemption check)
+
+  :returns: the line without line separator; None on EOF
+  """
+  chars = []
+  while True:
+    char = os.read(fd, 1)
+    if not char:
+      return None
+    if char == "\n":
+      return "".join(chars)
+    chars.append(char)
+
+
+
+def runWorker():
+  """ Run models one at a time as commanded by our SlotAgent over stdin until
+  stdin is closed, reusing this process and its message bus connection across
+  models; see htmengine.model_swapper.slot_agent.ModelRunnerWorkerProtocol
+  """
+  logger = _getLogger()
+
+  # Keep stdout to ourselves for replies; stray output goes to stderr
+  replyStream = os.fdopen(os.dup(sys.stdout.fileno()), "w", 0)
+  os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+  controlFD = sys.stdin.fileno()
+
+  rssBudgetMB = ModelSwapperConfig().getint("model_runner",
+                                            "warm_model_cache_rss_budget_mb")
+  modelCache = (_WarmModelCache(rssBudgetBytes=rssBudgetMB * 1024 * 1024)
+                if rssBudgetMB > 0 else None)
+
+  with ModelSwapperInterface() as swapperAPI:
+    while True:
+      command = _readControlLine(controlFD)
+      if command is None:
+        logger.debug("{TAG:SWAP.MR.WORKER} stdin closed, exiting")
+        break
+
+      method, _, modelID = command.partition(" ")
+      if method != ModelRunnerWorkerProtocol.RUN_COMMAND or not modelID:
+        raise ValueError("Unexpected worker command: %r" % (command,))
+
+      logger.info("{TAG:SWAP.MR.WORKER.RUN} model=%s", modelID)
+      try:
+        with ModelRunner(modelID=modelID, swapperAPI=swapperAPI,
+                         modelCache=modelCache) as runner:
+          runner.run()
+      except Exception:  # pylint: disable=W0703
+        logger.exception("{TAG:SWAP.MR.WORKER.RUN.ABORT} model=%s", modelID)
+        exitStatus = 1
+      else:
+        exitStatus = 0
+
+      replyStream.write("%s %s %d\n" % (ModelRunnerWorkerProtocol.EXITED_REPLY,
+                                         modelID, exitStatus))
+
+      # Wait for the SlotAgent to end the model session
+      command = _readControlLine(controlFD)
+      if command is None:
+        logger.debug("{TAG:SWAP.MR.WORKER} stdin closed, exiting")
+        break
+      if command != ModelRunnerWorkerProtocol.STOP_COMMAND:
+        raise ValueError("Unexpected worker command: %r" % (command,))
+
+
+
 def main(argv):
   # Parse command line options
   helpString = (
@@ -858,10 +1574,20 @@ def main(argv):
   parser.add_option("--modelID", action="store", type="str",
     help="The Model ID string that identifies the model to run.")
 
+  parser.add_option("--worker", action="store_true", default=False,
+    help="Run as a persistent worker that runs the models requested over "
+         "stdin one at a time.")
+
   (options, args) = parser.parse_args(argv[1:])
   if len(args) > 0:
     parser.error("Didn't expect any positional args (%r)." % (args,))
 
+  if options.worker:
+    if options.modelID is not None:
+      parser.error("--modelID and --worker are mutually exclusive")
+    runWorker()
+    return
+
   if options.modelID is None:
     parser.error("Missing model ID in command-line")
 
@@ -69,14 +69,18 @@ App layer reads results::
 
 from collections import namedtuple
 import datetime
+from functools import partial
 import json
 import time
 import types
 import uuid
 import weakref
 
+import msgpack
+
 from htmengine import exceptions as engine_exceptions
 from htmengine.model_swapper import ModelSwapperConfig
+from htmengine.utils import getConsistentHashPartition
 
 from nta.utils.date_time_utils import epochFromNaiveUTCDatetime
 from nta.utils import message_bus_connector
@@ -370,16 +374,31 @@ class ModelInputRow(_ModelRequestResultBase):
 
 @_ModelRequestResultBase.__register__
 class ModelInferenceResult(_ModelRequestResultBase):
-  """ Model inference result container """
+  """ Model inference result container
 
-  # NOTE: also used by serialization/deserialization in our base class
-  __slots__ = ("rowID", "status", "anomalyScore", "errorMessage")
+  Instance attributes:
+    rowID: row id of the corresponding input record
+    status: integer; 0 (zero) means success, otherwise it's an error code from
+      htmengine.htmengineerrno
+    anomalyScore: the Anomaly Score floating point value if status is 0 (zero),
+      None otherwise
+    errorMessage: error message if status is non-zero, None otherwise
+    timestamp: datetime.datetime timestamp of the corresponding input record of
+      a metric model, if provided by the producer; None otherwise
+    metricValue: metric value of the corresponding input record of a metric
+      model, if timestamp is provided; None otherwise
+  """
+
+  __slots__ = ("rowID", "status", "anomalyScore", "errorMessage", "timestamp",
+               "metricValue")
 
   __STATE_SIGNATURE__ = "iR"
 
 
-  def __init__(self, rowID, status, anomalyScore=None, errorMessage=None):
-    """ __init__(rowID, status, anomalyScore|errorMessage)
+  def __init__(self, rowID, status, anomalyScore=None, errorMessage=None,
+               timestamp=None, metricValue=None):
+    """ __init__(rowID, status, anomalyScore|errorMessage
+                 [, timestamp, metricValue])
 
     :param rowID: rowID id of the corresponding input record
     :param status: integer; 0 (zero) means success, otherwise it's an error code
@@ -387,6 +406,11 @@ class ModelInferenceResult(_ModelRequestResultBase):
     :param anomalyScore: the Anomaly Score floating point value if status is 0
       (zero), omit otherwise
     :param errorMessage: error message if status is non-zero, omit otherwise
+    :param timestamp: optional datetime.datetime timestamp of the corresponding
+      (timestamp, metricValue) input record, which saves consumers from looking
+      it up; may be passed only if status is 0 (zero)
+    :param metricValue: metric value of the corresponding input record; must be
+      passed if and only if timestamp is passed
     """
     assert isinstance(status, (int, long)), (
       "Expected int or long as status, but got: " + repr(status))
@@ -403,11 +427,24 @@ class ModelInferenceResult(_ModelRequestResultBase):
         repr(errorMessage))
       assert anomalyScore is None, (
         "Unexpected anomaly score with non-zero status: " + repr(errorMessage))
+      assert timestamp is None, (
+        "Unexpected timestamp with non-zero status: " + repr(timestamp))
+
+    if timestamp is not None:
+      assert isinstance(timestamp, datetime.datetime), (
+        "Expected datetime.datetime as timestamp, but got: " + repr(timestamp))
+      assert metricValue is not None, (
+        "Expected metricValue with timestamp=" + repr(timestamp))
+    else:
+      assert metricValue is None, (
+        "Unexpected metricValue without timestamp: " + repr(metricValue))
 
     self.rowID = rowID
     self.status = status
     self.anomalyScore = anomalyScore
     self.errorMessage = errorMessage
+    self.timestamp = timestamp
+    self.metricValue = metricValue
 
 
   def __repr__(self):
@@ -417,25 +454,97 @@ class ModelInferenceResult(_ModelRequestResultBase):
        else ", errorMsg=%s" % (self.errorMessage,)))
 
 
+  def __getstate__(self):
+    """ Return state suitable for serializing; used by BatchPackager. NOTE:
+    timestamp and metricValue are appended only if present, so that the state
+    of results without them remains readable by older consumers.
+    """
+    state = [self.__STATE_SIGNATURE__, self.rowID, self.status,
+             self.anomalyScore, self.errorMessage]
+
+    if self.timestamp is not None:
+      state.append(ModelInputRow._encodeDateTime(self.timestamp))
+      state.append(self.metricValue)
+
+    return state
+
+
+  def __setstate__(self, state):
+    """ Initialize instance members from given state that was produced by
+    __getstate__, with or without timestamp and metricValue; used by
+    BatchPackager.
+    """
+    assert len(state) in (5, 7), repr([len(state), state])
+    assert state[0] == self.__STATE_SIGNATURE__, repr(state)
+
+    self.rowID, self.status, self.anomalyScore, self.errorMessage = state[1:5]
+
+    if len(state) == 7:
+      self.timestamp = ModelInputRow._decodeDateTime(state[5])
+      self.metricValue = state[6]
+    else:
+      self.timestamp = None
+      self.metricValue = None
+
+
 
 class BatchPackager(object):
-  """ Serializer for a batch of request or result items """
+  """ Serializer for a batch of request or result items
+
+  Two batch formats are supported:
+
+  JSON_FORMAT: a JSON list of the items' __getstate__() values; the returned
+    string doesn't contain newlines.
+
+  MSGPACK_FORMAT: the _MSGPACK_HEADER followed by a msgpack-encoded list of
+    segments, each representing a run of consecutive items:
+      [_INPUT_ROWS_SEGMENT, rowIDs, epochMicroseconds, values] - ModelInputRow
+        instances with integer rowIDs and (datetime, float) data in columnar
+        form;
+      [_INFERENCE_RESULTS_SEGMENT, rowIDs, anomalyScores] - successful
+        ModelInferenceResult instances with integer rowIDs and float anomaly
+        scores in columnar form;
+      [_INFERENCE_RESULTS_WITH_INPUT_SEGMENT, rowIDs, anomalyScores,
+       epochMicroseconds, metricValues] - like _INFERENCE_RESULTS_SEGMENT, but
+        for results that also carry the (datetime, float) timestamp and
+        metricValue of their input record;
+      [_JSON_SEGMENT, jsonBatchState] - any other items in JSON_FORMAT.
+    The returned string may contain newlines.
+
+  unmarshal() detects the format of the given batch state, so consumers decode
+  either format.
+  """
+
+  JSON_FORMAT = "json"
+  MSGPACK_FORMAT = "msgpack"
+
+  # Prefix of MSGPACK_FORMAT batch states: format tag that can't start a JSON
+  # document followed by the format version
+  _MSGPACK_HEADER = "\x00\x01"
+
+  _INPUT_ROWS_SEGMENT = 0
+  _INFERENCE_RESULTS_SEGMENT = 1
+  _JSON_SEGMENT = 2
+  _INFERENCE_RESULTS_WITH_INPUT_SEGMENT = 3
+
+  _EPOCH = datetime.datetime.utcfromtimestamp(0)
 
 
   @classmethod
-  def marshal(cls, batch):
+  def marshal(cls, batch, batchFormat=JSON_FORMAT):
     """ Marshal a batch of requests or results into a string, preserving their
     order.
 
-    The returned string will NOT contain newlines (this makes it convenient to
-    write newline-separated batches to stdout and readline them from stdin
-    without further escaping of the data).
+    In JSON_FORMAT, the returned string will NOT contain newlines (this makes it
+    convenient to write newline-separated batches to stdout and readline them
+    from stdin without further escaping of the data).
 
     :param batch: a sequence of requests or results (instances of ModelCommand,
       ModelInputRow)
+    :param batchFormat: BatchPackager.JSON_FORMAT (default) or
+      BatchPackager.MSGPACK_FORMAT
 
     :returns: a string representation of the given batch, preserving order.
-      The returned string will not contain newlines.
 
     Example::
 
@@ -447,19 +556,175 @@ class BatchPackager(object):
 
     And similar for a result batch.
     """
-    return json.dumps([o.__getstate__() for o in batch])
+    if batchFormat == cls.JSON_FORMAT:
+      return cls._marshalJson(batch)
+    elif batchFormat == cls.MSGPACK_FORMAT:
+      return cls._marshalMsgpack(batch)
+    else:
+      raise ValueError("Unknown batchFormat=%r" % (batchFormat,))
 
 
   @classmethod
   def unmarshal(cls, batchState):
     """ Unmarshal the given batchState string into a sequence of request or
     result instances (e.g., ModelCommand, ModelInputRow), preserving the
-    original order
+    original order; batchState may be in any of the supported formats
     """
+    if batchState.startswith(cls._MSGPACK_HEADER):
+      return cls._unmarshalMsgpack(batchState)
+
+    return cls._unmarshalJson(batchState)
+
+
+  @classmethod
+  def _marshalJson(cls, batch):
+    return json.dumps([o.__getstate__() for o in batch])
+
+
+  @classmethod
+  def _unmarshalJson(cls, batchState):
     return tuple(_ModelRequestResultBase.__createFromState__(itemState)
                  for itemState in json.loads(batchState))
 
 
+  @classmethod
+  def _getSegmentType(cls, item):
+    """ Determine the type of segment that the given item can be encoded in
+
+    :returns: one of the _*_SEGMENT values
+    """
+    itemClass = item.__class__
+
+    if itemClass is ModelInputRow:
+      data = item.data
+      if (len(data) == 2 and
+          isinstance(item.rowID, (int, long)) and
+          data[0].__class__ is datetime.datetime and
+          data[0].tzinfo is None and
+          data[1].__class__ is float):
+        return cls._INPUT_ROWS_SEGMENT
+
+    elif itemClass is ModelInferenceResult:
+      if (item.status == 0 and
+          isinstance(item.rowID, (int, long)) and
+          item.anomalyScore.__class__ is float):
+        timestamp = item.timestamp
+        if timestamp is None:
+          return cls._INFERENCE_RESULTS_SEGMENT
+        elif (timestamp.__class__ is datetime.datetime and
+              timestamp.tzinfo is None and
+              item.metricValue.__class__ is float):
+          return cls._INFERENCE_RESULTS_WITH_INPUT_SEGMENT
+
+    return cls._JSON_SEGMENT
+
+
+  @classmethod
+  def _marshalMsgpack(cls, batch):
+    epoch = cls._EPOCH
+    segments = []
+    segmentType = None
+    segment = None
+
+    for item in batch:
+      itemSegmentType = cls._getSegmentType(item)
+
+      if itemSegmentType != segmentType:
+        segmentType = itemSegmentType
+        if segmentType == cls._INPUT_ROWS_SEGMENT:
+          segment = [segmentType, [], [], []]
+        elif segmentType == cls._INFERENCE_RESULTS_SEGMENT:
+          segment = [segmentType, [], []]
+        elif segmentType == cls._INFERENCE_RESULTS_WITH_INPUT_SEGMENT:
+          segment = [segmentType, [], [], [], []]
+        else:
+          segment = [segmentType, []]
+        segments.append(segment)
+
+      if segmentType == cls._INPUT_ROWS_SEGMENT:
+        timestamp, value = item.data
+        delta = timestamp - epoch
+        segment[1].append(item.rowID)
+        segment[2].append(
+          (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+        segment[3].append(value)
+      elif segmentType == cls._INFERENCE_RESULTS_SEGMENT:
+        segment[1].append(item.rowID)
+        segment[2].append(item.anomalyScore)
+      elif segmentType == cls._INFERENCE_RESULTS_WITH_INPUT_SEGMENT:
+        delta = item.timestamp - epoch
+        segment[1].append(item.rowID)
+        segment[2].append(item.anomalyScore)
+        segment[3].append(
+          (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+        segment[4].append(item.metricValue)
+      else:
+        segment[1].append(item)
+
+    for segment in segments:
+      if segment[0] == cls._JSON_SEGMENT:
+        segment[1] = cls._marshalJson(segment[1])
+
+    return cls._MSGPACK_HEADER + msgpack.packb(segments)
+
+
+  @classmethod
+  def _unmarshalMsgpack(cls, batchState):
+    epoch = cls._EPOCH
+    timedelta = datetime.timedelta
+    segments = msgpack.unpackb(batchState[len(cls._MSGPACK_HEADER):])
+
+    # NOTE: like in JSON_FORMAT, the items are created without calling their
+    # constructors, which would redundantly validate the decoded values
+    createInputRow = partial(object.__new__, ModelInputRow)
+    createInferenceResult = partial(object.__new__, ModelInferenceResult)
+
+    batch = []
+    for segment in segments:
+      segmentType = segment[0]
+
+      if segmentType == cls._INPUT_ROWS_SEGMENT:
+        _, rowIDs, timestamps, values = segment
+        for rowID, timestamp, value in zip(rowIDs, timestamps, values):
+          row = createInputRow()
+          row.rowID = rowID
+          row.data = [epoch + timedelta(microseconds=timestamp), value]
+          batch.append(row)
+
+      elif segmentType == cls._INFERENCE_RESULTS_SEGMENT:
+        _, rowIDs, anomalyScores = segment
+        for rowID, anomalyScore in zip(rowIDs, anomalyScores):
+          result = createInferenceResult()
+          result.rowID = rowID
+          result.status = 0
+          result.anomalyScore = anomalyScore
+          result.errorMessage = None
+          result.timestamp = None
+          result.metricValue = None
+          batch.append(result)
+
+      elif segmentType == cls._INFERENCE_RESULTS_WITH_INPUT_SEGMENT:
+        _, rowIDs, anomalyScores, timestamps, metricValues = segment
+        for rowID, anomalyScore, timestamp, metricValue in zip(
+            rowIDs, anomalyScores, timestamps, metricValues):
+          result = createInferenceResult()
+          result.rowID = rowID
+          result.status = 0
+          result.anomalyScore = anomalyScore
+          result.errorMessage = None
+          result.timestamp = epoch + timedelta(microseconds=timestamp)
+          result.metricValue = metricValue
+          batch.append(result)
+
+      elif segmentType == cls._JSON_SEGMENT:
+        batch.extend(cls._unmarshalJson(segment[1]))
+
+      else:
+        raise ValueError("Unexpected batch segment type=%r" % (segmentType,))
+
+    return tuple(batch)
+
+
 
 class RequestMessagePackager(object):
   """ Serializer for a request message """
@@ -572,10 +837,14 @@ class ModelSwapperInterface(object):
     section=_CONFIG_SECTION,
     option=_RESULTS_Q_OPTION_NAME)
 
+  _RESULTS_Q_PARTITIONS_OPTION_NAME = "results_queue_partitions"
+
   _SCHEDULER_NOTIFICATION_Q_OPTION_NAME = "scheduler_notification_queue"
 
   _MODEL_INPUT_Q_PREFIX_OPTION_NAME = "model_input_queue_prefix"
 
+  _BATCH_FORMAT_OPTION_NAME = "batch_format"
+
 
   def __init__(self):
     """
@@ -589,6 +858,11 @@ class ModelSwapperInterface(object):
     self._resultsQueueName = config.get(
       self._CONFIG_SECTION, self._RESULTS_Q_OPTION_NAME)
 
+    # Number of results message queues that models' results are partitioned
+    # into by model ID; see getResultsQueuePartition()
+    self._numResultsQueuePartitions = config.getint(
+      self._CONFIG_SECTION, self._RESULTS_Q_PARTITIONS_OPTION_NAME)
+
     # The name of a model's input message queue is the concatenation of this
     # prefix and the modelID
     self._modelInputQueueNamePrefix = config.get(
@@ -597,6 +871,11 @@ class ModelSwapperInterface(object):
     self._schedulerNotificationQueueName = config.get(
       self._CONFIG_SECTION, self._SCHEDULER_NOTIFICATION_Q_OPTION_NAME)
 
+    # BatchPackager format of the request and result batches that we publish;
+    # batches are decoded regardless of their format
+    self._batchFormat = config.get(
+      self._CONFIG_SECTION, self._BATCH_FORMAT_OPTION_NAME)
+
     # Message bus connector
     self._bus = MessageBusConnector()
 
@@ -774,6 +1053,20 @@ class ModelSwapperInterface(object):
       return False
 
 
+  def getModelInputDepth(self, modelID):
+    """ Get the number of input request batches pending for a model
+
+    :param modelID: a string that uniquely identifies the target model.
+
+    :returns: the number of request batches in the model's input queue; 0 if
+      the model's input queue doesn't exist
+    """
+    try:
+      return self._bus.getMessageCount(self._getModelInputQName(modelID))
+    except message_bus_connector.MessageQueueNotFound:
+      return 0
+
+
   def getModelsWithInputPending(self):
     """ Get model IDs of all models with pending input (non-empty input queues)
 
@@ -795,7 +1088,7 @@ class ModelSwapperInterface(object):
       if mq.startswith(prefix) and safeIsInputPending(mq))
 
 
-  def submitRequests(self, modelID, requests):
+  def submitRequests(self, modelID, requests, notifyScheduler=True):
     """
     Submit a batch of requests for processing by a model with the given modelID.
 
@@ -810,6 +1103,12 @@ class ModelSwapperInterface(object):
       method instead of submitting the "defineModel" or "deleteModel" commands.
       Together, the sequence of requests constitutes a request "batch".
 
+    :param notifyScheduler: if True (default), notify Model Scheduler that the
+      model has pending input. When submitting several batches for the same
+      model back-to-back, pass False and call notifyModelScheduler() once after
+      the last batch has been submitted, so that Model Scheduler receives a
+      single notification for all of them.
+
     :returns: UUID of the submitted batch (intended for test code only)
 
     :raises: ModelNotFound if model's input endpoint doesn't exist
@@ -824,7 +1123,8 @@ class ModelSwapperInterface(object):
     batchID = uuid.uuid1().hex
     msg = RequestMessagePackager.marshal(
       batchID=batchID,
-      batchState=BatchPackager.marshal(batch=requests))
+      batchState=BatchPackager.marshal(batch=requests,
+                                       batchFormat=self._batchFormat))
 
     mqName = self._getModelInputQName(modelID)
     try:
@@ -843,8 +1143,20 @@ class ModelSwapperInterface(object):
         msg[:32])
       raise
 
-    # Send a notification to Model Scheduler so it will schedule the model
-    # for processing input
+    if notifyScheduler:
+      self.notifyModelScheduler(modelID)
+
+    return batchID
+
+
+  def notifyModelScheduler(self, modelID):
+    """ Notify Model Scheduler that the given model has pending input, so it
+    will schedule the model for processing input. Notifications are idempotent:
+    a single notification sent after the last of several request batches is
+    sufficient for all of them.
+
+    :param modelID: a string that uniquely identifies the target model.
+    """
     try:
       self._bus.publish(self._schedulerNotificationQueueName,
                         json.dumps(modelID), persistent=False)
@@ -855,7 +1167,6 @@ class ModelSwapperInterface(object):
         "Couldn't send model data notification to Model Scheduler: mq=%s not "
         "found. Model Scheduler service not started or initialized the mq yet?",
         self._schedulerNotificationQueueName)
-    return batchID
 
 
   def consumeRequests(self, modelID, blocking=True):
@@ -906,8 +1217,61 @@ class ModelSwapperInterface(object):
     return consumer
 
 
-  def _initResultsMessageQueue(self):
-    self._bus.createMessageQueue(self._resultsQueueName, durable=True)
+  @classmethod
+  def getNumResultsQueuePartitions(cls):
+    """
+    :returns: the configured number of results message queue partitions; each
+      partition needs its own results consumer (see consumeResults())
+    """
+    return ModelSwapperConfig().getint(cls._CONFIG_SECTION,
+                                       cls._RESULTS_Q_PARTITIONS_OPTION_NAME)
+
+
+  @classmethod
+  def getResultsQueueNames(cls):
+    """
+    :returns: names of the configured results message queues, ordered by
+      partition
+    """
+    config = ModelSwapperConfig()
+    resultsQueueName = config.get(cls._CONFIG_SECTION,
+                                  cls._RESULTS_Q_OPTION_NAME)
+    numPartitions = config.getint(cls._CONFIG_SECTION,
+                                  cls._RESULTS_Q_PARTITIONS_OPTION_NAME)
+    return [cls._getResultsQNameOfPartition(resultsQueueName, numPartitions,
+                                            partition)
+            for partition in xrange(numPartitions)]
+
+
+  @staticmethod
+  def _getResultsQNameOfPartition(resultsQueueName, numPartitions, partition):
+    # NOTE: an unpartitioned results queue keeps the configured name
+    if numPartitions == 1:
+      return resultsQueueName
+
+    return "%s.%d" % (resultsQueueName, partition)
+
+
+  def _getResultsQName(self, partition):
+    return self._getResultsQNameOfPartition(self._resultsQueueName,
+                                            self._numResultsQueuePartitions,
+                                            partition)
+
+
+  def getResultsQueuePartition(self, modelID):
+    """ Get the results message queue partition of the given model; all of a
+    model's results are submitted to the same partition, so they are consumed
+    in order by that partition's consumer.
+
+    :param modelID: a string that uniquely identifies the model
+
+    :returns: partition index in [0, number of results queue partitions)
+    """
+    return getConsistentHashPartition(modelID, self._numResultsQueuePartitions)
+
+
+  def _initResultsMessageQueue(self, mqName):
+    self._bus.createMessageQueue(mqName, durable=True)
 
 
   def submitResults(self, modelID, results):
@@ -922,32 +1286,42 @@ class ModelSwapperInterface(object):
 
     NOTE: This assumes retry logic will be handled by the underlying MQ
     implementation.
+
+    NOTE: the results are published to the model's results message queue
+    partition; see getResultsQueuePartition()
     """
+    mqName = self._getResultsQName(self.getResultsQueuePartition(modelID))
+
     msg = ResultMessagePackager.marshal(
       modelID=modelID,
-      batchState=BatchPackager.marshal(batch=results))
+      batchState=BatchPackager.marshal(batch=results,
+                                       batchFormat=self._batchFormat))
     try:
       try:
-        self._bus.publish(self._resultsQueueName, msg, persistent=True)
+        self._bus.publish(mqName, msg, persistent=True)
       except message_bus_connector.MessageQueueNotFound:
         self._logger.info("submitResults: results mq=%s didn't exist; "
                           "declaring now and re-publishing message",
-                          self._resultsQueueName)
-        self._initResultsMessageQueue()
-        self._bus.publish(self._resultsQueueName, msg, persistent=True)
+                          mqName)
+        self._initResultsMessageQueue(mqName)
+        self._bus.publish(mqName, msg, persistent=True)
     except:
       self._logger.exception(
         "submitResults: Failed to publish results from model=%s via mq=%s; "
-        "msgLen=%s; msgPrefix=%r", modelID, self._resultsQueueName, len(msg),
-        msg[:32])
+        "msgLen=%s; msgPrefix=%r", modelID, mqName, len(msg), msg[:32])
       raise
 
 
-  def consumeResults(self):
+  def consumeResults(self, partition=0):
     """ Create an instance of the _MessageConsumer iterable for reading model
     results, a batch at a time. The iterable yields _ConsumedResultBatch
     instances.
 
+    :param int partition: index of the results message queue partition to
+      consume, in [0, getNumResultsQueuePartitions()); each partition must
+      have exactly one consumer in order to preserve the order of each model's
+      results
+
     :returns: an instance of model_swapper_interface._MessageConsumer iterable;
       IMPORTANT: the caller is responsible for closing it before closing this
       ModelSwapperInterface instance (hint: use the returned _MessageConsumer
@@ -960,18 +1334,37 @@ class ModelSwapperInterface(object):
             processResults(modelID=batch.modelID, results=batch.objects)
             batch.ack()
     """
-    consumer = _MessageConsumer(mqName=self._resultsQueueName,
+    if not 0 <= partition < self._numResultsQueuePartitions:
+      raise ValueError("Results queue partition=%r is not in [0, %d)" % (
+        partition, self._numResultsQueuePartitions))
+
+    mqName = self._getResultsQName(partition)
+
+    consumer = _MessageConsumer(mqName=mqName,
                                 blocking=True,
                                 decode=_ConsumedResultBatch.decodeMessage,
                                 swapper=self,
                                 bus=self._bus,
-                                onQueueNotFound=self._initResultsMessageQueue)
+                                onQueueNotFound=partial(
+                                  self._initResultsMessageQueue, mqName))
 
     self._consumers.append(consumer)
 
     return consumer
 
 
+  def schedulerNotificationQueueExists(self):
+    """ Check whether Model Scheduler's notification message queue exists; for
+    use by Model Scheduler before initSchedulerNotification(). The queue is
+    not durable, so if it doesn't exist, notifications sent since it was last
+    initialized may have been lost (e.g., due to a message broker restart).
+
+    :returns: True if the notification message queue exists; False if not
+    """
+    return self._bus.isMessageQeueuePresent(
+      self._schedulerNotificationQueueName)
+
+
   def initSchedulerNotification(self):
     """ Initialize Model Scheduler's notification message queue; for use by
     Model Scheduler.
@@ -0,0 +1,217 @@
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+This module implements PendingInputRegistry, the persistent set of models that
+SwapController considers to have pending input. It lets SwapController find the
+models that need to be scheduled at startup without scanning the input queues
+of all models.
+"""
+
+import errno
+import os
+
+from htmengine import htmengine_logging
+
+
+_MODULE_NAME = "htmengine.model_swapper.pending_input_registry"
+
+
+
+def _getLogger():
+  return htmengine_logging.getExtendedLogger(_MODULE_NAME)
+
+
+
+class PendingInputRegistry(object):
+  """ Persistent set of IDs of models with pending input, backed by an
+  append-only journal file.
+
+  The journal consists of one record per line: "+<modelID>" when a model is
+  added, "-<modelID>" when it's removed, and a final "closed" record that is
+  written by close(). The journal is buffered and not synced until close(), so
+  its contents are only trusted if its last record is "closed"; otherwise, the
+  previous owner didn't shut down gracefully, and open() reports that the
+  registry is unavailable so that the caller can fall back to a full scan.
+
+  NOTE: not thread-safe
+  """
+
+  _ADD_PREFIX = "+"
+  _REMOVE_PREFIX = "-"
+  _CLOSED_RECORD = "closed"
+
+  # The journal is compacted when the number of its records exceeds this
+  # multiple of the number of registered models
+  _COMPACTION_RATIO = 2
+
+  # ... but not before it has at least this many records
+  _MIN_RECORDS_TO_COMPACT = 1000
+
+
+  def __init__(self, path):
+    """
+    :param path: path of the journal file; its directory is created if needed
+    """
+    self._logger = _getLogger()
+
+    self._path = path
+
+    # Registered model IDs
+    self._modelIDs = set()
+
+    # Journal file object; None when closed
+    self._journal = None
+
+    # Number of records in the journal
+    self._numRecords = 0
+
+
+  def __contains__(self, modelID):
+    return modelID in self._modelIDs
+
+
+  def __len__(self):
+    return len(self._modelIDs)
+
+
+  def open(self):
+    """ Load the registry from its journal, and open the journal for updates.
+    The previous journal is replaced, so its contents will be untrusted until
+    close() is called.
+
+    :returns: frozenset of IDs of registered models if the registry was
+      gracefully closed by its previous owner; None if there is no journal or
+      the previous owner didn't close it (the registry starts out empty in this
+      case)
+    """
+    assert self._journal is None, "Already open"
+
+    registeredModelIDs = self._load()
+
+    self._modelIDs = set(registeredModelIDs or ())
+    self._compact()
+
+    return registeredModelIDs
+
+
+  def close(self):
+    """ Mark the journal as gracefully closed, sync it and close it """
+    if self._journal is None:
+      return
+
+    self._appendRecord(self._CLOSED_RECORD)
+    self._journal.flush()
+    os.fsync(self._journal.fileno())
+    self._journal.close()
+    self._journal = None
+
+    self._logger.info("Closed pending-input registry=%s with numModels=%d",
+                      self._path, len(self._modelIDs))
+
+
+  def add(self, modelID):
+    """ Register a model as having pending input; no-op if already registered
+    """
+    if modelID in self._modelIDs:
+      return
+
+    self._modelIDs.add(modelID)
+    self._appendRecord(self._ADD_PREFIX + modelID)
+
+
+  def remove(self, modelID):
+    """ Unregister a model; no-op if not registered """
+    if modelID not in self._modelIDs:
+      return
+
+    self._modelIDs.remove(modelID)
+    self._appendRecord(self._REMOVE_PREFIX + modelID)
+
+    if (self._numRecords >= self._MIN_RECORDS_TO_COMPACT and
+        self._numRecords > self._COMPACTION_RATIO * len(self._modelIDs)):
+      self._compact()
+
+
+  def _load(self):
+    """ Load registered model IDs from the journal
+
+    :returns: frozenset of registered model IDs; None if the journal doesn't
+      exist or wasn't closed gracefully
+    """
+    try:
+      with open(self._path, "r") as journal:
+        records = journal.read().splitlines()
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+
+      self._logger.info("Pending-input registry=%s not found", self._path)
+      return None
+
+    if not records or records[-1] != self._CLOSED_RECORD:
+      self._logger.warn("Pending-input registry=%s wasn't closed gracefully; "
+                        "numRecords=%d", self._path, len(records))
+      return None
+
+    modelIDs = set()
+    for record in records[:-1]:
+      if record.startswith(self._ADD_PREFIX):
+        modelIDs.add(record[len(self._ADD_PREFIX):])
+      elif record.startswith(self._REMOVE_PREFIX):
+        modelIDs.discard(record[len(self._REMOVE_PREFIX):])
+      else:
+        self._logger.error("Unexpected record=%r in pending-input registry=%s",
+                           record, self._path)
+        return None
+
+    self._logger.info("Loaded pending-input registry=%s with numModels=%d",
+                      self._path, len(modelIDs))
+
+    return frozenset(modelIDs)
+
+
+  def _compact(self):
+    """ Replace the journal with one that contains only the add-records of the
+    currently registered models, and open it for appending
+    """
+    if self._journal is not None:
+      self._journal.close()
+      self._journal = None
+
+    directory = os.path.dirname(self._path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    tempPath = self._path + ".tmp"
+    with open(tempPath, "w") as journal:
+      for modelID in self._modelIDs:
+        journal.write(self._ADD_PREFIX + modelID + "\n")
+
+    os.rename(tempPath, self._path)
+
+    self._journal = open(self._path, "a")
+    self._numRecords = len(self._modelIDs)
+
+
+  def _appendRecord(self, record):
+    self._journal.write(record + "\n")
+    self._numRecords += 1
@@ -0,0 +1,186 @@
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Scheduling policies that order the models waiting for a free model slot in
+SwapController.
+"""
+
+from abc import ABCMeta, abstractmethod
+import heapq
+import itertools
+import math
+import time
+
+
+
+class SchedulingPolicyBase(object):
+  """ Priority queue of models that are waiting to be scheduled for running.
+
+  Models with the lowest priority key are scheduled first; models with equal
+  keys are scheduled in the order that they were added. A model's priority key
+  is computed once, when the model is added, so add() and pop() are O(log n)
+  and the membership check is O(1).
+  """
+  __metaclass__ = ABCMeta
+
+
+  def __init__(self):
+    # Min-heap of (priorityKey, sequenceNumber, modelID) tuples
+    self._heap = []
+
+    # IDs of models in self._heap for O(1) membership checks
+    self._waitingModelIDs = set()
+
+    # Tie-breaker that preserves insertion order among equal priority keys
+    self._sequence = itertools.count()
+
+
+  def __len__(self):
+    return len(self._heap)
+
+
+  def __contains__(self, modelID):
+    return modelID in self._waitingModelIDs
+
+
+  def add(self, modelID):
+    """ Add a model to the waiting queue
+
+    :param modelID: ID of a model that is not already waiting
+    """
+    assert modelID not in self._waitingModelIDs, modelID
+
+    key = self._getPriorityKey(modelID, time.time())
+    heapq.heappush(self._heap, (key, next(self._sequence), modelID))
+    self._waitingModelIDs.add(modelID)
+
+
+  def pop(self):
+    """ Remove and return the waiting model that should be scheduled next
+
+    :returns: model ID
+    :raises: IndexError if no models are waiting
+    """
+    _key, _seq, modelID = heapq.heappop(self._heap)
+    self._waitingModelIDs.remove(modelID)
+    return modelID
+
+
+  @abstractmethod
+  def _getPriorityKey(self, modelID, now):
+    """ Compute the priority key of a model that is being added; lower keys are
+    scheduled first
+
+    :param modelID: ID of the model being added
+    :param now: the current time per time.time()
+
+    :returns: a number
+    """
+    raise NotImplementedError
+
+
+
+class FifoSchedulingPolicy(SchedulingPolicyBase):
+  """ Schedule waiting models in the order that they arrived """
+
+
+  def _getPriorityKey(self, modelID, now):
+    # Equal keys preserve insertion order
+    return 0
+
+
+
+class BacklogPrioritySchedulingPolicy(SchedulingPolicyBase):
+  """ Schedule waiting models by their arrival time, adjusted for the depth of
+  their pending input and the estimated cost of swapping them in.
+
+  The priority key of a model is its arrival time plus the swap cost amortized
+  over its pending input batches, less a bonus that grows logarithmically with
+  its pending input depth:
+
+    key = arrivalTime + swapCostSec / depth - depthWeightSec * log2(1 + depth)
+
+  Since the depth bonus grows only logarithmically, a model with a huge backlog
+  can jump ahead of models that arrived at most a few multiples of
+  depthWeightSec earlier, but can't starve them indefinitely; likewise, models
+  with little pending input are penalized by at most swapCostSec, so they can't
+  starve models with deep backlogs either.
+
+  NOTE: getInputDepth is called synchronously by add() for every model that
+  starts waiting; with ModelSwapperInterface.getModelInputDepth, that's a
+  message bus round-trip (a passive queue declaration) on SwapController's
+  event loop thread, which delays the handling of its other events. This is
+  paid only when a model has to wait for a free slot, and the depth needs to be
+  current as of then, so it isn't taken from the new-input notifications,
+  which don't carry it.
+  """
+
+
+  def __init__(self, getInputDepth, depthWeightSec, swapCostSec):
+    """
+    :param getInputDepth: function that takes a model ID and returns the
+      number of input batches pending for the model
+    :param depthWeightSec: number of seconds of waiting time credited per
+      doubling of a model's pending input depth
+    :param swapCostSec: estimated cost of swapping in a model, in seconds
+    """
+    super(BacklogPrioritySchedulingPolicy, self).__init__()
+
+    self._getInputDepth = getInputDepth
+    self._depthWeightSec = depthWeightSec
+    self._swapCostSec = swapCostSec
+
+
+  def _getPriorityKey(self, modelID, now):
+    depth = max(self._getInputDepth(modelID), 1)
+
+    return (now +
+            self._swapCostSec / float(depth) -
+            self._depthWeightSec * math.log(1 + depth, 2))
+
+
+
+def createSchedulingPolicy(config, getInputDepth):
+  """ Create the scheduling policy selected in the [swap_controller] section of
+  the given configuration
+
+  :param config: ModelSwapperConfig instance
+  :param getInputDepth: function that takes a model ID and returns the number
+    of input batches pending for the model
+
+  :returns: a SchedulingPolicyBase instance
+  :raises: ValueError if the configured policy name is unknown
+  """
+  policyName = config.get("swap_controller", "scheduling_policy")
+
+  if policyName == "fifo":
+    return FifoSchedulingPolicy()
+  elif policyName == "backlog_priority":
+    return BacklogPrioritySchedulingPolicy(
+      getInputDepth=getInputDepth,
+      depthWeightSec=config.getfloat("swap_controller",
+                                     "backlog_priority_depth_weight_sec"),
+      swapCostSec=config.getfloat("swap_controller",
+                                  "backlog_priority_swap_cost_sec"))
+  else:
+    raise ValueError("Unknown swap_controller scheduling_policy=%r" %
+                     (policyName,))
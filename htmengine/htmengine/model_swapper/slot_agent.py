@@ -31,11 +31,13 @@ import signal
 import subprocess
 import sys
 import threading
+import time
 
 
 from nupic.support.decorators import logExceptions
 
 from htmengine import htmengine_logging
+from htmengine.model_swapper import ModelSwapperConfig
 
 from nta.utils.error_handling import abortProgramOnAnyException
 
@@ -172,6 +174,231 @@ class ModelRunnerProxy(object):
 
 
 
+class ModelRunnerWorkerProtocol(object):
+  """ Line-based protocol between a SlotAgent and its persistent ModelRunner
+  worker process (`python -m htmengine.model_swapper.model_runner --worker`).
+
+  The SlotAgent writes commands to the worker's stdin; the worker writes
+  replies to its stdout (its log output goes to stderr):
+
+    "run <modelID>": run the model until it runs out of input or until "stop"
+      arrives; the worker replies "exited <modelID> <exitStatus>" when the
+      model stops, where exitStatus is 0 when successful.
+    "stop": stop the current model; ends each model session, so it's also
+      sent after a model stopped on its own, before the next "run".
+
+  The worker exits when its stdin is closed.
+  """
+
+  RUN_COMMAND = "run"
+  STOP_COMMAND = "stop"
+  EXITED_REPLY = "exited"
+
+
+
+class ModelRunnerWorker(object):
+  """ Long-lived ModelRunner worker process that runs models one at a time on
+  behalf of a SlotAgent, reusing its imports and message bus connection across
+  models; see ModelRunnerWorkerProtocol.
+  """
+
+  _MAX_WAIT_FOR_EXIT_SEC = 60
+
+
+  def __init__(self, logger):
+    self._logger = logger
+
+    self._process = subprocess.Popen(
+      args=[sys.executable,
+            "-m", "htmengine.model_swapper.model_runner",
+            "--worker"],
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      close_fds=True)
+
+    self._pid = self._process.pid
+
+    # Set when the worker process is known to have exited
+    self._exited = False
+
+    self._logger.debug("%r: Started ModelRunner worker", self)
+
+
+  def __repr__(self):
+    return "%s<pid=%s, returnCode=%s>" % (
+      self.__class__.__name__, self._pid, self._process.returncode)
+
+
+  @property
+  def isAlive(self):
+    return not self._exited and self._process.poll() is None
+
+
+  def runModel(self, modelID):
+    """ Request the worker to run the given model
+
+    :raises ModelRunnerProxy.ModelRunnerIOError: if the worker died
+    """
+    self._sendCommand(
+      "%s %s" % (ModelRunnerWorkerProtocol.RUN_COMMAND, modelID))
+
+
+  def stopModel(self):
+    """ Request the worker to stop the current model, ending the model
+    session; see ModelRunnerWorkerProtocol
+
+    :raises ModelRunnerProxy.ModelRunnerIOError: if the worker died
+    """
+    self._sendCommand(ModelRunnerWorkerProtocol.STOP_COMMAND)
+
+
+  def waitForModelExit(self):
+    """ Wait for the worker's reply to the current model's exit; blocking.
+
+    :returns: the model's exit status; if the worker process died, its return
+      code (non-zero unless it exited cleanly)
+    """
+    line = self._process.stdout.readline()
+    if line:
+      method, _modelID, exitStatus = line.split()
+      assert method == ModelRunnerWorkerProtocol.EXITED_REPLY, repr(line)
+      return int(exitStatus)
+
+    # EOF: the worker process died
+    self._exited = True
+    returnCode = self._process.wait()
+    self._logger.error("%r: ModelRunner worker exited while running a model",
+                       self)
+    return returnCode
+
+
+  def kill(self):
+    """ Force-kill the worker process """
+    self._exited = True
+    try:
+      os.kill(self._pid, signal.SIGKILL)
+    except OSError as e:
+      if e.errno != errno.ESRCH:
+        raise
+
+
+  def close(self):
+    """ Let the worker process exit after its current model, if any; blocking.
+    Force-kills it if it doesn't exit in time.
+
+    :returns: return code from the worker process
+    """
+    self._logger.debug("%r: Closing ModelRunner worker", self)
+    try:
+      self._process.stdin.close()
+    except IOError:
+      pass
+
+    deadline = time.time() + self._MAX_WAIT_FOR_EXIT_SEC
+    while self._process.poll() is None and time.time() < deadline:
+      time.sleep(0.1)
+
+    if self._process.returncode is None:
+      self._logger.error("%r: ModelRunner worker didn't exit; sending it "
+                         "SIGKILL", self)
+      self.kill()
+      self._process.wait()
+
+    self._exited = True
+    self._logger.debug("%r: ModelRunner worker closed", self)
+    return self._process.returncode
+
+
+  def _sendCommand(self, command):
+    try:
+      self._process.stdin.write(command + "\n")
+      self._process.stdin.flush()
+    except IOError as e:
+      self._logger.exception("%r: IO error sending command=%r to ModelRunner "
+                             "worker", self, command)
+      raise ModelRunnerProxy.ModelRunnerIOError(
+        "%r: IO error sending command=%r to ModelRunner worker: %r" % (
+          self, command, e))
+
+
+
+class PooledModelRunnerProxy(object):
+  """ API-compatible with ModelRunnerProxy for stopping and monitoring a model
+  that runs in a persistent ModelRunnerWorker process instead of a process of
+  its own.
+  """
+
+  def __init__(self, modelID, onTermination, logger, worker):
+    """
+    :param onTermination: thread-safe callback that will be called when the
+      model stops running in the worker
+    :param ModelRunnerWorker worker: the worker to run the model in; must not be
+      running another model
+    """
+    self._logger = logger
+    self._modelID = modelID
+    self._onTermination = onTermination
+    self._worker = worker
+
+    # The model's exit status once it stops
+    self._exitStatus = None
+
+    self._worker.runModel(modelID)
+
+    self._logger.debug("%r: Started model in ModelRunner worker", self)
+
+    # Start thread that notifies our client when the model stops
+    self._monitorThread = threading.Thread(
+      target=self._runModelMonitorThread,
+      name="%s-waitModel-%s" % (self.__class__.__name__, modelID,))
+    self._monitorThread.setDaemon(True)
+    self._monitorThread.start()
+
+
+  def __repr__(self):
+    return "%s<model=%s, worker=%r, exitStatus=%s>" % (
+      self.__class__.__name__, self._modelID, self._worker, self._exitStatus)
+
+
+  def stopGracefully(self):
+    """ Gracefully stop the model; blocking.
+
+    :returns: the model's exit status
+    """
+    self._logger.debug("%r: Stopping model", self)
+    try:
+      self._worker.stopModel()
+    except ModelRunnerProxy.ModelRunnerIOError:
+      # The worker died; the monitor thread will pick up its return code
+      pass
+
+    self._monitorThread.join(
+      timeout=ModelRunnerProxy._MAX_WAIT_FOR_GRACEFUL_STOP_SEC)
+    if self._monitorThread.isAlive():
+      self._logger.error("%r: Graceful stop of model timed out; sending "
+                         "SIGKILL to ModelRunner worker", self)
+      self._worker.kill()
+      self._monitorThread.join(
+        timeout=ModelRunnerProxy._MAX_WAIT_AFTER_SIGKILL_SEC)
+      assert not self._monitorThread.isAlive()
+
+    assert self._exitStatus is not None
+    self._logger.debug("%r: Model stopped", self)
+    return self._exitStatus
+
+
+  @abortProgramOnAnyException(
+    _EXIT_CODE_ON_UNHANDLED_EXCEPTION_IN_THREAD,
+    logger=_getLogger())
+  @logExceptions(_getLogger)
+  def _runModelMonitorThread(self):
+    self._logger.debug("%s: _runModelMonitorThread is running", self)
+    self._exitStatus = self._worker.waitForModelExit()
+    self._logger.debug("%s: model stopped in ModelRunner worker", self)
+    self._onTermination()
+
+
+
 class SlotAgent(object):
   """ Manage a single ModelRunner execution slot within a Model Scheduler
   service instance """
@@ -194,6 +421,11 @@ class SlotAgent(object):
 
     self._slotID = slotID
 
+    # When True, models run in a persistent ModelRunnerWorker process owned by
+    # the event loop instead of a new ModelRunner process per model
+    self._persistentModelRunners = ModelSwapperConfig().getboolean(
+      "model_runner", "persistent_workers")
+
     # ID of the model, if any, currently associated with this SlotAgent
     # instance; used for logging and error-checking at the interface only.
     # WARNING: not syncrhonized with the event loop thread!
@@ -290,6 +522,12 @@ class SlotAgent(object):
     """
     modelState = None
 
+    # Persistent ModelRunnerWorker, if enabled; pre-forked so that it's ready
+    # by the time the first model is assigned to us
+    worker = None
+    if self._persistentModelRunners:
+      worker = ModelRunnerWorker(logger=self._logger)
+
     while True:
       doStopModel = doClose = False
 
@@ -302,11 +540,24 @@ class SlotAgent(object):
         modelID = evt["modelID"]
         self._logger.debug("%r: {TAG:SWAP.SA.MODEL.STARTING} model=%s", self,
                            modelID)
-        modelRunner = ModelRunnerProxy(
-          modelID=modelID,
-          onTermination=lambda: self._eventQ.put(
-            {"method" : self._MODEL_RUNNER_EXITED}),
-          logger=self._logger)
+        onTermination = lambda: self._eventQ.put(
+          {"method" : self._MODEL_RUNNER_EXITED})
+        if worker is None:
+          modelRunner = ModelRunnerProxy(
+            modelID=modelID,
+            onTermination=onTermination,
+            logger=self._logger)
+        else:
+          if not worker.isAlive:
+            self._logger.warn("%r: Replacing dead ModelRunner worker=%r",
+                              self, worker)
+            worker.close()
+            worker = ModelRunnerWorker(logger=self._logger)
+          modelRunner = PooledModelRunnerProxy(
+            modelID=modelID,
+            onTermination=onTermination,
+            logger=self._logger,
+            worker=worker)
         modelState = _CurrentModelState(
           modelID=evt["modelID"], modelRunner=modelRunner,
           modelFinishedCallback=evt["modelFinishedCallback"])
@@ -373,6 +624,8 @@ class SlotAgent(object):
 
         if doClose:
           # Model is stopped, we're done!
+          if worker is not None:
+            worker.close()
           break
 
 
@@ -25,8 +25,12 @@ across a fixed set of SlotAgent instances based on incoming model commands and
 records.
 """
 
+from collections import OrderedDict
 from functools import partial
+import heapq
+import itertools
 import logging
+import os
 import Queue
 import threading
 import time
@@ -36,6 +40,9 @@ from nupic.support.decorators import logExceptions, logEntryExit
 from htmengine.model_swapper import ModelSwapperConfig
 from htmengine.model_swapper.model_swapper_interface import (
     ModelSwapperInterface)
+from htmengine.model_swapper.pending_input_registry import (
+    PendingInputRegistry)
+from htmengine.model_swapper.scheduling_policy import createSchedulingPolicy
 from htmengine.model_swapper.slot_agent import SlotAgent
 from nta.utils.error_handling import abortProgramOnAnyException
 from htmengine import htmengine_logging
@@ -62,6 +69,8 @@ class SwapController(object):
   _NEW_INPUT_NOTIFY_METHOD = "NewInputNotify"
   _MODEL_DONE_NOTIFY_METHOD = "ModelDoneNotify"
   _STOP_EVENT_LOOP_REQUEST_METHOD = "StopEventLoopRequest"
+  _PREEMPTION_RETRY_METHOD = "PreemptionRetry"
+  _UNREGISTER_IDLE_MODELS_METHOD = "UnregisterIdleModels"
 
 
   _NOTIFICATION_READER_THREAD_START_WAIT_TIMEOUT_SEC = 5
@@ -75,10 +84,17 @@ class SwapController(object):
     """
     self._logger = _getLogger()
 
+    config = ModelSwapperConfig()
+
     self._profiling = (
-      ModelSwapperConfig().getboolean("debugging", "profiling") or
+      config.getboolean("debugging", "profiling") or
       self._logger.isEnabledFor(logging.DEBUG))
 
+    # A running model is not preempted until it has been running for at least
+    # this many seconds, so that models aren't thrashed in and out of slots
+    self._minResidencySec = config.getfloat("swap_controller",
+                                            "min_residency_sec")
+
     # Allowed number of model slots
     self._concurrency = concurrency
 
@@ -105,17 +121,56 @@ class SwapController(object):
     # Thread-safe event queue for SwapController
     self._eventQ = Queue.Queue()
 
+    # Models with new input that the event loop hasn't handled yet, in the
+    # order of their first notification (OrderedDict used as an ordered set).
+    # Repeated notifications for a model that is already in the set are
+    # absorbed, and a single NewInputNotify event is enqueued when the set
+    # becomes non-empty, so the event queue traffic is proportional to the
+    # number of models with new input rather than the number of notifications.
+    # Guarded by self._dirtyModelsLock.
+    self._dirtyModels = OrderedDict()
+    self._dirtyModelsLock = threading.Lock()
+
     # Main event loop's ModelSwapperInterface instance. MUST NOT use from
     # threads because ModelSwapperInterface
     self._mainSwapper = ModelSwapperInterface()
 
-    # A (non-thread-safe) FIFO of models that are waiting to be scheduled for
-    # running; there is incoming data for them that needs to be processed
-    self._waitingModelsFIFO = []
+    # A (non-thread-safe) priority queue of models that are waiting to be
+    # scheduled for running; there is incoming data for them that needs to be
+    # processed
+    self._waitingModels = createSchedulingPolicy(
+      config,
+      getInputDepth=self._mainSwapper.getModelInputDepth)
 
     # A (non-thread-safe) map of modelIDs to _RunningModelInfo instances
     self._runningModelsMap = dict()
 
+    # A (non-thread-safe) min-heap of (activityTimestamp, sequenceNumber,
+    # _RunningModelInfo) tuples with one entry per running model that is not
+    # pending preemption, for picking preemption victims in LRU order. Entries
+    # are updated lazily: an entry's timestamp may be older than its model's
+    # current activity timestamp, and entries of models that are no longer
+    # running are discarded when they surface.
+    self._preemptionCandidatesHeap = []
+    self._preemptionCandidatesSequence = itertools.count()
+
+    # threading.Timer that posts a preemption retry event once a running model
+    # reaches its minimum residency time; None if not scheduled
+    self._preemptionRetryTimer = None
+
+    # (non-thread-safe) Persistent registry of models with pending input that
+    # spares us a scan of all model input queues at startup; None if disabled
+    registryPath = config.get("swap_controller",
+                              "pending_input_registry_path")
+    self._pendingInputRegistry = (
+      PendingInputRegistry(os.path.expanduser(os.path.expandvars(registryPath)))
+      if registryPath else None)
+
+    # Model IDs loaded from the pending-input registry at startup for the
+    # notification reader thread; None if the registry is disabled or wasn't
+    # closed gracefully, in which case a full scan is needed
+    self._registeredModelIDs = None
+
     # A (non-thread-safe) list of free slot indexes into the self._slotsAgents
     # tuple
     self._freeSlots = list(xrange(len(self._slotAgents)))
@@ -134,6 +189,9 @@ class SwapController(object):
   @logExceptions(_getLogger)
   def run(self):
     """ Run SwapController; blocking """
+    if self._pendingInputRegistry is not None:
+      self._registeredModelIDs = self._pendingInputRegistry.open()
+
     # Start our input-reader thread
     self._logger.info("Starting Notification Reader thread")
     self._notificationReaderThread.start()
@@ -148,15 +206,22 @@ class SwapController(object):
 
     while True:
       if self._eventLoopStopPending:
-        if not self._runningModelsMap and not self._waitingModelsFIFO:
+        if not self._runningModelsMap and not self._waitingModels:
           # All models are idle now, so close Slot Agents and bail out
           for sa in self._slotAgents:
             sa.close()
 
+          if self._preemptionRetryTimer is not None:
+            self._preemptionRetryTimer.cancel()
+            self._preemptionRetryTimer = None
+
+          if self._pendingInputRegistry is not None:
+            self._pendingInputRegistry.close()
+
           self._logger.info("Closed all Slot Agents; leaving event loop")
           break
 
-        elif not self._waitingModelsFIFO and not requestedStopOfRemainingModels:
+        elif not self._waitingModels and not requestedStopOfRemainingModels:
           # Only running models remain, so request to stop them gracefully
           assert self._runningModelsMap
 
@@ -199,12 +264,19 @@ class SwapController(object):
 
   def _newInputNotifyTS(self, modelID):
     """ [thread-safe] Notify Model Swapper that new input data arrived for the
-    given model
+    given model; idempotent until the event loop handles the notification
 
     :param modelID: ID of the model for which new data arrived
     """
-    self._eventQ.put(
-      {"method" : self._NEW_INPUT_NOTIFY_METHOD, "modelID" : modelID})
+    with self._dirtyModelsLock:
+      if modelID in self._dirtyModels:
+        return
+
+      wakeUpEventLoop = not self._dirtyModels
+      self._dirtyModels[modelID] = None
+
+    if wakeUpEventLoop:
+      self._eventQ.put({"method" : self._NEW_INPUT_NOTIFY_METHOD})
 
 
   def _modelDoneNotifyTS(self, modelID, exitStatus):
@@ -221,6 +293,23 @@ class SwapController(object):
                       "endTime" : time.time()})
 
 
+  def _preemptionRetryTS(self):
+    """ [thread-safe] Ask the event loop to retry preemption of a running
+    model. This method is called by the preemption retry timer.
+    """
+    self._eventQ.put({"method" : self._PREEMPTION_RETRY_METHOD})
+
+
+  def _handleUnregisterIdleModelsEvent(self, method,  # pylint: disable=W0613
+                                       modelIDs):
+    """ Remove models that were found without pending input at startup from the
+    pending-input registry. The notification reader enqueues this event before
+    any new input notifications, so these models can't be waiting or running.
+    """
+    for modelID in modelIDs:
+      self._pendingInputRegistry.remove(modelID)
+
+
   def _handleStopEventLoopRequestEvent(self, method):  # pylint: disable=W0613
     """ Set a flag to signal our event loop that it's time for graceful shutdown
     of the event loop. The event is enqueued by the "stop request" hander after
@@ -230,22 +319,31 @@ class SwapController(object):
     self._logger.info("Set _eventLoopStopPending")
 
 
-  def _handleNewInputNotifyEvent(self, method,  # pylint: disable=W0613
-                                 modelID):
-    """ Notification that new input was queued up for a particular model """
+  def _handleNewInputNotifyEvent(self, method):  # pylint: disable=W0613
+    """ Notification that new input was queued up for the models in the dirty
+    models set
+    """
+    with self._dirtyModelsLock:
+      dirtyModels = self._dirtyModels
+      self._dirtyModels = OrderedDict()
+
+    for modelID in dirtyModels:
+      self._handleNewModelInput(modelID)
+
+
+  def _handleNewModelInput(self, modelID):
+    """ Handle new input that was queued up for a particular model """
+    if self._pendingInputRegistry is not None:
+      self._pendingInputRegistry.add(modelID)
+
     runningModelInfo = self._runningModelsMap.get(modelID)
     if runningModelInfo is not None:
       # This model is already running
       runningModelInfo.updateTimestamp()
 
-    elif modelID not in self._waitingModelsFIFO:
+    elif modelID not in self._waitingModels:
       # This model was not running and is not awaiting execution
 
-      # TODO: for a large _waitingModelsFIFO, the membership check may be slow.
-      #  Consider employing a map of all models of interest with current state
-      #  (waiting/pending/running/idle) reflected in the items for O(1) lookups,
-      #  but profile first to see if it's a problem!
-
       # NOTE: it's possible that the model has already processed all its input
       #  and we're handling this notification belatedly, and this may result in
       #  unnecessary start-up of its ModelRunner. We should generally be pretty
@@ -255,19 +353,19 @@ class SwapController(object):
 
       if self._freeSlots:
         # No models should be waiting if we have a free slot
-        assert not self._waitingModelsFIFO, repr(self._waitingModelsFIFO)
+        assert not self._waitingModels, len(self._waitingModels)
 
         # Assign the model to a free slot
         self._assignModelToFreeSlot(modelID)
 
       else:
         # This model needs to wait until resources become available
-        self._waitingModelsFIFO.append(modelID)
+        self._waitingModels.add(modelID)
 
         if self._profiling:
           self._logger.info("{TAG:SWAP.SC.MODEL.WAIT} model=%s; "
                             "numWaitingModels=%s; numPendingPreemptSlots=%s",
-                            modelID, len(self._waitingModelsFIFO),
+                            modelID, len(self._waitingModels),
                             len(self._pendingPreemptSlotsSet))
 
         self._requestPreemptionOfRunningSlotIfNeededAndPossible()
@@ -288,7 +386,7 @@ class SwapController(object):
         "{TAG:SWAP.SC.MODEL.DONE} model=%s; slot=%d; exitStatus=%d; "
         "duration=%s; numRunningModels=%s; numWaitingModels=%s", modelID,
         doneModelInfo.slotIndex, exitStatus, endTime - doneModelInfo.startTime,
-        len(self._runningModelsMap), len(self._waitingModelsFIFO))
+        len(self._runningModelsMap), len(self._waitingModels))
 
     assert doneModelInfo.slotIndex not in self._freeSlots
     assert 0 <= doneModelInfo.slotIndex < len(self._slotAgents)
@@ -307,19 +405,39 @@ class SwapController(object):
       # There is more unprocessed input data for the completed model,
       # so notify ourselves asynchronously to schedule this model
       self._newInputNotifyTS(modelID)
+    elif self._pendingInputRegistry is not None:
+      self._pendingInputRegistry.remove(modelID)
 
-    if self._waitingModelsFIFO:
-      # Start a waiting model, now that we know there is a free slot
-      newModelID = self._waitingModelsFIFO.pop(0)
+    if self._waitingModels:
+      # Start the highest-priority waiting model, now that we know there is a
+      # free slot
+      newModelID = self._waitingModels.pop()
       self._assignModelToFreeSlot(newModelID)
 
       self._requestPreemptionOfRunningSlotIfNeededAndPossible()
 
 
+  def _handlePreemptionRetryEvent(self, method):  # pylint: disable=W0613
+    """ A running model that was too young to preempt may have reached its
+    minimum residency time; retry preemption if there are still waiting models
+    """
+    self._preemptionRetryTimer = None
+
+    if self._freeSlots:
+      return
+
+    # Preemptions of several waiting models may have been deferred, so keep
+    # requesting preemptions while they succeed
+    numPendingPreemptSlots = -1
+    while numPendingPreemptSlots != len(self._pendingPreemptSlotsSet):
+      numPendingPreemptSlots = len(self._pendingPreemptSlotsSet)
+      self._requestPreemptionOfRunningSlotIfNeededAndPossible()
+
+
   def _assignModelToFreeSlot(self, modelID):
     """ Assign the given model to a free slot """
     assert modelID not in self._runningModelsMap
-    assert modelID not in self._waitingModelsFIFO
+    assert modelID not in self._waitingModels
 
     freeSlotIndex = self._freeSlots.pop()
 
@@ -327,7 +445,9 @@ class SwapController(object):
       modelID=modelID,
       modelFinishedCallback=partial(self._modelDoneNotifyTS, modelID))
 
-    self._runningModelsMap[modelID] = _RunningModelInfo(freeSlotIndex)
+    modelInfo = _RunningModelInfo(modelID, freeSlotIndex)
+    self._runningModelsMap[modelID] = modelInfo
+    self._pushPreemptionCandidate(modelInfo)
 
     assert ((len(self._runningModelsMap) + len(self._freeSlots)) ==
             len(self._slotAgents)), (
@@ -337,7 +457,72 @@ class SwapController(object):
       "{TAG:SWAP.SC.MODEL.ASSIGN} model=%s; slot=%s; numRunningModels=%s; "
       "numFreeSlots=%s; numWaitingModels=%s; numPendingPreemptSlots=%s",
       modelID, freeSlotIndex, len(self._runningModelsMap), len(self._freeSlots),
-      len(self._waitingModelsFIFO), len(self._pendingPreemptSlotsSet))
+      len(self._waitingModels), len(self._pendingPreemptSlotsSet))
+
+
+  def _pushPreemptionCandidate(self, modelInfo):
+    """ Add a running model to the preemption candidates heap """
+    heapq.heappush(
+      self._preemptionCandidatesHeap,
+      (modelInfo.timestamp, next(self._preemptionCandidatesSequence),
+       modelInfo))
+
+
+  def _popLeastRecentlyActivePreemptionCandidate(self, minStartTime):
+    """ Remove and return the least recently active running model that is not
+    pending preemption and was started no later than minStartTime. Candidates
+    started after minStartTime are kept in the heap.
+
+    :param minStartTime: latest start time of a model that may be preempted
+
+    :returns: a two-tuple (modelInfo, earliestResidencyTime); modelInfo is the
+      _RunningModelInfo of the candidate or None if no candidate qualifies;
+      earliestResidencyTime is the earliest start time among the skipped
+      candidates that were too young, or None if none were skipped.
+    """
+    heap = self._preemptionCandidatesHeap
+    tooYoung = []
+    victim = None
+
+    while heap:
+      timestamp, _seq, modelInfo = heapq.heappop(heap)
+
+      if self._runningModelsMap.get(modelInfo.modelID) is not modelInfo:
+        # The model is no longer running; discard the entry
+        continue
+
+      if timestamp != modelInfo.timestamp:
+        # Stale entry; the model received input since the entry was pushed
+        self._pushPreemptionCandidate(modelInfo)
+        continue
+
+      if modelInfo.startTime > minStartTime:
+        # The model hasn't been resident long enough to be preempted
+        tooYoung.append(modelInfo)
+        continue
+
+      victim = modelInfo
+      break
+
+    for modelInfo in tooYoung:
+      self._pushPreemptionCandidate(modelInfo)
+
+    earliestResidencyTime = (
+      min(i.startTime for i in tooYoung) if tooYoung else None)
+
+    return victim, earliestResidencyTime
+
+
+  def _schedulePreemptionRetry(self, delaySec):
+    """ Schedule a preemption retry event, unless one is already scheduled """
+    if self._preemptionRetryTimer is not None:
+      return
+
+    self._preemptionRetryTimer = threading.Timer(delaySec,
+                                                 self._preemptionRetryTS)
+    # Allow process to exit even if the timer is still pending
+    self._preemptionRetryTimer.setDaemon(True)
+    self._preemptionRetryTimer.start()
 
 
   def _requestPreemptionOfRunningSlotIfNeededAndPossible(self):
@@ -345,20 +530,28 @@ class SwapController(object):
     # There shouldn't be any free slots when we're asked to preempt
     assert not self._freeSlots, repr(self._freeSlots)
 
-    if (len(self._waitingModelsFIFO) <= len(self._pendingPreemptSlotsSet) or
+    if (len(self._waitingModels) <= len(self._pendingPreemptSlotsSet) or
         len(self._pendingPreemptSlotsSet) >= len(self._slotAgents)):
       # Not needed or no preemptable slots
       return
 
-    # Find an LRU non-pending-preempt busy slot agent, and request to
-    # preempt it
-    lru = sorted(
-      ((i.slotIndex, i.timestamp)
-        for i in self._runningModelsMap.itervalues()
-        if i.slotIndex not in self._pendingPreemptSlotsSet),
-      key=lambda element: element[1])
+    # Find an LRU non-pending-preempt busy slot agent that has been running for
+    # at least the minimum residency time, and request to preempt it
+    now = time.time()
+    victim, earliestResidencyTime = (
+      self._popLeastRecentlyActivePreemptionCandidate(
+        minStartTime=now - self._minResidencySec))
+
+    if victim is None:
+      # All candidates are too young to preempt; try again when the oldest of
+      # them reaches the minimum residency time
+      assert earliestResidencyTime is not None
+      self._schedulePreemptionRetry(
+        max(earliestResidencyTime + self._minResidencySec - now, 0))
+      return
 
-    slotIndex, timestamp = lru.pop(0)
+    slotIndex = victim.slotIndex
+    timestamp = victim.timestamp
 
     # Request preemption of the LRU slot
     self._slotAgents[slotIndex].stopModel()
@@ -368,7 +561,7 @@ class SwapController(object):
       self._logger.info(
         "{TAG:SWAP.SC.SLOT.PREEMPT.REQ} slot=%d with timestamp=%s; "
         "numWaitingModels=%s; numPendingPreemptSlots=%s",
-        slotIndex, timestamp, len(self._waitingModelsFIFO),
+        slotIndex, timestamp, len(self._waitingModels),
         len(self._pendingPreemptSlotsSet))
 
 
@@ -386,6 +579,11 @@ class SwapController(object):
 
 
     with ModelSwapperInterface() as swapperAPI:
+      # Notifications that were sent while we were down are still in our
+      # notification message queue, unless the queue was lost (it's not
+      # durable) or never created
+      notificationsRetained = swapperAPI.schedulerNotificationQueueExists()
+
       # First, make sure our notification message queue exists, so we don't
       # miss any new notifications while we're checking for models with pending
       # input
@@ -393,10 +591,33 @@ class SwapController(object):
       swapperAPI.initSchedulerNotification()
 
       # At start, notify main event loop of each model whose input is non-empty
-      self._logger.info("Checking for models with pending input")
+      if self._registeredModelIDs is not None and notificationsRetained:
+        # Only the registered models may have pending input that we weren't
+        # notified about
+        self._logger.info("Checking for models with pending input among "
+                          "numRegisteredModels=%d",
+                          len(self._registeredModelIDs))
+        modelsWithInputPending = []
+        idleModelIDs = []
+        for modelID in self._registeredModelIDs:
+          if swapperAPI.modelInputPending(modelID):
+            modelsWithInputPending.append(modelID)
+          else:
+            idleModelIDs.append(modelID)
+
+        if idleModelIDs:
+          self._eventQ.put({"method" : self._UNREGISTER_IDLE_MODELS_METHOD,
+                            "modelIDs" : idleModelIDs})
+      else:
+        # Fall back to a full scan of the input queues of all models
+        self._logger.info("Checking for models with pending input via full "
+                          "scan; registryLoaded=%s; notificationsRetained=%s",
+                          self._registeredModelIDs is not None,
+                          notificationsRetained)
+        modelsWithInputPending = swapperAPI.getModelsWithInputPending()
 
       i = 0
-      for i, modelID in enumerate(swapperAPI.getModelsWithInputPending(), 1):
+      for i, modelID in enumerate(modelsWithInputPending, 1):
         self._logger.debug("Input pending for model=%s", modelID)
         self._newInputNotifyTS(modelID=modelID)
 
@@ -434,7 +655,8 @@ class _RunningModelInfo(object):
   """ Information about a running model """
 
 
-  def __init__(self, slotIndex):
+  def __init__(self, modelID, slotIndex):
+    self._modelID = modelID
     self._slotIndex = slotIndex
     now = time.time()
     self._startTime = now
@@ -460,6 +682,11 @@ class _RunningModelInfo(object):
     return self._activityTimestamp
 
 
+  @property
+  def modelID(self):
+    return self._modelID
+
+
   @property
   def slotIndex(self):
     return self._slotIndex
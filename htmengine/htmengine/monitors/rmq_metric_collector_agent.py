@@ -56,6 +56,7 @@ from nta.utils.config import Config
 from nta.utils.error_handling import retry
 
 from htmengine.model_swapper import ModelSwapperConfig
+from htmengine.model_swapper.model_swapper_interface import ModelSwapperInterface
 import htmengine.utils
 
 from nta.utils import amqp
@@ -180,8 +181,7 @@ def _parseArgs():
               else "%" + rmqParams.vhost.encode("hex"))
   appConfig = Config("application.conf", os.environ.get("APPLICATION_CONFIG_PATH"))
   swapperConfig = ModelSwapperConfig()
-  defaultQueues = [
-    swapperConfig.get("interface_bus", "results_queue"),
+  defaultQueues = ModelSwapperInterface.getResultsQueueNames() + [
     swapperConfig.get("interface_bus", "scheduler_notification_queue"),
     appConfig.get("metric_listener", "queue_name")
   ]
@@ -30,6 +30,7 @@ from nta.utils import sqlalchemy_utils
 from htmengine.repository.queries import (
     addMetric,
     addMetricData,
+    addMultiMetricData,
     deleteMetric,
     deleteModel,
     getCustomMetricByName,
@@ -42,8 +43,10 @@ from htmengine.repository.queries import (
     getMetric,
     getMetricWithSharedLock,
     getMetricWithUpdateLock,
+    getMetricsWithUpdateLock,
     getMetricCountForServer,
     getMetricData,
+    getMetricDataTimestamps,
     getMetricDataCount,
     getProcessedMetricDataCount,
     getMetricDataWithRawAnomalyScoresTail,
@@ -58,6 +61,7 @@ from htmengine.repository.queries import (
     updateMetricColumns,
     updateMetricColumnsForRefStatus,
     updateMetricDataColumns,
+    updateMetricDataColumnsBatch,
     lockOperationExclusive,
     OperationLock)
 
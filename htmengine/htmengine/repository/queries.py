@@ -21,7 +21,7 @@
 from collections import namedtuple
 from datetime import datetime, timedelta
 
-from sqlalchemy import func, MetaData, Numeric, text
+from sqlalchemy import and_, bindparam, case, func, MetaData, Numeric, or_, text
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import select
 from sqlalchemy.engine.base import Connection, Engine
@@ -36,6 +36,20 @@ from htmengine.repository.schema import metadata
 
 
 
+# Max number of metric_data rows updated by each UPDATE statement issued by
+# updateMetricDataColumnsBatch (a power of two); the CASE expressions are
+# evaluated by scanning their WHEN clauses, so the cost per row grows with the
+# number of rows per statement
+_MAX_ROWS_PER_METRIC_DATA_UPDATE = 128
+
+# UPDATE statements of updateMetricDataColumnsBatch keyed by (column names,
+# number of rows), and their compiled forms; building and compiling a statement
+# with thousands of bind parameters costs more than executing it
+_metricDataUpdateStatements = dict()
+_metricDataUpdateCompiledCache = dict()
+
+
+
 class MetricStatus(object):
   """ Metric states stored in the "metric" SQL table
 
@@ -263,6 +277,36 @@ def getMetricWithUpdateLock(conn, metricId, fields=None):
 
 
 
+def getMetricsWithUpdateLock(conn, metricIds, fields=None):
+  """ Perform a single SELECT ... FOR UPDATE on the given metric uids and
+  return the requested fields. Rows are locked in uid order, which keeps
+  concurrent multi-metric lockers from deadlocking each other.
+
+  :param conn: SQLAlchemy connection
+  :type conn: sqlalchemy.engine.Connection
+
+  :param metricIds: Sequence of metric uids
+
+  :param fields: Sequence of columns to be returned by underlying query; must
+    include schema.metric.c.uid if not None
+
+  :returns: Metrics that were found, ordered by uid; metric uids that weren't
+    found are omitted
+  :rtype: list of sqlalchemy.engine.RowProxy
+  """
+  if not metricIds:
+    return []
+
+  fields = fields or [schema.metric]
+
+  sel = (select(fields, order_by=schema.metric.c.uid.asc())
+         .where(schema.metric.c.uid.in_(metricIds))
+         .with_for_update(read=_SelectLock.UPDATE))
+
+  return conn.execute(sel).fetchall()
+
+
+
 class _SelectLock(object):
   """ Values for the read parameter of
   sqlalchemy.sql.selectable.Select.with_for_update
@@ -627,6 +671,59 @@ def addMetricData(conn, metricId, data):
 
 
 
+def addMultiMetricData(conn, data, lastRowids):
+  """ Add Metric Data for multiple metrics, allocating the rowids of all
+  metrics with one UPDATE and storing all rows with one multi-row INSERT.
+
+  The caller must have locked the metric rows via getMetricsWithUpdateLock in
+  the transaction that's in progress on `conn`, which is where `lastRowids`
+  come from.
+
+  :param conn: SQLAlchemy connection object
+  :type conn: sqlalchemy.engine.Connection
+  :param data: A dict mapping metric uid to a sequence of metric data sample
+    pairs (value, datetime.datetime)
+  :param lastRowids: A dict mapping each metric uid in `data` to its current
+    last_rowid, as read under the update lock
+  :returns: A dict mapping metric uid to the sequence of its new metric data
+    rows ordered by rowid in ascending order; each row is a dict of column
+    names/values
+  """
+  assert type(conn) is Connection
+
+  data = dict((metricId, samples)
+              for metricId, samples in data.iteritems() if samples)
+
+  if not data:
+    return dict()
+
+  rowsByMetric = dict()
+  newLastRowids = dict()
+  for metricId, samples in data.iteritems():
+    firstRowid = (lastRowids[metricId] or 0) + 1
+    rowsByMetric[metricId] = [
+      dict(uid=metricId,
+           rowid=rowid,
+           timestamp=timestamp,
+           metric_value=metricValue)
+      for rowid, (metricValue, timestamp) in enumerate(samples, firstRowid)
+    ]
+    newLastRowids[metricId] = firstRowid + len(samples) - 1
+
+  with conn.begin():
+    update = (schema.metric.update()  # pylint: disable=E1120
+              .where(schema.metric.c.uid.in_(newLastRowids.keys()))
+              .values(last_rowid=case(newLastRowids,
+                                      value=schema.metric.c.uid)))
+    conn.execute(update)
+
+    conn.execute(schema.metric_data.insert(),
+                 [row for rows in rowsByMetric.itervalues() for row in rows])
+
+  return rowsByMetric
+
+
+
 def getMetricData(conn,
                   metricId=None,
                   fields=None,
@@ -698,6 +795,29 @@ def getMetricData(conn,
 
 
 
+def getMetricDataTimestamps(conn, rowids):
+  """Get the timestamps of one MetricData row of each of multiple metrics in
+  one query
+
+  :param conn: SQLAlchemy connection object
+  :type conn: sqlalchemy.engine.base.Connection
+  :param rowids: A dict mapping metric uid to the MetricData row id whose
+    timestamp is requested
+  :returns: A dict mapping metric uid to the datetime.datetime timestamp of the
+    requested row; metrics whose row doesn't exist are omitted
+  """
+  if not rowids:
+    return dict()
+
+  sel = (select([schema.metric_data.c.uid, schema.metric_data.c.timestamp])
+         .where(or_(*[and_(schema.metric_data.c.uid == metricId,
+                           schema.metric_data.c.rowid == rowid)
+                      for metricId, rowid in rowids.iteritems()])))
+
+  return dict((row.uid, row.timestamp) for row in conn.execute(sel))
+
+
+
 def getMetricDataWithRawAnomalyScoresTail(conn, metricId, limit):
   """Get MetricData ordered by timestamp, descending
 
@@ -767,6 +887,83 @@ def updateMetricDataColumns(conn, metricDataObj, fields):
 
 
 
+def _getMetricDataUpdateStatement(columns, numRows):
+  """Get the UPDATE statement that sets the given columns of numRows MetricData
+  rows of one metric to per-row values
+
+  :param columns: tuple of the names of the columns to be updated
+  :param numRows: number of rows to be updated
+  :returns: UPDATE statement with the bind parameters "metricId" and, for each
+    row i, "rowid_<i>" and "<column name>_<i>"
+  """
+  key = (columns, numRows)
+  update = _metricDataUpdateStatements.get(key)
+
+  if update is None:
+    rowids = [bindparam("rowid_%d" % (i,)) for i in xrange(numRows)]
+
+    update = (schema.metric_data.update() # pylint: disable=E1120
+              .where(schema.metric_data.c.uid == bindparam("metricId"))
+              .where(schema.metric_data.c.rowid.in_(rowids))
+              .values(dict(
+                (name, case([(rowid, bindparam("%s_%d" % (name, i)))
+                             for i, rowid in enumerate(rowids)],
+                            value=schema.metric_data.c.rowid))
+                for name in columns)))
+
+    _metricDataUpdateStatements[key] = update
+
+  return update
+
+
+
+def updateMetricDataColumnsBatch(conn, metricId, rowFields):
+  """Update columns of multiple MetricData rows of one metric, using one UPDATE
+  statement per up to _MAX_ROWS_PER_METRIC_DATA_UPDATE rows instead of one per
+  row.
+
+  Each statement sets every column to a CASE expression keyed on rowid. Unlike
+  INSERT ... ON DUPLICATE KEY UPDATE, this never creates rows that were deleted
+  in the meantime.
+
+  :param conn: SQLAlchemy connection object
+  :type conn: sqlalchemy.engine.base.Connection
+  :param metricId: Metric uid
+  :type metricId: str
+  :param rowFields: A dict mapping MetricData row id to a dict of the column
+    names/values to be updated in that row; all rows must have the same column
+    names
+  """
+  if not rowFields:
+    return
+
+  rowids = sorted(rowFields)
+  columns = tuple(sorted(rowFields[rowids[0]]))
+
+  conn = conn.execution_options(
+    compiled_cache=_metricDataUpdateCompiledCache)
+
+  for start in xrange(0, len(rowids), _MAX_ROWS_PER_METRIC_DATA_UPDATE):
+    chunk = rowids[start:start + _MAX_ROWS_PER_METRIC_DATA_UPDATE]
+
+    # Round the number of rows up to a power of two by repeating the last row,
+    # so that only a few distinct statements are ever built and compiled
+    numRows = 1
+    while numRows < len(chunk):
+      numRows *= 2
+    chunk += chunk[-1:] * (numRows - len(chunk))
+
+    params = {"metricId": metricId}
+    for i, rowid in enumerate(chunk):
+      fields = rowFields[rowid]
+      params["rowid_%d" % (i,)] = rowid
+      for name in columns:
+        params["%s_%d" % (name, i)] = fields[name]
+
+    conn.execute(_getMetricDataUpdateStatement(columns, numRows), params)
+
+
+
 def getMetricStats(conn, metricId):
   """
   :param conn: SQLAlchemy connection object
@@ -25,8 +25,10 @@ import json
 import logging
 from collections import namedtuple
 import math
+import multiprocessing
 from optparse import OptionParser
 import os
+import signal
 import sys
 import time
 import zlib
@@ -75,6 +77,10 @@ PROBATION_FACTOR = 1.0 / RED_BAR_FLOOR
 INACTIVE_BAR_FLOOR = -10000
 LOG_1_MINUS_0_9999999999 = math.log(1.0 - 0.9999999999)
 
+# Interval, in seconds, at which the parent process of partition workers checks
+# on them
+_PARTITION_WORKER_POLL_INTERVAL_SEC = 1
+
 
 
 def _getLogger():
@@ -155,6 +161,12 @@ class RejectedInferenceResultBatch(Exception):
 
 
 
+class _PartitionWorkerError(Exception):
+  """ A partition worker process exited unexpectedly """
+  pass
+
+
+
 class AnomalyService(object):
   """ Anomaly Service for processing CLA model results, calculating Anomaly
   Likelihood scores, and updating the associated metric data records
@@ -169,6 +181,11 @@ class AnomalyService(object):
   configuration directive from the ``metric_streamer`` section of
   ``config``.
 
+  When the model results queue is partitioned by model ID (see
+  ``ModelSwapperInterface.getNumResultsQueuePartitions()``), each partition is
+  consumed by its own ``AnomalyService`` instance in a separate process, so a
+  given model's results are still processed in order by a single consumer.
+
   Other services may be subscribed to the model results fanout exchange for
   subsequent (and parallel) processing.  For example,
   ``htmengine.runtime.notification_service.NotificationService`` is one example
@@ -187,6 +204,11 @@ class AnomalyService(object):
     self._modelResultsExchange = (
       config.get("metric_streamer", "results_exchange_name"))
 
+    # Model command results are also published here, so that subscribers that
+    # only need those (e.g., metric_storer) don't receive all inference results
+    self._modelCommandResultsExchange = (
+      config.get("metric_streamer", "command_results_exchange_name"))
+
     self._statisticsSampleSize = (
       config.getint("anomaly_likelihood", "statistics_sample_size"))
 
@@ -318,16 +340,31 @@ class AnomalyService(object):
                         metricID, getMetricLogPrefix(metricObj))
       return None
 
-    # Load the MetricData instances corresponding to the results
-    with engine.connect() as conn:
-      metricDataRows = repository.getMetricData(conn,
-                                                metricID,
-                                                start=inferenceResults[0].rowID,
-                                                stop=inferenceResults[-1].rowID)
+    if self._inferenceResultsCarryInput(inferenceResults):
+      # Results from an up-to-date ModelRunner carry the timestamp and value of
+      # their input, so there is no need to load them from metric_data
+      metricDataRows = [
+        MutableMetricDataRow(anomaly_score=None,
+                             display_value=None,
+                             metric_value=result.metricValue,
+                             raw_anomaly_score=None,
+                             rowid=result.rowID,
+                             timestamp=result.timestamp,
+                             uid=metricID)
+        for result in inferenceResults
+      ]
+    else:
+      # Load the MetricData instances corresponding to the results
+      with engine.connect() as conn:
+        metricDataRows = repository.getMetricData(
+          conn,
+          metricID,
+          start=inferenceResults[0].rowID,
+          stop=inferenceResults[-1].rowID)
 
-    # metricDataRows must be mutable, as the data is massaged in
-    # _scrubInferenceResultsAndInitMetricData()
-    metricDataRows = list(metricDataRows)
+      # metricDataRows must be mutable, as the data is massaged in
+      # _scrubInferenceResultsAndInitMetricData()
+      metricDataRows = list(metricDataRows)
 
     if not metricDataRows:
       self._log.error("Rejected inference result batch=[%s..%s] of model=%s "
@@ -366,17 +403,21 @@ class AnomalyService(object):
         metricData.anomaly_score,
         active=(metricObj.status == MetricStatus.ACTIVE))
 
+    rowFields = dict(
+      (metricData.rowid,
+       {"raw_anomaly_score": metricData.raw_anomaly_score,
+        "anomaly_score": metricData.anomaly_score,
+        "display_value": metricData.display_value})
+      for metricData in metricDataRows)
+
     # Update database once via transaction!
     startTime = time.time()
     try:
       @retryOnTransientErrors
       def runSQL(engine):
         with engine.begin() as conn:
-          for metricData in metricDataRows:
-            fields = {"raw_anomaly_score": metricData.raw_anomaly_score,
-                      "anomaly_score": metricData.anomaly_score,
-                      "display_value": metricData.display_value}
-            repository.updateMetricDataColumns(conn, metricData, fields)
+          repository.updateMetricDataColumnsBatch(conn, metricObj.uid,
+                                                  rowFields)
 
           self._updateAnomalyLikelihoodParams(
             conn,
@@ -386,10 +427,15 @@ class AnomalyService(object):
 
       runSQL(engine)
     except (ObjectNotFoundError, MetricNotActiveError):
+      self.likelihoodHelper.discardCachedStatsSamples(metricObj.uid)
       self._log.warning("Rejected inference result batch=[%s..%s] of model=%s",
                         inferenceResults[0].rowID, inferenceResults[-1].rowID,
                         metricID, exc_info=True)
       return None
+    except Exception:
+      # The samples cached by updateModelAnomalyScores weren't saved
+      self.likelihoodHelper.discardCachedStatsSamples(metricObj.uid)
+      raise
 
     self._log.debug("Updated HTM metric_data rows=[%s..%s] "
                     "of model=%s: duration=%ss",
@@ -399,6 +445,27 @@ class AnomalyService(object):
     return (metricObj, metricDataRows,)
 
 
+  @staticmethod
+  def _inferenceResultsCarryInput(inferenceResults):
+    """ Determine whether the metric_data rows of the given inference results
+    may be initialized from the results alone: all of them must be successful
+    and carry the timestamp and value of their input record. The timestamps
+    must also be whole seconds, like the ones stored in metric_data.
+
+    :param inferenceResults: a sequence of ModelInferenceResult instances
+
+    :returns: True if the results carry their input; False otherwise (e.g.,
+      results from an older ModelRunner)
+    """
+    for result in inferenceResults:
+      if (result.status != 0 or
+          result.timestamp is None or
+          result.timestamp.microsecond != 0):
+        return False
+
+    return True
+
+
   @classmethod
   def _updateAnomalyLikelihoodParams(cls, conn, metricId, modelParamsJson,
                                      likelihoodParams):
@@ -543,8 +610,9 @@ class AnomalyService(object):
     :param inferenceResults: a sequence of ModelInferenceResult instances
       representing the inference result batch ordered by row id
 
-    :param metricDataRows: a mutable list of MetricData instances with row ids
-      in the range of inferenceResults[0].rowID to inferenceResults[-1].rowID
+    :param metricDataRows: a mutable list of MetricData or MutableMetricDataRow
+      instances with row ids in the range of inferenceResults[0].rowID to
+      inferenceResults[-1].rowID
 
     :param metricObj: a Metric instance associated with the given
       inferenceResults
@@ -607,7 +675,10 @@ class AnomalyService(object):
       #               calendar.timegm(metricData.timestamp.timetuple()),
       #               metricData.metric_value)
 
-      mutableMetricData = MutableMetricDataRow(**dict(metricData.items()))
+      if isinstance(metricData, MutableMetricDataRow):
+        mutableMetricData = metricData
+      else:
+        mutableMetricData = MutableMetricDataRow(**dict(metricData.items()))
       mutableMetricData.raw_anomaly_score = result.anomalyScore
       mutableMetricData.anomaly_score = 0
       metricDataRows[index] = mutableMetricData
@@ -628,11 +699,14 @@ class AnomalyService(object):
     return json.loads(zlib.decompress(payload))
 
 
-  def run(self):
+  def run(self, partition=0):
     """
     Consumes pending results.  Once result batch arrives, it will be dispatched
     to the correct model command result handler.
 
+    :param int partition: index of the model results queue partition to
+      consume; see ModelSwapperInterface.consumeResults()
+
     :see: `_processModelCommandResult` and `_processModelInferenceResults`
     """
     # Properties for publishing model command results on RabbitMQ exchange
@@ -650,9 +724,12 @@ class AnomalyService(object):
       amqpClient.declareExchange(self._modelResultsExchange,
                                  exchangeType="fanout",
                                  durable=True)
+      amqpClient.declareExchange(self._modelCommandResultsExchange,
+                                 exchangeType="fanout",
+                                 durable=True)
 
     with ModelSwapperInterface() as modelSwapper, MessageBusConnector() as bus:
-      with modelSwapper.consumeResults() as consumer:
+      with modelSwapper.consumeResults(partition=partition) as consumer:
         for batch in consumer:
           if self._profiling:
             batchStartTime = time.time()
@@ -671,11 +748,14 @@ class AnomalyService(object):
                 except (ObjectNotFoundError, MetricNotMonitoredError):
                   pass
                 else:
-                  bus.publishExg(
-                    exchange=self._modelResultsExchange,
-                    routingKey="",
-                    body=self._serializeModelResult(cmdResultMessage),
-                    properties=modelCommandResultProperties)
+                  cmdResultBody = self._serializeModelResult(cmdResultMessage)
+                  for exchange in (self._modelResultsExchange,
+                                   self._modelCommandResultsExchange):
+                    bus.publishExg(
+                      exchange=exchange,
+                      routingKey="",
+                      body=cmdResultBody,
+                      properties=modelCommandResultProperties)
               elif isinstance(result, ModelInferenceResult):
                 inferenceResults.append(result)
               else:
@@ -734,11 +814,85 @@ class AnomalyService(object):
 
 
 
+def _runPartitionWorker(partition):
+  """ Body of a partition worker process: runs AnomalyService on the given
+  model results queue partition
+
+  :param int partition: index of the model results queue partition
+  """
+  logger = _getLogger()
+  logger.setLogPrefix("%s, SERVICE=ANOMALY, PARTITION=%d" % (
+    getStandardLogPrefix(), partition))
+
+  try:
+    AnomalyService().run(partition=partition)
+  except Exception:
+    logger.exception("Error in Anomaly Service partition=%d run()", partition)
+    raise
+
+
+
+def _runPartitionWorkers(numPartitions):
+  """ Run an AnomalyService worker process for each model results queue
+  partition until SIGTERM is received or a worker exits; the workers are
+  stopped before returning.
+
+  Workers must be started before this process opens any database or message
+  bus connections, so they don't inherit them.
+
+  :param int numPartitions: number of model results queue partitions
+
+  :raises: _PartitionWorkerError if a worker exited
+  """
+  logger = _getLogger()
+
+  workers = []
+  stopSignals = []
+  try:
+    for partition in xrange(numPartitions):
+      process = multiprocessing.Process(
+        target=_runPartitionWorker,
+        name="AnomalyServicePartition-%d" % (partition,),
+        args=(partition,))
+      process.daemon = True
+      process.start()
+      workers.append(process)
+
+    logger.info("Started %d anomaly service partition workers", numPartitions)
+
+    # NOTE: installed after starting the workers, so they don't inherit it
+    signal.signal(signal.SIGTERM,
+                  lambda signum, _frame: stopSignals.append(signum))
+
+    while not stopSignals and all(process.is_alive() for process in workers):
+      time.sleep(_PARTITION_WORKER_POLL_INTERVAL_SEC)
+
+    if not stopSignals:
+      raise _PartitionWorkerError(
+        "Anomaly service partition workers exited: %s" % (
+          ", ".join("%s (exitcode=%s)" % (process.name, process.exitcode)
+                    for process in workers if not process.is_alive()),))
+
+    logger.info("Stopping anomaly service partition workers on signal=%s",
+                stopSignals[0])
+  finally:
+    # NOTE: the results of the batches that the workers didn't finish are
+    # redelivered, since they weren't acked
+    for process in workers:
+      if process.is_alive():
+        process.terminate()
+
+    for process in workers:
+      process.join()
+
+
+
 def main(args):
   # Parse command line options
   helpString = (
     "Usage: %prog\n"
-    "This script runs the HTM Anomaly service.")
+    "This script runs the HTM Anomaly service; with a partitioned model "
+    "results queue, in a worker process per partition.")
 
   parser = OptionParser(helpString)
 
@@ -747,8 +901,13 @@ def main(args):
   if len(args) > 0:
     parser.error("Didn't expect any positional args (%r)." % (args,))
 
+  numPartitions = ModelSwapperInterface.getNumResultsQueuePartitions()
+
   try:
-    AnomalyService().run()
+    if numPartitions == 1:
+      AnomalyService().run()
+    else:
+      _runPartitionWorkers(numPartitions)
   except Exception:
     _getLogger().exception("Error in Anomaly Service run()")
     raise
@@ -28,6 +28,9 @@ they come in as a batch but to time out quickly to avoid long delays in
 uploading.
 """
 
+from collections import namedtuple
+import cPickle
+import cStringIO
 import datetime
 import errno
 import itertools
@@ -35,11 +38,16 @@ import json
 import logging
 import optparse
 import os
+import Queue
+import select
 import socket
 import SocketServer
+import struct
 import threading
 import time
 
+import msgpack
+
 from nta.utils.config import Config
 from nta.utils.logging_support_raw import LoggingSupport
 from nta.utils import threading_utils
@@ -48,6 +56,7 @@ from htmengine import raiseExceptionOnMissingRequiredApplicationConfigPath
 from htmengine.htmengine_logging import getExtendedLogger
 from htmengine.model_swapper.model_swapper_interface import (
   MessageBusConnector)
+from htmengine.utils import getConsistentHashPartition
 from nta.utils.message_bus_connector import MessageQueueNotFound
 
 
@@ -55,6 +64,23 @@ from nta.utils.message_bus_connector import MessageQueueNotFound
 # Max number of data samples per batch
 _MAX_BATCH_SIZE = 200
 
+# Default number of message bus publishers shared by all connections in
+# event-loop mode
+_DEFAULT_NUM_PUBLISHERS = 4
+
+# Bounds for coalescing UDP datagrams into one message: a buffer is published
+# when it reaches this many samples or when its oldest sample is this old
+_UDP_COALESCE_MAX_SAMPLES = 500
+_UDP_COALESCE_MAX_DELAY_SEC = 0.05
+
+# Length prefix of a frame in the pickle and msgpack batch protocols: 4-byte
+# unsigned integer in network byte order
+_FRAME_HEADER = struct.Struct("!L")
+
+# Max payload size of a frame in the pickle and msgpack batch protocols; same
+# limit as Graphite's carbon uses for pickle
+_MAX_FRAME_SIZE = 1 << 20
+
 
 LOGGER = getExtendedLogger(__name__)
 
@@ -67,28 +93,48 @@ gProfiling = False
 
 class Protocol(object):
   """
-  Currently supports only the Carbon plaintext protocol
-  Future options are pickle and amqp
+  PLAIN: Carbon plaintext protocol; newline-terminated
+    "<metric-name> <value> <unix-timestamp>" samples
+  PICKLE: Carbon pickle protocol; length-prefixed pickled lists of
+    (<metric-name>, (<unix-timestamp>, <value>)) samples
+  MSGPACK: length-prefixed msgpack maps of equal-length "names", "values" and
+    "timestamps" (unix) arrays
+
+  PICKLE and MSGPACK are TCP-only and are forwarded to the metric storer as
+  msgpack-encoded SampleColumns (see `_forwardColumns`)
   """
 
   PLAIN = "plain"
+  PICKLE = "pickle"
+  MSGPACK = "msgpack"
 
   current = None
 
   @classmethod
   def values(cls):
-    return (cls.PLAIN,)
+    return (cls.PLAIN, cls.PICKLE, cls.MSGPACK)
 
   @classmethod
   def getDefaultPort(cls, protocol):
-    if protocol == cls.PLAIN:
+    portOptions = {
+      cls.PLAIN: "plaintext_port",
+      cls.PICKLE: "pickle_port",
+      cls.MSGPACK: "msgpack_port",
+    }
+    if protocol in portOptions:
       return int((Config("application.conf",
                          os.environ["APPLICATION_CONFIG_PATH"])
-                  .get("metric_listener", "plaintext_port")))
+                  .get("metric_listener", portOptions[protocol])))
     raise ValueError("Unknown protocol %r" % protocol)
 
 
 
+# Columnar batch of data samples: equal-length sequences of metric names,
+# floating-point values and floating-point unix timestamps
+SampleColumns = namedtuple("SampleColumns", "names values timestamps")
+
+
+
 def parsePlaintext(data):
   """ Parse a plaintext data sample
 
@@ -113,6 +159,109 @@ def parsePlaintext(data):
 
 
 
+def _getPlaintextMetricName(data):
+  """ Get the metric name of a plaintext data sample without parsing the rest
+
+  :param data: a plaintext data sample (see `parsePlaintext`)
+
+  :returns: the sample's first whitespace-separated item; empty string if none
+  """
+  items = data.split(None, 1)
+  return items[0] if items else ""
+
+
+
+def _loadPickleSafely(payload):
+  """ Unpickle data from an untrusted source; only primitive types may be
+  loaded, since the unpickler is unable to resolve any module globals (such
+  as classes and functions).
+  """
+  unpickler = cPickle.Unpickler(cStringIO.StringIO(payload))
+  unpickler.find_global = None
+  return unpickler.load()
+
+
+
+def parsePickleBatch(payload):
+  """ Parse the payload of a Carbon pickle protocol frame
+
+  :param payload: pickled sequence of (<metric-name>, (<unix-timestamp>,
+    <value>)) samples
+
+  :raises: ValueError when the payload doesn't match the expected type and
+      format
+
+  :returns: the samples
+  :rtype: SampleColumns
+  """
+  try:
+    samples = _loadPickleSafely(payload)
+    names = []
+    values = []
+    timestamps = []
+    for name, (timestamp, value) in samples:
+      if isinstance(name, unicode):
+        name = name.encode("utf-8")
+      elif not isinstance(name, str):
+        raise TypeError("Unexpected metric name type %r" % (type(name),))
+      names.append(name)
+      values.append(float(value))
+      timestamps.append(float(timestamp))
+  except (cPickle.UnpicklingError, AttributeError, EOFError, ImportError,
+          LookupError, TypeError, ValueError) as e:
+    raise ValueError("Unable to parse pickle batch of size=%d: %r" %
+                     (len(payload), e))
+  return SampleColumns(names, values, timestamps)
+
+
+
+def parseMsgpackBatch(payload):
+  """ Parse a msgpack-encoded columnar batch; used both by the msgpack protocol
+  frames and by the messages that _forwardColumns publishes
+
+  :param payload: msgpack-encoded map containing equal-length "names",
+    "values" and "timestamps" arrays
+
+  :raises: ValueError when the payload doesn't match the expected type and
+      format
+
+  :returns: the samples
+  :rtype: SampleColumns
+  """
+  try:
+    batch = msgpack.unpackb(payload)
+    names = batch["names"]
+    values = [float(value) for value in batch["values"]]
+    timestamps = [float(timestamp) for timestamp in batch["timestamps"]]
+    if not len(names) == len(values) == len(timestamps):
+      raise ValueError("Column lengths differ: names=%d, values=%d, "
+                       "timestamps=%d" % (len(names), len(values),
+                                          len(timestamps)))
+    if not all(isinstance(name, str) for name in names):
+      raise TypeError("Metric names must be strings")
+  except (msgpack.UnpackException, AttributeError, LookupError, TypeError,
+          ValueError) as e:
+    raise ValueError("Unable to parse msgpack batch of size=%d: %r" %
+                     (len(payload), e))
+  return SampleColumns(names, values, timestamps)
+
+
+
+def packColumnsMessage(columns):
+  """ Encode a message for the custom metric data queue carrying the given
+  samples in binary form
+
+  :param SampleColumns columns: the samples
+
+  :returns: msgpack-encoded map; see `parseMsgpackBatch`
+  """
+  return msgpack.packb({"protocol": Protocol.MSGPACK,
+                        "names": columns.names,
+                        "values": columns.values,
+                        "timestamps": columns.timestamps})
+
+
+
 class Transport(object):
   __slots__ = ("UDP", "TCP")
   UDP = "udp"
@@ -124,6 +273,24 @@ class Transport(object):
 
 
 
+class Concurrency(object):
+  """ Connection-handling models supported by the listener
+
+  THREADED: a thread and a message bus connection per client connection (TCP)
+    or per datagram (UDP)
+  EVENT_LOOP: a single thread multiplexes all client connections and hands
+    batches off to a small, shared pool of message bus publishers
+  """
+  __slots__ = ("THREADED", "EVENT_LOOP")
+  THREADED = "threaded"
+  EVENT_LOOP = "eventloop"
+
+  @classmethod
+  def values(cls):
+    return [getattr(cls, a) for a in cls.__slots__]
+
+
+
 def _forwardData(messageBus, data):
   """Puts the data in the custom metric queue.
 
@@ -133,14 +300,7 @@ def _forwardData(messageBus, data):
     startTime = time.time()
 
   message = json.dumps({"protocol": Protocol.PLAIN, "data": data})
-  try:
-    LOGGER.debug("Publishing message: %s", message)
-    messageBus.publish(mqName=gQueueName, body=message, persistent=True)
-  except MessageQueueNotFound:
-    LOGGER.debug("Creating message queue that doesn't exist: %s", gQueueName)
-    messageBus.createMessageQueue(mqName=gQueueName, durable=True)
-    LOGGER.debug("Re-publishing message: %s", message)
-    messageBus.publish(mqName=gQueueName, body=message, persistent=True)
+  _publishMessage(messageBus, message)
 
   LOGGER.debug("forwarded batchLen=%d", len(data))
 
@@ -158,6 +318,72 @@ def _forwardData(messageBus, data):
 
 
 
+def _forwardColumns(messageBus, columns):
+  """Puts the columnar data in the custom metric queue in binary form.
+
+  :param SampleColumns columns: the samples
+  """
+  if gProfiling:
+    startTime = time.time()
+
+  _publishMessage(messageBus, packColumnsMessage(columns))
+
+  LOGGER.debug("forwarded columnar batchLen=%d", len(columns.names))
+
+  if gProfiling and columns.names:
+    now = time.time()
+    for metricName, timestamp in itertools.izip(columns.names,
+                                                 columns.timestamps):
+      LOGGER.info(
+        "{TAG:CUSLSR.FW.DONE} metricName=%s; timestamp=%s; duration=%.4fs",
+        metricName,
+        datetime.datetime.utcfromtimestamp(timestamp).isoformat() + "Z",
+        now - startTime)
+
+
+
+def _forwardBatch(messageBus, batch):
+  """Puts a batch in the custom metric queue, using the encoding that fits its
+  format
+
+  :param batch: SampleColumns or a sequence of plaintext data samples
+  """
+  if isinstance(batch, SampleColumns):
+    _forwardColumns(messageBus, batch)
+  else:
+    _forwardData(messageBus, batch)
+
+
+
+def _getBatchSummary(batch):
+  """ Describe a batch for logging without dumping all of its samples
+
+  :param batch: SampleColumns or a non-empty sequence of plaintext data samples
+
+  :returns: a three-tuple <numSamples, firstSample, lastSample>; the samples of
+    SampleColumns are given as (name, value, timestamp) tuples
+  """
+  if isinstance(batch, SampleColumns):
+    return (len(batch.names),
+            (batch.names[0], batch.values[0], batch.timestamps[0]),
+            (batch.names[-1], batch.values[-1], batch.timestamps[-1]))
+
+  return len(batch), batch[0], batch[-1]
+
+
+
+def _publishMessage(messageBus, message):
+  try:
+    LOGGER.debug("Publishing message: %r", message)
+    messageBus.publish(mqName=gQueueName, body=message, persistent=True)
+  except MessageQueueNotFound:
+    LOGGER.debug("Creating message queue that doesn't exist: %s", gQueueName)
+    messageBus.createMessageQueue(mqName=gQueueName, durable=True)
+    LOGGER.debug("Re-publishing message: %r", message)
+    messageBus.publish(mqName=gQueueName, body=message, persistent=True)
+
+
+
 class _TimeoutSafeBufferedLineReader(object):
   """We have and use this class as an indirect replacement for socket.makefile()
   instance, because socket.makefile() doesn't work properly when timeout is set
@@ -286,6 +512,33 @@ class ThreadedUDPServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
 
 
 
+class CoalescingUDPHandler(SocketServer.BaseRequestHandler):
+
+  def handle(self):
+    data = self.request[0].strip()
+    if data:
+      self.server.coalescer.add(data)
+
+
+
+class CoalescingUDPServer(SocketServer.UDPServer, object):
+  """ Handles datagrams serially on the server thread, adding each sample to a
+  shared _SampleCoalescer instead of publishing it over a connection of its
+  own
+  """
+  allow_reuse_address = True
+
+
+  def __init__(self, listeningAddr, handlerClass, coalescer):
+    """
+    :param _SampleCoalescer coalescer: accumulates the received samples
+    """
+    self.coalescer = coalescer
+
+    super(CoalescingUDPServer, self).__init__(listeningAddr, handlerClass)
+
+
+
 class TCPHandler(SocketServer.StreamRequestHandler):
 
   def handle(self):
@@ -315,6 +568,47 @@ class TCPHandler(SocketServer.StreamRequestHandler):
 
 
 
+class FramedTCPHandler(SocketServer.BaseRequestHandler):
+  """ Handles a connection using one of the length-prefixed batch protocols;
+  each frame is forwarded as one message
+  """
+
+  _RECV_BUF_SIZE = 65536
+
+
+  def handle(self):
+
+    with self.server.concurrencyTracker as concurrencyCount:
+      LOGGER.info("(thread=%s) Receiving %s batches from client=%s at "
+                  "currentConcurrency=%d", threading.currentThread().ident,
+                  Protocol.current, self.client_address, concurrencyCount)
+
+      accumulator = _FrameBatchAccumulator(Protocol.current)
+      with MessageBusConnector() as messageBus:
+        while True:
+          try:
+            data = self.request.recv(self._RECV_BUF_SIZE)
+          except socket.error as e:
+            if e.args[0] == errno.EINTR:
+              continue
+            raise
+
+          if not data:
+            accumulator.close()
+            return
+
+          try:
+            batches = accumulator.feed(data)
+          except ValueError as e:
+            LOGGER.warn("Closing connection from client=%s on protocol "
+                        "error: %r", self.client_address, e)
+            return
+
+          for batch in batches:
+            _forwardColumns(messageBus, batch)
+
+
+
 class ThreadedTCPServer(SocketServer.ThreadingMixIn,
                         SocketServer.TCPServer,
                         object):
@@ -328,18 +622,667 @@ class ThreadedTCPServer(SocketServer.ThreadingMixIn,
 
 
 
+class _PublisherPool(object):
+  """ A small pool of publisher threads, each owning a long-lived
+  MessageBusConnector, that forward the batches submitted by the event loop.
+  Publishing never happens on the event loop's thread, so a slow broker only
+  applies back-pressure once a publisher's bounded pending-batch queue fills
+  up.
+
+  Each publisher has its own queue, and batches are submitted to a specific
+  publisher, which publishes them in submission order. Submitters must send all
+  batches of a given source (e.g., a connection or a metric) to the same
+  publisher: metric_storer rejects samples that are older than their metric's
+  last stored sample, so publishing one source's batches out of order would
+  lose samples.
+
+  NOTE: unlike the threaded servers, which close the client's connection when
+  publishing fails, the pool can't report a failure to the client that sent the
+  batch, since its samples were already acknowledged by being read. A batch
+  that fails to publish after MessageBusConnector's retries is logged and
+  dropped.
+  """
+
+  # Max number of batches waiting for a publisher before submit() blocks
+  _MAX_PENDING_BATCHES = 1000
+
+
+  def __init__(self, numPublishers):
+    """
+    :param int numPublishers: number of publisher threads (and message bus
+      connections) to run
+    """
+    if numPublishers < 1:
+      raise ValueError("numPublishers must be positive, but got %r" %
+                       (numPublishers,))
+
+    # Pending batch queue of each publisher thread
+    self._batchQs = [Queue.Queue(maxsize=self._MAX_PENDING_BATCHES)
+                     for _ in xrange(numPublishers)]
+
+    self._threads = []
+    for i, batchQ in enumerate(self._batchQs):
+      thread = threading.Thread(target=self._runPublisher,
+                                args=(batchQ,),
+                                name="MetricListenerPublisher-%d" % (i,))
+      thread.setDaemon(True)
+      self._threads.append(thread)
+
+
+  @property
+  def numPublishers(self):
+    return len(self._batchQs)
+
+
+  def start(self):
+    for thread in self._threads:
+      thread.start()
+
+
+  def stop(self):
+    """ Publish the batches that are still pending and stop the publisher
+    threads
+    """
+    for batchQ in self._batchQs:
+      batchQ.put(None)
+
+    for thread in self._threads:
+      thread.join()
+
+
+  def getPublisherIndex(self, key):
+    """ Get the publisher that batches of a given source should be submitted to
+
+    :param key: string that identifies the source; e.g., metric name
+
+    :returns: publisher index in [0, numPublishers)
+    """
+    return getConsistentHashPartition(key, len(self._batchQs))
+
+
+  def submit(self, batch, publisherIndex):
+    """ Queue a batch of data samples for publishing by the given publisher,
+    after the batches already submitted to it; blocks while the publisher's
+    pending batch queue is full
+
+    :param batch: SampleColumns or a sequence of plaintext data samples
+    :param int publisherIndex: index of the publisher in [0, numPublishers)
+    """
+    self._batchQs[publisherIndex].put(batch)
+
+
+  @staticmethod
+  def _runPublisher(batchQ):
+    with MessageBusConnector() as messageBus:
+      while True:
+        batch = batchQ.get()
+        if batch is None:
+          # Stop request
+          return
+
+        try:
+          _forwardBatch(messageBus, batch)
+        except Exception:  # pylint: disable=W0703
+          numSamples, firstSample, lastSample = _getBatchSummary(batch)
+          LOGGER.exception("Failed to forward batch of %d samples; dropping "
+                           "batch=[%r..%r]", numSamples, firstSample,
+                           lastSample)
+
+
+
+class _SampleCoalescer(object):
+  """ Coalesces individually-received samples into time- and size-bounded
+  batches for a _PublisherPool, so that a stream of single-sample datagrams is
+  published as a few large messages over long-lived connections.
+
+  Samples are batched per publisher by metric name, so all samples of a metric
+  are published by the same publisher in the order that they were added, while
+  different metrics are spread over all publishers. Batches are submitted while
+  holding the coalescer's lock, so a batch that is submitted by add() and one
+  that is submitted by the flusher thread can't overtake each other.
+  """
+
+  def __init__(self, publisherPool,
+               maxSamples=_UDP_COALESCE_MAX_SAMPLES,
+               maxDelaySec=_UDP_COALESCE_MAX_DELAY_SEC):
+    """
+    :param _PublisherPool publisherPool: publishers for completed batches
+    :param int maxSamples: a publisher's batch is submitted as soon as it has
+      this many samples
+    :param float maxDelaySec: batches are submitted no later than this many
+      seconds after the first sample of any of them was added
+    """
+    self._publisherPool = publisherPool
+    self._maxSamples = maxSamples
+    self._maxDelaySec = maxDelaySec
+
+    self._cond = threading.Condition()
+    # Map of publisher index to the pending batch of samples for it
+    self._batches = dict()
+    # time.time() when the pending batches are due; None while there are none
+    self._deadline = None
+    self._stopRequested = False
+
+    self._flusherThread = threading.Thread(target=self._runFlusher,
+                                           name="MetricListenerCoalescer")
+    self._flusherThread.setDaemon(True)
+
+
+  def start(self):
+    self._flusherThread.start()
+
+
+  def stop(self):
+    """ Submit the pending batches, if any, and stop the flusher thread """
+    with self._cond:
+      self._stopRequested = True
+      self._cond.notify()
+
+    self._flusherThread.join()
+
+
+  def add(self, sample):
+    """ Add a sample to the pending batch of its metric's publisher; submits
+    the batch to the publisher pool if it's full
+
+    :param sample: a plaintext data sample
+    """
+    publisherIndex = self._publisherPool.getPublisherIndex(
+      _getPlaintextMetricName(sample))
+
+    with self._cond:
+      batch = self._batches.setdefault(publisherIndex, [])
+      batch.append(sample)
+      if len(batch) >= self._maxSamples:
+        del self._batches[publisherIndex]
+        if not self._batches:
+          self._deadline = None
+        self._publisherPool.submit(batch, publisherIndex=publisherIndex)
+      elif self._deadline is None:
+        self._deadline = time.time() + self._maxDelaySec
+        self._cond.notify()
+
+
+  def _runFlusher(self):
+    while True:
+      with self._cond:
+        while not self._stopRequested:
+          if self._deadline is None:
+            self._cond.wait()
+            continue
+
+          remainingSec = self._deadline - time.time()
+          if remainingSec <= 0:
+            break
+
+          self._cond.wait(remainingSec)
+
+        for publisherIndex, batch in self._batches.iteritems():
+          LOGGER.debug("Submitting coalesced batchLen=%d", len(batch))
+          self._publisherPool.submit(batch, publisherIndex=publisherIndex)
+        self._batches.clear()
+        self._deadline = None
+
+        if self._stopRequested:
+          return
+
+
+
+class _Poller(object):
+  """ Readiness notification for many sockets; uses epoll where available and
+  falls back to poll, neither of which is limited to FD_SETSIZE descriptors
+  like select.select.
+  """
+
+  if hasattr(select, "epoll"):
+    _READ_EVENT_MASK = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+  else:
+    _READ_EVENT_MASK = select.POLLIN | select.POLLERR | select.POLLHUP
+
+
+  def __init__(self):
+    if hasattr(select, "epoll"):
+      self._impl = select.epoll()
+      self._timeoutScale = 1
+    else:
+      self._impl = select.poll()
+      # select.poll expects its timeout in milliseconds
+      self._timeoutScale = 1000
+
+
+  def close(self):
+    if hasattr(self._impl, "close"):
+      self._impl.close()
+
+
+  def registerForRead(self, fd):
+    self._impl.register(fd, self._READ_EVENT_MASK)
+
+
+  def unregister(self, fd):
+    self._impl.unregister(fd)
+
+
+  def poll(self, timeout):
+    """
+    :param float timeout: max seconds to wait for events
+
+    :returns: sequence of file descriptors that are ready to be read (or have
+      been hung up or errored out, which reading will reveal)
+    """
+    while True:
+      try:
+        return [fd for fd, _events
+                in self._impl.poll(timeout * self._timeoutScale)]
+      except (IOError, OSError, select.error) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+
+        raise
+
+
+
+class _LineBatchAccumulator(object):
+  """ Splits a client's byte stream into newline-terminated data samples and
+  groups them into batches using the same rules as TCPHandler: a batch is
+  complete when it reaches _MAX_BATCH_SIZE samples or when there is a break in
+  the data flow.
+  """
+
+  __slots__ = ("_lineBuf", "_batch")
+
+
+  def __init__(self):
+    self._lineBuf = bytearray()
+    self._batch = []
+
+
+  def feed(self, data):
+    """ Add received data
+
+    :param data: bytes received from the client
+
+    :returns: a (possibly empty) list of complete batches
+    """
+    self._lineBuf.extend(data)
+
+    batches = []
+    start = 0
+    while True:
+      eolPos = self._lineBuf.find("\n", start)
+      if eolPos == -1:
+        break
+
+      line = str(self._lineBuf[start:eolPos]).strip()
+      start = eolPos + 1
+      if line:
+        self._batch.append(line)
+        if len(self._batch) >= _MAX_BATCH_SIZE:
+          batches.append(self._batch)
+          self._batch = []
+
+    del self._lineBuf[0:start]
+
+    return batches
+
+
+  def flush(self):
+    """ Signal a break in data flow
+
+    :returns: the pending batch of complete lines, if any; None if there is
+      nothing to forward
+    """
+    batch = self._batch or None
+    self._batch = []
+    return batch
+
+
+  def close(self):
+    """ Signal end of stream; the trailing line doesn't need a newline
+
+    :returns: the remnant batch, if any; None if there is nothing to forward
+    """
+    line = str(self._lineBuf).strip()
+    del self._lineBuf[:]
+    if line:
+      self._batch.append(line)
+
+    return self.flush()
+
+
+
+class _FrameBatchAccumulator(object):
+  """ Splits a client's byte stream into the length-prefixed frames of the
+  pickle and msgpack batch protocols; each valid, non-empty frame is a batch.
+  Frames are self-delimiting, so there is never a pending batch to flush on a
+  break in data flow. Has the same interface as _LineBatchAccumulator.
+  """
+
+  __slots__ = ("_parse", "_buf")
+
+
+  def __init__(self, protocol):
+    """
+    :param protocol: Protocol.PICKLE or Protocol.MSGPACK
+    """
+    if protocol == Protocol.PICKLE:
+      self._parse = parsePickleBatch
+    elif protocol == Protocol.MSGPACK:
+      self._parse = parseMsgpackBatch
+    else:
+      raise ValueError("Not a batch protocol: %r" % (protocol,))
+
+    self._buf = bytearray()
+
+
+  def feed(self, data):
+    """ Add received data
+
+    :param data: bytes received from the client
+
+    :raises: ValueError if a frame exceeds _MAX_FRAME_SIZE, after which the
+      stream can't be trusted to be in sync anymore
+
+    :returns: a (possibly empty) list of SampleColumns batches
+    """
+    self._buf.extend(data)
+
+    batches = []
+    start = 0
+    while len(self._buf) - start >= _FRAME_HEADER.size:
+      (frameSize,) = _FRAME_HEADER.unpack_from(self._buf, start)
+      if frameSize > _MAX_FRAME_SIZE:
+        raise ValueError("Frame size=%d exceeds max=%d" %
+                         (frameSize, _MAX_FRAME_SIZE))
+
+      frameEnd = start + _FRAME_HEADER.size + frameSize
+      if len(self._buf) < frameEnd:
+        break
+
+      payload = str(self._buf[start + _FRAME_HEADER.size:frameEnd])
+      start = frameEnd
+
+      try:
+        batch = self._parse(payload)
+      except ValueError:
+        LOGGER.warn("Discarding frame that can't be parsed", exc_info=True)
+        continue
+
+      if batch.names:
+        batches.append(batch)
+
+    del self._buf[0:start]
+
+    return batches
+
+
+  def flush(self):  # pylint: disable=R0201
+    return None
+
+
+  def close(self):
+    if self._buf:
+      LOGGER.warn("Discarding truncated frame of %d bytes at end of stream",
+                  len(self._buf))
+      del self._buf[:]
+
+    return None
+
+
+
+class EventLoopServer(object):
+  """ Single-threaded, readiness-based listener for plaintext samples over TCP
+  or UDP, or for the batch protocols over TCP. Unlike ThreadedTCPServer and
+  ThreadedUDPServer, it doesn't dedicate a thread or a message bus connection
+  to each client, so one process can hold many thousands of concurrent,
+  long-lived client connections at a stable memory footprint. Completed
+  batches are handed off to a _PublisherPool.
+
+  Batching matches TCPHandler: a batch is forwarded when it reaches
+  _MAX_BATCH_SIZE samples or when a break in the data flow is detected, which
+  in this case means that a connection has no more data available for reading.
+
+  Like TCPHandler's per-connection MessageBusConnector, all batches of a TCP
+  connection go to the same publisher, so they are published in the order that
+  they were received; connections are assigned to publishers round-robin. UDP
+  datagrams aren't associated with connections, so their samples are batched
+  per publisher by metric name instead.
+  """
+
+  _RECV_BUF_SIZE = 65536
+
+  # Max recv calls per connection per loop iteration; a limit keeps a single
+  # high-volume client from starving the others
+  _MAX_RECVS_PER_READY_EVENT = 16
+
+  _POLL_TIMEOUT_SEC = 1
+
+  _LISTEN_BACKLOG = 1024
+
+
+  def __init__(self, listeningAddr, transport, publisherPool, coalescer=None,
+               protocol=Protocol.PLAIN):
+    """
+    :param listeningAddr: (host, port) pair to bind to
+    :param transport: one of Transport values
+    :param _PublisherPool publisherPool: publishers for completed batches
+    :param _SampleCoalescer coalescer: optional; if given, UDP samples are
+      added to it instead of being batched per data break
+    :param protocol: one of Protocol values; the batch protocols require
+      Transport.TCP
+    """
+    if protocol != Protocol.PLAIN and transport != Transport.TCP:
+      raise ValueError("Protocol %r requires TCP transport" % (protocol,))
+
+    self._transport = transport
+    self._protocol = protocol
+    self._publisherPool = publisherPool
+    self._coalescer = coalescer
+
+    if transport == Transport.TCP:
+      self._serverSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    elif transport == Transport.UDP:
+      self._serverSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    else:
+      raise ValueError("Unknown transport %r" % (transport,))
+
+    try:
+      self._serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self._serverSock.bind(listeningAddr)
+      if transport == Transport.TCP:
+        self._serverSock.listen(self._LISTEN_BACKLOG)
+      self._serverSock.setblocking(0)
+    except Exception:
+      self._serverSock.close()
+      raise
+
+    self.server_address = self._serverSock.getsockname()
+
+    self._recvBuf = bytearray(self._RECV_BUF_SIZE)
+
+    self._poller = None
+
+    # Map of file descriptor to (client socket, client address, accumulator,
+    # publisher index) for connected TCP clients; the accumulator is a
+    # _LineBatchAccumulator or _FrameBatchAccumulator
+    self._clients = dict()
+
+    # Publisher assignment of accepted TCP connections
+    self._connectionCounter = itertools.count()
+
+    self._stopRequested = False
+
+
+  def serve_forever(self):
+    """ Run the event loop until shutdown() is called """
+    self._poller = _Poller()
+    serverFd = self._serverSock.fileno()
+    self._poller.registerForRead(serverFd)
+    try:
+      while not self._stopRequested:
+        for fd in self._poller.poll(self._POLL_TIMEOUT_SEC):
+          if fd == serverFd:
+            if self._transport == Transport.TCP:
+              self._acceptClients()
+            else:
+              self._receiveDatagrams()
+          elif fd in self._clients:
+            self._receiveFromClient(fd)
+    finally:
+      for fd in self._clients.keys():
+        self._closeClient(fd)
+      self._poller.close()
+      self._poller = None
+
+
+  def shutdown(self):
+    """ Request that serve_forever() return; takes effect within
+    _POLL_TIMEOUT_SEC
+    """
+    self._stopRequested = True
+
+
+  def server_close(self):
+    self._serverSock.close()
+
+
+  def _acceptClients(self):
+    while True:
+      try:
+        clientSock, clientAddr = self._serverSock.accept()
+      except socket.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          LOGGER.warn("accept failed: %r", e)
+        return
+
+      clientSock.setblocking(0)
+      fd = clientSock.fileno()
+      if self._protocol == Protocol.PLAIN:
+        accumulator = _LineBatchAccumulator()
+      else:
+        accumulator = _FrameBatchAccumulator(self._protocol)
+      publisherIndex = (next(self._connectionCounter) %
+                        self._publisherPool.numPublishers)
+      self._clients[fd] = (clientSock, clientAddr, accumulator, publisherIndex)
+      self._poller.registerForRead(fd)
+      LOGGER.info("Receiving samples from client=%s at currentConcurrency=%d",
+                  clientAddr, len(self._clients))
+
+
+  def _receiveFromClient(self, fd):
+    clientSock, clientAddr, accumulator, publisherIndex = self._clients[fd]
+    for _ in xrange(self._MAX_RECVS_PER_READY_EVENT):
+      try:
+        nbytes = clientSock.recv_into(self._recvBuf)
+      except socket.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          # No more data available for now: break in data flow
+          batch = accumulator.flush()
+          if batch is not None:
+            LOGGER.debug("got data break; batchLen=%d", len(batch))
+            self._publisherPool.submit(batch, publisherIndex)
+          return
+
+        LOGGER.warn("Closing connection from client=%s on error: %r",
+                    clientAddr, e)
+        self._closeClient(fd)
+        return
+
+      if nbytes == 0:
+        LOGGER.debug("EOF from client=%s", clientAddr)
+        self._closeClient(fd)
+        return
+
+      try:
+        batches = accumulator.feed(buffer(self._recvBuf, 0, nbytes))
+      except ValueError as e:
+        LOGGER.warn("Closing connection from client=%s on protocol error: %r",
+                    clientAddr, e)
+        self._closeClient(fd)
+        return
+
+      for batch in batches:
+        self._publisherPool.submit(batch, publisherIndex)
+
+
+  def _closeClient(self, fd):
+    (clientSock, _clientAddr, accumulator,
+     publisherIndex) = self._clients.pop(fd)
+    self._poller.unregister(fd)
+    clientSock.close()
+
+    # Send the remnant
+    batch = accumulator.close()
+    if batch is not None:
+      self._publisherPool.submit(batch, publisherIndex)
+
+
+  def _receiveDatagrams(self):
+    # Map of publisher index to the batch of samples for it
+    batches = dict()
+    while True:
+      try:
+        data = self._serverSock.recv(self._RECV_BUF_SIZE)
+      except socket.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          LOGGER.warn("recv failed: %r", e)
+        break
+
+      data = data.strip()
+      if data and self._coalescer is not None:
+        self._coalescer.add(data)
+      elif data:
+        publisherIndex = self._publisherPool.getPublisherIndex(
+          _getPlaintextMetricName(data))
+        batch = batches.setdefault(publisherIndex, [])
+        batch.append(data)
+        if len(batch) >= _MAX_BATCH_SIZE:
+          self._publisherPool.submit(batch, publisherIndex)
+          del batches[publisherIndex]
+
+    for publisherIndex, batch in batches.iteritems():
+      self._publisherPool.submit(batch, publisherIndex)
+
+
+
 @raiseExceptionOnMissingRequiredApplicationConfigPath
 def runServer(host="0.0.0.0", port=None, protocol=Protocol.PLAIN,
-              transport=Transport.TCP):
+              transport=Transport.TCP, concurrency=Concurrency.THREADED,
+              numPublishers=_DEFAULT_NUM_PUBLISHERS, udpCoalesce=False):
   Protocol.current = protocol
   if port is None:
     port = Protocol.getDefaultPort(protocol)
 
-  LOGGER.info("Starting with host=%s, port=%s, protocol=%s, transport=%s",
-              host, port, protocol, transport)
-
-  if transport == Transport.UDP:
+  LOGGER.info("Starting with host=%s, port=%s, protocol=%s, transport=%s, "
+              "concurrency=%s, udpCoalesce=%s", host, port, protocol,
+              transport, concurrency, udpCoalesce)
+
+  publisherPool = None
+  coalescer = None
+  if protocol != Protocol.PLAIN and transport != Transport.TCP:
+    raise ValueError("Protocol %r requires TCP transport" % (protocol,))
+
+  if transport == Transport.UDP and udpCoalesce:
+    publisherPool = _PublisherPool(numPublishers)
+    coalescer = _SampleCoalescer(publisherPool)
+
+  if concurrency == Concurrency.EVENT_LOOP:
+    if publisherPool is None:
+      publisherPool = _PublisherPool(numPublishers)
+    server = EventLoopServer((host, port), transport, publisherPool,
+                             coalescer=coalescer, protocol=protocol)
+  elif coalescer is not None:
+    server = CoalescingUDPServer((host, port), CoalescingUDPHandler, coalescer)
+  elif transport == Transport.UDP:
     server = ThreadedUDPServer((host, port), UDPHandler)
+  elif protocol != Protocol.PLAIN:
+    server = ThreadedTCPServer((host, port), FramedTCPHandler)
   elif transport == Transport.TCP:
     server = ThreadedTCPServer((host, port), TCPHandler)
 
@@ -353,8 +1296,19 @@ def runServer(host="0.0.0.0", port=None, protocol=Protocol.PLAIN,
   gProfiling = (config.getboolean("debugging", "profiling") or
                 LOGGER.isEnabledFor(logging.DEBUG))
 
+  if publisherPool is not None:
+    publisherPool.start()
+  if coalescer is not None:
+    coalescer.start()
+
   # Serve until there is an interrupt
-  server.serve_forever()
+  try:
+    server.serve_forever()
+  finally:
+    if coalescer is not None:
+      coalescer.stop()
+    if publisherPool is not None:
+      publisherPool.stop()
 
 
 
@@ -365,11 +1319,26 @@ if __name__ == "__main__":
   parser.add_option("--host", default="0.0.0.0")
   parser.add_option("--port", type="int", default=None,
                     help="Default ports (from config): 2003 for plaintext, "
-                         "2004 for pickle")
+                         "2004 for pickle, 2005 for msgpack")
   parser.add_option("--protocol", choices=Protocol.values(),
                     default=Protocol.PLAIN)
   parser.add_option("--transport", choices=Transport.values(),
                     default=Transport.TCP)
+  parser.add_option("--concurrency", choices=Concurrency.values(),
+                    default=Concurrency.THREADED,
+                    help="threaded: a thread per connection; eventloop: a "
+                         "single thread for all connections")
+  parser.add_option("--publishers", type="int",
+                    default=_DEFAULT_NUM_PUBLISHERS,
+                    help="Number of shared message bus publishers in "
+                         "eventloop mode or with --udp-coalesce")
+  parser.add_option("--udp-coalesce", action="store_true", default=False,
+                    dest="udpCoalesce",
+                    help="Publish UDP samples in batches of up to %d samples "
+                         "or %d ms over shared message bus connections" % (
+                           _UDP_COALESCE_MAX_SAMPLES,
+                           _UDP_COALESCE_MAX_DELAY_SEC * 1000))
   options, _ = parser.parse_args()
 
-  runServer(options.host, options.port, options.protocol, options.transport)
+  runServer(options.host, options.port, options.protocol, options.transport,
+            options.concurrency, options.publishers, options.udpCoalesce)
@@ -24,29 +24,34 @@
 
 This process is designed work in parallel with metric_listener for accepting
 metrics and adding them to the database.
-
-TODO: Get just the values for metrics from the database that we need instead
-of the entire rows. We might only need the `uid`.
 """
 
-from collections import defaultdict
+from collections import namedtuple, OrderedDict
 import datetime
 import itertools
 import json
 import logging
+import multiprocessing
+import optparse
 import os
 import time
+import zlib
 
 from htmengine import (raiseExceptionOnMissingRequiredApplicationConfigPath,
                        repository)
 from htmengine.adapters.datasource import createCustomDatasourceAdapter
 import htmengine.exceptions
 from htmengine.htmengine_logging import getExtendedLogger
-from htmengine.runtime.metric_listener import parsePlaintext, Protocol
+from htmengine.runtime.metric_listener import (parseMsgpackBatch,
+                                               parsePlaintext,
+                                               Protocol)
 from htmengine.runtime.metric_streamer_util import MetricStreamer
 from htmengine.model_swapper.model_swapper_interface import (
     MessageBusConnector, ModelSwapperInterface)
+from htmengine.repository import schema
+from htmengine.utils import getConsistentHashPartition
 
+from nta.utils import amqp
 from nta.utils.config import Config
 from nta.utils.logging_support_raw import LoggingSupport
 
@@ -54,29 +59,536 @@ from nta.utils.logging_support_raw import LoggingSupport
 
 LOGGER = getExtendedLogger(__name__)
 
-MAX_CACHED_METRICS = 15000
-CACHED_METRICS_TO_KEEP = 10000
+MAX_CACHED_METRICS = 100000
 MAX_MESSAGES_PER_BATCH = 200
 POLL_DELAY_SEC = 1
 
-# Dict mapping metric name to [metric, lastAccessedDatetime]
+# Max seconds to wait for a partition worker process to exit on shutdown
+_PARTITION_WORKER_JOIN_TIMEOUT_SEC = 30
+
+# _MetricCache of the custom metrics
 gCustomMetrics = None
 
+# Metric columns cached in _MetricCache
+_CACHED_METRIC_FIELDS = (schema.metric.c.name,
+                         schema.metric.c.uid)
+
 
 gProfiling = False
 
 
 
+CachedMetric = namedtuple("CachedMetric", "uid")
+
+
+
+class _MetricCache(object):
+  """ LRU cache of custom metrics keyed by metric name.
+
+  Only the metric fields that the storer needs are cached, as `CachedMetric`
+  objects, so that the cache can hold all of a large deployment's metrics.
+  Lookups, insertions and evictions are O(1).
+  """
+
+  def __init__(self, maxSize):
+    """
+    :param int maxSize: max number of cached metrics; the least recently used
+      metrics are evicted beyond that
+    """
+    self._maxSize = maxSize
+
+    # Map of metric name to CachedMetric ordered from least to most recently
+    # used
+    self._metrics = OrderedDict()
+
+    # Map of metric uid to metric name for invalidation
+    self._namesByUid = dict()
+
+
+  def __len__(self):
+    return len(self._metrics)
+
+
+  def __contains__(self, metricName):
+    return metricName in self._metrics
+
+
+  def names(self):
+    """
+    :returns: cached metric names ordered from least to most recently used
+    """
+    return self._metrics.keys()
+
+
+  def get(self, metricName):
+    """ Get a cached metric and mark it most recently used
+
+    :param metricName: metric name
+    :returns: the CachedMetric or None if not cached
+    """
+    metric = self._metrics.pop(metricName, None)
+    if metric is not None:
+      self._metrics[metricName] = metric
+    return metric
+
+
+  def put(self, metricName, uid):
+    """ Cache a metric as the most recently used one, replacing the metric's
+    previously-cached entry, if any, and evicting the least recently used
+    metric when the cache is full
+
+    :param metricName: metric name
+    :param uid: unique metric id
+    :returns: the new CachedMetric
+    """
+    self.remove(metricName)
+
+    metric = self._metrics[metricName] = CachedMetric(uid=uid)
+    self._namesByUid[uid] = metricName
+
+    if len(self._metrics) > self._maxSize:
+      _evictedName, evicted = self._metrics.popitem(last=False)
+      del self._namesByUid[evicted.uid]
+
+    return metric
+
+
+  def load(self, metricRows):
+    """ Cache the given metrics, such as from a bulk query at startup
+
+    :param metricRows: iterable of rows with name and uid attributes
+    """
+    for row in metricRows:
+      self.put(row.name, row.uid)
+
+
+  def remove(self, metricName):
+    """ Remove a metric from the cache, if cached """
+    metric = self._metrics.pop(metricName, None)
+    if metric is not None:
+      del self._namesByUid[metric.uid]
+
+
+  def invalidate(self, uid):
+    """ Remove a metric from the cache by uid, if cached
+
+    :param uid: unique metric id
+    """
+    metricName = self._namesByUid.get(uid)
+    if metricName is not None:
+      self.remove(metricName)
+
+
+
+class _MetricCacheInvalidator(object):
+  """ Invalidates cached metrics whose models received command results
+  (e.g., deleteModel), as published on the model command results exchange by
+  AnomalyService, so that their uid is looked up again.
+
+  NOTE: only model command results are published on that exchange, so the
+  private queue is normally empty and poll() costs a single round trip.
+  """
+
+  def __init__(self, metricCache, exchangeName):
+    """
+    :param _MetricCache metricCache: cache to invalidate
+    :param str exchangeName: name of the model command results fanout exchange
+    """
+    self._metricCache = metricCache
+    self._exchangeName = exchangeName
+    self._amqpClient = None
+    self._queueName = None
+
+
+  def __enter__(self):
+    self.open()
+    return self
+
+
+  def __exit__(self, *args):
+    self.close()
+
+
+  def open(self):
+    """ Connect to the message bus and subscribe to the model command results
+    exchange
+    """
+    self._amqpClient = amqp.synchronous_amqp_client.SynchronousAmqpClient(
+      amqp.connection.getRabbitmqConnectionParameters())
+    try:
+      self._amqpClient.declareExchange(self._exchangeName,
+                                       exchangeType="fanout",
+                                       durable=True)
+      # Private queue that goes away with our connection
+      self._queueName = self._amqpClient.declareQueue(
+        "", exclusive=True, autoDelete=True).queue
+      self._amqpClient.bindQueue(queue=self._queueName,
+                                 exchange=self._exchangeName,
+                                 routingKey="")
+    except Exception:
+      self._amqpClient.close()
+      raise
+
+
+  def close(self):
+    """ Disconnect from the message bus; our private queue goes away with the
+    connection
+    """
+    self._amqpClient.close()
+
+
+  def poll(self):
+    """ Apply all pending model command results to the cache
+
+    :returns: number of invalidated metric uids
+    """
+    numInvalidated = 0
+    while True:
+      message = self._amqpClient.getOneMessage(self._queueName, noAck=True)
+      if message is None:
+        return numInvalidated
+
+      if self.handleMessage(message):
+        numInvalidated += 1
+
+
+  def handleMessage(self, message):
+    """ Invalidate the cached metric of a model command result message;
+    ignores other messages
+
+    :returns: True if the message was a model command result
+    """
+    headers = message.properties.headers
+    if not headers or headers.get("dataType") != "model-cmd-result":
+      return False
+
+    # See AnomalyService.deserializeModelResult
+    commandResult = json.loads(zlib.decompress(message.body))
+    LOGGER.debug("Invalidating cached metric=%s on command result method=%s",
+                 commandResult["modelId"], commandResult["method"])
+    self._metricCache.invalidate(commandResult["modelId"])
+    return True
+
+
+
+def _getMetricPartition(metricName, numPartitions):
+  """ Map a metric name to a partition; see
+  `htmengine.utils.getConsistentHashPartition`
+
+  :param metricName: metric name
+  :param int numPartitions: number of partitions
+
+  :returns: partition index in [0, numPartitions)
+  """
+  return getConsistentHashPartition(metricName, numPartitions)
+
+
+
+class _PartitionWorkerError(Exception):
+  """ A partition worker process failed """
+  pass
+
+
+
+class _PartitionedMetricDataWriter(object):
+  """ Stores metric data using a pool of worker processes, each of which owns a
+  fixed partition of the metric names (see `_getMetricPartition`) and has its
+  own database engine, MetricStreamer and ModelSwapperInterface.
+
+  A given metric's samples are always handled by the same worker and
+  `addMetricData` doesn't return until every worker involved in a batch has
+  finished it, so per-metric ordering is preserved and the caller may ack the
+  batch's messages as soon as `addMetricData` returns.
+
+  Workers must be started before the parent process opens any database
+  connections, so they don't inherit its connection pool.
+  """
+
+  def __init__(self, numWorkers):
+    """
+    :param int numWorkers: number of worker processes; at least 2
+    """
+    if numWorkers < 2:
+      raise ValueError("numWorkers must be at least 2, but got %r" %
+                       (numWorkers,))
+
+    self._numWorkers = numWorkers
+    self._workers = []
+
+
+  def start(self):
+    for i in xrange(self._numWorkers):
+      conn, workerConn = multiprocessing.Pipe()
+      process = multiprocessing.Process(
+        target=_runPartitionWorker,
+        name="MetricStorerPartition-%d" % (i,),
+        args=(i, self._numWorkers, workerConn))
+      process.daemon = True
+      process.start()
+      workerConn.close()
+      self._workers.append((process, conn))
+
+    LOGGER.info("Started %d metric storer partition workers", self._numWorkers)
+
+
+  def stop(self):
+    for process, conn in self._workers:
+      try:
+        conn.send(None)
+      except (EOFError, IOError):
+        pass
+
+    for process, conn in self._workers:
+      process.join(_PARTITION_WORKER_JOIN_TIMEOUT_SEC)
+      if process.is_alive():
+        LOGGER.error("Terminating unresponsive partition worker=%s",
+                     process.name)
+        process.terminate()
+      conn.close()
+
+    self._workers = []
+
+
+  def addMetricData(self, batchColumns):
+    """ Store the batch's metric data and stream it to models; returns after all
+    partitions of the batch have been processed
+
+    :param _BatchColumns batchColumns: the data samples grouped by metric
+
+    :raises: _PartitionWorkerError if a worker process failed; it's unknown
+      how much of the batch was stored in that case
+    """
+    busyWorkers = []
+    for (process, conn), partition in itertools.izip(
+        self._workers, batchColumns.partition(self._numWorkers)):
+      if not partition.numSamples:
+        continue
+      try:
+        conn.send(partition)
+      except (EOFError, IOError) as e:
+        raise _PartitionWorkerError("Failed to send batch to worker=%s: %r" %
+                                    (process.name, e))
+      busyWorkers.append((process, conn))
+
+    for process, conn in busyWorkers:
+      try:
+        conn.recv()
+      except (EOFError, IOError) as e:
+        raise _PartitionWorkerError("Lost worker=%s (exitcode=%s): %r" %
+                                    (process.name, process.exitcode, e))
+
+
+
+def _runPartitionWorker(partitionIndex, numPartitions, conn):
+  """ Body of a _PartitionedMetricDataWriter worker process: stores the
+  partitions of batches received over `conn` and replies when each is done.
+
+  :param int partitionIndex: index of the partition owned by this worker
+  :param int numPartitions: total number of partitions
+  :param multiprocessing.Connection conn: connection to the parent process
+  """
+  appConfig = Config("application.conf",
+                     os.environ["APPLICATION_CONFIG_PATH"])
+
+  engine = repository.engineFactory(appConfig)
+  global gCustomMetrics
+  gCustomMetrics = _MetricCache(MAX_CACHED_METRICS)
+
+  with engine.connect() as dbConn:
+    gCustomMetrics.load(
+      m for m in repository.getCustomMetrics(dbConn,
+                                             fields=_CACHED_METRIC_FIELDS)
+      if _getMetricPartition(m.name, numPartitions) == partitionIndex)
+
+  LOGGER.info("Partition worker %d of %d started with %d cached metrics",
+              partitionIndex, numPartitions, len(gCustomMetrics))
+
+  invalidator = _MetricCacheInvalidator(
+    gCustomMetrics,
+    appConfig.get("metric_streamer", "command_results_exchange_name"))
+  del appConfig
+
+  invalidator.open()
+  metricStreamer = MetricStreamer()
+  modelSwapper = ModelSwapperInterface()
+  try:
+    while True:
+      batchColumns = conn.recv()
+      if batchColumns is None:
+        break
+
+      try:
+        invalidator.poll()
+        _addMetricData(engine, batchColumns, metricStreamer, modelSwapper)
+      except Exception:  # pylint: disable=W0703
+        LOGGER.exception("Unknown failure in processing partition=%d of batch",
+                         partitionIndex)
+
+      conn.send(True)
+  finally:
+    invalidator.close()
+    modelSwapper.close()
+
+
+
+class _BatchColumns(object):
+  """ Data samples of a storer batch grouped by metric name into per-metric
+  columns of float values and float unix timestamps, built in a single pass
+  over the messages' rows.
+
+  datetime timestamps are only built by `getMetricData`, once a metric's
+  samples are about to be stored, and samples with equal unix timestamps (the
+  common case for metrics that are collected together) share one datetime
+  object.
+  """
+
+  def __init__(self):
+    # Map of metric name to (values, timestamps) pair of lists
+    self._columns = dict()
+
+    # Map of unix timestamp to naive UTC datetime.datetime
+    self._datetimes = dict()
+
+    self.numSamples = 0
+
+
+  def __len__(self):
+    """ Number of metrics """
+    return len(self._columns)
+
+
+  def metricNames(self):
+    return self._columns.keys()
+
+
+  def _getColumn(self, metricName):
+    try:
+      return self._columns[metricName]
+    except KeyError:
+      column = self._columns[metricName] = ([], [])
+      return column
+
+
+  def addPlaintextRows(self, rows, rxTime=None):
+    """ Parse and add plaintext data samples; see
+    `metric_listener.parsePlaintext` for the format. Rows that can't be parsed
+    are logged and discarded.
+
+    :param rows: sequence of plaintext data samples
+    :param rxTime: message-receive time (from time.time()) if profiling, else
+      None
+    """
+    for row in rows:
+      try:
+        metricName, value, timestamp = row.split()
+        value = float(value)
+        timestamp = float(timestamp)
+      except (AttributeError, TypeError, ValueError):
+        LOGGER.warn("Discarding plaintext message that can't be parsed: %s",
+                    row)
+        continue
+
+      values, timestamps = self._getColumn(metricName)
+      values.append(value)
+      timestamps.append(timestamp)
+      self.numSamples += 1
+
+    if gProfiling and rxTime is not None:
+      for row in rows:
+        try:
+          metricName, _value, metricTimestamp = parsePlaintext(row)
+        except ValueError:
+          continue
+        self._logRx(metricName, metricTimestamp, rxTime)
+
+
+  def addColumns(self, columns, rxTime=None):
+    """ Add data samples from a columnar batch
+
+    :param metric_listener.SampleColumns columns: the samples
+    :param rxTime: message-receive time (from time.time()) if profiling, else
+      None
+    """
+    for metricName, value, timestamp in itertools.izip(*columns):
+      values, timestamps = self._getColumn(metricName)
+      values.append(value)
+      timestamps.append(timestamp)
+
+    self.numSamples += len(columns.names)
+
+    if gProfiling and rxTime is not None:
+      for metricName, timestamp in itertools.izip(columns.names,
+                                                   columns.timestamps):
+        try:
+          metricTimestamp = datetime.datetime.utcfromtimestamp(timestamp)
+        except ValueError:
+          continue
+        self._logRx(metricName, metricTimestamp, rxTime)
+
+
+  @staticmethod
+  def _logRx(metricName, metricTimestamp, rxTime):
+    LOGGER.info(
+      "{TAG:CUSSTR.DATA.RX} metricName=%s; timestamp=%s; rxTime=%.4f",
+      metricName, metricTimestamp.isoformat() + "Z", rxTime)
+
+
+  def partition(self, numPartitions):
+    """ Split the batch by metric name using `_getMetricPartition`
+
+    :param int numPartitions: number of partitions
+
+    :returns: list of numPartitions (possibly empty) _BatchColumns instances
+    """
+    partitions = [_BatchColumns() for _ in xrange(numPartitions)]
+    for metricName, column in self._columns.iteritems():
+      partition = partitions[_getMetricPartition(metricName, numPartitions)]
+      partition._columns[metricName] = column  # pylint: disable=W0212
+      partition.numSamples += len(column[0])
+
+    return partitions
+
+
+  def getMetricData(self, metricName):
+    """ Get a metric's samples in the form that MetricStreamer expects; samples
+    with out-of-range timestamps are logged and discarded.
+
+    :param metricName: name of a metric in this batch
+
+    :returns: (possibly empty) list of (datetime.datetime, float) pairs in the
+      order they were received
+    """
+    datetimes = self._datetimes
+    metricData = []
+    values, timestamps = self._columns[metricName]
+    for value, timestamp in itertools.izip(values, timestamps):
+      try:
+        dt = datetimes[timestamp]
+      except KeyError:
+        try:
+          dt = datetimes[timestamp] = datetime.datetime.utcfromtimestamp(
+            timestamp)
+        except ValueError:
+          LOGGER.warn("Discarding sample with invalid timestamp: %s %s %s",
+                      metricName, value, timestamp)
+          continue
+
+      metricData.append((dt, value))
+
+    return metricData
+
+
+
 def _handleBatch(engine, messages, messageRxTimes, metricStreamer,
-                 modelSwapper):
+                 modelSwapper, partitionedWriter=None):
   """Process a batch of messages from the queue.
 
   This parses the message contents as JSON and uses the 'protocol' field to
-  determine how to parse the 'data' in the message. The data is added to the
+  determine how to parse the 'data' in the message; non-JSON messages are
+  columnar batches from one of the binary protocols. The data is added to the
   database and sent through the metric streamer.
 
-  The Metric objects are cached in gCustomMetrics to minimize database
-  lookups.
+  The metrics are cached in gCustomMetrics to minimize database lookups.
 
   :param engine: SQLAlchemy engine object
   :type engine: sqlalchemy.engine.Engine
@@ -87,92 +599,145 @@ def _handleBatch(engine, messages, messageRxTimes, metricStreamer,
 
   :param metricStreamer: a :class:`MetricStreamer` instance to use
   :param modelSwapper: a :class:`ModelSwapperInterface` instance to use
+  :param partitionedWriter: optional :class:`_PartitionedMetricDataWriter`;
+    if given, it stores the data instead of `metricStreamer` and
+    `modelSwapper`
   """
   # Use the protocol to determine the message format
-  data = []
+  batchColumns = _BatchColumns()
   for m, rxTime in itertools.izip_longest(messages, messageRxTimes):
-    try:
-      message = json.loads(m.body)
-      protocol = message["protocol"]
-      rawData = message["data"]
-    except ValueError:
-      LOGGER.warn("Discarding message with unknown format: %s", m.body)
-      return
+    if m.body.startswith("{"):
+      try:
+        message = json.loads(m.body)
+        protocol = message["protocol"]
+        rawData = message["data"]
+      except ValueError:
+        LOGGER.warn("Discarding message with unknown format: %s", m.body)
+        return
+    else:
+      # Binary columnar message from one of the batch protocols
+      try:
+        rawData = parseMsgpackBatch(m.body)
+        protocol = Protocol.MSGPACK
+      except ValueError:
+        LOGGER.warn("Discarding message with unknown format: %r", m.body)
+        return
+
     if protocol == Protocol.PLAIN:
-      for row in rawData:
-        try:
-          data.append(parsePlaintext(row))
-          if gProfiling and rxTime is not None:
-            metricName, _value, metricTimestamp = data[-1]
-            LOGGER.info(
-              "{TAG:CUSSTR.DATA.RX} metricName=%s; timestamp=%s; rxTime=%.4f",
-              metricName, metricTimestamp.isoformat() + "Z", rxTime)
-        except ValueError:
-          LOGGER.warn("Discarding plaintext message that can't be parsed: %s",
-                      row.strip())
+      batchColumns.addPlaintextRows(rawData, rxTime)
+    elif protocol == Protocol.MSGPACK:
+      batchColumns.addColumns(rawData, rxTime)
     else:
       LOGGER.warn("Discarding message with unknown protocol: %s", protocol)
       return
   # Make sure we got some valid data
-  if not data:
+  if not batchColumns.numSamples:
     return
-  # Create a dict mapping metric name to data list
-  dataDict = defaultdict(list)
-  for record in data:
-    dataDict[record[0]].append(record)
 
   LOGGER.info("Processing %i records for %i models from %i batches.",
-              len(data), len(dataDict), len(messages))
+              batchColumns.numSamples, len(batchColumns), len(messages))
 
   # For each metric, create the metric if it doesn't exist and add the data
-  _addMetricData(engine, dataDict, metricStreamer, modelSwapper)
+  if partitionedWriter is not None:
+    partitionedWriter.addMetricData(batchColumns)
+  else:
+    _addMetricData(engine, batchColumns, metricStreamer, modelSwapper)
 
 
 
-def _addMetricData(engine, dataDict, metricStreamer, modelSwapper):
-  """Send metric data for each metric to the metric streamer.
+def _addMetricData(engine, batchColumns, metricStreamer, modelSwapper):
+  """Send metric data for all metrics to the metric streamer in one
+  multi-metric transaction; falls back to one metric at a time for metrics that
+  weren't found and when the multi-metric transaction fails.
 
-  TODO: document args
+  :param engine: SQLAlchemy engine object
+  :param _BatchColumns batchColumns: the data samples grouped by metric
+  :param metricStreamer: a :class:`MetricStreamer` instance to use
+  :param modelSwapper: a :class:`ModelSwapperInterface` instance to use
   """
-  # For each metric, create the metric if it doesn't exist and add the data
-  for metricName, metricData in dataDict.iteritems():
-    if metricName not in gCustomMetrics:
-      # Metric doesn't exist, create it
-      _addMetric(engine, metricName)
-    else:
-      gCustomMetrics[metricName][1] = datetime.datetime.utcnow()
-    # Add the data
-    metricData = [(dt, value) for _, value, dt in metricData]
+  # For each metric, create the metric if it doesn't exist
+  metricDataByName = dict()
+  metricIDsByName = dict()
+  metricDataByID = dict()
+  for metricName in batchColumns.metricNames():
+    metricData = batchColumns.getMetricData(metricName)
+    if not metricData:
+      continue
+
+    metric = gCustomMetrics.get(metricName)
+    if metric is None:
+      # Metric isn't cached or doesn't exist
+      metric = _addMetric(engine, metricName)
+
+    metricDataByName[metricName] = metricData
+    metricIDsByName[metricName] = metric.uid
+    metricDataByID[metric.uid] = metricData
+
+  if not metricDataByID:
+    return
 
-    try:
-      metricStreamer.streamMetricData(metricData,
-                                      gCustomMetrics[metricName][0].uid,
-                                      modelSwapper)
-    except htmengine.exceptions.ObjectNotFoundError:
+  # Add the data
+  try:
+    missingMetricIDs = set(
+      metricStreamer.streamMultiMetricData(metricDataByID, modelSwapper))
+  except Exception:  # Exception excludes KeyboardInterrupt from supervisor
+    LOGGER.exception("Error adding custom metric data for %d metrics; "
+                     "retrying one metric at a time", len(metricDataByID))
+    for metricName, metricData in metricDataByName.iteritems():
+      _addSingleMetricData(engine, metricName, metricIDsByName[metricName],
+                           metricData, metricStreamer, modelSwapper)
+    return
+
+  for metricName, metricData in metricDataByName.iteritems():
+    if metricIDsByName[metricName] in missingMetricIDs:
       # The metric may have been deleted and re-created, so attempt to update
       # the cache.
-      _addMetric(engine, metricName)
-      try:
-        metricStreamer.streamMetricData(metricData,
-                                        gCustomMetrics[metricName][0].uid,
-                                        modelSwapper)
-      except htmengine.exceptions.ObjectNotFoundError:
-        LOGGER.exception("Failed to add data for metric %s with uid %s",
-                         metricName, gCustomMetrics[metricName][0].uid)
-    except Exception:  # Exception excludes KeyboardInterrupt from supervisor
-      LOGGER.exception("Error adding custom metric data: %r", metricData)
+      metric = _addMetric(engine, metricName)
+      _addSingleMetricData(engine, metricName, metric.uid, metricData,
+                           metricStreamer, modelSwapper)
+
+
+
+def _addSingleMetricData(engine, metricName, metricID, metricData,
+                         metricStreamer, modelSwapper):
+  """Send one metric's data to the metric streamer.
+
+  :param engine: SQLAlchemy engine object
+  :param metricName: metric name
+  :param metricID: unique metric id
+  :param metricData: sequence of (datetime.datetime, float) data samples
+  :param metricStreamer: a :class:`MetricStreamer` instance to use
+  :param modelSwapper: a :class:`ModelSwapperInterface` instance to use
+  """
+  try:
+    metricStreamer.streamMetricData(metricData, metricID, modelSwapper)
+  except htmengine.exceptions.ObjectNotFoundError:
+    # The metric may have been deleted and re-created, so attempt to update
+    # the cache.
+    metricID = _addMetric(engine, metricName).uid
+    try:
+      metricStreamer.streamMetricData(metricData, metricID, modelSwapper)
+    except htmengine.exceptions.ObjectNotFoundError:
+      LOGGER.exception("Failed to add data for metric %s with uid %s",
+                       metricName, metricID)
+  except Exception:  # Exception excludes KeyboardInterrupt from supervisor
+    LOGGER.exception("Error adding custom metric data: %r", metricData)
 
 
 
 def _addMetric(engine, metricName):
-  """Add the new metric to the database."""
-  if metricName in gCustomMetrics:
+  """Add the new metric to the database, or reload the cached metric.
+
+  :returns: the metric's CachedMetric
+  """
+  cachedMetric = gCustomMetrics.get(metricName)
+  if cachedMetric is not None:
     try:
       # Attempt to reload the metric
-      metricId = gCustomMetrics[metricName][0].uid
       with engine.connect() as conn:
-        gCustomMetrics[metricName][0] = repository.getMetric(conn, metricId)
-      return
+        metric = repository.getMetric(conn, cachedMetric.uid,
+                                      fields=_CACHED_METRIC_FIELDS)
+      return gCustomMetrics.put(metricName, metric.uid)
     except htmengine.exceptions.ObjectNotFoundError:
       # Do nothing, we will create new metric and update cache below
       pass
@@ -184,54 +749,86 @@ def _addMetric(engine, metricName):
     metricId = e.uid
 
   with engine.connect() as conn:
-    metric = repository.getMetric(conn, metricId)
+    metric = repository.getMetric(conn, metricId, fields=_CACHED_METRIC_FIELDS)
 
   # Add it to our cache
-  gCustomMetrics[metricName] = [metric, datetime.datetime.utcnow()]
+  return gCustomMetrics.put(metricName, metric.uid)
 
-  _trimMetricCache()
 
+@raiseExceptionOnMissingRequiredApplicationConfigPath
+def runServer(numWorkers=1):
+  """
+  :param int numWorkers: number of processes that store metric data; with
+    more than one, metric names are partitioned across worker processes (see
+    `_PartitionedMetricDataWriter`)
+  """
+  partitionedWriter = None
+  if numWorkers > 1:
+    # Start the workers before creating any database connections, so that they
+    # don't inherit them
+    partitionedWriter = _PartitionedMetricDataWriter(numWorkers)
+    partitionedWriter.start()
 
+  try:
+    _runConsumer(partitionedWriter)
+  finally:
+    if partitionedWriter is not None:
+      partitionedWriter.stop()
 
-def _trimMetricCache():
-  # Make sure we don't have too many cached metrics now
-  if len(gCustomMetrics) > MAX_CACHED_METRICS:
-    # Compute the number of metrics we want to remove
-    numMetricsToRemove = len(gCustomMetrics) - CACHED_METRICS_TO_KEEP
-    # Get a list of metric names sorted by last accessed time
-    metricList = []
-    for name, (_metric, ts) in gCustomMetrics.iteritems():
-      metricList.append((ts, name))
-    metricList.sort()
-    # Remove the metrics accessed least recently
-    for _, name in metricList[:numMetricsToRemove]:
-      del gCustomMetrics[name]
 
 
-@raiseExceptionOnMissingRequiredApplicationConfigPath
-def runServer():
+def _runConsumer(partitionedWriter):
   # Get the current list of custom metrics
   appConfig = Config("application.conf",
                      os.environ["APPLICATION_CONFIG_PATH"])
 
   engine = repository.engineFactory(appConfig)
   global gCustomMetrics
-  now = datetime.datetime.utcnow()
 
-  with engine.connect() as conn:
-    gCustomMetrics = dict(
-      (m.name, [m, now]) for m in repository.getCustomMetrics(conn))
+  if partitionedWriter is None:
+    gCustomMetrics = _MetricCache(MAX_CACHED_METRICS)
+    with engine.connect() as conn:
+      gCustomMetrics.load(
+        repository.getCustomMetrics(conn, fields=_CACHED_METRIC_FIELDS))
+    LOGGER.info("Preloaded %d custom metrics", len(gCustomMetrics))
 
   queueName = appConfig.get("metric_listener", "queue_name")
+  commandResultsExchange = appConfig.get("metric_streamer",
+                                         "command_results_exchange_name")
 
   global gProfiling
   gProfiling = (appConfig.getboolean("debugging", "profiling") or
                 LOGGER.isEnabledFor(logging.DEBUG))
   del appConfig
 
-  metricStreamer = MetricStreamer()
-  modelSwapper = ModelSwapperInterface()
+  if partitionedWriter is None:
+    metricStreamer = MetricStreamer()
+    modelSwapper = ModelSwapperInterface()
+    invalidator = _MetricCacheInvalidator(gCustomMetrics,
+                                          commandResultsExchange)
+    invalidator.open()
+  else:
+    # Partition workers maintain their own metric caches
+    metricStreamer = None
+    modelSwapper = None
+    invalidator = None
+
+  try:
+    _consumeMessages(engine, queueName, metricStreamer, modelSwapper,
+                     partitionedWriter, invalidator)
+  finally:
+    if invalidator is not None:
+      invalidator.close()
+
+
 
+def _consumeMessages(engine, queueName, metricStreamer, modelSwapper,
+                     partitionedWriter, invalidator):
+  """ Consume and store batches of messages from the metric data queue
+
+  :param invalidator: optional _MetricCacheInvalidator of gCustomMetrics to
+    poll before each batch
+  """
   with MessageBusConnector() as bus:
     if not bus.isMessageQeueuePresent(queueName):
       bus.createMessageQueue(mqName=queueName, durable=True)
@@ -250,11 +847,18 @@ def runServer():
           if messages:
             # Process the batch
             try:
+              if invalidator is not None:
+                invalidator.poll()
               _handleBatch(engine,
                            messages,
                            messageRxTimes,
                            metricStreamer,
-                           modelSwapper)
+                           modelSwapper,
+                           partitionedWriter)
+            except _PartitionWorkerError:
+              # Don't ack: the unfinished partitions will be redelivered
+              # after restart
+              raise
             except Exception:  # pylint: disable=W0703
               LOGGER.exception("Unknown failure in processing messages.")
               # Make sure that we ack messages when there is an unexpected error
@@ -274,4 +878,11 @@ def runServer():
 if __name__ == "__main__":
   LoggingSupport.initService()
 
-  runServer()
+  parser = optparse.OptionParser()
+  parser.add_option("--workers", type="int", default=1,
+                    help="Number of processes storing metric data; metrics "
+                         "are partitioned across them by name "
+                         "[default: %default]")
+  options, _ = parser.parse_args()
+
+  runServer(options.workers)
@@ -23,6 +23,7 @@ the anomaly-scoring is handled by AnomalyService, and the MetricCollector and
 AggregatorService instances send data to ModelSwapper directly, as opposed to
 writing data to queue
 """
+from collections import OrderedDict
 import itertools
 import logging
 import os
@@ -48,8 +49,83 @@ config = Config("application.conf", os.environ.get("APPLICATION_CONFIG_PATH"))
 
 
 
+class _TailTimestampCache(object):
+  """ Bounded LRU cache of the tail metric data timestamps of metrics with
+  per-entry expiration.
+
+  Entries are evicted incrementally: the least recently used entry when the
+  cache is full, and expired entries as they are encountered, so that the
+  cached metrics never all fall back to the database at once.
+  """
+
+  # Max number of expired entries to evict at the head of the cache per put
+  _MAX_EXPIRED_EVICTIONS_PER_PUT = 2
+
+
+  def __init__(self, maxSize, ttlSec):
+    """
+    :param int maxSize: max number of cached metrics
+    :param ttlSec: number of seconds for which an entry is valid after it was
+      last put
+    """
+    self._maxSize = maxSize
+    self._ttlSec = ttlSec
+
+    # Map of metric id to (timestamp, expiration time) ordered from least to
+    # most recently used; expiration time is in seconds since unix epoch
+    # (time.time())
+    self._entries = OrderedDict()
+
+
+  def __len__(self):
+    return len(self._entries)
+
+
+  def get(self, metricID):
+    """
+    :returns: the metric's cached tail timestamp; None if not cached or
+      expired
+    :rtype: datetime.datetime or None
+    """
+    entry = self._entries.pop(metricID, None)
+    if entry is None:
+      return None
+
+    timestamp, expiration = entry
+    if expiration <= time.time():
+      return None
+
+    self._entries[metricID] = entry
+    return timestamp
+
+
+  def put(self, metricID, timestamp):
+    """ Cache the metric's tail timestamp as the most recently used entry
+
+    :param metricID: unique metric id
+    :param datetime.datetime timestamp: the metric's tail timestamp
+    """
+    now = time.time()
+    self._entries.pop(metricID, None)
+    self._entries[metricID] = (timestamp, now + self._ttlSec)
+
+    if len(self._entries) > self._maxSize:
+      self._entries.popitem(last=False)
+
+    for _ in xrange(self._MAX_EXPIRED_EVICTIONS_PER_PUT):
+      headMetricID = next(iter(self._entries))
+      if self._entries[headMetricID][1] > now:
+        break
+      del self._entries[headMetricID]
+
+
+
 class MetricStreamer(object):
-  _TAIL_INPUT_TIMESTAMP_GC_INTERVAL_SEC = 7 * 24 * 60 * 60
+  # Number of seconds that a cached tail metric data timestamp remains valid
+  _TAIL_INPUT_TIMESTAMP_TTL_SEC = 7 * 24 * 60 * 60
+
+  # Max number of metrics whose tail metric data timestamps are cached
+  _MAX_CACHED_TAIL_INPUT_TIMESTAMPS = 100000
 
   def __init__(self):
     super(MetricStreamer, self).__init__()
@@ -68,12 +144,12 @@ class MetricStreamer(object):
 
     # Cache of latest metric_data timestamps for each metric; used for filtering
     # out duplicate/re-delivered input metric data so it won't be saved again
-    # in the metric_data table. Each key is a metric id and the corresponding
-    # value is a datetime.datetime timestamp of the last metric_data stored by
-    # us in metric_data table.
-    self._tailInputMetricDataTimestamps = dict()
-    # Last garbage-collection time; seconds since unix epoch (time.time())
-    self._lastTailInputMetricDataTimestampsGCTime = 0
+    # in the metric_data table. Maps metric id to the datetime.datetime
+    # timestamp of the last metric_data stored in metric_data table; updated
+    # write-through by us as we store metric data.
+    self._tailInputMetricDataTimestamps = _TailTimestampCache(
+      maxSize=self._MAX_CACHED_TAIL_INPUT_TIMESTAMPS,
+      ttlSec=self._TAIL_INPUT_TIMESTAMP_TTL_SEC)
 
 
   def _scrubDataSamples(self, data, metricID, conn, lastDataRowID):
@@ -91,10 +167,29 @@ class MetricStreamer(object):
       the scrubbing.
     :rtype: sequence of pairs: (datetime.datetime, float)
     """
+    return self._filterDataSamples(
+      data,
+      metricID,
+      self._getTailMetricRowTimestamp(conn, metricID, lastDataRowID))
+
+
+  def _filterDataSamples(self, data, metricID, tailTimestamp):
+    """ Filter out metric data samples that are out of order or have duplicate
+    timestamps, given the timestamp of the metric's last stored sample.
+
+    :param data: A sequence of data samples; each data sample is a pair:
+                  (datetime.datetime, float)
+    :param metricID: unique metric id
+    :param tailTimestamp: timestamp of the metric's last metric data row; None
+      if none have been stored
+
+    :returns: a (possibly empty) sequence of metric data samples that passed
+      the filtering.
+    :rtype: sequence of pairs: (datetime.datetime, float)
+    """
     passingSamples = []
     rejectedDataTimestamps = []
-    prevSampleTimestamp = self._getTailMetricRowTimestamp(conn, metricID,
-                                                          lastDataRowID)
+    prevSampleTimestamp = tailTimestamp
     for sample in data:
       timestamp, metricValue = sample
       # Filter out those whose timestamp is not newer than previous sampale's
@@ -152,7 +247,7 @@ class MetricStreamer(object):
       rows = repository.addMetricData(conn, metricID, data)
 
       # Update tail metric data timestamp cache for metrics stored by us
-      self._tailInputMetricDataTimestamps[metricID] = rows[-1]["timestamp"]
+      self._tailInputMetricDataTimestamps.put(metricID, rows[-1]["timestamp"])
 
       # Add newly-stored records to batch for sending to CLA model
       modelInputRows = tuple(
@@ -191,32 +286,41 @@ class MetricStreamer(object):
         metric_data table for the given metric id, or None if none have been
         stored
     :rtype: datetime.datetime or None
-
-    TODO: unit-test
     """
-    if (time.time() - self._lastTailInputMetricDataTimestampsGCTime >
-        self._TAIL_INPUT_TIMESTAMP_GC_INTERVAL_SEC):
-      # Garbage-collect our cache
-      # TODO: unit-test
-      self._tailInputMetricDataTimestamps.clear()
-      self._lastTailInputMetricDataTimestampsGCTime = time.time()
-      self._log.info("Garbage-collected tailInputMetricDataTimestamps cache")
+    return self._getTailMetricRowTimestamps(
+      conn, {metricID: lastDataRowID}).get(metricID)
+
 
-    timestamp = None
-    try:
+  def _getTailMetricRowTimestamps(self, conn, lastDataRowIDs):
+    """ Multi-metric version of `_getTailMetricRowTimestamp`: the timestamps
+    that aren't cached are loaded from db in one query
+
+    :param sqlalchemy.engine.Connection conn: A sqlalchemy connection object
+    :param lastDataRowIDs: A dict mapping unique metric id to the metric's last
+      metric data row identifier; None if the metric has no data
+
+    :returns: A dict mapping metric id to the timestamp of the metric's last
+      metric data row; metrics without metric data rows are omitted
+    """
+    timestamps = dict()
+    missingRowIDs = dict()
+    for metricID, lastDataRowID in lastDataRowIDs.iteritems():
       # First try to get it from cache
-      timestamp = self._tailInputMetricDataTimestamps[metricID]
-    except KeyError:
-      # Not in cache, so try to load it from db
-      rows = repository.getMetricData(conn,
-                                      metricID,
-                                      rowid=lastDataRowID)
+      timestamp = self._tailInputMetricDataTimestamps.get(metricID)
+      if timestamp is not None:
+        timestamps[metricID] = timestamp
+      elif lastDataRowID is not None:
+        missingRowIDs[metricID] = lastDataRowID
 
-      if rows.rowcount > 0 and rows.returns_rows:
-        timestamp = next(iter(rows)).timestamp
-        self._tailInputMetricDataTimestamps[metricID] = timestamp
+    if missingRowIDs:
+      # Not in cache, so load them from db
+      loadedTimestamps = repository.getMetricDataTimestamps(conn,
+                                                            missingRowIDs)
+      for metricID, timestamp in loadedTimestamps.iteritems():
+        self._tailInputMetricDataTimestamps.put(metricID, timestamp)
+      timestamps.update(loadedTimestamps)
 
-    return timestamp
+    return timestamps
 
 
   def streamMetricData(self, data, metricID, modelSwapper):
@@ -295,6 +399,174 @@ class MetricStreamer(object):
      datasource,
      metricStatus) = storeDataWithRetries()
 
+    self._forwardStoredRows(modelInputRows, metricID, datasource, metricStatus,
+                            modelSwapper)
+
+
+  def streamMultiMetricData(self, dataByMetric, modelSwapper):
+    """ Multi-metric version of `streamMetricData`: store the data samples of
+    several metrics in metric_data table in a single transaction, then stream
+    them to the metrics' models as needed.
+
+    All affected metric rows are locked with one SELECT ... FOR UPDATE, their
+    rowids are allocated with one UPDATE and all of their data rows are stored
+    with one multi-row INSERT, so the number of database round-trips doesn't
+    depend on the number of metrics.
+
+    :param dataByMetric: A dict mapping unique metric id to a sequence of data
+      samples; each data sample is a pair: (datetime.datetime, float)
+
+    :param modelSwapper: ModelSwapper object for sending data to models
+    :type modelSwapper: an instance of ModelSwapperInterface
+
+    :returns: a (possibly empty) sequence of the metric ids that weren't found;
+      their data samples were not stored
+    """
+    dataByMetric = dict((metricID, data)
+                        for metricID, data in dataByMetric.iteritems()
+                        if data)
+    if not dataByMetric:
+      self._log.warn("Empty multi-metric input data batch")
+      return ()
+
+    @repository.retryOnTransientErrors
+    def storeDataWithRetries():
+      """
+      :returns: a two-tuple <results, missingMetricIDs>; results: a list of
+        four-tuples <metricID, modelInputRows, datasource, metricStatus> for
+        metrics in state suitable for streaming, where modelInputRows is a
+        (possibly empty) tuple of ModelInputRow objects corresponding to the
+        samples that were stored, ordered by rowid
+      """
+      with repository.engineFactory(config).connect() as conn:
+        with conn.begin():
+          # Syncrhonize with adapter's monitorMetric
+          metricObjs = repository.getMetricsWithUpdateLock(
+            conn,
+            dataByMetric.keys(),
+            fields=[schema.metric.c.uid,
+                    schema.metric.c.status,
+                    schema.metric.c.last_rowid,
+                    schema.metric.c.datasource])
+
+          missingMetricIDs = set(dataByMetric.keys())
+          streamableMetricObjs = []
+          for metricObj in metricObjs:
+            missingMetricIDs.discard(metricObj.uid)
+            if (metricObj.status != MetricStatus.UNMONITORED and
+                metricObj.status != MetricStatus.ACTIVE and
+                metricObj.status != MetricStatus.PENDING_DATA and
+                metricObj.status != MetricStatus.CREATE_PENDING):
+              self._log.error("Can't stream: metric=%s has unexpected "
+                              "status=%s", metricObj.uid, metricObj.status)
+            else:
+              streamableMetricObjs.append(metricObj)
+
+          # Load the tail timestamps of all metrics in one query as needed
+          tailTimestamps = self._getTailMetricRowTimestamps(
+            conn,
+            dict((metricObj.uid, metricObj.last_rowid)
+                 for metricObj in streamableMetricObjs))
+
+          passingSamplesByMetric = dict()
+          for metricObj in streamableMetricObjs:
+            passingSamples = self._filterDataSamples(
+              dataByMetric[metricObj.uid],
+              metricObj.uid,
+              tailTimestamps.get(metricObj.uid))
+            if passingSamples:
+              passingSamplesByMetric[metricObj.uid] = passingSamples
+
+          modelInputRowsByMetric = self._storeMultiMetricDataSamples(
+            passingSamplesByMetric,
+            dict((metricObj.uid, metricObj.last_rowid)
+                 for metricObj in streamableMetricObjs),
+            conn)
+
+      results = [
+        (metricObj.uid,
+         modelInputRowsByMetric.get(metricObj.uid, tuple()),
+         metricObj.datasource,
+         metricObj.status)
+        for metricObj in streamableMetricObjs]
+
+      return results, missingMetricIDs
+
+
+    results, missingMetricIDs = storeDataWithRetries()
+
+    # Update tail metric data timestamp cache for metrics stored by us only
+    # now that the transaction is committed, so that a rolled back or retried
+    # transaction doesn't leave timestamps of data that isn't stored
+    for metricID, modelInputRows, _datasource, _metricStatus in results:
+      if modelInputRows:
+        self._tailInputMetricDataTimestamps.put(metricID,
+                                                modelInputRows[-1].data[0])
+
+    for metricID, modelInputRows, datasource, metricStatus in results:
+      try:
+        self._forwardStoredRows(modelInputRows, metricID, datasource,
+                                metricStatus, modelSwapper)
+      except Exception:  # pylint: disable=W0703
+        # The data is stored already, so don't let one metric's model
+        # interfere with the others
+        self._log.exception("Failed to forward stored rows of metric=%s",
+                            metricID)
+
+    if missingMetricIDs:
+      self._log.warn("Metrics not found: %s", sorted(missingMetricIDs))
+
+    return tuple(missingMetricIDs)
+
+
+  def _storeMultiMetricDataSamples(self, dataByMetric, lastRowids, conn):
+    """ Store the given metrics' data samples in metric_data table
+
+    :param dataByMetric: A dict mapping unique metric id to a non-empty
+      sequence of data samples; each data sample is a pair:
+      (datetime.datetime, float)
+    :param lastRowids: A dict mapping each metric id in dataByMetric to its
+      last_rowid, as read under the update lock held in `conn`'s transaction
+    :param sqlalchemy.engine.Connection conn: A sqlalchemy connection object
+
+    :returns: A dict mapping metric id to the tuple of ModelInputRow objects
+      corresponding to the samples that were stored; ordered by rowid
+    """
+    if not dataByMetric:
+      return dict()
+
+    # repository.addMultiMetricData expects samples as pairs of
+    # (value, timestamp)
+    rowsByMetric = repository.addMultiMetricData(
+      conn,
+      dict((metricID, tuple((value, ts) for (ts, value) in data))
+           for metricID, data in dataByMetric.iteritems()),
+      lastRowids)
+
+    modelInputRowsByMetric = dict()
+    for metricID, rows in rowsByMetric.iteritems():
+      # Add newly-stored records to batch for sending to CLA model
+      modelInputRowsByMetric[metricID] = tuple(
+        ModelInputRow(rowID=row["rowid"],
+                      data=(row["timestamp"], row["metric_value"],))
+        for row in rows)
+
+    return modelInputRowsByMetric
+
+
+  def _forwardStoredRows(self, modelInputRows, metricID, datasource,
+                         metricStatus, modelSwapper):
+    """ Stream newly-stored rows to the metric's model if it's active, or
+    activate the model if the metric has been waiting for enough data
+
+    :param modelInputRows: None if the metric was in a state not suitable for
+      streaming; otherwise a (possibly empty) tuple of ModelInputRow objects
+      corresponding to the samples that were stored; ordered by rowid
+    :param metricID: unique id of the HTM metric
+    :param datasource: the metric's datasource
+    :param metricStatus: the metric's status at the time of storage
+    :param modelSwapper: ModelSwapper object for sending data to models
+    """
     if modelInputRows is None:
       # Metric was in state not suitable for streaming
       return
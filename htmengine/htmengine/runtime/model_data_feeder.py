@@ -23,6 +23,7 @@
 Utilities for feeding metric data to models
 """
 
+import sys
 import time
 
 from htmengine.model_swapper import model_swapper_interface
@@ -49,39 +50,63 @@ def sendInputRowsToModel(modelId, inputRows, batchSize,
   """
   logger.debug("Streaming numRecords=%d to model=%s", len(inputRows), modelId)
 
-  # Stream data to HTM model in batches
-  for batch in (inputRows[i:i+batchSize] for i in
-                xrange(0, len(inputRows), batchSize)):
-    if profiling:
-      submitStartTime = time.time()
-
-    try:
-      batchID = modelSwapper.submitRequests(modelId, batch)
-    except model_swapper_interface.ModelNotFound as ex:
-      # Likely a race-condition with the app layer's model deletion code path
-      # TODO: unit-test
-      logger.warning("model=%s not found from submitRequests; "
-                     "race-condition with model deletion path? %r", modelId, ex)
-      return
-    except:
-      # TODO: unit-test
-      logger.exception(
-        "Error submitting batch to model=%s; numRows=%d; rows=[%s]",
-        modelId,
-        len(batch),
-        (("%s:%s" % (batch[0].rowID, batch[-1].rowID))
-         if len(batch) > 1 else batch[0].rowID))
-      raise
-    else:
+  # Model Scheduler is notified once after the batches are submitted instead of
+  # once per batch, including when only some of the batches were submitted
+  # before a failure
+  numSubmittedBatches = 0
+  try:
+    # Stream data to HTM model in batches
+    for batch in (inputRows[i:i+batchSize] for i in
+                  xrange(0, len(inputRows), batchSize)):
       if profiling:
-        headTS = batch[0].data[0]
-        tailTS = batch[-1].data[0]
-        logger.info(
-          "{TAG:STRM.DATA.TO_MODEL.DONE} Submitted batch=%s to "
-          "model=%s; numRows=%d; rows=[%s]; ts=[%s]; duration=%.4fs",
-          batchID, modelId, len(batch),
-          (("%s..%s" % (batch[0].rowID, batch[-1].rowID))
-            if len(batch) > 1 else batch[0].rowID),
-          (("%sZ..%sZ" % (headTS.isoformat(), tailTS.isoformat()))
-            if len(batch) > 1 else (headTS.isoformat() + "Z")),
-          time.time() - submitStartTime)
+        submitStartTime = time.time()
+
+      try:
+        batchID = modelSwapper.submitRequests(modelId, batch,
+                                              notifyScheduler=False)
+      except model_swapper_interface.ModelNotFound as ex:
+        # Likely a race-condition with the app layer's model deletion code path
+        # TODO: unit-test
+        logger.warning("model=%s not found from submitRequests; "
+                       "race-condition with model deletion path? %r",
+                       modelId, ex)
+        break
+      except:
+        # TODO: unit-test
+        logger.exception(
+          "Error submitting batch to model=%s; numRows=%d; rows=[%s]",
+          modelId,
+          len(batch),
+          (("%s:%s" % (batch[0].rowID, batch[-1].rowID))
+           if len(batch) > 1 else batch[0].rowID))
+        raise
+      else:
+        numSubmittedBatches += 1
+
+        if profiling:
+          headTS = batch[0].data[0]
+          tailTS = batch[-1].data[0]
+          logger.info(
+            "{TAG:STRM.DATA.TO_MODEL.DONE} Submitted batch=%s to "
+            "model=%s; numRows=%d; rows=[%s]; ts=[%s]; duration=%.4fs",
+            batchID, modelId, len(batch),
+            (("%s..%s" % (batch[0].rowID, batch[-1].rowID))
+              if len(batch) > 1 else batch[0].rowID),
+            (("%sZ..%sZ" % (headTS.isoformat(), tailTS.isoformat()))
+              if len(batch) > 1 else (headTS.isoformat() + "Z")),
+            time.time() - submitStartTime)
+  except:
+    if numSubmittedBatches:
+      et, ei, tb = sys.exc_info()
+      # Don't let a notification failure mask the original exception
+      try:
+        modelSwapper.notifyModelScheduler(modelId)
+      except Exception:  # pylint: disable=W0703
+        logger.exception("Failed to notify Model Scheduler of input for "
+                         "model=%s after submission error", modelId)
+      raise et, ei, tb
+
+    raise
+
+  if numSubmittedBatches:
+    modelSwapper.notifyModelScheduler(modelId)
@@ -19,9 +19,11 @@
 # http://numenta.org/licenses/
 # ----------------------------------------------------------------------
 import datetime
+import hashlib
 import json
 import math
 import msgpack
+import struct
 import time
 import uuid
 import validictory
@@ -118,6 +120,28 @@ def roundUpDatetime(dt, periodSec):
 
 
 
+def getConsistentHashPartition(key, numPartitions):
+  """ Map a key to a partition using jump consistent hashing (Lamping and
+  Veach); a key always maps to the same partition for a given number of
+  partitions, and changing that number only moves the minimum number of keys.
+
+  :param key: string key (e.g., metric name or model id)
+  :param int numPartitions: number of partitions
+
+  :returns: partition index in [0, numPartitions)
+  """
+  (key,) = struct.unpack_from("<Q", hashlib.md5(key).digest())
+  bucket = -1
+  candidate = 0
+  while candidate < numPartitions:
+    bucket = candidate
+    key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+    candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+
+  return bucket
+
+
+
 # Convenience function to specify default/standard arguments to json.loads
 jsonDecode = partial(json.loads, object_hook=_jsonDecodeDictUTF8)
 
@@ -141,6 +141,25 @@ class ModelRunnerIntTestCase(unittest.TestCase):
                        msg=repr(waitResult))
 
 
+  @classmethod
+  def _loadLoggedInputSamples(cls, checkpointMgr, modelID, attrs):
+    """ Load the input samples from the model checkpoint's sample log
+
+    :returns: list of input samples
+    """
+    numSamples = attrs[
+      model_runner._ModelArchiver._INPUT_SAMPLE_LOG_SIZE_ATTR_NAME]
+
+    sampleLog = checkpointMgr.mapCheckpointLog(
+      modelID,
+      size=numSamples * model_runner._ModelArchiver._SAMPLE_LOG_DTYPE.itemsize)
+    try:
+      return list(model_runner._ModelArchiver._iterLoggedDataSamples(
+        sampleLog, count=numSamples))
+    finally:
+      sampleLog.close()
+
+
   def testRunModelWithFullThenIncrementalCheckpoints(self):
     # Have model_runner create a full checkpoint, then incremental checkpoint
     modelID = "foobar"
@@ -265,14 +284,12 @@ class ModelRunnerIntTestCase(unittest.TestCase):
         attrs[model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME],
         [inputBatchID], msg=repr(attrs))
 
-      self.assertIn(
+      self.assertNotIn(
         model_runner._ModelArchiver._INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME,
         attrs, msg=repr(attrs))
 
       self.assertSequenceEqual(
-        model_runner._ModelArchiver._decodeDataSamples(
-          attrs[model_runner._ModelArchiver.
-                _INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME]),
+        self._loadLoggedInputSamples(checkpointMgr, modelID, attrs),
         [row.data for row in inputRows2], msg=repr(attrs))
 
       # Final run with incremental checkpointing
@@ -316,13 +333,11 @@ class ModelRunnerIntTestCase(unittest.TestCase):
         attrs[model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME],
         [inputBatchID], msg=repr(attrs))
 
-      self.assertIn(
+      self.assertNotIn(
         model_runner._ModelArchiver._INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME,
         attrs, msg=repr(attrs))
       self.assertSequenceEqual(
-        model_runner._ModelArchiver._decodeDataSamples(
-          attrs[model_runner._ModelArchiver.
-                _INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME]),
+        self._loadLoggedInputSamples(checkpointMgr, modelID, attrs),
         [row.data for row in itertools.chain(inputRows2, inputRows3)],
         msg=repr(attrs))
 
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Benchmark of BatchPackager formats on the model request and result batches that
+flow between metric storer, model runner and anomaly service: reports encoding
+and decoding time and message size per 1000 items for each format.
+
+Usage: python batch_packager_benchmark.py [--rows=N] [--repeat=N]
+"""
+
+import datetime
+from optparse import OptionParser
+import random
+import timeit
+
+from htmengine.model_swapper.model_swapper_interface import (
+  BatchPackager,
+  ModelInferenceResult,
+  ModelInputRow)
+
+
+
+def _generateInputRows(numRows):
+  start = datetime.datetime(2015, 1, 1)
+  return [
+    ModelInputRow(rowID=i + 1,
+                  data=(start + datetime.timedelta(minutes=5 * i),
+                        random.uniform(0, 100)))
+    for i in xrange(numRows)
+  ]
+
+
+
+def _generateInferenceResults(numRows):
+  return [
+    ModelInferenceResult(rowID=i + 1, status=0, anomalyScore=random.random())
+    for i in xrange(numRows)
+  ]
+
+
+
+def _benchmark(batch, batchFormat, repeat):
+  """
+  :returns: three-tuple (encodeSec, decodeSec, sizeBytes) per 1000 items
+  """
+  batchState = BatchPackager.marshal(batch, batchFormat=batchFormat)
+
+  scale = 1000.0 / len(batch)
+
+  encodeSec = min(timeit.repeat(
+    lambda: BatchPackager.marshal(batch, batchFormat=batchFormat),
+    repeat=repeat, number=1))
+
+  decodeSec = min(timeit.repeat(
+    lambda: BatchPackager.unmarshal(batchState),
+    repeat=repeat, number=1))
+
+  return encodeSec * scale, decodeSec * scale, len(batchState) * scale
+
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option("--rows", type="int", default=10000,
+                    help="Number of items per batch [default: %default]")
+  parser.add_option("--repeat", type="int", default=10,
+                    help="Number of timed repetitions; the fastest is "
+                         "reported [default: %default]")
+  options, _args = parser.parse_args()
+
+  batches = (
+    ("input rows", _generateInputRows(options.rows)),
+    ("inference results", _generateInferenceResults(options.rows)),
+  )
+
+  print "Per 1000 items; batch size=%d; best of %d" % (options.rows,
+                                                        options.repeat)
+  print "%-18s %-8s %12s %12s %12s" % ("batch", "format", "encode (ms)",
+                                       "decode (ms)", "size (bytes)")
+  for batchName, batch in batches:
+    for batchFormat in (BatchPackager.JSON_FORMAT,
+                        BatchPackager.MSGPACK_FORMAT):
+      encodeSec, decodeSec, size = _benchmark(batch, batchFormat,
+                                              options.repeat)
+      print "%-18s %-8s %12.3f %12.3f %12d" % (
+        batchName, batchFormat, encodeSec * 1000, decodeSec * 1000, size)
+
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Benchmark of ModelCheckpointMgr.save with per-file fsync versus group commit:
+N concurrent processes, like ModelRunners in N model slots, each repeatedly
+checkpoint their own model; reports checkpoint throughput and latency for each
+mode.
+
+The benchmark directory should be on the filesystem of the model checkpoint
+archive; fsync is nearly free on tmpfs, so /tmp may not be representative.
+
+Usage: python checkpoint_group_commit_benchmark.py [--dir=PATH]
+  [--processes=N] [--checkpoints=N] [--files=N] [--file-kb=N]
+"""
+
+import multiprocessing
+from optparse import OptionParser
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from nta.utils.test_utils.config_test_utils import ConfigAttributePatch
+
+from htmengine.model_checkpoint_mgr.model_checkpoint_mgr import (
+  ModelCheckpointConfig,
+  ModelCheckpointMgr)
+
+
+
+class _FakeModel(object):
+  """ Stands in for an OPF model: saves a model.pkl and network files, like
+  a model's modelextradata tree, of which only the first one changes between
+  checkpoints
+  """
+
+  def __init__(self, numFiles, fileSize):
+    self._fileSize = fileSize
+    self._unchangedFiles = [os.urandom(fileSize) for _ in xrange(numFiles - 1)]
+
+
+  def save(self, saveModelDir):
+    networkDir = os.path.join(saveModelDir, "modelextradata", "network.nta")
+    os.makedirs(networkDir)
+
+    with open(os.path.join(saveModelDir, "model.pkl"), "wb") as fileObj:
+      fileObj.write(os.urandom(self._fileSize))
+
+    for i, contents in enumerate(self._unchangedFiles):
+      with open(os.path.join(networkDir, "R%d-pkl" % (i,)), "wb") as fileObj:
+        fileObj.write(contents)
+
+
+
+def _runCheckpoints(numCheckpoints, numFiles, fileSize, startEvent,
+                    resultQueue):
+  checkpointMgr = ModelCheckpointMgr()
+  modelID = uuid.uuid1().hex
+  checkpointMgr.define(modelID, definition=dict())
+
+  model = _FakeModel(numFiles, fileSize)
+
+  startEvent.wait()
+
+  latencies = []
+  for _ in xrange(numCheckpoints):
+    startTime = time.time()
+    checkpointMgr.save(modelID, model, attributes=dict())
+    latencies.append(time.time() - startTime)
+
+  resultQueue.put(latencies)
+
+
+
+def _benchmark(storageRoot, groupCommit, options):
+  """
+  :returns: three-tuple (checkpointsPerSec, meanLatencySec, p95LatencySec)
+  """
+  with ConfigAttributePatch(
+      ModelCheckpointConfig.CONFIG_NAME,
+      os.environ.get("APPLICATION_CONFIG_PATH"),
+      (("storage", "root", storageRoot),
+       ("storage", "group_commit", str(groupCommit).lower()))):
+
+    startEvent = multiprocessing.Event()
+    resultQueue = multiprocessing.Queue()
+
+    processes = [
+      multiprocessing.Process(
+        target=_runCheckpoints,
+        args=(options.checkpoints, options.files, options.file_kb * 1024,
+              startEvent, resultQueue))
+      for _ in xrange(options.processes)
+    ]
+
+    for process in processes:
+      process.start()
+
+    startTime = time.time()
+    startEvent.set()
+
+    latencies = []
+    for _ in processes:
+      latencies.extend(resultQueue.get())
+
+    elapsedSec = time.time() - startTime
+
+    for process in processes:
+      process.join()
+
+  latencies.sort()
+
+  return (len(latencies) / elapsedSec,
+          sum(latencies) / len(latencies),
+          latencies[int(len(latencies) * 0.95)])
+
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option("--dir", default=tempfile.gettempdir(),
+                    help="Directory for the benchmark's checkpoint archives "
+                         "[default: %default]")
+  parser.add_option("--processes", type="int", default=8,
+                    help="Number of concurrent checkpointing processes "
+                         "[default: %default]")
+  parser.add_option("--checkpoints", type="int", default=20,
+                    help="Number of checkpoints per process "
+                         "[default: %default]")
+  parser.add_option("--files", type="int", default=8,
+                    help="Number of files per checkpoint [default: %default]")
+  parser.add_option("--file-kb", type="int", default=256,
+                    help="Size of each file in KB [default: %default]")
+  options, _args = parser.parse_args()
+
+  print ("processes=%d; checkpoints per process=%d; files=%d; file size=%d KB"
+         % (options.processes, options.checkpoints, options.files,
+            options.file_kb))
+  print "%-8s %16s %18s %16s" % ("mode", "checkpoints/sec", "mean latency (ms)",
+                                 "p95 latency (ms)")
+
+  for groupCommit in (False, True):
+    storageRoot = tempfile.mkdtemp(prefix="checkpoint_benchmark",
+                                   dir=options.dir)
+    try:
+      throughput, meanLatency, p95Latency = _benchmark(storageRoot,
+                                                       groupCommit, options)
+    finally:
+      shutil.rmtree(storageRoot)
+
+    print "%-8s %16.1f %18.1f %16.1f" % (
+      "group" if groupCommit else "fsync", throughput, meanLatency * 1000,
+      p95Latency * 1000)
+
+
+
+if __name__ == "__main__":
+  main()
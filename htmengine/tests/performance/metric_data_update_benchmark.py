@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Benchmark of storing the anomaly scores of an inference result batch, as
+AnomalyService does, with one updateMetricDataColumns call per row versus one
+updateMetricDataColumnsBatch call; reports the duration of the transaction for
+each batch size.
+
+Runs against the repository database in the htmengine configuration at
+APPLICATION_CONFIG_PATH; the benchmark metric and its rows are deleted
+afterwards.
+
+Usage: python metric_data_update_benchmark.py [--batch-sizes=N,N,...]
+  [--repeat=N]
+"""
+
+import datetime
+from optparse import OptionParser
+import os
+import random
+import time
+
+from nta.utils.config import Config
+
+from htmengine import raiseExceptionOnMissingRequiredApplicationConfigPath
+from htmengine import repository
+from htmengine.repository.queries import MetricStatus
+import htmengine.utils
+
+
+
+config = raiseExceptionOnMissingRequiredApplicationConfigPath(Config)(
+  "application.conf", os.environ["APPLICATION_CONFIG_PATH"])
+
+
+
+class _MetricDataRow(object):
+  """ Stands in for a MutableMetricDataRow """
+
+  def __init__(self, uid, rowid):
+    self.uid = uid
+    self.rowid = rowid
+
+
+
+def _generateRowFields(rowids):
+  rowFields = dict()
+  for rowid in rowids:
+    anomalyScore = random.random()
+    rowFields[rowid] = {"raw_anomaly_score": random.random(),
+                        "anomaly_score": anomalyScore,
+                        "display_value": int(anomalyScore * 1000)}
+
+  return rowFields
+
+
+
+def _updatePerRow(conn, metricId, rowFields):
+  for rowid, fields in rowFields.iteritems():
+    repository.updateMetricDataColumns(conn, _MetricDataRow(metricId, rowid),
+                                       fields)
+
+
+
+def _updateBatch(conn, metricId, rowFields):
+  repository.updateMetricDataColumnsBatch(conn, metricId, rowFields)
+
+
+
+def _benchmark(engine, metricId, rowids, updateFn, repeat):
+  """
+  :returns: duration of the fastest transaction, in seconds
+  """
+  durations = []
+  for _ in xrange(repeat):
+    rowFields = _generateRowFields(rowids)
+
+    startTime = time.time()
+    with engine.begin() as conn:
+      updateFn(conn, metricId, rowFields)
+    durations.append(time.time() - startTime)
+
+  return min(durations)
+
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option("--batch-sizes", default="10,100,500,2000,5000",
+                    help="Comma-separated numbers of metric data rows per "
+                         "inference result batch [default: %default]")
+  parser.add_option("--repeat", type="int", default=5,
+                    help="Number of timed repetitions; the fastest is "
+                         "reported [default: %default]")
+  options, _args = parser.parse_args()
+
+  batchSizes = [int(size) for size in options.batch_sizes.split(",")]
+
+  engine = repository.engineFactory(config)
+
+  metricId = htmengine.utils.createGuid()
+  start = datetime.datetime(2015, 1, 1)
+  with engine.connect() as conn:
+    repository.addMetric(conn,
+                         uid=metricId,
+                         datasource="custom",
+                         name="metric_data_update_benchmark.%s" % (metricId,),
+                         status=MetricStatus.ACTIVE)
+    repository.addMetricData(
+      conn,
+      metricId,
+      [(random.uniform(0, 100), start + datetime.timedelta(minutes=5 * i))
+       for i in xrange(max(batchSizes))])
+
+  try:
+    print "Best of %d" % (options.repeat,)
+    print "%10s %14s %14s %8s" % ("rows", "per-row (ms)", "batch (ms)",
+                                  "speedup")
+    for batchSize in batchSizes:
+      rowids = range(1, batchSize + 1)
+
+      perRowSec = _benchmark(engine, metricId, rowids, _updatePerRow,
+                             options.repeat)
+      batchSec = _benchmark(engine, metricId, rowids, _updateBatch,
+                            options.repeat)
+
+      print "%10d %14.1f %14.1f %7.1fx" % (
+        batchSize, perRowSec * 1000, batchSec * 1000, perRowSec / batchSec)
+  finally:
+    with engine.connect() as conn:
+      repository.deleteMetric(conn, metricId)
+
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""Unit tests for htmengine.anomaly_likelihood_helper"""
+
+# Disable pylint warning: "access to protected member"
+# pylint: disable=W0212
+
+from collections import deque
+import copy
+import datetime
+import json
+import random
+import unittest
+
+from mock import MagicMock, Mock, patch
+
+from nupic.algorithms import anomaly_likelihood as algorithms
+
+from htmengine import anomaly_likelihood_helper
+from htmengine.anomaly_likelihood_helper import AnomalyLikelihoodHelper
+from htmengine.repository.queries import MetricStatus
+
+
+
+def _updateAnomalyLikelihoodsPerScore(anomalyScores, params):
+  """ The reference computation: algorithms.updateAnomalyLikelihoods() called
+  once per score, as AnomalyLikelihoodHelper used to do it
+  """
+  params = copy.deepcopy(params)
+  likelihoods = []
+  for score in anomalyScores:
+    (likelihood,), _, params = algorithms.updateAnomalyLikelihoods(
+      ((None, 0, score),), params)
+    likelihoods.append(likelihood)
+
+  return likelihoods, params
+
+
+
+def _estimateAnomalyLikelihoods(anomalyScores):
+  # NOTE: the metric values must vary, or else the estimated distribution is
+  # the null distribution
+  _, _, params = algorithms.estimateAnomalyLikelihoods(
+    [(None, float(i), score) for i, score in enumerate(anomalyScores)],
+    skipRecords=anomaly_likelihood_helper.NUM_SKIP_RECORDS)
+  return params
+
+
+
+def _recordBatch(rng, numRows, spikeProbability=0.0):
+  """ Generate a batch of raw anomaly scores resembling recorded model output:
+  mostly low scores with occasional bursts and spikes
+  """
+  scores = []
+  for _ in xrange(numRows):
+    if rng.random() < spikeProbability:
+      scores.append(1.0)
+    elif rng.random() < 0.1:
+      scores.append(rng.random())
+    else:
+      scores.append(rng.random() * 0.05)
+
+  return scores
+
+
+
+class _MetricData(object):
+  """ Stand-in for a metric_data row """
+
+  def __init__(self, rowid, rawAnomalyScore):
+    self.rowid = rowid
+    self.timestamp = (datetime.datetime(2015, 1, 1) +
+                      datetime.timedelta(minutes=5 * rowid))
+    self.metric_value = float(rowid)
+    self.raw_anomaly_score = rawAnomalyScore
+    self.anomaly_score = 0
+
+
+
+class AnomalyLikelihoodBatchUpdateTestCase(unittest.TestCase):
+
+
+  def _assertBitForBitEqual(self, likelihoods, params, expectedLikelihoods,
+                            expectedParams):
+    self.assertEqual([float(v).hex() for v in likelihoods],
+                     [float(v).hex() for v in expectedLikelihoods])
+
+    self.assertEqual(params["movingAverage"]["total"].hex(),
+                     expectedParams["movingAverage"]["total"].hex())
+    self.assertEqual([float(v).hex() for v in params["historicalLikelihoods"]],
+                     [float(v).hex() for v in
+                      expectedParams["historicalLikelihoods"]])
+
+    self.assertEqual(params, expectedParams)
+
+
+  def _estimateParams(self, rng, numRows):
+    return _estimateAnomalyLikelihoods(_recordBatch(rng, numRows))
+
+
+  def testMatchesPerScoreUpdates(self):
+    rng = random.Random(1)
+
+    for numRows in (1, 2, 9, 10, 11, 100, 1000, 5000):
+      params = self._estimateParams(rng, numRows=1000)
+      scores = _recordBatch(rng, numRows, spikeProbability=0.02)
+
+      likelihoods, newParams = (
+        anomaly_likelihood_helper._updateAnomalyLikelihoodsBatch(scores,
+                                                                 params))
+
+      expectedLikelihoods, expectedParams = _updateAnomalyLikelihoodsPerScore(
+        scores, params)
+
+      self._assertBitForBitEqual(likelihoods, newParams, expectedLikelihoods,
+                                 expectedParams)
+
+
+  def testMatchesPerScoreUpdatesInRedZone(self):
+    # Consecutive likelihoods in the red zone are filtered to the yellow zone
+    rng = random.Random(2)
+
+    params = self._estimateParams(rng, numRows=1000)
+    scores = _recordBatch(rng, 20) + [1.0] * 30 + _recordBatch(rng, 20)
+
+    likelihoods, newParams = (
+      anomaly_likelihood_helper._updateAnomalyLikelihoodsBatch(scores, params))
+
+    expectedLikelihoods, expectedParams = _updateAnomalyLikelihoodsPerScore(
+      scores, params)
+
+    self._assertBitForBitEqual(likelihoods, newParams, expectedLikelihoods,
+                               expectedParams)
+
+
+  def testMatchesPerScoreUpdatesWithPartialHistory(self):
+    rng = random.Random(3)
+
+    for numHistoricalValues in (0, 1, 5):
+      for historicalLikelihoods in (None, [], [0.5]):
+        params = self._estimateParams(rng, numRows=500)
+
+        movingAverage = params["movingAverage"]
+        movingAverage["historicalValues"] = (
+          movingAverage["historicalValues"][:numHistoricalValues])
+        movingAverage["total"] = sum(movingAverage["historicalValues"])
+
+        if historicalLikelihoods is None:
+          del params["historicalLikelihoods"]
+        else:
+          params["historicalLikelihoods"] = historicalLikelihoods
+
+        for numRows in (1, 3, 20):
+          scores = _recordBatch(rng, numRows)
+
+          likelihoods, newParams = (
+            anomaly_likelihood_helper._updateAnomalyLikelihoodsBatch(scores,
+                                                                     params))
+
+          expectedLikelihoods, expectedParams = (
+            _updateAnomalyLikelihoodsPerScore(scores, params))
+
+          self._assertBitForBitEqual(likelihoods, newParams,
+                                     expectedLikelihoods, expectedParams)
+
+
+  def testDoesNotModifyParams(self):
+    rng = random.Random(4)
+
+    params = self._estimateParams(rng, numRows=500)
+    originalParams = copy.deepcopy(params)
+
+    anomaly_likelihood_helper._updateAnomalyLikelihoodsBatch(
+      _recordBatch(rng, 50), params)
+
+    self.assertEqual(params, originalParams)
+
+
+  def testInvalidArguments(self):
+    params = self._estimateParams(random.Random(5), numRows=500)
+
+    with self.assertRaises(ValueError):
+      anomaly_likelihood_helper._updateAnomalyLikelihoodsBatch([], params)
+
+    with self.assertRaises(ValueError):
+      anomaly_likelihood_helper._updateAnomalyLikelihoodsBatch(
+        [0.5], {"distribution": params["distribution"]})
+
+
+
+@patch.object(anomaly_likelihood_helper, "repository", autospec=True)
+class UpdateModelAnomalyScoresTestCase(unittest.TestCase):
+
+
+  def setUp(self):
+    configMock = Mock()
+    configMock.getint.side_effect = lambda _section, option: dict(
+      statistics_refresh_rate=1000,
+      statistics_min_sample_size=100,
+      statistics_sample_size=1000)[option]
+
+    self.helper = AnomalyLikelihoodHelper(log=Mock(), config=configMock)
+
+    rng = random.Random(6)
+    self.params = _estimateAnomalyLikelihoods(_recordBatch(rng, 1000))
+
+    self.rng = rng
+
+
+  def _createMetric(self, lastRowIDForStats):
+    return Mock(
+      status=MetricStatus.ACTIVE,
+      uid="abc",
+      model_params=json.dumps(
+        {"anomalyLikelihoodParams": {"last_rowid_for_stats": lastRowIDForStats,
+                                     "params": self.params}}))
+
+
+  def testScoresMatchPerRowUpdates(self, _repositoryMock):
+    # The whole batch is processed as a single run that ends before the next
+    # statistics refresh
+    rows = [_MetricData(rowid, score) for rowid, score
+            in enumerate(_recordBatch(self.rng, 5000), start=1001)]
+
+    anomalyParams = self.helper.updateModelAnomalyScores(
+      engine=MagicMock(),
+      metricObj=self._createMetric(lastRowIDForStats=1000 + len(rows)),
+      metricDataRows=rows)
+
+    expectedLikelihoods, expectedParams = _updateAnomalyLikelihoodsPerScore(
+      [row.raw_anomaly_score for row in rows], self.params)
+
+    self.assertEqual(
+      [row.anomaly_score.hex() for row in rows],
+      [float(1.0 - likelihood).hex() for likelihood in expectedLikelihoods])
+    self.assertEqual(anomalyParams["params"], expectedParams)
+
+
+  def testHighAnomalyScoreEndsRunAndRefreshesParams(self, _repositoryMock):
+    scores = _recordBatch(self.rng, 50)
+    rows = [_MetricData(rowid, score) for rowid, score
+            in enumerate(scores + [1.0] * 5 + scores, start=1001)]
+
+    refreshedParams = {"last_rowid_for_stats": 2000, "params": self.params}
+
+    with patch.object(AnomalyLikelihoodHelper, "_refreshAnomalyParams",
+                      autospec=True,
+                      return_value=(refreshedParams, [])) as refreshMock:
+      self.helper.updateModelAnomalyScores(
+        engine=MagicMock(),
+        metricObj=self._createMetric(lastRowIDForStats=1000),
+        metricDataRows=rows)
+
+    # The first run ends with the first sample whose anomaly score exceeds the
+    # threshold
+    consumedSamples = refreshMock.call_args_list[0][1]["consumedSamples"]
+    self.assertGreater(consumedSamples[-1].anomaly_score, 0.99)
+    self.assertTrue(all(row.anomaly_score <= 0.99
+                        for row in consumedSamples[:-1]))
+    self.assertEqual(consumedSamples, rows[:len(consumedSamples)])
+
+    expectedLikelihoods, _ = _updateAnomalyLikelihoodsPerScore(
+      [row.raw_anomaly_score for row in consumedSamples], self.params)
+
+    self.assertEqual(
+      [row.anomaly_score.hex() for row in consumedSamples],
+      [float(1.0 - likelihood).hex() for likelihood in expectedLikelihoods])
+
+
+
+class StatsSampleCacheTestCase(unittest.TestCase):
+
+
+  def _samples(self, firstRowID, numSamples):
+    return deque(
+      anomaly_likelihood_helper._makeStatsSamples(
+        _MetricData(rowid, 0.5)
+        for rowid in xrange(firstRowID, firstRowID + numSamples)))
+
+
+  def testPopRequiresContiguousRowID(self):
+    cache = anomaly_likelihood_helper._StatsSampleCache(maxSamples=100)
+
+    samples = self._samples(1, 10)
+    cache.put("abc", samples)
+    self.assertIs(cache.pop("abc", nextRowID=11), samples)
+    self.assertIsNone(cache.pop("abc", nextRowID=11))
+
+    # Redelivered batch
+    cache.put("abc", samples)
+    self.assertIsNone(cache.pop("abc", nextRowID=5))
+    self.assertEqual(len(cache), 0)
+
+    cache.put("abc", samples)
+    cache.discard("abc")
+    self.assertIsNone(cache.pop("abc", nextRowID=11))
+
+
+  def testEvictsLeastRecentlyUsedModels(self):
+    cache = anomaly_likelihood_helper._StatsSampleCache(maxSamples=25)
+
+    cache.put("a", self._samples(1, 10))
+    cache.put("b", self._samples(1, 10))
+    cache.put("a", cache.pop("a", nextRowID=11))
+
+    # Exceeds maxSamples, evicting "b"
+    cache.put("c", self._samples(1, 10))
+    self.assertEqual(len(cache), 2)
+    self.assertIsNone(cache.pop("b", nextRowID=11))
+    self.assertIsNotNone(cache.pop("a", nextRowID=11))
+    self.assertIsNotNone(cache.pop("c", nextRowID=11))
+
+    # An entry that exceeds maxSamples by itself isn't kept
+    cache.put("d", self._samples(1, 30))
+    self.assertEqual(len(cache), 0)
+
+
+
+@patch.object(anomaly_likelihood_helper, "repository", autospec=True)
+class UpdateModelAnomalyScoresWithStatsSampleCacheTestCase(unittest.TestCase):
+
+
+  def setUp(self):
+    configMock = Mock()
+    configMock.getint.side_effect = lambda _section, option: dict(
+      statistics_refresh_rate=1000,
+      statistics_min_sample_size=100,
+      statistics_sample_size=1000)[option]
+
+    self.config = configMock
+    self.rng = random.Random(7)
+
+
+  def _createMetric(self, anomalyParams):
+    return Mock(
+      status=MetricStatus.ACTIVE,
+      uid="abc",
+      model_params=json.dumps({"anomalyLikelihoodParams": anomalyParams}))
+
+
+  def _createRows(self, firstRowID, numRows):
+    return [_MetricData(rowid, score) for rowid, score
+            in enumerate(_recordBatch(self.rng, numRows), start=firstRowID)]
+
+
+  @staticmethod
+  def _setProcessedRows(repositoryMock, processedRows):
+    # Emulates getMetricDataWithRawAnomalyScoresTail, which returns the rows
+    # in descending order
+    repositoryMock.getMetricDataWithRawAnomalyScoresTail.side_effect = (
+      lambda _conn, _metricID, limit: processedRows[::-1][:limit])
+
+
+  def _process(self, helper, anomalyParams, rows):
+    """
+    :returns: the tuple (anomalyParams, anomalyScores)
+    """
+    rows = copy.deepcopy(rows)
+    anomalyParams = helper.updateModelAnomalyScores(
+      engine=MagicMock(),
+      metricObj=self._createMetric(anomalyParams),
+      metricDataRows=rows)
+
+    return anomalyParams, [row.anomaly_score for row in rows]
+
+
+  def testRefreshFromCachedSamplesMatchesLoadedSamples(self, repositoryMock):
+    processedRows = self._createRows(1, 1000)
+    batch1 = self._createRows(1001, 100)
+    batch2 = self._createRows(1101, 100)
+
+    params = _estimateAnomalyLikelihoods(
+      [row.raw_anomaly_score for row in processedRows])
+
+    helper = AnomalyLikelihoodHelper(log=Mock(), config=self.config)
+
+    # Statistics are refreshed within each batch
+    self._setProcessedRows(repositoryMock, processedRows)
+    self._process(helper, {"last_rowid_for_stats": 50, "params": params},
+                  batch1)
+    self.assertEqual(
+      repositoryMock.getMetricDataWithRawAnomalyScoresTail.call_count, 1)
+
+    batch2Params = {"last_rowid_for_stats": 150, "params": params}
+    cachedResult = self._process(helper, batch2Params, batch2)
+    self.assertEqual(
+      repositoryMock.getMetricDataWithRawAnomalyScoresTail.call_count, 1)
+
+    # Compare with loading the processed samples from metric_data
+    self._setProcessedRows(repositoryMock, processedRows + batch1)
+    loadedResult = self._process(
+      AnomalyLikelihoodHelper(log=Mock(), config=self.config),
+      batch2Params,
+      batch2)
+    self.assertEqual(
+      repositoryMock.getMetricDataWithRawAnomalyScoresTail.call_count, 2)
+
+    self.assertEqual(cachedResult, loadedResult)
+
+    # A non-contiguous batch (e.g., redelivered) reloads the samples
+    self._process(helper, batch2Params, batch2)
+    self.assertEqual(
+      repositoryMock.getMetricDataWithRawAnomalyScoresTail.call_count, 3)
+
+
+  def testInitFromCachedSamplesMatchesLoadedSamples(self, repositoryMock):
+    processedRows = self._createRows(1, 50)
+    batch1 = self._createRows(51, 30)
+    batch2 = self._createRows(81, 30)
+
+    helper = AnomalyLikelihoodHelper(log=Mock(), config=self.config)
+
+    # Not enough samples for the anomaly likelihood model yet
+    self._setProcessedRows(repositoryMock, processedRows)
+    anomalyParams, _ = self._process(helper, None, batch1)
+    self.assertIsNone(anomalyParams)
+
+    cachedResult = self._process(helper, None, batch2)
+    self.assertIsNotNone(cachedResult[0])
+    self.assertEqual(
+      repositoryMock.getMetricDataWithRawAnomalyScoresTail.call_count, 1)
+
+    # Compare with loading the processed samples from metric_data
+    self._setProcessedRows(repositoryMock, processedRows + batch1)
+    loadedResult = self._process(
+      AnomalyLikelihoodHelper(log=Mock(), config=self.config),
+      None,
+      batch2)
+
+    self.assertEqual(cachedResult, loadedResult)
+    self.assertFalse(repositoryMock.getProcessedMetricDataCount.called)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Unit tests for htmengine.model_checkpoint_mgr.checkpoint_chunk_store
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from mock import patch
+
+from htmengine.model_checkpoint_mgr import checkpoint_chunk_store
+from htmengine.model_checkpoint_mgr.checkpoint_chunk_store import (
+  CheckpointChunkStore)
+
+
+# Disable warning: Access to a protected member
+# pylint: disable=W0212
+
+
+
+class CheckpointChunkStoreTestCase(unittest.TestCase):
+
+
+  def setUp(self):
+    self._tempDir = tempfile.mkdtemp(prefix=self.__class__.__name__)
+    self.addCleanup(shutil.rmtree, self._tempDir)
+
+    self._scratchDir = os.path.join(self._tempDir, "scratch")
+    os.mkdir(self._scratchDir)
+
+    self._storeDir = os.path.join(self._tempDir, "chunks")
+
+    self._store = CheckpointChunkStore(storeDir=self._storeDir,
+                                       scratchDir=self._scratchDir)
+
+
+  def _makeTree(self, name, files, dirs=()):
+    """ Create a tree with the given files
+
+    :param name: name of the tree's root directory
+    :param files: dict of relative file paths to contents
+    :param dirs: relative paths of additional directories to create
+
+    :returns: path of the tree's root directory
+    """
+    treeDir = os.path.join(self._tempDir, name)
+    for d in dirs:
+      os.makedirs(os.path.join(treeDir, d))
+    for path, contents in files.iteritems():
+      filePath = os.path.join(treeDir, path)
+      if not os.path.isdir(os.path.dirname(filePath)):
+        os.makedirs(os.path.dirname(filePath))
+      with open(filePath, "wb") as fileObj:
+        fileObj.write(contents)
+    return treeDir
+
+
+  def _readTree(self, treeDir):
+    """
+    :returns: pair of (dict of relative file paths to contents, set of
+      relative dir paths)
+    """
+    files = dict()
+    dirs = set()
+    for parentPath, dirNames, fileNames in os.walk(treeDir):
+      for d in dirNames:
+        dirs.add(os.path.relpath(os.path.join(parentPath, d), treeDir))
+      for f in fileNames:
+        filePath = os.path.join(parentPath, f)
+        with open(filePath, "rb") as fileObj:
+          files[os.path.relpath(filePath, treeDir)] = fileObj.read()
+    return files, dirs
+
+
+  @patch.object(CheckpointChunkStore, "_CHUNK_SIZE", 16)
+  def testStoreAndRestoreTree(self):
+    files = {
+      "model.pkl": "x" * 40,
+      "extra/network.nta/R0-pkl": "".join(chr(i % 256) for i in xrange(32)),
+      "extra/network.nta/empty": "",
+    }
+    treeDir = self._makeTree("tree", files, dirs=("extra/emptyDir",))
+
+    storedTree = self._store.storeTree(treeDir)
+
+    # 3 chunks of model.pkl, 2 of R0-pkl, 1 of the empty file; the first two
+    # chunks of model.pkl are the same
+    self.assertEqual(storedTree.numChunks, 6)
+    self.assertEqual(storedTree.numNewChunks, 5)
+    self.assertEqual(len(os.listdir(self._storeDir)), 5)
+    self.assertEqual(
+      storedTree.newChunkBytes,
+      sum(os.path.getsize(os.path.join(self._storeDir, chunkID))
+          for chunkID in os.listdir(self._storeDir)))
+
+    # Chunks are compressed
+    chunkID = storedTree.manifest["files"]["model.pkl"][0]
+    with open(os.path.join(self._storeDir, chunkID), "rb") as fileObj:
+      self.assertEqual(zlib.decompress(fileObj.read()), "x" * 16)
+
+    # No temp files are left behind
+    self.assertEqual(os.listdir(self._scratchDir), [])
+
+    restoredDir = os.path.join(self._tempDir, "restored")
+    self._store.restoreTree(storedTree.manifest, restoredDir)
+
+    self.assertEqual(self._readTree(restoredDir), self._readTree(treeDir))
+
+
+  @patch.object(CheckpointChunkStore, "_CHUNK_SIZE", 16)
+  def testStoreTreeWritesOnlyChangedChunks(self):
+    treeDir1 = self._makeTree(
+      "tree1", {"model.pkl": "a" * 16 + "b" * 16, "R0-pkl": "c" * 10})
+    storedTree1 = self._store.storeTree(treeDir1)
+    self.assertEqual(storedTree1.numNewChunks, 3)
+
+    treeDir2 = self._makeTree(
+      "tree2", {"model.pkl": "a" * 16 + "d" * 16, "R0-pkl": "c" * 10})
+
+    with patch.object(self._store, "_writeChunk", autospec=True,
+                      side_effect=self._store._writeChunk) as writeChunkMock:
+      storedTree2 = self._store.storeTree(treeDir2)
+
+    self.assertEqual(storedTree2.numChunks, 3)
+    self.assertEqual(storedTree2.numNewChunks, 1)
+    writeChunkMock.assert_called_once_with(
+      storedTree2.manifest["files"]["model.pkl"][1], "d" * 16)
+
+    # Remove the chunks that only the first tree referenced
+    self.assertEqual(
+      self._store.removeUnreferencedChunks([storedTree2.manifest]), 1)
+    self.assertEqual(len(os.listdir(self._storeDir)), 3)
+
+    restoredDir = os.path.join(self._tempDir, "restored")
+    self._store.restoreTree(storedTree2.manifest, restoredDir)
+    self.assertEqual(self._readTree(restoredDir), self._readTree(treeDir2))
+
+
+  def testStagedChunksArePublished(self):
+    treeDir = self._makeTree("tree", {"model.pkl": "abc", "R0-pkl": "abc"})
+
+    stagingDir = os.path.join(self._tempDir, "staging")
+    os.mkdir(stagingDir)
+
+    with patch.object(checkpoint_chunk_store, "_fsyncReliably",
+                      autospec=True) as fsyncMock:
+      storedTree = self._store.storeTree(treeDir, stagingDir=stagingDir)
+
+    # Syncing is up to the caller
+    self.assertEqual(fsyncMock.call_count, 0)
+
+    self.assertEqual(storedTree.numChunks, 2)
+    self.assertEqual(storedTree.numNewChunks, 1)
+    self.assertFalse(os.path.exists(self._storeDir))
+    self.assertEqual(len(os.listdir(stagingDir)), 1)
+
+    self._store.publishChunks(stagingDir)
+
+    self.assertEqual(os.listdir(stagingDir), [])
+    self.assertEqual(len(os.listdir(self._storeDir)), 1)
+
+    restoredDir = os.path.join(self._tempDir, "restored")
+    self._store.restoreTree(storedTree.manifest, restoredDir)
+    self.assertEqual(self._readTree(restoredDir), self._readTree(treeDir))
+
+
+  def testRemoveUnreferencedChunksWithoutStore(self):
+    self.assertEqual(self._store.removeUnreferencedChunks([]), 0)
+
+
+  def testFailedChunkWriteLeavesNoChunk(self):
+    treeDir = self._makeTree("tree", {"model.pkl": "abc"})
+
+    with patch.object(checkpoint_chunk_store, "_fsyncReliably", autospec=True,
+                      side_effect=OSError("fsync failed")):
+      with self.assertRaises(OSError):
+        self._store.storeTree(treeDir)
+
+    self.assertEqual(os.listdir(self._storeDir), [])
+    self.assertEqual(os.listdir(self._scratchDir), [])
+
+
+
+if __name__ == "__main__":
+  unittest.main()
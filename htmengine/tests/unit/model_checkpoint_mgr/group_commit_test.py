@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Unit tests for htmengine.model_checkpoint_mgr.group_commit
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from htmengine.model_checkpoint_mgr import group_commit
+from htmengine.model_checkpoint_mgr.group_commit import GroupCommitSync
+
+
+# Disable warning: Access to a protected member
+# pylint: disable=W0212
+
+
+
+@patch.object(group_commit, "_syncfs", autospec=True, return_value=0)
+class GroupCommitSyncTestCase(unittest.TestCase):
+
+
+  def setUp(self):
+    self._tempDir = tempfile.mkdtemp(prefix=self.__class__.__name__)
+    self.addCleanup(shutil.rmtree, self._tempDir)
+
+    self._lockFilePath = os.path.join(self._tempDir, "lock")
+
+
+  def _readGeneration(self):
+    fd = os.open(self._lockFilePath, os.O_RDONLY)
+    try:
+      return GroupCommitSync._readGeneration(fd)
+    finally:
+      os.close(fd)
+
+
+  def testSyncFlushesFilesystem(self, syncfsMock):
+    groupCommit = GroupCommitSync(lockFilePath=self._lockFilePath)
+
+    self.assertTrue(groupCommit.sync())
+    self.assertEqual(syncfsMock.call_count, 1)
+    self.assertEqual(self._readGeneration(), 1)
+
+    # Nobody flushed since the previous call
+    self.assertTrue(groupCommit.sync())
+    self.assertEqual(syncfsMock.call_count, 2)
+    self.assertEqual(self._readGeneration(), 2)
+
+
+  def testSyncSharesFlushOfAnotherProcess(self, syncfsMock):
+    groupCommit = GroupCommitSync(lockFilePath=self._lockFilePath)
+
+    realFlock = fcntl.flock
+
+    def flockWithConcurrentFlush(fd, operation):
+      if operation == fcntl.LOCK_EX:
+        # Simulate another process that flushed while we were waiting for the
+        # exclusive lock
+        GroupCommitSync._writeGeneration(fd, GroupCommitSync._readGeneration(fd)
+                                         + 1)
+      realFlock(fd, operation)
+
+    with patch.object(group_commit.fcntl, "flock", autospec=True,
+                      side_effect=flockWithConcurrentFlush):
+      self.assertFalse(groupCommit.sync())
+
+    self.assertEqual(syncfsMock.call_count, 0)
+    self.assertEqual(self._readGeneration(), 1)
+
+
+  @patch.object(group_commit.ctypes, "get_errno", autospec=True,
+                return_value=errno.EIO)
+  def testSyncfsFailure(self, _getErrnoMock, syncfsMock):
+    syncfsMock.return_value = -1
+
+    groupCommit = GroupCommitSync(lockFilePath=self._lockFilePath)
+
+    with self.assertRaises(OSError) as cm:
+      groupCommit.sync()
+
+    self.assertEqual(cm.exception.errno, errno.EIO)
+    self.assertEqual(self._readGeneration(), 0)
+
+
+  def testReleasesLock(self, _syncfsMock):
+    GroupCommitSync(lockFilePath=self._lockFilePath).sync()
+
+    fd = os.open(self._lockFilePath, os.O_RDWR)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    finally:
+      os.close(fd)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -20,10 +20,15 @@
 # http://numenta.org/licenses/
 # ----------------------------------------------------------------------
 
+import errno
+import os
 import uuid
 
 import unittest
 
+from mock import patch
+
+from htmengine.model_checkpoint_mgr import model_checkpoint_mgr
 from htmengine.model_checkpoint_mgr.model_checkpoint_mgr import (
     ModelCheckpointMgr, ModelNotFound, ModelAlreadyExists)
 from htmengine.model_checkpoint_mgr.model_checkpoint_test_utils import (
@@ -382,6 +387,56 @@ class TestModelCheckpointMgr(unittest.TestCase):
                      newAttributes)
 
 
+  def testCheckpointLog(self):
+    checkpointMgr = ModelCheckpointMgr()
+
+    modelID = uuid.uuid1().hex
+
+    checkpointMgr.define(modelID, dict(a=1))
+
+    with self.assertRaises(ModelNotFound):
+      checkpointMgr.writeCheckpointLog(modelID, offset=0, data="abc")
+
+    checkpointMgr.save(modelID, ModelFactory.create(
+      self._getModelParams("variant1")), attributes="attributes1")
+
+    self.assertIsNone(checkpointMgr.mapCheckpointLog(modelID, size=0))
+
+    checkpointMgr.writeCheckpointLog(modelID, offset=0, data="abcdef")
+
+    # Writing at an offset discards the contents beyond it
+    checkpointMgr.writeCheckpointLog(modelID, offset=3, data="gh")
+
+    logMap = checkpointMgr.mapCheckpointLog(modelID, size=5)
+    try:
+      self.assertEqual(logMap[:], "abcgh")
+    finally:
+      logMap.close()
+
+    # The log of a clone is independent of the source's
+    destModelID = uuid.uuid1().hex
+    checkpointMgr.clone(modelID, destModelID)
+    checkpointMgr.writeCheckpointLog(modelID, offset=0, data="xyz")
+
+    logMap = checkpointMgr.mapCheckpointLog(destModelID, size=5)
+    try:
+      self.assertEqual(logMap[:], "abcgh")
+    finally:
+      logMap.close()
+
+    # A new checkpoint starts without a log
+    checkpointMgr.save(modelID, ModelFactory.create(
+      self._getModelParams("variant2")), attributes="attributes2")
+    checkpointMgr.writeCheckpointLog(modelID, offset=0, data="i")
+
+    logMap = checkpointMgr.mapCheckpointLog(modelID, size=1)
+    try:
+      self.assertEqual(logMap.size(), 1)
+      self.assertEqual(logMap[:], "i")
+    finally:
+      logMap.close()
+
+
   def testCloneModelFromNonExistentSourceRaisesModelNotFound(self):
     checkpointMgr = ModelCheckpointMgr()
 
@@ -463,6 +518,74 @@ class TestModelCheckpointMgr(unittest.TestCase):
     self.assertEqual(str(model.getFieldInfo()), str(model1.getFieldInfo()))
 
 
+  def testCloneModelLinksCheckpointFiles(self):
+    checkpointMgr = ModelCheckpointMgr()
+
+    modelID = uuid.uuid1().hex
+    destModelID = uuid.uuid1().hex
+
+    checkpointMgr.define(modelID, dict(a=1))
+    checkpointMgr.save(modelID, ModelFactory.create(
+      self._getModelParams("variant1")), attributes="attributes1")
+
+    checkpointMgr.clone(modelID, destModelID)
+
+    # The clone's chunks are hard links to the source model's chunks
+    srcChunksDirPath = os.path.join(
+      checkpointMgr._getModelDir(modelID, mustExist=True),
+      ModelCheckpointMgr._CHUNK_STORE_DIR_NAME)
+    destChunksDirPath = os.path.join(
+      checkpointMgr._getModelDir(destModelID, mustExist=True),
+      ModelCheckpointMgr._CHUNK_STORE_DIR_NAME)
+
+    chunkIDs = os.listdir(srcChunksDirPath)
+    self.assertTrue(chunkIDs)
+    self.assertItemsEqual(os.listdir(destChunksDirPath), chunkIDs)
+    for chunkID in chunkIDs:
+      self.assertTrue(os.path.samefile(
+        os.path.join(srcChunksDirPath, chunkID),
+        os.path.join(destChunksDirPath, chunkID)))
+
+    # Updating the source's checkpoint must not affect the clone
+    checkpointMgr.updateCheckpointAttributes(modelID, "attributes2")
+    checkpointMgr.save(modelID, ModelFactory.create(
+      self._getModelParams("variant2")), attributes="attributes3")
+
+    self.assertEqual(checkpointMgr.loadCheckpointAttributes(destModelID),
+                     "attributes1")
+    self.assertEqual(checkpointMgr.loadCheckpointAttributes(modelID),
+                     "attributes3")
+
+    checkpointMgr.load(destModelID)
+
+
+  @patch.object(model_checkpoint_mgr.fcntl, "ioctl", autospec=True,
+                side_effect=IOError(errno.EOPNOTSUPP, "Not supported"))
+  @patch.object(model_checkpoint_mgr.os, "link", autospec=True,
+                side_effect=OSError(errno.EXDEV, "Cross-device link"))
+  def testCloneModelFallsBackToCopy(self, linkMock, ioctlMock):
+    checkpointMgr = ModelCheckpointMgr()
+
+    modelID = uuid.uuid1().hex
+    destModelID = uuid.uuid1().hex
+
+    checkpointMgr.define(modelID, dict(a=1))
+    model1 = ModelFactory.create(self._getModelParams("variant1"))
+    checkpointMgr.save(modelID, model1, attributes="attributes1")
+
+    checkpointMgr.clone(modelID, destModelID)
+
+    self.assertTrue(linkMock.called)
+    self.assertTrue(ioctlMock.called)
+
+    checkpointMgr.remove(modelID)
+
+    self.assertEqual(checkpointMgr.loadCheckpointAttributes(destModelID),
+                     "attributes1")
+    model = checkpointMgr.load(destModelID)
+    self.assertEqual(str(model.getFieldInfo()), str(model1.getFieldInfo()))
+
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Unit tests for the Model Runner's AdaptiveCheckpointPolicy
+"""
+
+import json
+import unittest
+
+from htmengine.model_swapper.checkpoint_policy import (
+  AdaptiveCheckpointPolicy,
+  CheckpointDecision)
+
+
+
+class AdaptiveCheckpointPolicyTestCase(unittest.TestCase):
+
+
+  def testInitialCheckpointIsFull(self):
+    policy = AdaptiveCheckpointPolicy(maxRecoverySec=10)
+
+    decision = policy.decide(hasCheckpoint=False, numReplayRows=1)
+
+    self.assertTrue(decision.full)
+    self.assertEqual(decision.reason, AdaptiveCheckpointPolicy.REASON_INITIAL)
+    self.assertEqual(decision.numReplayRows, 0)
+
+
+  def testUncalibratedPolicyLimitsIncrementalRows(self):
+    policy = AdaptiveCheckpointPolicy(maxRecoverySec=10)
+    maxRows = AdaptiveCheckpointPolicy._MAX_UNCALIBRATED_INCREMENTAL_ROWS
+
+    decision = policy.decide(hasCheckpoint=True, numReplayRows=maxRows)
+    self.assertEqual(
+      decision,
+      CheckpointDecision(full=False,
+                         reason=AdaptiveCheckpointPolicy.REASON_INCREMENTAL,
+                         numReplayRows=maxRows, estReplaySec=None))
+
+    decision = policy.decide(hasCheckpoint=True, numReplayRows=maxRows + 1)
+    self.assertTrue(decision.full)
+    self.assertEqual(decision.reason, AdaptiveCheckpointPolicy.REASON_MAX_ROWS)
+
+
+  def testCalibratedPolicyAllowsMoreIncrementalRows(self):
+    policy = AdaptiveCheckpointPolicy(maxRecoverySec=10)
+    policy.recordProcessing(numRows=100, durationSec=0.1)
+    policy.recordCheckpoint(
+      policy.decide(hasCheckpoint=False, numReplayRows=100), durationSec=2)
+
+    decision = policy.decide(hasCheckpoint=True, numReplayRows=1000)
+
+    self.assertFalse(decision.full)
+    self.assertAlmostEqual(decision.estReplaySec, 1)
+
+
+  def testExpensiveReplayForcesFullCheckpoint(self):
+    policy = AdaptiveCheckpointPolicy(maxRecoverySec=10)
+    policy.recordProcessing(numRows=10, durationSec=1)
+    policy.recordCheckpoint(
+      policy.decide(hasCheckpoint=False, numReplayRows=10), durationSec=20)
+
+    self.assertFalse(policy.decide(hasCheckpoint=True, numReplayRows=100).full)
+
+    decision = policy.decide(hasCheckpoint=True, numReplayRows=101)
+    self.assertTrue(decision.full)
+    self.assertEqual(decision.reason,
+                     AdaptiveCheckpointPolicy.REASON_REPLAY_TIME)
+
+
+  def testReplayCostOnLoadForcesFullCheckpoint(self):
+    policy = AdaptiveCheckpointPolicy(maxRecoverySec=10)
+    policy.recordProcessing(numRows=100, durationSec=1)
+    policy.recordCheckpoint(
+      policy.decide(hasCheckpoint=False, numReplayRows=10), durationSec=1)
+
+    decision = policy.decide(hasCheckpoint=True, numReplayRows=10)
+    self.assertFalse(decision.full)
+
+    # Incremental checkpoints' durations don't accumulate, since they only
+    # append to the checkpoint log
+    policy.recordCheckpoint(decision, durationSec=5)
+    self.assertFalse(policy.decide(hasCheckpoint=True, numReplayRows=99).full)
+
+    # Replaying the rows on load would take as long as a full checkpoint
+    decision = policy.decide(hasCheckpoint=True, numReplayRows=100)
+    self.assertTrue(decision.full)
+    self.assertEqual(decision.reason,
+                     AdaptiveCheckpointPolicy.REASON_LOAD_COST)
+
+
+  def testMaxRequestsPerCheckpoint(self):
+    policy = AdaptiveCheckpointPolicy(maxRecoverySec=10)
+
+    # Uncalibrated
+    self.assertEqual(
+      policy.getMaxRequestsPerCheckpoint(targetMaxRequests=500,
+                                         numReplayRows=0),
+      500)
+
+    policy.recordProcessing(numRows=10, durationSec=1)
+
+    self.assertEqual(
+      policy.getMaxRequestsPerCheckpoint(targetMaxRequests=500,
+                                         numReplayRows=0),
+      100)
+    self.assertEqual(
+      policy.getMaxRequestsPerCheckpoint(targetMaxRequests=500,
+                                         numReplayRows=60),
+      40)
+    self.assertEqual(
+      policy.getMaxRequestsPerCheckpoint(targetMaxRequests=20,
+                                         numReplayRows=0),
+      20)
+    self.assertEqual(
+      policy.getMaxRequestsPerCheckpoint(targetMaxRequests=500,
+                                         numReplayRows=200),
+      1)
+
+
+  def testStateRoundTrip(self):
+    policy = AdaptiveCheckpointPolicy(maxRecoverySec=10)
+    policy.recordProcessing(numRows=10, durationSec=1)
+    policy.recordCheckpoint(
+      policy.decide(hasCheckpoint=False, numReplayRows=10), durationSec=2)
+    policy.recordCheckpoint(
+      policy.decide(hasCheckpoint=True, numReplayRows=10), durationSec=0.5)
+
+    restored = AdaptiveCheckpointPolicy(
+      maxRecoverySec=10, state=json.loads(json.dumps(policy.state)))
+
+    self.assertEqual(restored.state, policy.state)
+    self.assertAlmostEqual(restored.perRowSec, 0.1)
+    self.assertAlmostEqual(restored.fullSaveSec, 2)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -28,13 +28,14 @@ import base64
 import cPickle
 import datetime
 import logging
+import mmap
 import os
 import select
 import threading
 import unittest
 
 
-from mock import Mock, patch
+from mock import ANY, Mock, patch
 
 
 from nupic.data.fieldmeta import FieldMetaInfo
@@ -44,6 +45,7 @@ from nta.utils.test_utils.config_test_utils import ConfigAttributePatch
 
 from htmengine.model_checkpoint_mgr import model_checkpoint_mgr
 from htmengine.model_swapper import model_runner
+from htmengine.model_swapper.checkpoint_policy import AdaptiveCheckpointPolicy
 from htmengine.model_swapper import ModelSwapperConfig
 from htmengine.model_swapper.model_swapper_interface import (
   _ConsumedRequestBatch,
@@ -704,7 +706,8 @@ class TestModelRunner(unittest.TestCase):
 
     expectedCheckpointAttributes = {
       model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
-        [requests[0].batchID]
+        [requests[0].batchID],
+      model_runner._ModelArchiver._CHECKPOINT_POLICY_ATTR_NAME: ANY
       }
     checkpointMgrInstanceMock.save.assert_called_once_with(
       modelID=modelID,
@@ -715,9 +718,13 @@ class TestModelRunner(unittest.TestCase):
     requestObjects = requests[0].objects
     expectedResults = [
       ModelInferenceResult(
-        rowID=requestObjects[0].rowID, status=0, anomalyScore=anomalyScore1),
+        rowID=requestObjects[0].rowID, status=0, anomalyScore=anomalyScore1,
+        timestamp=requestObjects[0].data[0],
+        metricValue=requestObjects[0].data[1]),
       ModelInferenceResult(
-        rowID=requestObjects[1].rowID, status=0, anomalyScore=anomalyScore2),
+        rowID=requestObjects[1].rowID, status=0, anomalyScore=anomalyScore2,
+        timestamp=requestObjects[1].data[0],
+        metricValue=requestObjects[1].data[1]),
     ]
 
     swapperMock.submitResults.assert_called_once_with(
@@ -787,14 +794,18 @@ class TestModelRunner(unittest.TestCase):
     # Verify expected saving of model
     self.assertEqual(checkpointMgrInstanceMock.save.call_count, 0)
 
+    checkpointMgrInstanceMock.writeCheckpointLog.assert_called_once_with(
+      modelID,
+      offset=0,
+      data=model_runner._ModelArchiver._encodeLoggedDataSamples(
+        [row.data for row in requests[0].objects]))
+
     expectedCheckpointAttributes = {
       model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
         [requests[0].batchID],
-      model_runner._ModelArchiver._INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME:
-        base64.standard_b64encode(cPickle.dumps(
-          [row.data for row in requests[0].objects],
-          cPickle.HIGHEST_PROTOCOL
-        ))
+      model_runner._ModelArchiver._INPUT_SAMPLE_LOG_SIZE_ATTR_NAME:
+        len(requests[0].objects),
+      model_runner._ModelArchiver._CHECKPOINT_POLICY_ATTR_NAME: ANY
       }
     checkpointMgrInstanceMock.updateCheckpointAttributes. \
       assert_called_once_with(modelID, expectedCheckpointAttributes)
@@ -806,9 +817,13 @@ class TestModelRunner(unittest.TestCase):
     requestObjects = requests[0].objects
     expectedResults = [
       ModelInferenceResult(
-        rowID=requestObjects[0].rowID, status=0, anomalyScore=anomalyScore1),
+        rowID=requestObjects[0].rowID, status=0, anomalyScore=anomalyScore1,
+        timestamp=requestObjects[0].data[0],
+        metricValue=requestObjects[0].data[1]),
       ModelInferenceResult(
-        rowID=requestObjects[1].rowID, status=0, anomalyScore=anomalyScore2),
+        rowID=requestObjects[1].rowID, status=0, anomalyScore=anomalyScore2,
+        timestamp=requestObjects[1].data[0],
+        metricValue=requestObjects[1].data[1]),
     ]
 
     swapperMock.submitResults.assert_called_once_with(
@@ -826,7 +841,7 @@ class TestModelRunner(unittest.TestCase):
     inputRecordSchema = [FieldMetaInfo("c1", "float", "")]
     anomalyScores = [
       float(n) for n in xrange(
-        model_runner._ModelArchiver._MAX_INCREMENTAL_CHECKPOINT_DATA_ROWS + 1)]
+        AdaptiveCheckpointPolicy._MAX_UNCALIBRATED_INCREMENTAL_ROWS + 1)]
 
     modelInstanceMock = Mock(
       run=Mock(
@@ -889,7 +904,8 @@ class TestModelRunner(unittest.TestCase):
 
     expectedCheckpointAttributes = {
       model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
-        [requests[0].batchID]
+        [requests[0].batchID],
+      model_runner._ModelArchiver._CHECKPOINT_POLICY_ATTR_NAME: ANY
       }
     checkpointMgrInstanceMock.save.assert_called_once_with(
       modelID=modelID,
@@ -902,9 +918,9 @@ class TestModelRunner(unittest.TestCase):
     # Verify emitted results
     requestObjects = requests[0].objects
     expectedResults = [
-      ModelInferenceResult(rowID=rowid, status=0, anomalyScore=score)
-      for rowid, score in zip(
-        [obj.rowID for obj in requestObjects], anomalyScores)
+      ModelInferenceResult(rowID=obj.rowID, status=0, anomalyScore=score,
+                           timestamp=obj.data[0], metricValue=obj.data[1])
+      for obj, score in zip(requestObjects, anomalyScores)
     ]
 
     swapperMock.submitResults.assert_called_once_with(
@@ -997,14 +1013,21 @@ class TestModelRunner(unittest.TestCase):
     # Verify expected saving of model
     self.assertEqual(checkpointMgrInstanceMock.save.call_count, 0)
 
+    # The samples of the pre-existing checkpoint are moved to the sample log
+    # along with the new ones
+    checkpointMgrInstanceMock.writeCheckpointLog.assert_called_once_with(
+      modelID,
+      offset=0,
+      data=model_runner._ModelArchiver._encodeLoggedDataSamples(
+        initialIncrementalSamples +
+        [row.data for row in requests[0].objects]))
+
     expectedCheckpointAttributes = {
       model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
         [requests[0].batchID],
-      model_runner._ModelArchiver._INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME:
-        base64.standard_b64encode(cPickle.dumps(
-          initialIncrementalSamples + [row.data for row in requests[0].objects],
-          cPickle.HIGHEST_PROTOCOL
-        ))
+      model_runner._ModelArchiver._INPUT_SAMPLE_LOG_SIZE_ATTR_NAME:
+        len(initialIncrementalSamples) + len(requests[0].objects),
+      model_runner._ModelArchiver._CHECKPOINT_POLICY_ATTR_NAME: ANY
       }
     checkpointMgrInstanceMock.updateCheckpointAttributes. \
       assert_called_once_with(modelID, expectedCheckpointAttributes)
@@ -1017,9 +1040,13 @@ class TestModelRunner(unittest.TestCase):
     requestObjects = requests[0].objects
     expectedResults = [
       ModelInferenceResult(
-        rowID=requestObjects[0].rowID, status=0, anomalyScore=anomalyScore3),
+        rowID=requestObjects[0].rowID, status=0, anomalyScore=anomalyScore3,
+        timestamp=requestObjects[0].data[0],
+        metricValue=requestObjects[0].data[1]),
       ModelInferenceResult(
-        rowID=requestObjects[1].rowID, status=0, anomalyScore=anomalyScore4),
+        rowID=requestObjects[1].rowID, status=0, anomalyScore=anomalyScore4,
+        timestamp=requestObjects[1].data[0],
+        metricValue=requestObjects[1].data[1]),
     ]
 
     swapperMock.submitResults.assert_called_once_with(
@@ -1039,7 +1066,7 @@ class TestModelRunner(unittest.TestCase):
     # and the rest from new input rows
     anomalyScores = [
       float(n) for n in xrange(
-        2 + model_runner._ModelArchiver._MAX_INCREMENTAL_CHECKPOINT_DATA_ROWS)]
+        2 + AdaptiveCheckpointPolicy._MAX_UNCALIBRATED_INCREMENTAL_ROWS)]
 
     modelInstanceMock = Mock(
       run=Mock(
@@ -1078,7 +1105,7 @@ class TestModelRunner(unittest.TestCase):
         objects=[
           ModelInputRow(rowID=n, data=[datetime.datetime.utcnow(), float(n)])
           for n in xrange(
-            model_runner._ModelArchiver._MAX_INCREMENTAL_CHECKPOINT_DATA_ROWS)
+            AdaptiveCheckpointPolicy._MAX_UNCALIBRATED_INCREMENTAL_ROWS)
         ]
       )
     ]
@@ -1112,7 +1139,8 @@ class TestModelRunner(unittest.TestCase):
 
     expectedCheckpointAttributes = {
       model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
-        [requests[0].batchID]
+        [requests[0].batchID],
+      model_runner._ModelArchiver._CHECKPOINT_POLICY_ATTR_NAME: ANY
       }
     checkpointMgrInstanceMock.save.assert_called_once_with(
       modelID=modelID,
@@ -1126,15 +1154,197 @@ class TestModelRunner(unittest.TestCase):
     # Verify emitted results
     requestObjects = requests[0].objects
     expectedResults = [
-      ModelInferenceResult(rowID=rowid, status=0, anomalyScore=score)
-      for rowid, score in zip(
-        [obj.rowID for obj in requestObjects], anomalyScores[2:])
+      ModelInferenceResult(rowID=obj.rowID, status=0, anomalyScore=score,
+                           timestamp=obj.data[0], metricValue=obj.data[1])
+      for obj, score in zip(requestObjects, anomalyScores[2:])
+    ]
+
+    swapperMock.submitResults.assert_called_once_with(
+      modelID=modelID, results=expectedResults)
+
+
+  def testLoadFromSampleLogAndSaveIncremental(
+      self,
+      modelCheckpointMgrClassMock,
+      modelSwapperInterfaceClassMock):
+    # Test replaying the input samples of an incremental checkpoint from the
+    # checkpoint's sample log, and appending new input samples to it
+    modelID = "abc"
+
+    inputRecordSchema = [FieldMetaInfo("c1", "float", "")]
+    anomalyScores = [1.1, 2.2, 3.3, 4.4]
+
+    modelInstanceMock = Mock(
+      run=Mock(
+        side_effect=[
+          Mock(inferences=dict(anomalyScore=score)) for score in anomalyScores
+        ]
+      )
+    )
+
+    loggedSamples = [
+      [datetime.datetime(2015, 3, 4, 5, 6, 7, 8), -1.0],
+      [datetime.datetime(2015, 3, 4, 5, 11, 7, 8), -2.0]
+    ]
+    recordSize = model_runner._ModelArchiver._SAMPLE_LOG_DTYPE.itemsize
+
+    # Stale records of an incomplete checkpoint follow the logged samples
+    logData = model_runner._ModelArchiver._encodeLoggedDataSamples(
+      loggedSamples + [[datetime.datetime(2015, 3, 4, 5, 16), -3.0]])
+    sampleLog = mmap.mmap(-1, len(logData))
+    sampleLog.write(logData)
+
+    checkpointMgrInstanceMock = modelCheckpointMgrClassMock.return_value
+    checkpointMgrInstanceMock.loadCheckpointAttributes. \
+      return_value = (
+        {
+          model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
+            ["1", "2", "3"],
+          model_runner._ModelArchiver._INPUT_SAMPLE_LOG_SIZE_ATTR_NAME:
+            len(loggedSamples)
+        }
+      )
+    checkpointMgrInstanceMock.mapCheckpointLog.return_value = sampleLog
+    checkpointMgrInstanceMock.loadModelDefinition.return_value = (
+      dict(inputSchema=inputRecordSchema))
+    checkpointMgrInstanceMock.load.return_value = modelInstanceMock
+
+    # Prepare input requests for ModelRunner
+    requests = [
+      _ConsumedRequestBatch(
+        batchID="foobar",
+        ack=Mock(),
+        objects=[
+          ModelInputRow(rowID=1, data=[datetime.datetime.utcnow(), 1.0]),
+          ModelInputRow(rowID=2, data=[datetime.datetime.utcnow(), 2.0])])
+    ]
+
+    swapperMock = modelSwapperInterfaceClassMock.return_value
+    swapperMock.consumeRequests.return_value = _FakeConsumer(requests)
+
+    mr = model_runner.ModelRunner(modelID=modelID)
+
+    runnerThread = threading.Thread(target=mr.run)
+    runnerThread.setDaemon(True)
+    runnerThread.start()
+
+    runnerThread.join(timeout=5)
+    self.assertFalse(runnerThread.isAlive())
+
+    mr.close()
+
+    # Verify replay of the logged samples
+    checkpointMgrInstanceMock.mapCheckpointLog.assert_called_once_with(
+      modelID, size=len(loggedSamples) * recordSize)
+    self.assertEqual(modelInstanceMock.run.call_count,
+                     len(loggedSamples) + len(requests[0].objects))
+
+    # The sample log was closed after the replay
+    with self.assertRaises(ValueError):
+      sampleLog.read_byte()
+
+    # Verify that only the new samples were appended to the sample log
+    self.assertEqual(checkpointMgrInstanceMock.save.call_count, 0)
+
+    checkpointMgrInstanceMock.writeCheckpointLog.assert_called_once_with(
+      modelID,
+      offset=len(loggedSamples) * recordSize,
+      data=model_runner._ModelArchiver._encodeLoggedDataSamples(
+        [row.data for row in requests[0].objects]))
+
+    expectedCheckpointAttributes = {
+      model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
+        [requests[0].batchID],
+      model_runner._ModelArchiver._INPUT_SAMPLE_LOG_SIZE_ATTR_NAME:
+        len(loggedSamples) + len(requests[0].objects),
+      model_runner._ModelArchiver._CHECKPOINT_POLICY_ATTR_NAME: ANY
+      }
+    checkpointMgrInstanceMock.updateCheckpointAttributes. \
+      assert_called_once_with(modelID, expectedCheckpointAttributes)
+
+    # Verify emitted results
+    requestObjects = requests[0].objects
+    expectedResults = [
+      ModelInferenceResult(
+        rowID=requestObjects[0].rowID, status=0,
+        anomalyScore=anomalyScores[2],
+        timestamp=requestObjects[0].data[0],
+        metricValue=requestObjects[0].data[1]),
+      ModelInferenceResult(
+        rowID=requestObjects[1].rowID, status=0,
+        anomalyScore=anomalyScores[3],
+        timestamp=requestObjects[1].data[0],
+        metricValue=requestObjects[1].data[1]),
     ]
 
     swapperMock.submitResults.assert_called_once_with(
       modelID=modelID, results=expectedResults)
 
 
+  def testSaveIncrementalWithSamplesThatDontFitSampleLog(
+      self,
+      modelCheckpointMgrClassMock,
+      modelSwapperInterfaceClassMock):
+    # Input samples other than (datetime, number) pairs are saved in the
+    # checkpoint attributes
+    modelID = "abc"
+
+    inputRecordSchema = [FieldMetaInfo("c1", "string", ""),
+                         FieldMetaInfo("c2", "float", "")]
+
+    modelInstanceMock = Mock(
+      run=Mock(return_value=Mock(inferences=dict(anomalyScore=1.0))))
+
+    checkpointMgrInstanceMock = modelCheckpointMgrClassMock.return_value
+    checkpointMgrInstanceMock.loadCheckpointAttributes. \
+      return_value = (
+      {
+        model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
+          ["1", "2", "3"]})
+    checkpointMgrInstanceMock.loadModelDefinition.return_value = (
+      dict(inputSchema=inputRecordSchema))
+    checkpointMgrInstanceMock.load.return_value = modelInstanceMock
+
+    requests = [
+      _ConsumedRequestBatch(
+        batchID="foobar",
+        ack=Mock(),
+        objects=[
+          ModelInputRow(rowID=1, data=["a", 1.0]),
+          ModelInputRow(rowID=2, data=["b", 2.0])])
+    ]
+
+    swapperMock = modelSwapperInterfaceClassMock.return_value
+    swapperMock.consumeRequests.return_value = _FakeConsumer(requests)
+
+    mr = model_runner.ModelRunner(modelID=modelID)
+
+    runnerThread = threading.Thread(target=mr.run)
+    runnerThread.setDaemon(True)
+    runnerThread.start()
+
+    runnerThread.join(timeout=5)
+    self.assertFalse(runnerThread.isAlive())
+
+    mr.close()
+
+    self.assertEqual(checkpointMgrInstanceMock.writeCheckpointLog.call_count,
+                     0)
+
+    expectedCheckpointAttributes = {
+      model_runner._ModelArchiver._BATCH_IDS_CHECKPOINT_ATTR_NAME:
+        [requests[0].batchID],
+      model_runner._ModelArchiver._INPUT_SAMPLES_SINCE_CHECKPOINT_ATTR_NAME:
+        base64.standard_b64encode(cPickle.dumps(
+          [row.data for row in requests[0].objects],
+          cPickle.HIGHEST_PROTOCOL
+        )),
+      model_runner._ModelArchiver._CHECKPOINT_POLICY_ATTR_NAME: ANY
+      }
+    checkpointMgrInstanceMock.updateCheckpointAttributes. \
+      assert_called_once_with(modelID, expectedCheckpointAttributes)
+
+
   @patch.object(
     model_runner, "ModelFactory", autospec=True,
     create=Mock(spec_set=model_runner.ModelFactory.create))
@@ -1188,13 +1398,17 @@ class TestModelRunner(unittest.TestCase):
 
       mr = model_runner.ModelRunner(modelID=modelID)
 
-      runnerThread = threading.Thread(target=mr.run)
-      runnerThread.setDaemon(True)
-      runnerThread.start()
+      # Keep the checkpoint policy from timing the mock checkpoints, so that
+      # its decisions don't depend on how long they took
+      with patch.object(model_runner.AdaptiveCheckpointPolicy,
+                        "recordCheckpoint", autospec=True):
+        runnerThread = threading.Thread(target=mr.run)
+        runnerThread.setDaemon(True)
+        runnerThread.start()
 
-      # It should stop almost immediately after mock-processing all requests
-      runnerThread.join(timeout=5)
-      self.assertFalse(runnerThread.isAlive())
+        # It should stop almost immediately after mock-processing all requests
+        runnerThread.join(timeout=5)
+        self.assertFalse(runnerThread.isAlive())
 
       mr.close()
       swapperMock.close.assert_called_once_with()
@@ -1281,13 +1495,17 @@ class TestModelRunner(unittest.TestCase):
 
       mr = model_runner.ModelRunner(modelID=modelID)
 
-      runnerThread = threading.Thread(target=mr.run)
-      runnerThread.setDaemon(True)
-      runnerThread.start()
+      # Keep the checkpoint policy from timing the mock checkpoints, so that
+      # its decisions don't depend on how long they took
+      with patch.object(model_runner.AdaptiveCheckpointPolicy,
+                        "recordCheckpoint", autospec=True):
+        runnerThread = threading.Thread(target=mr.run)
+        runnerThread.setDaemon(True)
+        runnerThread.start()
 
-      # It should stop almost immediately after mock-processing all requests
-      runnerThread.join(timeout=5)
-      self.assertFalse(runnerThread.isAlive())
+        # It should stop almost immediately after mock-processing all requests
+        runnerThread.join(timeout=5)
+        self.assertFalse(runnerThread.isAlive())
 
       mr.close()
       swapperMock.close.assert_called_once_with()
@@ -1313,6 +1531,111 @@ class TestModelRunner(unittest.TestCase):
       self.assertEqual(swapperMock.submitResults.call_count, len(requests) // 2)
 
 
+  @patch.object(
+    model_runner, "ModelFactory", autospec=True,
+    create=Mock(spec_set=model_runner.ModelFactory.create))
+  @patch.object(os, "waitpid")
+  @patch.object(os, "fork", return_value=1234)
+  def testBackgroundFullCheckpointDefersAck(
+      self, forkMock, waitpidMock, modelFactoryClassMock,
+      modelCheckpointMgrClassMock, modelSwapperInterfaceClassMock):
+    # Verify that a full checkpoint is saved by a forked child process, and that
+    # the input batches are acked only after the child process succeeds
+    modelID = "abc"
+    inputRecordSchema = [FieldMetaInfo("c1", "float", "")]
+    dummyModelParams = dict(modelConfig="a", inferenceArgs="b")
+
+    checkpointMgrInstanceMock = modelCheckpointMgrClassMock.return_value
+    checkpointMgrInstanceMock.loadCheckpointAttributes.side_effect = (
+      model_checkpoint_mgr.ModelNotFound)
+    checkpointMgrInstanceMock.loadModelDefinition.return_value = dict(
+      inputSchema=inputRecordSchema, modelParams=dummyModelParams)
+    checkpointMgrInstanceMock.load.side_effect = (
+      model_checkpoint_mgr.ModelNotFound)
+
+    modelFactoryClassMock.create.return_value = Mock(
+      run=Mock(return_value=Mock(inferences=dict(anomalyScore=1.0))))
+
+    events = []
+    waitpidMock.side_effect = lambda pid, options: (
+      events.append("waitpid") or (pid, 0))
+
+    requests = [
+      _ConsumedRequestBatch(
+        batchID="foobar",
+        ack=Mock(side_effect=lambda multiple=False: events.append("ack")),
+        objects=[
+          ModelInputRow(rowID=1, data=[datetime.datetime.utcnow(), 1.0])])
+    ]
+
+    swapperMock = modelSwapperInterfaceClassMock.return_value
+    swapperMock.consumeRequests.return_value = _FakeConsumer(requests)
+
+    with ConfigAttributePatch(
+        modelSwapperConfig.CONFIG_NAME,
+        modelSwapperConfig.baseConfigDir,
+        (("model_runner", "background_checkpoints", "true"),)):
+      with model_runner.ModelRunner(modelID=modelID) as mr:
+        mr.run()
+
+    forkMock.assert_called_once_with()
+    waitpidMock.assert_called_once_with(1234, 0)
+
+    # The checkpoint is saved by the child process, not by us
+    self.assertEqual(checkpointMgrInstanceMock.save.call_count, 0)
+
+    requests[0].ack.assert_called_once_with(multiple=True)
+    self.assertEqual(events, ["waitpid", "ack"])
+
+
+  @patch.object(
+    model_runner, "ModelFactory", autospec=True,
+    create=Mock(spec_set=model_runner.ModelFactory.create))
+  @patch.object(os, "waitpid", return_value=(1234, 1 << 8))
+  @patch.object(os, "fork", return_value=1234)
+  def testFailedBackgroundCheckpointSuppressesAck(
+      self, forkMock, waitpidMock, modelFactoryClassMock,
+      modelCheckpointMgrClassMock, modelSwapperInterfaceClassMock):
+    modelID = "abc"
+    inputRecordSchema = [FieldMetaInfo("c1", "float", "")]
+    dummyModelParams = dict(modelConfig="a", inferenceArgs="b")
+
+    checkpointMgrInstanceMock = modelCheckpointMgrClassMock.return_value
+    checkpointMgrInstanceMock.loadCheckpointAttributes.side_effect = (
+      model_checkpoint_mgr.ModelNotFound)
+    checkpointMgrInstanceMock.loadModelDefinition.return_value = dict(
+      inputSchema=inputRecordSchema, modelParams=dummyModelParams)
+    checkpointMgrInstanceMock.load.side_effect = (
+      model_checkpoint_mgr.ModelNotFound)
+
+    modelFactoryClassMock.create.return_value = Mock(
+      run=Mock(return_value=Mock(inferences=dict(anomalyScore=1.0))))
+
+    requests = [
+      _ConsumedRequestBatch(
+        batchID="foobar",
+        ack=Mock(),
+        objects=[
+          ModelInputRow(rowID=1, data=[datetime.datetime.utcnow(), 1.0])])
+    ]
+
+    swapperMock = modelSwapperInterfaceClassMock.return_value
+    swapperMock.consumeRequests.return_value = _FakeConsumer(requests)
+
+    with ConfigAttributePatch(
+        modelSwapperConfig.CONFIG_NAME,
+        modelSwapperConfig.baseConfigDir,
+        (("model_runner", "background_checkpoints", "true"),)):
+      with model_runner.ModelRunner(modelID=modelID) as mr:
+        with self.assertRaises(model_runner._BackgroundCheckpointError):
+          mr.run()
+
+    forkMock.assert_called_once_with()
+    waitpidMock.assert_called_once_with(1234, 0)
+
+    # The batch will be redelivered
+    self.assertEqual(requests[0].ack.call_count, 0)
+
   def testInferencePathWithModelNotFound(
     self, modelCheckpointMgrClassMock, modelSwapperInterfaceClassMock):
     # Test ModelRunner's inference-processing error plumbing by sending input
@@ -1448,5 +1771,181 @@ class TestModelRunner(unittest.TestCase):
 
 
 
+  def testModelReturnedToWarmModelCache(
+      self, modelCheckpointMgrClassMock, modelSwapperInterfaceClassMock):
+    modelID = "abc"
+
+    modelCheckpointMgrClassMock.return_value.loadCheckpointAttributes. \
+      side_effect = (model_checkpoint_mgr.ModelNotFound)
+
+    swapperMock = modelSwapperInterfaceClassMock.return_value
+    swapperMock.consumeRequests.return_value = _FakeConsumer([])
+
+    cachedArchiverMock = Mock(spec_set=model_runner._ModelArchiver)
+    modelCacheMock = Mock(spec_set=model_runner._WarmModelCache)
+    modelCacheMock.checkOut.return_value = cachedArchiverMock
+
+    with model_runner.ModelRunner(modelID=modelID, swapperAPI=swapperMock,
+                                  modelCache=modelCacheMock) as mr:
+      modelCacheMock.checkOut.assert_called_once_with(modelID)
+      self.assertIs(mr._archiver, cachedArchiverMock)
+      mr.run()
+
+    # The model goes back to the cache, and the shared ModelSwapperInterface
+    # isn't closed
+    modelCacheMock.checkIn.assert_called_once_with(modelID,
+                                                   cachedArchiverMock)
+    self.assertFalse(swapperMock.close.called)
+
+
+  def testDirtyModelNotReturnedToWarmModelCache(
+      self, modelCheckpointMgrClassMock, modelSwapperInterfaceClassMock):
+    modelID = "abc"
+
+    swapperMock = modelSwapperInterfaceClassMock.return_value
+    modelCacheMock = Mock(spec_set=model_runner._WarmModelCache)
+    modelCacheMock.checkOut.return_value = None
+
+    mr = model_runner.ModelRunner(modelID=modelID, swapperAPI=swapperMock,
+                                  modelCache=modelCacheMock)
+    # Simulate failure after processing input, but before checkpointing
+    mr._modelDirty = True
+    mr.close()
+
+    self.assertFalse(modelCacheMock.checkIn.called)
+
+
+
+class TestWarmModelCache(unittest.TestCase):
+  """ Unit tests for the persistent ModelRunner worker's _WarmModelCache """
+
+  def _patchRSS(self, psutilMock, rss):
+    """ Make the process's RSS track the one-element list rss """
+    psutilMock.Process.return_value.get_memory_info.side_effect = (
+      lambda: Mock(rss=rss[0]))
+
+
+  @staticmethod
+  def _createArchiver(rss, modelBytes):
+    """ Create an archiver mock whose loadModel grows the RSS """
+    archiver = Mock(spec_set=model_runner._ModelArchiver,
+                    isCheckpointCurrent=Mock(return_value=True))
+
+    def loadModel():
+      rss[0] += modelBytes
+
+    archiver.loadModel.side_effect = loadModel
+    return archiver
+
+
+  @patch.object(model_runner, "psutil", autospec=True)
+  def testEvictsLeastRecentlyUsedOverBudget(self, psutilMock):
+    rss = [1000]
+    self._patchRSS(psutilMock, rss)
+
+    # Evicts by the models' size estimates, even though the RSS is within the
+    # baseline plus budget
+    cache = model_runner._WarmModelCache(rssBudgetBytes=100)
+    rss[0] = 0
+
+    archivers = dict((modelID, self._createArchiver(rss, modelBytes=40))
+                     for modelID in ("a", "b", "c", "d"))
+
+    for modelID in ("a", "b", "c"):
+      cache.loadModel(archivers[modelID])
+      self.assertEqual(archivers[modelID].loadModel.call_count, 1)
+      cache.checkIn(modelID, archivers[modelID])
+
+    # 120 bytes exceed the budget
+    self.assertEqual(len(cache), 2)
+    self.assertNotIn("a", cache)
+
+    # Use "b", so that "c" becomes the least recently used model
+    self.assertIs(cache.checkOut("b"), archivers["b"])
+    self.assertNotIn("b", cache)
+    cache.checkIn("b", archivers["b"])
+
+    # A model without a size estimate is assumed to be of average size
+    cache.checkIn("d", archivers["d"])
+
+    self.assertEqual(len(cache), 2)
+    self.assertIn("b", cache)
+    self.assertIn("d", cache)
+
+
+  @patch.object(model_runner, "gc", autospec=True)
+  @patch.object(model_runner, "psutil", autospec=True)
+  def testEvictsOverRSSBudgetWhileRSSDrops(self, psutilMock, gcMock):
+    rss = [1000]
+    self._patchRSS(psutilMock, rss)
+
+    cache = model_runner._WarmModelCache(rssBudgetBytes=100)
+
+    # Models loaded into reused memory have no size estimates
+    for modelID in ("a", "b", "c", "d"):
+      archiver = self._createArchiver(rss, modelBytes=0)
+      cache.loadModel(archiver)
+      cache.checkIn(modelID, archiver)
+    self.assertEqual(len(cache), 4)
+
+    # Each eviction releases 100 bytes until the RSS is within the budget
+    def collect():
+      rss[0] -= 100
+
+    gcMock.collect.side_effect = collect
+    rss[0] = 1250
+    cache.checkIn("e", self._createArchiver(rss, modelBytes=0))
+
+    self.assertEqual(gcMock.collect.call_count, 2)
+    self.assertEqual(len(cache), 3)
+    for modelID in ("c", "d", "e"):
+      self.assertIn(modelID, cache)
+
+
+  @patch.object(model_runner, "gc", autospec=True)
+  @patch.object(model_runner, "psutil", autospec=True)
+  def testStopsEvictingWhenRSSDoesNotShrink(self, psutilMock, gcMock):
+    rss = [1000]
+    self._patchRSS(psutilMock, rss)
+
+    cache = model_runner._WarmModelCache(rssBudgetBytes=100)
+
+    for modelID in ("a", "b", "c"):
+      cache.checkIn(modelID, self._createArchiver(rss, modelBytes=0))
+
+    # The RSS stays over budget, since the allocator keeps the freed memory;
+    # e.g., the baseline RSS grew
+    rss[0] = 2000
+    cache.checkIn("d", self._createArchiver(rss, modelBytes=0))
+
+    self.assertEqual(gcMock.collect.call_count, 1)
+    self.assertEqual(len(cache), 3)
+    self.assertNotIn("a", cache)
+
+    # Every checkIn over budget evicts at most one model while RSS doesn't drop
+    cache.checkIn("e", self._createArchiver(rss, modelBytes=0))
+
+    self.assertEqual(gcMock.collect.call_count, 2)
+    self.assertEqual(len(cache), 3)
+
+
+  @patch.object(model_runner, "psutil", autospec=True)
+  def testModelsNotLoadedOrStaleAreNotReused(self, psutilMock):
+    psutilMock.Process.return_value.get_memory_info.return_value = Mock(rss=0)
+
+    cache = model_runner._WarmModelCache(rssBudgetBytes=100)
+
+    cache.checkIn("a", Mock(spec_set=model_runner._ModelArchiver, model=None))
+    self.assertNotIn("a", cache)
+
+    staleArchiver = Mock(spec_set=model_runner._ModelArchiver,
+                         isCheckpointCurrent=Mock(return_value=False))
+    cache.checkIn("b", staleArchiver)
+    self.assertIsNone(cache.checkOut("b"))
+    self.assertNotIn("b", cache)
+    self.assertIsNone(cache.checkOut("c"))
+
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -441,6 +441,54 @@ class ModelInferenceResultTestCase(unittest.TestCase):
     self.assertIn("ModelInferenceResult<", repr(inferenceResult2))
 
 
+  def testModelInferenceResultSerializableStateWithInput(self):
+    timestamp = datetime.datetime(2015, 3, 4, 5, 6, 7)
+    inferenceResult = ModelInferenceResult(rowID=1, status=0,
+      anomalyScore=0.5, timestamp=timestamp, metricValue=12.5)
+
+    inferenceResult2 = _ModelRequestResultBase.__createFromState__(
+      json.loads(json.dumps(inferenceResult.__getstate__())))
+
+    self.assertEqual(inferenceResult2.rowID, 1)
+    self.assertEqual(inferenceResult2.status, 0)
+    self.assertEqual(inferenceResult2.anomalyScore, 0.5)
+    self.assertIsNone(inferenceResult2.errorMessage)
+    self.assertEqual(inferenceResult2.timestamp, timestamp)
+    self.assertEqual(inferenceResult2.metricValue, 12.5)
+
+
+  def testModelInferenceResultStateWithoutInputIsBackwardCompatible(self):
+    # The state of results without input must remain readable by consumers
+    # that predate timestamp and metricValue, and vice versa
+    inferenceResult = ModelInferenceResult(rowID=1, status=0,
+      anomalyScore=0.5)
+
+    self.assertEqual(inferenceResult.__getstate__(), ["iR", 1, 0, 0.5, None])
+
+    inferenceResult2 = _ModelRequestResultBase.__createFromState__(
+      ["iR", 1, 0, 0.5, None])
+
+    self.assertEqual(inferenceResult2, inferenceResult)
+    self.assertIsNone(inferenceResult2.timestamp)
+    self.assertIsNone(inferenceResult2.metricValue)
+
+
+  def testModelInferenceResultConstructorInvalidInput(self):
+    timestamp = datetime.datetime(2015, 3, 4, 5, 6, 7)
+
+    with self.assertRaises(AssertionError):
+      ModelInferenceResult(rowID=1, status=0, anomalyScore=0.5,
+                           timestamp=timestamp)
+
+    with self.assertRaises(AssertionError):
+      ModelInferenceResult(rowID=1, status=0, anomalyScore=0.5,
+                           metricValue=12.5)
+
+    with self.assertRaises(AssertionError):
+      ModelInferenceResult(rowID=1, status=1, errorMessage="error",
+                           timestamp=timestamp, metricValue=12.5)
+
+
 
 class BatchPackagerTestCase(unittest.TestCase):
   """
@@ -462,6 +510,74 @@ class BatchPackagerTestCase(unittest.TestCase):
     self.assertEqual(requestBatch[2].rowID, inputBatch[2].rowID)
 
 
+  def testMarshalUnmarshalMsgpack(self):
+    now = datetime.datetime(2015, 3, 4, 5, 6, 7, 891011)
+    inputBatch = [
+      ModelCommand(commandID="abc", method="defineModel",
+        args={"key1": 4098, "key2": 4139}),
+      ModelInputRow(rowID=1, data=[now, 1.5]),
+      ModelInputRow(rowID=2, data=[now + datetime.timedelta(minutes=5), -2.0]),
+      ModelInputRow(rowID="foo", data=[9, 54, "Sep 21 02:24:38 UTC 2013"]),
+      ModelInputRow(rowID=3, data=[datetime.datetime(1969, 7, 20, 20, 17),
+                                   0.0]),
+      ModelInferenceResult(rowID=4, status=0, anomalyScore=0.25),
+      ModelInferenceResult(rowID=5, status=1, errorMessage="error"),
+      ModelInferenceResult(rowID=6, status=0, anomalyScore=1.0),
+      ModelInferenceResult(rowID=7, status=0, anomalyScore=0.5,
+                           timestamp=now, metricValue=1.5),
+      ModelInferenceResult(rowID=8, status=0, anomalyScore=0.75,
+                           timestamp=datetime.datetime(1969, 7, 20, 20, 17),
+                           metricValue=-2.0),
+      ModelInferenceResult(rowID=9, status=0, anomalyScore=0.5,
+                           timestamp=now, metricValue=3),
+      ModelCommandResult(commandID="commandID", method="testMethod", status=1,
+        errorMessage="errorMessage"),
+    ]
+
+    batchState = BatchPackager.marshal(
+      batch=inputBatch, batchFormat=BatchPackager.MSGPACK_FORMAT)
+
+    self.assertTrue(batchState.startswith(BatchPackager._MSGPACK_HEADER))
+
+    outputBatch = BatchPackager.unmarshal(batchState=batchState)
+
+    self.assertEqual(len(outputBatch), len(inputBatch))
+    for outputItem, inputItem in zip(outputBatch, inputBatch):
+      self.assertIs(outputItem.__class__, inputItem.__class__)
+      self.assertEqual(outputItem, inputItem)
+
+    self.assertEqual(outputBatch[1].data, [now, 1.5])
+    self.assertEqual(outputBatch[4].data[0],
+                     datetime.datetime(1969, 7, 20, 20, 17))
+    self.assertIsNone(outputBatch[5].timestamp)
+    self.assertEqual(outputBatch[9].timestamp,
+                     datetime.datetime(1969, 7, 20, 20, 17))
+    self.assertEqual(outputBatch[9].metricValue, -2.0)
+
+
+  def testUnmarshalJsonAndMsgpackEquivalent(self):
+    now = datetime.datetime(2015, 3, 4, 5, 6, 7, 891011)
+    inputBatch = [
+      ModelInputRow(rowID=i, data=[now + datetime.timedelta(minutes=i),
+                                   float(i)])
+      for i in xrange(10)
+    ]
+
+    jsonBatch = BatchPackager.unmarshal(
+      BatchPackager.marshal(batch=inputBatch,
+                            batchFormat=BatchPackager.JSON_FORMAT))
+    msgpackBatch = BatchPackager.unmarshal(
+      BatchPackager.marshal(batch=inputBatch,
+                            batchFormat=BatchPackager.MSGPACK_FORMAT))
+
+    self.assertEqual(jsonBatch, msgpackBatch)
+
+
+  def testMarshalUnknownFormat(self):
+    with self.assertRaises(ValueError):
+      BatchPackager.marshal(batch=[], batchFormat="xml")
+
+
 
 class RequestMessagePackagerTestCase(unittest.TestCase):
   """
@@ -607,6 +723,40 @@ class ModelSwapperInterfaceTestCase(unittest.TestCase):
       notificationMQName, json.dumps(modelID), persistent=False)
 
 
+  @patch.object(model_swapper_interface, "MessageBusConnector", autospec=True)
+  def testSubmitRequestsWithoutSchedulerNotification(
+      self, messageBusConnectorClassMock):
+    requests = [
+      ModelInputRow(rowID="foo", data=[1, 2, "Sep 21 02:24:21 UTC 2013"]),
+      ModelInputRow(rowID="bar", data=[9, 54, "Sep 21 02:24:38 UTC 2013"])
+    ]
+
+    modelID = "foofar"
+
+    messageBusConnectorMock = messageBusConnectorClassMock.return_value
+
+    with ModelSwapperInterface() as interface:
+      interface.submitRequests(modelID=modelID, requests=requests[:1],
+                               notifyScheduler=False)
+      interface.submitRequests(modelID=modelID, requests=requests[1:],
+                               notifyScheduler=False)
+
+      modelMQName = interface._modelInputQueueNamePrefix + modelID
+
+      # Only the request batches should have been published
+      self.assertEqual(messageBusConnectorMock.publish.call_count, 2)
+      for call in messageBusConnectorMock.publish.call_args_list:
+        self.assertEqual(call[0][0], modelMQName)
+
+      interface.notifyModelScheduler(modelID)
+
+      notificationMQName = interface._schedulerNotificationQueueName
+
+    self.assertEqual(messageBusConnectorMock.publish.call_count, 3)
+    messageBusConnectorMock.publish.assert_called_with(
+      notificationMQName, json.dumps(modelID), persistent=False)
+
+
   @patch.object(model_swapper_interface, "MessageBusConnector", autospec=True,
                 publish=Mock(spec_set=MessageBusConnector.publish))
   def testSubmitRequestsWithModelNotFoundException(
@@ -952,6 +1102,42 @@ class ModelSwapperInterfaceTestCase(unittest.TestCase):
     self.assertFalse(inputPending)
 
 
+  @patch.object(
+    model_swapper_interface, "MessageBusConnector", autospec=True,
+    getMessageCount=Mock(spec_set=MessageBusConnector.getMessageCount))
+  def testGetModelInputDepth(self, messageBusConnectorClassMock):
+    modelID = "model_foo"
+
+    messageBusConnectorMock = messageBusConnectorClassMock.return_value
+    messageBusConnectorMock.getMessageCount.return_value = 7
+
+    with ModelSwapperInterface() as interface:
+      depth = interface.getModelInputDepth(modelID=modelID)
+
+    self.assertEqual(messageBusConnectorMock.getMessageCount.call_count, 1)
+
+    self.assertEqual(depth, 7)
+
+
+  @patch.object(
+    model_swapper_interface, "MessageBusConnector", autospec=True,
+    getMessageCount=Mock(spec_set=MessageBusConnector.getMessageCount))
+  def testGetModelInputDepthMessageQueueNotFoundInterpretedAsZero(
+    self, messageBusConnectorClassMock):
+    modelID = "model_foo"
+
+    messageBusConnectorMock = messageBusConnectorClassMock.return_value
+    messageBusConnectorMock.getMessageCount.side_effect = (
+      message_bus_connector.MessageQueueNotFound)
+
+    with ModelSwapperInterface() as interface:
+      depth = interface.getModelInputDepth(modelID=modelID)
+
+    self.assertEqual(messageBusConnectorMock.getMessageCount.call_count, 1)
+
+    self.assertEqual(depth, 0)
+
+
   @patch.object(
     model_swapper_interface, "MessageBusConnector", autospec=True,
     isEmpty=Mock(spec_set=MessageBusConnector.isEmpty),
@@ -1106,6 +1292,70 @@ class ModelSwapperInterfaceTestCase(unittest.TestCase):
                                                        persistent=True)
 
 
+  @patch.object(model_swapper_interface, "MessageBusConnector", autospec=True)
+  def testSubmitResultsToPartitionedResultsQueue(self,
+                                                 messageBusConnectorClassMock):
+    results = [ModelInferenceResult(rowID=1, status=0, anomalyScore=1)]
+
+    messageBusConnectorMock = messageBusConnectorClassMock.return_value
+
+    with ConfigAttributePatch(
+        modelSwapperConfig.CONFIG_NAME,
+        modelSwapperConfig.baseConfigDir,
+        ((ModelSwapperInterface._CONFIG_SECTION,
+          ModelSwapperInterface._RESULTS_Q_PARTITIONS_OPTION_NAME,
+          "4"),)):
+
+      resultsQNames = ModelSwapperInterface.getResultsQueueNames()
+
+      with ModelSwapperInterface() as interface:
+        self.assertEqual(
+          resultsQNames,
+          ["%s.%d" % (interface._resultsQueueName, partition)
+           for partition in xrange(4)])
+
+        modelIDs = ["model%d" % (i,) for i in xrange(100)]
+        for modelID in modelIDs * 2:
+          interface.submitResults(modelID=modelID, results=results)
+
+        partitions = [interface.getResultsQueuePartition(modelID)
+                      for modelID in modelIDs]
+
+    self.assertEqual(set(partitions), set(xrange(4)))
+
+    # All of a model's results are published to its partition's queue
+    self.assertEqual(
+      [call[0][0] for call in messageBusConnectorMock.publish.call_args_list],
+      [resultsQNames[partition] for partition in partitions * 2])
+
+
+  @patch.object(model_swapper_interface, "MessageBusConnector", autospec=True,
+                consume=Mock(spec_set=MessageBusConnector.consume))
+  def testConsumeResultsPartition(self, messageBusConnectorClassMock):
+    messageBusConnectorMock = messageBusConnectorClassMock.return_value
+
+    with ConfigAttributePatch(
+        modelSwapperConfig.CONFIG_NAME,
+        modelSwapperConfig.baseConfigDir,
+        ((ModelSwapperInterface._CONFIG_SECTION,
+          ModelSwapperInterface._RESULTS_Q_PARTITIONS_OPTION_NAME,
+          "4"),)):
+
+      self.assertEqual(ModelSwapperInterface.getNumResultsQueuePartitions(), 4)
+
+      with ModelSwapperInterface() as interface:
+        with interface.consumeResults(partition=2) as consumer:
+          iter(consumer)
+
+        with self.assertRaises(ValueError):
+          interface.consumeResults(partition=4)
+
+        resultsQName = interface._resultsQueueName
+
+    messageBusConnectorMock.consume.assert_called_once_with(
+      resultsQName + ".2", blocking=True)
+
+
   @patch.object(
     model_swapper_interface, "MessageBusConnector", autospec=True,
     consume=Mock(spec_set=MessageBusConnector.consume))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Unit tests for the Model Swapper's PendingInputRegistry class
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from htmengine.model_swapper.pending_input_registry import (
+  PendingInputRegistry)
+
+
+
+class PendingInputRegistryTestCase(unittest.TestCase):
+
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tempDir)
+    self.path = os.path.join(self.tempDir, "registry", "journal")
+
+
+  def testOpenWithoutJournal(self):
+    registry = PendingInputRegistry(self.path)
+
+    self.assertIsNone(registry.open())
+    self.assertEqual(len(registry), 0)
+    self.assertTrue(os.path.isfile(self.path))
+
+    registry.close()
+
+
+  def testRegistryPersistedAcrossGracefulClose(self):
+    registry = PendingInputRegistry(self.path)
+    registry.open()
+
+    registry.add("a")
+    registry.add("b")
+    registry.add("a")
+    registry.add("c")
+    registry.remove("b")
+    registry.remove("d")
+
+    self.assertIn("a", registry)
+    self.assertNotIn("b", registry)
+    self.assertEqual(len(registry), 2)
+
+    registry.close()
+
+    registry = PendingInputRegistry(self.path)
+    self.assertEqual(registry.open(), frozenset(["a", "c"]))
+    self.assertEqual(len(registry), 2)
+    registry.close()
+
+
+  def testRegistryNotTrustedWithoutGracefulClose(self):
+    registry = PendingInputRegistry(self.path)
+    registry.open()
+    registry.add("a")
+    registry.close()
+
+    # Reopen and abandon it without closing
+    registry = PendingInputRegistry(self.path)
+    self.assertEqual(registry.open(), frozenset(["a"]))
+    registry.add("b")
+    registry._journal.flush()
+
+    registry = PendingInputRegistry(self.path)
+    self.assertIsNone(registry.open())
+    self.assertEqual(len(registry), 0)
+    registry.close()
+
+
+  def testJournalCompactedOnRemove(self):
+    registry = PendingInputRegistry(self.path)
+    registry._MIN_RECORDS_TO_COMPACT = 10
+    registry.open()
+
+    registry.add("keep")
+    for i in xrange(10):
+      registry.add(str(i))
+      registry.remove(str(i))
+
+    self.assertLess(registry._numRecords, 10)
+
+    registry.close()
+
+    with open(self.path) as journal:
+      self.assertLess(len(journal.read().splitlines()), 10)
+
+    registry = PendingInputRegistry(self.path)
+    self.assertEqual(registry.open(), frozenset(["keep"]))
+    registry.close()
+
+
+
+if __name__ == '__main__':
+  unittest.main()
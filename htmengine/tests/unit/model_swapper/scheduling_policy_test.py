@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2015, Numenta, Inc.  Unless you have purchased from
+# Numenta, Inc. a separate commercial license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+"""
+Unit tests for the Model Swapper's SwapController scheduling policies
+"""
+
+import unittest
+
+from mock import Mock, patch
+
+from htmengine.model_swapper import scheduling_policy
+from htmengine.model_swapper.scheduling_policy import (
+  BacklogPrioritySchedulingPolicy,
+  FifoSchedulingPolicy)
+
+
+
+class FifoSchedulingPolicyTestCase(unittest.TestCase):
+
+
+  def testFifoOrder(self):
+    policy = FifoSchedulingPolicy()
+    self.assertEqual(len(policy), 0)
+
+    for modelID in ("c", "a", "b"):
+      policy.add(modelID)
+
+    self.assertEqual(len(policy), 3)
+    self.assertIn("a", policy)
+    self.assertNotIn("d", policy)
+
+    self.assertEqual([policy.pop() for _ in xrange(3)], ["c", "a", "b"])
+    self.assertEqual(len(policy), 0)
+    self.assertNotIn("a", policy)
+
+    with self.assertRaises(IndexError):
+      policy.pop()
+
+
+
+class BacklogPrioritySchedulingPolicyTestCase(unittest.TestCase):
+
+
+  @patch.object(scheduling_policy.time, "time", autospec=True)
+  def testDeepBacklogScheduledAheadOfRecentShallowModels(self, timeMock):
+    depths = {"shallow1": 1, "shallow2": 1, "deep": 1000}
+    policy = BacklogPrioritySchedulingPolicy(getInputDepth=depths.get,
+                                             depthWeightSec=10,
+                                             swapCostSec=2)
+
+    timeMock.return_value = 1000
+    policy.add("shallow1")
+    timeMock.return_value = 1001
+    policy.add("shallow2")
+    timeMock.return_value = 1002
+    policy.add("deep")
+
+    self.assertEqual([policy.pop() for _ in xrange(3)],
+                     ["deep", "shallow1", "shallow2"])
+
+
+  @patch.object(scheduling_policy.time, "time", autospec=True)
+  def testLongWaitingShallowModelNotStarved(self, timeMock):
+    depths = {"shallow": 1, "deep": 1000}
+    policy = BacklogPrioritySchedulingPolicy(getInputDepth=depths.get,
+                                             depthWeightSec=10,
+                                             swapCostSec=2)
+
+    # The depth bonus of the deep model is about 100 seconds, so a shallow
+    # model that has waited longer than that is scheduled first
+    timeMock.return_value = 1000
+    policy.add("shallow")
+    timeMock.return_value = 1200
+    policy.add("deep")
+
+    self.assertEqual([policy.pop() for _ in xrange(2)], ["shallow", "deep"])
+
+
+  @patch.object(scheduling_policy.time, "time", autospec=True,
+                return_value=1000)
+  def testEmptyInputQueueTreatedAsDepthOne(self, _timeMock):
+    getInputDepth = Mock(side_effect={"a": 0, "b": 1}.get)
+    policy = BacklogPrioritySchedulingPolicy(getInputDepth=getInputDepth,
+                                             depthWeightSec=10,
+                                             swapCostSec=2)
+
+    policy.add("a")
+    policy.add("b")
+
+    self.assertEqual(getInputDepth.call_count, 2)
+    self.assertEqual([policy.pop() for _ in xrange(2)], ["a", "b"])
+
+
+
+class CreateSchedulingPolicyTestCase(unittest.TestCase):
+
+
+  def _createConfigMock(self, policyName):
+    config = Mock(spec_set=["get", "getfloat"])
+    config.get.return_value = policyName
+    config.getfloat.return_value = 1.0
+    return config
+
+
+  def testCreateFifo(self):
+    policy = scheduling_policy.createSchedulingPolicy(
+      self._createConfigMock("fifo"), getInputDepth=Mock())
+
+    self.assertIsInstance(policy, FifoSchedulingPolicy)
+
+
+  def testCreateBacklogPriority(self):
+    policy = scheduling_policy.createSchedulingPolicy(
+      self._createConfigMock("backlog_priority"), getInputDepth=Mock())
+
+    self.assertIsInstance(policy, BacklogPrioritySchedulingPolicy)
+
+
+  def testCreateUnknownPolicy(self):
+    with self.assertRaises(ValueError):
+      scheduling_policy.createSchedulingPolicy(
+        self._createConfigMock("lifo"), getInputDepth=Mock())
+
+
+
+if __name__ == '__main__':
+  unittest.main()
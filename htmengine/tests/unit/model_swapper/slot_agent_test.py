@@ -197,6 +197,83 @@ class SlotAgentTestCase(unittest.TestCase):
       self.assertEqual(modelRunnerProxyMock.stopGracefully.call_count, 1)
 
 
+  @patch.object(slot_agent, "PooledModelRunnerProxy", autospec=True)
+  @patch.object(slot_agent, "ModelRunnerWorker", autospec=True)
+  @patch.object(slot_agent, "ModelRunnerProxy", autospec=True,
+                side_effect=AssertionError(
+                  "ModelRunnerProxy constructor should not have been called"))
+  @patch.object(slot_agent, "ModelSwapperConfig", autospec=True)
+  def testSwapModelsInPersistentWorker(self, modelSwapperConfigClassMock,
+                                       _modelRunnerProxyClassMock,
+                                       modelRunnerWorkerClassMock,
+                                       pooledModelRunnerProxyClassMock):
+    modelSwapperConfigClassMock.return_value.getboolean.return_value = True
+
+    workerMock = Mock(spec_set=slot_agent.ModelRunnerWorker, isAlive=True)
+    modelRunnerWorkerClassMock.return_value = workerMock
+
+    pooledModelRunnerProxyClassMock.return_value.stopGracefully.return_value = 0
+
+    modelFinishedQ = Queue.Queue()
+
+    def modelFinishedCallback(modelID, exitStatus):
+      modelFinishedQ.put((modelID, exitStatus))
+
+    sa = slot_agent.SlotAgent(slotID=1)
+
+    modelIDs = ["abc", "def"]
+
+    for modelID in modelIDs:
+      sa.startModel(
+        modelID=modelID,
+        modelFinishedCallback=partial(modelFinishedCallback, modelID))
+      sa.stopModel()
+      self.assertEqual((modelID, 0), modelFinishedQ.get(timeout=5))
+      sa.releaseSlot()
+
+    # Close slot agent
+    t = threading.Thread(target=sa.close)
+    t.setDaemon(True)
+    t.start()
+    t.join(timeout=5)
+    self.assertFalse(t.isAlive())
+
+    # Both models ran in the same worker, which was closed with the agent
+    self.assertEqual(modelRunnerWorkerClassMock.call_count, 1)
+    self.assertEqual(
+      [kwargs["modelID"] for _args, kwargs
+       in pooledModelRunnerProxyClassMock.call_args_list],
+      modelIDs)
+    for _args, kwargs in pooledModelRunnerProxyClassMock.call_args_list:
+      self.assertIs(kwargs["worker"], workerMock)
+    self.assertEqual(workerMock.close.call_count, 1)
+
+
+  def testPooledModelRunnerProxyStopGracefully(self):
+    modelStopRequested = threading.Event()
+    workerMock = Mock(spec_set=slot_agent.ModelRunnerWorker)
+    workerMock.stopModel.side_effect = modelStopRequested.set
+    workerMock.waitForModelExit.side_effect = (
+      lambda: modelStopRequested.wait(5) and 0)
+
+    onTermination = Mock()
+
+    proxy = slot_agent.PooledModelRunnerProxy(
+      modelID="abc",
+      onTermination=onTermination,
+      logger=slot_agent._getLogger(),
+      worker=workerMock)
+
+    workerMock.runModel.assert_called_once_with("abc")
+    self.assertFalse(onTermination.called)
+
+    self.assertEqual(proxy.stopGracefully(), 0)
+
+    self.assertEqual(workerMock.stopModel.call_count, 1)
+    self.assertEqual(onTermination.call_count, 1)
+    self.assertFalse(workerMock.kill.called)
+
+
   @patch.object(
     slot_agent, "ModelRunnerProxy", autospec=True,
     side_effect=RuntimeError("Something that should trigger "
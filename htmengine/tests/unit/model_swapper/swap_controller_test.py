@@ -299,6 +299,33 @@ class TestSwapController(unittest.TestCase):
     del sc
 
 
+  @patch.multiple(swap_controller, autospec=True,
+                  ModelSwapperInterface=mock.DEFAULT,
+                  SlotAgent=mock.DEFAULT)
+  def testNewInputNotificationsCoalesced(self, **_kwargs):
+    sc = SwapController(concurrency=3)
+
+    for modelID in ("abc", "def", "abc", "abc", "def"):
+      sc._newInputNotifyTS(modelID)
+
+    # A single event should have been enqueued for all notifications
+    self.assertEqual(sc._eventQ.qsize(), 1)
+    evt = sc._eventQ.get_nowait()
+    self.assertEqual(evt, {"method": SwapController._NEW_INPUT_NOTIFY_METHOD})
+
+    with patch.object(sc, "_handleNewModelInput",
+                      autospec=True) as handleNewModelInputMock:
+      sc._handleNewInputNotifyEvent(**evt)
+
+    self.assertEqual(
+      [call[0][0] for call in handleNewModelInputMock.call_args_list],
+      ["abc", "def"])
+
+    # The dirty set was drained, so a new notification enqueues a new event
+    sc._newInputNotifyTS("abc")
+    self.assertEqual(sc._eventQ.qsize(), 1)
+
+
   @patch.object(swap_controller, "ModelSwapperInterface", autospec=True,
                 return_value=_createModelSwapperInterfaceInstanceMock())
   @patch.object(swap_controller, "SlotAgent", autospec=True)
@@ -463,6 +463,44 @@ class InferenceResultTestCase(unittest.TestCase):
         batch.objects,
         metricID=metricDataRow.uid)
 
+    (ModelSwapperInterfaceMock.return_value.__enter__.return_value
+     .consumeResults.assert_called_once_with(partition=0))
+
+
+  def testRunPublishesCommandResultToCommandResultsExchange(
+      self, _repositoryMock, ModelSwapperInterfaceMock,
+      MessageBusConnectorMock, *_args):
+    """ AnomalyService.run() should publish model command results to both the
+    model results exchange and the model command results exchange
+    """
+    batch = model_swapper_interface._ConsumedResultBatch(
+      modelID="abcdef",
+      objects=[
+        model_swapper_interface.ModelCommandResult(
+          commandID="123", method="defineModel", status=0)],
+      ack=Mock(spec_set=(lambda multiple: None))
+    )
+
+    (ModelSwapperInterfaceMock.return_value.__enter__.return_value
+     .consumeResults.return_value) = MagicMock(
+       __enter__=Mock(return_value=[batch]))
+
+    service = anomaly_service.AnomalyService()
+
+    with patch.object(service, "_processModelCommandResult", autospec=True), \
+        patch.object(service, "_composeModelCommandResultMessage",
+                     autospec=True, return_value=dict(method="defineModel")):
+      service.run()
+
+    publishExgMock = (
+      MessageBusConnectorMock.return_value.__enter__.return_value.publishExg)
+    self.assertEqual(
+      [call[1]["exchange"] for call in publishExgMock.call_args_list],
+      [service._modelResultsExchange, service._modelCommandResultsExchange])
+    self.assertEqual(publishExgMock.call_args_list[0][1]["body"],
+                     publishExgMock.call_args_list[1][1]["body"])
+    batch.ack.assert_called_once_with()
+
 
   def testComposeModelInferenceResultsMessage(self, *_args):
     """ Validate AnomalyService._composeModelInferenceResultsMessage result
@@ -696,6 +734,209 @@ class InferenceResultTestCase(unittest.TestCase):
     self.assertEqual(updateAnomalyLikelihoodParamsMock.call_count, 0)
 
 
+  def testProcessModelInferenceResultsUpdatesMetricDataInBatch(
+      self, repoMock, *_args):
+    """_processModelInferenceResults should store the scores of all metric data
+    rows of the batch with one updateMetricDataColumnsBatch call
+    """
+    class MetricRowSpec(object):
+      uid = None
+      status = None
+      parameters = None
+      server = None
+      model_params = None
+
+    metricRowMock = Mock(
+        spec_set=MetricRowSpec,
+        uid="abc",
+        status=MetricStatus.ACTIVE,
+        parameters=None,
+        model_params="{}")
+    repoMock.getMetric.return_value = metricRowMock
+
+    timestamp = datetime.datetime(2015, 4, 17, 12, 3, 35)
+    metricDataRows = [
+      anomaly_service.MutableMetricDataRow(
+        uid="abc",
+        rowid=rowid,
+        metric_value=10.9,
+        timestamp=timestamp + datetime.timedelta(minutes=5 * rowid),
+        raw_anomaly_score=rowid / 10.0,
+        anomaly_score=None,
+        display_value=None)
+      for rowid in xrange(1, 4)
+    ]
+    repoMock.getMetricData.return_value = metricDataRows
+
+    runner = anomaly_service.AnomalyService()
+
+    runner._scrubInferenceResultsAndInitMetricData = Mock(
+      spec_set=runner._scrubInferenceResultsAndInitMetricData,
+      return_value=None)
+
+    def updateModelAnomalyScores(engine, metricObj, metricDataRows):
+      for metricData in metricDataRows:
+        metricData.anomaly_score = 1.0 - metricData.raw_anomaly_score
+      return {"params": "likelihood-params"}
+
+    runner.likelihoodHelper.updateModelAnomalyScores = Mock(
+      spec_set=runner.likelihoodHelper.updateModelAnomalyScores,
+      side_effect=updateModelAnomalyScores)
+
+    runner._updateAnomalyLikelihoodParams = Mock(
+      spec_set=runner._updateAnomalyLikelihoodParams)
+
+    inferenceResults = [
+      ModelInferenceResult(rowID=row.rowid, status=0,
+                           anomalyScore=row.raw_anomaly_score)
+      for row in metricDataRows
+    ]
+
+    self.assertEqual(
+      runner._processModelInferenceResults(inferenceResults, metricID="abc"),
+      (metricRowMock, metricDataRows))
+
+    self.assertEqual(repoMock.updateMetricDataColumnsBatch.call_count, 1)
+    self.assertFalse(repoMock.updateMetricDataColumns.called)
+
+    _conn, metricId, rowFields = (
+      repoMock.updateMetricDataColumnsBatch.call_args[0])
+    self.assertEqual(metricId, "abc")
+    self.assertEqual(
+      rowFields,
+      dict((row.rowid, {"raw_anomaly_score": row.raw_anomaly_score,
+                        "anomaly_score": 1.0 - row.raw_anomaly_score,
+                        "display_value": row.display_value})
+           for row in metricDataRows))
+
+    runner._updateAnomalyLikelihoodParams.assert_called_once_with(
+      _conn, "abc", "{}", {"params": "likelihood-params"})
+
+
+  def testProcessModelInferenceResultsDiscardsCachedStatsSamplesOnFailure(
+      self, repoMock, *_args):
+    """_processModelInferenceResults should discard the model's statistics
+    samples cached by updateModelAnomalyScores if the batch fails to be saved
+    """
+    class MetricRowSpec(object):
+      uid = None
+      status = None
+      parameters = None
+      server = None
+      model_params = None
+
+    repoMock.getMetric.return_value = Mock(
+        spec_set=MetricRowSpec,
+        uid="abc",
+        status=MetricStatus.ACTIVE,
+        parameters=None,
+        model_params="{}")
+
+    runner = anomaly_service.AnomalyService()
+
+    runner.likelihoodHelper.updateModelAnomalyScores = Mock(
+      spec_set=runner.likelihoodHelper.updateModelAnomalyScores,
+      return_value=dict())
+
+    runner.likelihoodHelper.discardCachedStatsSamples = Mock(
+      spec_set=runner.likelihoodHelper.discardCachedStatsSamples)
+
+    runner._updateAnomalyLikelihoodParams = Mock(
+      spec_set=runner._updateAnomalyLikelihoodParams)
+
+    timestamp = datetime.datetime(2015, 4, 17, 12, 3, 35)
+    inferenceResults = [
+      ModelInferenceResult(rowID=rowid, status=0, anomalyScore=rowid / 10.0,
+                           timestamp=timestamp + datetime.timedelta(
+                             minutes=5 * rowid),
+                           metricValue=float(rowid))
+      for rowid in xrange(1, 4)
+    ]
+
+    # Saved
+    self.assertIsNotNone(
+      runner._processModelInferenceResults(inferenceResults, metricID="abc"))
+    self.assertFalse(runner.likelihoodHelper.discardCachedStatsSamples.called)
+
+    # Rejected
+    repoMock.updateMetricDataColumnsBatch.side_effect = (
+      app_exceptions.MetricNotActiveError("faking it"))
+
+    self.assertIsNone(
+      runner._processModelInferenceResults(inferenceResults, metricID="abc"))
+    runner.likelihoodHelper.discardCachedStatsSamples.assert_called_once_with(
+      "abc")
+
+    # Failed
+    runner.likelihoodHelper.discardCachedStatsSamples.reset_mock()
+    repoMock.updateMetricDataColumnsBatch.side_effect = RuntimeError(
+      "faking it")
+
+    with self.assertRaises(RuntimeError):
+      runner._processModelInferenceResults(inferenceResults, metricID="abc")
+    runner.likelihoodHelper.discardCachedStatsSamples.assert_called_once_with(
+      "abc")
+
+
+  def testProcessModelInferenceResultsWithInputSkipsMetricDataQuery(
+      self, repoMock, *_args):
+    """_processModelInferenceResults should initialize the metric data rows
+    from results that carry their input instead of loading them, and fall back
+    to loading them otherwise
+    """
+    class MetricRowSpec(object):
+      uid = None
+      status = None
+      parameters = None
+      server = None
+      model_params = None
+
+    repoMock.getMetric.return_value = Mock(
+        spec_set=MetricRowSpec,
+        uid="abc",
+        status=MetricStatus.ACTIVE,
+        parameters=None,
+        model_params="{}")
+
+    runner = anomaly_service.AnomalyService()
+
+    runner.likelihoodHelper.updateModelAnomalyScores = Mock(
+      spec_set=runner.likelihoodHelper.updateModelAnomalyScores,
+      return_value=dict())
+
+    runner._updateAnomalyLikelihoodParams = Mock(
+      spec_set=runner._updateAnomalyLikelihoodParams)
+
+    timestamp = datetime.datetime(2015, 4, 17, 12, 3, 35)
+    inferenceResults = [
+      ModelInferenceResult(rowID=rowid, status=0, anomalyScore=rowid / 10.0,
+                           timestamp=timestamp + datetime.timedelta(
+                             minutes=5 * rowid),
+                           metricValue=float(rowid))
+      for rowid in xrange(1, 4)
+    ]
+
+    _metricObj, metricDataRows = runner._processModelInferenceResults(
+      inferenceResults, metricID="abc")
+
+    self.assertFalse(repoMock.getMetricData.called)
+    self.assertEqual(
+      [(row.uid, row.rowid, row.timestamp, row.metric_value,
+        row.raw_anomaly_score) for row in metricDataRows],
+      [("abc", result.rowID, result.timestamp, result.metricValue,
+        result.anomalyScore) for result in inferenceResults])
+
+    # metric_data stores whole seconds, so the rows are loaded if the input
+    # timestamps have fractional seconds
+    inferenceResults[1].timestamp += datetime.timedelta(microseconds=500000)
+    repoMock.getMetricData.return_value = []
+
+    self.assertIsNone(
+      runner._processModelInferenceResults(inferenceResults, metricID="abc"))
+
+    self.assertEqual(repoMock.getMetricData.call_count, 1)
+
+
   def testTruncatedInferenceResultsInScrubInferernceResults(
       self, *_args):
     """Calling _scrubInferenceResultsAndInitMetricData with fewer
@@ -944,5 +1185,91 @@ class UpdateAnomalyLikelihoodParamsTestCase(unittest.TestCase):
         json.dumps({"anomalyLikelihoodParams": "likelihood-state"})})
 
 
+
+@patch.object(anomaly_service, "time", autospec=True)
+@patch.object(anomaly_service, "signal", autospec=True)
+@patch.object(anomaly_service.multiprocessing, "Process", autospec=True)
+class PartitionWorkersTestCase(unittest.TestCase):
+  """ Unit tests for running AnomalyService on a partitioned model results
+  queue
+  """
+
+  @staticmethod
+  def _createProcesses(processClassMock, numProcesses):
+    processes = [Mock(spec_set=anomaly_service.multiprocessing.Process,
+                      exitcode=None)
+                 for _ in xrange(numProcesses)]
+    for process in processes:
+      process.is_alive.return_value = True
+
+    processClassMock.side_effect = processes
+    return processes
+
+
+  def testRunPartitionWorkersStopsWorkersWhenOneExits(
+      self, processClassMock, _signalMock, timeMock):
+    processes = self._createProcesses(processClassMock, 3)
+
+    def exitWorker(_sec):
+      processes[1].is_alive.return_value = False
+      processes[1].exitcode = 1
+
+    timeMock.sleep.side_effect = exitWorker
+
+    with self.assertRaises(anomaly_service._PartitionWorkerError):
+      anomaly_service._runPartitionWorkers(3)
+
+    self.assertEqual(
+      [call[1]["args"] for call in processClassMock.call_args_list],
+      [(0,), (1,), (2,)])
+
+    for process in processes:
+      self.assertEqual(process.start.call_count, 1)
+      self.assertEqual(process.join.call_count, 1)
+
+    self.assertEqual(processes[0].terminate.call_count, 1)
+    self.assertFalse(processes[1].terminate.called)
+    self.assertEqual(processes[2].terminate.call_count, 1)
+
+
+  def testRunPartitionWorkersStopsWorkersOnSigterm(
+      self, processClassMock, signalMock, timeMock):
+    processes = self._createProcesses(processClassMock, 2)
+
+    def sendSigterm(_sec):
+      (signum, handler), _kwargs = signalMock.signal.call_args
+      self.assertIs(signum, signalMock.SIGTERM)
+      handler(signum, None)
+
+    timeMock.sleep.side_effect = sendSigterm
+
+    anomaly_service._runPartitionWorkers(2)
+
+    for process in processes:
+      self.assertEqual(process.terminate.call_count, 1)
+      self.assertEqual(process.join.call_count, 1)
+
+
+  @patch.object(anomaly_service, "_runPartitionWorkers", autospec=True)
+  @patch.object(anomaly_service, "AnomalyService", autospec=True)
+  @patch.object(anomaly_service, "ModelSwapperInterface", autospec=True)
+  def testMainRunsWorkerPerResultsQueuePartition(
+      self, modelSwapperInterfaceClassMock, anomalyServiceClassMock,
+      runPartitionWorkersMock, *_args):
+    modelSwapperInterfaceClassMock.getNumResultsQueuePartitions.return_value = 1
+    anomaly_service.main([])
+
+    anomalyServiceClassMock.return_value.run.assert_called_once_with()
+    self.assertFalse(runPartitionWorkersMock.called)
+
+    anomalyServiceClassMock.reset_mock()
+    modelSwapperInterfaceClassMock.getNumResultsQueuePartitions.return_value = 4
+    anomaly_service.main([])
+
+    runPartitionWorkersMock.assert_called_once_with(4)
+    self.assertFalse(anomalyServiceClassMock.called)
+
+
+
 if __name__ == '__main__':
   unittest.main()
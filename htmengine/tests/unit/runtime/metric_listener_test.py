@@ -22,11 +22,17 @@
 
 """Tests the metric listener."""
 
+import cPickle
+import os
 import socket
+import struct
+import threading
+import time
 import unittest
 
 import mock
 from mock import MagicMock, Mock, patch
+import msgpack
 
 from htmengine.runtime import metric_listener
 from htmengine.runtime.metric_listener import Protocol, TCPHandler
@@ -121,6 +127,427 @@ class MetricListenerTest(unittest.TestCase):
       reader.next()
 
 
+  def testLineBatchAccumulator(self):
+    accumulator = metric_listener._LineBatchAccumulator()
+
+    self.assertEqual(accumulator.feed("test.metric 4 1386120789\ntest.met"),
+                     [])
+    self.assertEqual(accumulator.feed("ric 5 1386120799\n\ntest.metric 6"),
+                     [])
+
+    # Data break forwards complete lines only
+    self.assertEqual(accumulator.flush(),
+                     ["test.metric 4 1386120789", "test.metric 5 1386120799"])
+    self.assertIsNone(accumulator.flush())
+
+    # End of stream forwards the unterminated remnant
+    self.assertEqual(accumulator.feed(" 1386120999"), [])
+    self.assertEqual(accumulator.close(), ["test.metric 6 1386120999"])
+    self.assertIsNone(accumulator.close())
+
+
+  @patch.object(metric_listener, "_MAX_BATCH_SIZE", 2)
+  def testLineBatchAccumulatorMaxBatchSize(self):
+    accumulator = metric_listener._LineBatchAccumulator()
+
+    batches = accumulator.feed("a 1 1\nb 2 2\nc 3 3\nd 4 4\ne 5 5\n")
+
+    self.assertEqual(batches, [["a 1 1", "b 2 2"], ["c 3 3", "d 4 4"]])
+    self.assertEqual(accumulator.flush(), ["e 5 5"])
+
+
+  def testEventLoopServerTCP(self):
+    publisherPoolMock = Mock(spec_set=metric_listener._PublisherPool)
+    publisherPoolMock.numPublishers = 2
+
+    server = metric_listener.EventLoopServer(
+      ("127.0.0.1", 0), metric_listener.Transport.TCP, publisherPoolMock)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.setDaemon(True)
+    serverThread.start()
+    try:
+      samples = ["test.metric.%d %d 1386120789" % (i % 3, i)
+                 for i in xrange(metric_listener._MAX_BATCH_SIZE + 5)]
+
+      clients = [socket.create_connection(server.server_address)
+                 for _ in xrange(3)]
+      for i, client in enumerate(clients):
+        client.sendall("".join(
+          sample + "\n" for sample in samples if sample.startswith(
+            "test.metric.%d " % (i,))))
+
+      # The last sample is sent without a trailing newline
+      clients[0].sendall("test.metric.0 999 1386120999")
+
+      for client in clients:
+        client.close()
+
+      # Wait for the server to drain the connections
+      deadline = time.time() + 10
+      while (sum(len(args[0]) for args, _kwargs
+                 in publisherPoolMock.submit.call_args_list) <
+             len(samples) + 1 and time.time() < deadline):
+        time.sleep(0.01)
+    finally:
+      server.shutdown()
+      serverThread.join(10)
+      server.server_close()
+
+    self.assertFalse(serverThread.isAlive())
+
+    forwarded = []
+    publisherIndexes = dict()
+    for (batch, publisherIndex), _kwargs in (
+        publisherPoolMock.submit.call_args_list):
+      self.assertLessEqual(len(batch), metric_listener._MAX_BATCH_SIZE)
+      forwarded.extend(batch)
+
+      # All batches of a connection go to the same publisher
+      metricName = batch[0].split()[0]
+      self.assertEqual(publisherIndexes.setdefault(metricName, publisherIndex),
+                       publisherIndex)
+
+    self.assertItemsEqual(forwarded,
+                          samples + ["test.metric.0 999 1386120999"])
+    self.assertItemsEqual(publisherIndexes.values(), [0, 1, 0])
+
+
+  def testEventLoopServerUDPBatchesSamplesPerPublisherByMetric(self):
+    publisherPoolMock = Mock(spec_set=metric_listener._PublisherPool)
+    publisherPoolMock.getPublisherIndex.side_effect = (
+      lambda key: metric_listener.getConsistentHashPartition(key, 4))
+
+    server = metric_listener.EventLoopServer(
+      ("127.0.0.1", 0), metric_listener.Transport.UDP, publisherPoolMock)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.setDaemon(True)
+    serverThread.start()
+    try:
+      samples = ["test.metric.%d %d %d" % (i % 5, i, 1386120789 + i)
+                 for i in xrange(50)]
+
+      client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      for sample in samples:
+        client.sendto(sample, server.server_address)
+      client.close()
+
+      deadline = time.time() + 10
+      while (sum(len(args[0]) for args, _kwargs
+                 in publisherPoolMock.submit.call_args_list) <
+             len(samples) and time.time() < deadline):
+        time.sleep(0.01)
+    finally:
+      server.shutdown()
+      serverThread.join(10)
+      server.server_close()
+
+    self.assertFalse(serverThread.isAlive())
+
+    forwardedByMetric = dict()
+    for (batch, publisherIndex), _kwargs in (
+        publisherPoolMock.submit.call_args_list):
+      for sample in batch:
+        metricName = sample.split()[0]
+        self.assertEqual(
+          publisherIndex,
+          metric_listener.getConsistentHashPartition(metricName, 4))
+        forwardedByMetric.setdefault(metricName, []).append(sample)
+
+    # Each metric's samples are submitted in the order that they were received
+    for metricName, forwarded in forwardedByMetric.iteritems():
+      self.assertEqual(
+        forwarded,
+        [sample for sample in samples if sample.split()[0] == metricName])
+    self.assertEqual(sum(len(forwarded)
+                         for forwarded in forwardedByMetric.itervalues()),
+                     len(samples))
+
+
+  @patch.object(metric_listener, "MessageBusConnector", autospec=True)
+  @patch.object(metric_listener, "_forwardBatch", autospec=True)
+  def testEventLoopServerTCPPublishesConnectionBatchesInOrder(
+      self, forwardBatchMock, _messageBusConnectorMock):
+    published = []
+    publishedLock = threading.Lock()
+
+    def forwardBatch(_messageBus, batch):
+      # Slow down some publishers, so that a batch submitted to another
+      # publisher would overtake the batches before it
+      time.sleep(0.001 * (len(published) % 3))
+      with publishedLock:
+        published.extend(batch)
+
+    forwardBatchMock.side_effect = forwardBatch
+
+    publisherPool = metric_listener._PublisherPool(numPublishers=4)
+    server = metric_listener.EventLoopServer(
+      ("127.0.0.1", 0), metric_listener.Transport.TCP, publisherPool)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.setDaemon(True)
+    publisherPool.start()
+    serverThread.start()
+    try:
+      samples = ["test.metric %d %d" % (i, 1386120789 + i)
+                 for i in xrange(metric_listener._MAX_BATCH_SIZE * 10)]
+
+      client = socket.create_connection(server.server_address)
+      for i in xrange(0, len(samples), 50):
+        client.sendall("".join(sample + "\n" for sample in samples[i:i+50]))
+      client.close()
+
+      deadline = time.time() + 10
+      while len(published) < len(samples) and time.time() < deadline:
+        time.sleep(0.01)
+    finally:
+      server.shutdown()
+      serverThread.join(10)
+      server.server_close()
+      publisherPool.stop()
+
+    self.assertFalse(serverThread.isAlive())
+    self.assertGreater(forwardBatchMock.call_count, 1)
+    self.assertEqual(published, samples)
+
+
+
+  def testSampleCoalescerMaxSamples(self):
+    publisherPoolMock = Mock(spec_set=metric_listener._PublisherPool)
+    publisherPoolMock.getPublisherIndex.return_value = 0
+
+    # Large delay, so only the size bound can trigger submission
+    coalescer = metric_listener._SampleCoalescer(publisherPoolMock,
+                                                 maxSamples=3,
+                                                 maxDelaySec=3600)
+    coalescer.start()
+    try:
+      for i in xrange(7):
+        coalescer.add("test.metric %d 1386120789" % (i,))
+
+      self.assertEqual(publisherPoolMock.submit.call_count, 2)
+    finally:
+      coalescer.stop()
+
+    # stop() submits the remnant
+    self.assertEqual(
+      publisherPoolMock.submit.call_args_list,
+      [mock.call(["test.metric %d 1386120789" % (i,) for i in xrange(3)],
+                 publisherIndex=0),
+       mock.call(["test.metric %d 1386120789" % (i,) for i in xrange(3, 6)],
+                 publisherIndex=0),
+       mock.call(["test.metric 6 1386120789"], publisherIndex=0)])
+
+
+  def testSampleCoalescerMaxDelay(self):
+    publisherPoolMock = Mock(spec_set=metric_listener._PublisherPool)
+    publisherPoolMock.getPublisherIndex.return_value = 0
+
+    coalescer = metric_listener._SampleCoalescer(publisherPoolMock,
+                                                 maxSamples=1000,
+                                                 maxDelaySec=0.01)
+    coalescer.start()
+    try:
+      coalescer.add("test.metric 4 1386120789")
+      coalescer.add("test.metric 5 1386120799")
+
+      deadline = time.time() + 10
+      while not publisherPoolMock.submit.called and time.time() < deadline:
+        time.sleep(0.01)
+
+      publisherPoolMock.submit.assert_called_once_with(
+        ["test.metric 4 1386120789", "test.metric 5 1386120799"],
+        publisherIndex=0)
+    finally:
+      coalescer.stop()
+
+    self.assertEqual(publisherPoolMock.submit.call_count, 1)
+
+
+  @patch.object(metric_listener, "MessageBusConnector", autospec=True)
+  @patch.object(metric_listener, "_forwardBatch", autospec=True)
+  def testSampleCoalescerPublishesEachMetricInOrder(self, forwardBatchMock,
+                                                    _messageBusConnectorMock):
+    published = []
+    publishedLock = threading.Lock()
+
+    def forwardBatch(_messageBus, batch):
+      # Slow down some publishers, so that a batch submitted to another
+      # publisher would overtake the batches before it
+      time.sleep(0.001 * (len(published) % 3))
+      with publishedLock:
+        published.extend(batch)
+
+    forwardBatchMock.side_effect = forwardBatch
+
+    publisherPool = metric_listener._PublisherPool(numPublishers=4)
+    coalescer = metric_listener._SampleCoalescer(publisherPool,
+                                                 maxSamples=7,
+                                                 maxDelaySec=0.001)
+    samples = ["test.metric.%d %d %d" % (i % 10, i, 1386120789 + i)
+               for i in xrange(2000)]
+
+    publisherPool.start()
+    coalescer.start()
+    try:
+      for sample in samples:
+        coalescer.add(sample)
+    finally:
+      coalescer.stop()
+      publisherPool.stop()
+
+    # Batches of both the size and the time bounds were published
+    self.assertGreater(forwardBatchMock.call_count, 2)
+    self.assertItemsEqual(published, samples)
+
+    for i in xrange(10):
+      metricPrefix = "test.metric.%d " % (i,)
+      self.assertEqual(
+        [sample for sample in published if sample.startswith(metricPrefix)],
+        [sample for sample in samples if sample.startswith(metricPrefix)])
+
+    # Each coalesced batch contains samples of one publisher only
+    for (_messageBus, batch), _kwargs in forwardBatchMock.call_args_list:
+      self.assertEqual(
+        len(set(publisherPool.getPublisherIndex(sample.split()[0])
+                for sample in batch)),
+        1)
+
+
+  def testCoalescingUDPHandler(self):
+    mockServer = Mock(spec=metric_listener.CoalescingUDPServer)
+    mockServer.coalescer = Mock(spec_set=metric_listener._SampleCoalescer)
+
+    metric_listener.CoalescingUDPHandler(
+      request=("test.metric 4 1386120789\n", Mock(spec_set=socket.socket)),
+      client_address=("127.0.0.1", 2999),
+      server=mockServer)
+
+    mockServer.coalescer.add.assert_called_once_with(
+      "test.metric 4 1386120789")
+
+
+
+  def testParsePickleBatch(self):
+    payload = cPickle.dumps([("test.metric", (1386120789, 4)),
+                             (u"test.metric2", (1386120799.5, "5.5"))],
+                            protocol=2)
+
+    columns = metric_listener.parsePickleBatch(payload)
+
+    self.assertEqual(columns.names, ["test.metric", "test.metric2"])
+    self.assertEqual(columns.values, [4.0, 5.5])
+    self.assertEqual(columns.timestamps, [1386120789.0, 1386120799.5])
+
+
+  def testParsePickleBatchRejectsGlobals(self):
+    class Exploit(object):
+      def __reduce__(self):
+        return (os.system, ("true",))
+
+    payload = cPickle.dumps([("test.metric", (1386120789, Exploit()))])
+
+    with patch.object(os, "system", autospec=True) as systemMock:
+      with self.assertRaises(ValueError):
+        metric_listener.parsePickleBatch(payload)
+
+    self.assertFalse(systemMock.called)
+
+
+  def testParsePickleBatchInvalid(self):
+    for samples in ([("test.metric", 4, 1386120789)],
+                    [(4, (1386120789, 4))],
+                    [("test.metric", (1386120789, "abc"))]):
+      with self.assertRaises(ValueError):
+        metric_listener.parsePickleBatch(cPickle.dumps(samples))
+
+    with self.assertRaises(ValueError):
+      metric_listener.parsePickleBatch("not a pickle")
+
+
+  def testParseMsgpackBatch(self):
+    payload = msgpack.packb({"names": ["test.metric", "test.metric2"],
+                             "values": [4, 5.5],
+                             "timestamps": [1386120789, 1386120799.5]})
+
+    columns = metric_listener.parseMsgpackBatch(payload)
+
+    self.assertEqual(columns.names, ["test.metric", "test.metric2"])
+    self.assertEqual(columns.values, [4.0, 5.5])
+    self.assertEqual(columns.timestamps, [1386120789.0, 1386120799.5])
+
+
+  def testParseMsgpackBatchInvalid(self):
+    for batch in ({"names": ["test.metric"], "values": [4.0]},
+                  {"names": ["test.metric"], "values": [4.0, 5.0],
+                   "timestamps": [1386120789, 1386120799]},
+                  {"names": [4], "values": [4.0], "timestamps": [1386120789]},
+                  ["test.metric", 4.0, 1386120789]):
+      with self.assertRaises(ValueError):
+        metric_listener.parseMsgpackBatch(msgpack.packb(batch))
+
+    with self.assertRaises(ValueError):
+      metric_listener.parseMsgpackBatch(msgpack.packb({"names": []})[:-2])
+
+
+  def testPackColumnsMessageRoundTrip(self):
+    columns = metric_listener.SampleColumns(
+      names=["test.metric"], values=[4.0], timestamps=[1386120789.0])
+
+    message = metric_listener.packColumnsMessage(columns)
+
+    self.assertEqual(metric_listener.parseMsgpackBatch(message), columns)
+
+
+  def testGetBatchSummary(self):
+    columns = metric_listener.SampleColumns(
+      names=["test.metric", "test.metric2", "test.metric3"],
+      values=[4.0, 5.0, 6.0],
+      timestamps=[1386120789.0, 1386120799.0, 1386120809.0])
+
+    self.assertEqual(
+      metric_listener._getBatchSummary(columns),
+      (3, ("test.metric", 4.0, 1386120789.0),
+       ("test.metric3", 6.0, 1386120809.0)))
+
+    self.assertEqual(
+      metric_listener._getBatchSummary(["a 1 2", "b 3 4"]),
+      (2, "a 1 2", "b 3 4"))
+
+
+  def testFrameBatchAccumulator(self):
+    accumulator = metric_listener._FrameBatchAccumulator(Protocol.MSGPACK)
+
+    def frame(payload):
+      return struct.pack("!L", len(payload)) + payload
+
+    stream = (
+      frame(msgpack.packb({"names": ["a"], "values": [1],
+                           "timestamps": [1386120789]})) +
+      frame("garbage") +
+      frame(msgpack.packb({"names": [], "values": [], "timestamps": []})) +
+      frame(msgpack.packb({"names": ["b", "c"], "values": [2, 3],
+                           "timestamps": [1386120799, 1386120799]})))
+
+    # Feed a byte at a time to exercise partial headers and payloads
+    batches = []
+    for i in xrange(len(stream)):
+      batches.extend(accumulator.feed(stream[i]))
+
+    self.assertEqual(
+      batches,
+      [metric_listener.SampleColumns(["a"], [1.0], [1386120789.0]),
+       metric_listener.SampleColumns(["b", "c"], [2.0, 3.0],
+                                     [1386120799.0, 1386120799.0])])
+    self.assertIsNone(accumulator.flush())
+    self.assertIsNone(accumulator.close())
+
+
+  def testFrameBatchAccumulatorFrameTooLarge(self):
+    accumulator = metric_listener._FrameBatchAccumulator(Protocol.PICKLE)
+
+    with self.assertRaises(ValueError):
+      accumulator.feed(struct.pack("!L", metric_listener._MAX_FRAME_SIZE + 1))
+
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -26,11 +26,13 @@
 # pylint: disable=W0212
 
 import datetime
+import json
 import unittest
+import zlib
 
 from mock import MagicMock, patch
 
-from htmengine.runtime import metric_storer
+from htmengine.runtime import metric_listener, metric_storer
 
 
 class MetricStorerTest(unittest.TestCase):
@@ -39,14 +41,13 @@ class MetricStorerTest(unittest.TestCase):
   @patch("sqlalchemy.engine")
   def testHandleBatchSingle(self, mockEngine, addMetricMock):
     # Create mocks
-    metric_storer.gCustomMetrics = {}
-    metricMock = MagicMock()
+    metric_storer.gCustomMetrics = metric_storer._MetricCache(5)
     def addMetricSideEffect(*_args, **_kwargs):
-      metric_storer.gCustomMetrics["test.metric"] = [
-          metricMock, datetime.datetime.utcnow()]
+      return metric_storer.gCustomMetrics.put("test.metric", "uid1")
     addMetricMock.side_effect = addMetricSideEffect
     modelSwapperMock = MagicMock()
     metricStreamerMock = MagicMock()
+    metricStreamerMock.streamMultiMetricData.return_value = ()
     body = '{"protocol": "plain", "data": ["test.metric 4.0 1386792175"]}'
     message = MagicMock()
     message.body = body
@@ -55,15 +56,80 @@ class MetricStorerTest(unittest.TestCase):
                                modelSwapperMock)
     # Check the results
     addMetricMock.assert_called_once_with(mockEngine, "test.metric")
-    metricStreamerMock.streamMetricData.assert_called_once()
-    data, _uid, modelSwapper = metricStreamerMock.streamMetricData.call_args[0]
+    self.assertEqual(metricStreamerMock.streamMultiMetricData.call_count, 1)
+    dataByMetric, modelSwapper = (
+      metricStreamerMock.streamMultiMetricData.call_args[0])
     self.assertIs(modelSwapper, modelSwapperMock)
+    self.assertEqual(dataByMetric.keys(), ["uid1"])
+    data = dataByMetric["uid1"]
     self.assertEqual(len(data), 1)
     self.assertEqual(len(data[0]), 2)
     self.assertEqual(repr(data[0][0]),
                      "datetime.datetime(2013, 12, 11, 20, 2, 55)")
     self.assertAlmostEqual(data[0][1], 4.0)
 
+  @patch("htmengine.runtime.metric_storer._addMetric")
+  @patch("sqlalchemy.engine")
+  def testHandleBatchColumnar(self, mockEngine, addMetricMock):
+    # Create mocks
+    metric_storer.gCustomMetrics = metric_storer._MetricCache(5)
+    def addMetricSideEffect(_engine, metricName):
+      return metric_storer.gCustomMetrics.put(metricName, metricName + ".uid")
+    addMetricMock.side_effect = addMetricSideEffect
+    modelSwapperMock = MagicMock()
+    metricStreamerMock = MagicMock()
+    metricStreamerMock.streamMultiMetricData.return_value = ()
+    message = MagicMock()
+    message.body = metric_listener.packColumnsMessage(
+      metric_listener.SampleColumns(
+        names=["test.metric", "test.metric2", "test.metric"],
+        values=[4.0, 5.0, 6.0],
+        timestamps=[1386792175, 1386792175, 1386792475]))
+    # Call the function under test
+    metric_storer._handleBatch(mockEngine, [message], [], metricStreamerMock,
+                               modelSwapperMock)
+    # Check the results
+    self.assertEqual(addMetricMock.call_count, 2)
+    self.assertEqual(metricStreamerMock.streamMultiMetricData.call_count, 1)
+    self.assertFalse(metricStreamerMock.streamMetricData.called)
+    streamed, modelSwapper = (
+      metricStreamerMock.streamMultiMetricData.call_args[0])
+    self.assertIs(modelSwapper, modelSwapperMock)
+    self.assertEqual(
+      streamed,
+      {"test.metric.uid": [(datetime.datetime(2013, 12, 11, 20, 2, 55), 4.0),
+                           (datetime.datetime(2013, 12, 11, 20, 7, 55), 6.0)],
+       "test.metric2.uid": [(datetime.datetime(2013, 12, 11, 20, 2, 55), 5.0)]})
+
+
+  @patch("htmengine.runtime.metric_storer._addMetric")
+  @patch("sqlalchemy.engine")
+  def testHandleBatchMissingMetricFallback(self, mockEngine, addMetricMock):
+    metric_storer.gCustomMetrics = metric_storer._MetricCache(5)
+    metric_storer.gCustomMetrics.put("test.metric", "uid1")
+    metric_storer.gCustomMetrics.put("test.metric2", "uid2")
+    def addMetricSideEffect(_engine, metricName):
+      # Simulate re-creation of a deleted metric
+      return metric_storer.gCustomMetrics.put(metricName, "uid3")
+    addMetricMock.side_effect = addMetricSideEffect
+    modelSwapperMock = MagicMock()
+    metricStreamerMock = MagicMock()
+    metricStreamerMock.streamMultiMetricData.return_value = ("uid2",)
+    message = MagicMock()
+    message.body = ('{"protocol": "plain", "data": '
+                    '["test.metric 4.0 1386792175", '
+                    '"test.metric2 5.0 1386792175"]}')
+
+    metric_storer._handleBatch(mockEngine, [message], [], metricStreamerMock,
+                               modelSwapperMock)
+
+    addMetricMock.assert_called_once_with(mockEngine, "test.metric2")
+    metricStreamerMock.streamMetricData.assert_called_once_with(
+      [(datetime.datetime(2013, 12, 11, 20, 2, 55), 5.0)],
+      "uid3",
+      modelSwapperMock)
+
+
   @patch.object(metric_storer, "LOGGER")
   @patch("sqlalchemy.engine")
   def testHandleDataInvalidProtocol(self, mockEngine, loggingMock):
@@ -93,64 +159,181 @@ class MetricStorerTest(unittest.TestCase):
     self.assertTrue(loggingMock.warn.called)
 
 
-  def testTrimMetricCacheNoMetrics(self):
-    metric_storer.MAX_CACHED_METRICS = 5
-    metric_storer.CACHED_METRICS_TO_KEEP = 3
-    metric_storer.gCustomMetrics = {}
+  def testBatchColumns(self):
+    batchColumns = metric_storer._BatchColumns()
+
+    batchColumns.addPlaintextRows(["test.metric 4.0 1386792175",
+                                   "test.metric2 5.0 1386792175",
+                                   "test.metric 4.0 12:30PM",
+                                   "test.metric 6.0 1386792475"])
+    batchColumns.addColumns(metric_listener.SampleColumns(
+      names=["test.metric2", "test.metric2"],
+      values=[7.0, 8.0],
+      timestamps=[1386792475, 1e100]))
+
+    self.assertEqual(len(batchColumns), 2)
+    self.assertEqual(batchColumns.numSamples, 5)
+    self.assertItemsEqual(batchColumns.metricNames(),
+                          ["test.metric", "test.metric2"])
+
+    data = batchColumns.getMetricData("test.metric")
+    self.assertEqual(data,
+                     [(datetime.datetime(2013, 12, 11, 20, 2, 55), 4.0),
+                      (datetime.datetime(2013, 12, 11, 20, 7, 55), 6.0)])
+
+    # The sample with the out-of-range timestamp is discarded
+    data2 = batchColumns.getMetricData("test.metric2")
+    self.assertEqual(data2,
+                     [(datetime.datetime(2013, 12, 11, 20, 2, 55), 5.0),
+                      (datetime.datetime(2013, 12, 11, 20, 7, 55), 7.0)])
+
+    # Equal unix timestamps share datetime objects
+    self.assertIs(data[0][0], data2[0][0])
+    self.assertIs(data[1][0], data2[1][0])
+
+
+  def testGetMetricPartition(self):
+    names = ["test.metric.%d" % (i,) for i in xrange(1000)]
+
+    partitions = [metric_storer._getMetricPartition(name, 4) for name in names]
+
+    self.assertEqual(
+      partitions,
+      [metric_storer._getMetricPartition(name, 4) for name in names])
+    self.assertEqual(set(partitions), set(xrange(4)))
+    self.assertEqual(
+      set(metric_storer._getMetricPartition(name, 1) for name in names),
+      set([0]))
+
+    # Growing the number of partitions only moves names to the new partition
+    for name, partition in zip(names, partitions):
+      newPartition = metric_storer._getMetricPartition(name, 5)
+      self.assertIn(newPartition, (partition, 4))
+
+
+  def testBatchColumnsPartition(self):
+    batchColumns = metric_storer._BatchColumns()
+    batchColumns.addPlaintextRows(
+      ["test.metric.%d %d 1386792175" % (i % 10, i) for i in xrange(30)])
+
+    partitions = batchColumns.partition(3)
+
+    self.assertEqual(len(partitions), 3)
+    self.assertEqual(sum(p.numSamples for p in partitions), 30)
+    for i, partition in enumerate(partitions):
+      for metricName in partition.metricNames():
+        self.assertEqual(metric_storer._getMetricPartition(metricName, 3), i)
+        self.assertEqual(partition.getMetricData(metricName),
+                         batchColumns.getMetricData(metricName))
+
+
+  @patch("sqlalchemy.engine")
+  def testHandleBatchPartitioned(self, mockEngine):
+    partitionedWriterMock = MagicMock(
+      spec_set=metric_storer._PartitionedMetricDataWriter)
+    metricStreamerMock = MagicMock()
+    message = MagicMock()
+    message.body = ('{"protocol": "plain", "data": '
+                    '["test.metric 4.0 1386792175"]}')
+
+    metric_storer._handleBatch(mockEngine, [message], [], metricStreamerMock,
+                               MagicMock(), partitionedWriterMock)
+
+    self.assertEqual(partitionedWriterMock.addMetricData.call_count, 1)
+    (batchColumns,), _ = partitionedWriterMock.addMetricData.call_args
+    self.assertEqual(batchColumns.getMetricData("test.metric"),
+                     [(datetime.datetime(2013, 12, 11, 20, 2, 55), 4.0)])
+    self.assertFalse(metricStreamerMock.streamMetricData.called)
+
+
+  def testMetricCacheNoMetrics(self):
+    cache = metric_storer._MetricCache(5)
+
+    self.assertEqual(len(cache), 0)
+    self.assertNotIn("m1", cache)
+    self.assertIsNone(cache.get("m1"))
+
+
+  def testMetricCacheMaxMetrics(self):
+    cache = metric_storer._MetricCache(5)
+    for i in xrange(1, 6):
+      cache.put("m%d" % i, "uid%d" % i)
+
+    self.assertEqual(cache.names(), ["m1", "m2", "m3", "m4", "m5"])
+    self.assertEqual(cache.get("m1"),
+                     metric_storer.CachedMetric(uid="uid1"))
+
+
+  def testMetricCacheOverLimit(self):
+    cache = metric_storer._MetricCache(5)
+    for i in xrange(1, 6):
+      cache.put("m%d" % i, "uid%d" % i)
+
+    # Touch m1 and m2, so that m3 becomes the least recently used
+    cache.get("m2")
+    cache.get("m1")
+    cache.put("m6", "uid6")
 
-    metric_storer._trimMetricCache()
+    self.assertEqual(cache.names(), ["m4", "m5", "m2", "m1", "m6"])
 
-    self.assertDictEqual(metric_storer.gCustomMetrics, {})
+    # Evicted metrics can't be invalidated by uid anymore, others can
+    cache.invalidate("uid3")
+    self.assertEqual(len(cache), 5)
+    cache.invalidate("uid4")
+    self.assertEqual(cache.names(), ["m5", "m2", "m1", "m6"])
 
 
-  def testTrimMetricCacheOneMetric(self):
-    metric_storer.MAX_CACHED_METRICS = 5
-    metric_storer.CACHED_METRICS_TO_KEEP = 3
-    m1 = (MagicMock(), datetime.datetime.utcnow())
-    metric_storer.gCustomMetrics = {"m1": m1}
+  def testMetricCacheReplace(self):
+    cache = metric_storer._MetricCache(5)
+    cache.load([MagicMock(uid="uid1"), MagicMock(uid="uid2")])
+    names = cache.names()
+    cache.put(names[0], "uid3")
 
-    metric_storer._trimMetricCache()
+    self.assertEqual(cache.names(), [names[1], names[0]])
+    self.assertEqual(cache.get(names[0]),
+                     metric_storer.CachedMetric(uid="uid3"))
 
-    self.assertDictEqual(metric_storer.gCustomMetrics, {"m1": m1})
+    # The replaced uid no longer maps to the metric
+    cache.invalidate("uid1")
+    self.assertIn(names[0], cache)
+    cache.invalidate("uid3")
+    self.assertNotIn(names[0], cache)
 
 
-  def testTrimMetricCacheMaxMetric(self):
-    metric_storer.MAX_CACHED_METRICS = 5
-    metric_storer.CACHED_METRICS_TO_KEEP = 3
-    startDT = datetime.datetime.utcnow()
-    m1 = (MagicMock(), startDT)
-    m2 = (MagicMock(), startDT)
-    m3 = (MagicMock(), startDT)
-    m4 = (MagicMock(), startDT)
-    m5 = (MagicMock(), startDT)
-    metric_storer.gCustomMetrics = {
-        "m1": m1, "m2": m2, "m3": m3, "m4": m4, "m5": m5}
+  def testMetricCacheInvalidatorHandleMessage(self):
+    cache = metric_storer._MetricCache(5)
+    cache.put("m1", "uid1")
+    cache.put("m2", "uid2")
+    invalidator = metric_storer._MetricCacheInvalidator(cache, "exchange")
 
-    metric_storer._trimMetricCache()
+    inferenceResultMessage = MagicMock(
+      body=zlib.compress(json.dumps(dict(metric=dict(uid="uid1")))))
+    inferenceResultMessage.properties.headers = None
+    self.assertFalse(invalidator.handleMessage(inferenceResultMessage))
+    self.assertEqual(cache.names(), ["m1", "m2"])
 
-    self.assertDictEqual(metric_storer.gCustomMetrics,
-                         {"m1": m1, "m2": m2, "m3": m3, "m4": m4, "m5": m5})
+    commandResultMessage = MagicMock(
+      body=zlib.compress(json.dumps(dict(method="deleteModel",
+                                         modelId="uid1"))))
+    commandResultMessage.properties.headers = dict(dataType="model-cmd-result")
+    self.assertTrue(invalidator.handleMessage(commandResultMessage))
+    self.assertEqual(cache.names(), ["m2"])
 
 
-  def testTrimMetricCacheOverLimit(self):
-    metric_storer.MAX_CACHED_METRICS = 5
-    metric_storer.CACHED_METRICS_TO_KEEP = 3
-    startDT = datetime.datetime.utcnow()
-    td = datetime.timedelta(minutes=1)
-    m1 = (MagicMock(), startDT - (td * 5))
-    m2 = (MagicMock(), startDT - (td * 4))
-    m3 = (MagicMock(), startDT - (td * 3))
-    m4 = (MagicMock(), startDT - (td * 2))
-    m5 = (MagicMock(), startDT - td)
-    m6 = (MagicMock(), startDT)
-    metric_storer.gCustomMetrics = {
-        "m1": m1, "m2": m2, "m3": m3, "m4": m4, "m5": m5, "m6": m6}
+  @patch.object(metric_storer, "createCustomDatasourceAdapter", autospec=True)
+  @patch.object(metric_storer, "repository", autospec=True)
+  def testAddMetricReloadsCachedMetric(self, repositoryMock, adapterFactory):
+    metric_storer.gCustomMetrics = metric_storer._MetricCache(5)
+    metric_storer.gCustomMetrics.put("m1", "uid1")
+    repositoryMock.getMetric.return_value = MagicMock(uid="uid1")
+    engineMock = MagicMock()
 
-    metric_storer._trimMetricCache()
+    metric = metric_storer._addMetric(engineMock, "m1")
 
-    self.assertDictEqual(
-        metric_storer.gCustomMetrics,
-        {"m4": m4, "m5": m5, "m6": m6})
+    self.assertEqual(metric, metric_storer.CachedMetric(uid="uid1"))
+    self.assertEqual(metric_storer.gCustomMetrics.get("m1"), metric)
+    self.assertEqual(repositoryMock.getMetric.call_args[0][1], "uid1")
+    self.assertFalse(adapterFactory.called)
 
 
 
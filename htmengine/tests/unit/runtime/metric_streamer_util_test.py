@@ -79,6 +79,167 @@ class MetricStreamerTestCase(unittest.TestCase):
     self.assertSequenceEqual(passingData, expectedPassingSamples)
 
 
+  @patch.object(metric_streamer_util, "repository", autospec=True)
+  def testStreamMultiMetricData(self, repositoryMock):
+    repositoryMock.retryOnTransientErrors.side_effect = lambda f: f
+    now = datetime.utcnow()
+    repositoryMock.getMetricsWithUpdateLock.return_value = [
+      Mock(uid="uid1", status=metric_streamer_util.MetricStatus.ACTIVE,
+           last_rowid=10, datasource="custom"),
+      Mock(uid="uid2", status=metric_streamer_util.MetricStatus.ACTIVE,
+           last_rowid=20, datasource="custom"),
+    ]
+    repositoryMock.getMetricDataTimestamps.return_value = {
+      "uid1": now - timedelta(seconds=300)}
+    repositoryMock.addMultiMetricData.return_value = {
+      "uid1": [dict(rowid=11, timestamp=now, metric_value=1.0)],
+      "uid2": [dict(rowid=21, timestamp=now, metric_value=2.0)],
+    }
+
+    streamer = metric_streamer_util.MetricStreamer()
+    modelSwapper = Mock(
+      spec_set=model_swapper_interface.ModelSwapperInterface)
+
+    with patch.object(streamer, "_forwardStoredRows",
+                     autospec=True) as forwardStoredRowsMock:
+      missing = streamer.streamMultiMetricData(
+        {"uid1": [(now, 1.0)], "uid2": [(now, 2.0)], "uid3": [(now, 3.0)]},
+        modelSwapper)
+
+    self.assertSequenceEqual(missing, ("uid3",))
+
+    # Tail timestamps of all metrics are loaded with one query
+    self.assertEqual(repositoryMock.getMetricDataTimestamps.call_count, 1)
+    self.assertEqual(repositoryMock.getMetricDataTimestamps.call_args[0][1],
+                     {"uid1": 10, "uid2": 20})
+
+    # All metrics are locked and stored with one call each
+    self.assertEqual(repositoryMock.getMetricsWithUpdateLock.call_count, 1)
+    self.assertItemsEqual(
+      repositoryMock.getMetricsWithUpdateLock.call_args[0][1],
+      ["uid1", "uid2", "uid3"])
+    self.assertEqual(repositoryMock.addMultiMetricData.call_count, 1)
+    _conn, data, lastRowids = repositoryMock.addMultiMetricData.call_args[0]
+    self.assertEqual(data, {"uid1": ((1.0, now),), "uid2": ((2.0, now),)})
+    self.assertEqual(lastRowids, {"uid1": 10, "uid2": 20})
+
+    forwarded = dict((args[1], args)
+                     for args, _kwargs in forwardStoredRowsMock.call_args_list)
+    self.assertItemsEqual(forwarded.keys(), ["uid1", "uid2"])
+    modelInputRows, _uid, datasource, _status, swapper = forwarded["uid1"]
+    self.assertEqual(
+      modelInputRows,
+      (metric_streamer_util.ModelInputRow(rowID=11, data=(now, 1.0)),))
+    self.assertEqual(datasource, "custom")
+    self.assertIs(swapper, modelSwapper)
+
+    # Tail timestamps of the stored data are cached
+    self.assertEqual(streamer._tailInputMetricDataTimestamps.get("uid1"), now)
+    self.assertEqual(streamer._tailInputMetricDataTimestamps.get("uid2"), now)
+
+
+  @patch.object(metric_streamer_util, "repository", autospec=True)
+  def testStreamMultiMetricDataCommitFailureDoesNotCacheTailTimestamps(
+      self, repositoryMock):
+    repositoryMock.retryOnTransientErrors.side_effect = lambda f: f
+    now = datetime.utcnow()
+    repositoryMock.getMetricsWithUpdateLock.return_value = [
+      Mock(uid="uid1", status=metric_streamer_util.MetricStatus.ACTIVE,
+           last_rowid=10, datasource="custom"),
+    ]
+    repositoryMock.getMetricDataTimestamps.return_value = {
+      "uid1": now - timedelta(seconds=300)}
+    repositoryMock.addMultiMetricData.return_value = {
+      "uid1": [dict(rowid=11, timestamp=now, metric_value=1.0)],
+    }
+
+    class CommitError(Exception):
+      pass
+
+    conn = (repositoryMock.engineFactory.return_value.connect.return_value
+            .__enter__.return_value)
+    conn.begin.return_value.__exit__.side_effect = CommitError
+
+    streamer = metric_streamer_util.MetricStreamer()
+    modelSwapper = Mock(
+      spec_set=model_swapper_interface.ModelSwapperInterface)
+
+    with patch.object(streamer, "_forwardStoredRows",
+                      autospec=True) as forwardStoredRowsMock:
+      with self.assertRaises(CommitError):
+        streamer.streamMultiMetricData({"uid1": [(now, 1.0)]}, modelSwapper)
+
+    self.assertEqual(repositoryMock.addMultiMetricData.call_count, 1)
+    self.assertFalse(forwardStoredRowsMock.called)
+
+    # Only the timestamp loaded from db is cached, not that of the data that
+    # wasn't committed
+    self.assertEqual(streamer._tailInputMetricDataTimestamps.get("uid1"),
+                     now - timedelta(seconds=300))
+
+
+  @patch.object(metric_streamer_util, "repository", autospec=True)
+  def testGetTailMetricRowTimestamps(self, repositoryMock):
+    streamer = metric_streamer_util.MetricStreamer()
+    now = datetime.utcnow()
+    conn = Mock(name="SqlalchemyConnection")
+
+    streamer._tailInputMetricDataTimestamps.put("uid1", now)
+    repositoryMock.getMetricDataTimestamps.return_value = {"uid2": now}
+
+    timestamps = streamer._getTailMetricRowTimestamps(
+      conn, {"uid1": 1, "uid2": 2, "uid3": 3, "uid4": None})
+
+    self.assertEqual(timestamps, {"uid1": now, "uid2": now})
+    # Only the uncached metrics with data are loaded, in one query
+    repositoryMock.getMetricDataTimestamps.assert_called_once_with(
+      conn, {"uid2": 2, "uid3": 3})
+
+    # Loaded timestamps are cached
+    repositoryMock.getMetricDataTimestamps.reset_mock()
+    self.assertEqual(streamer._getTailMetricRowTimestamp(conn, "uid2", 2), now)
+    self.assertFalse(repositoryMock.getMetricDataTimestamps.called)
+
+
+  def testTailTimestampCacheEvictsLeastRecentlyUsed(self):
+    cache = metric_streamer_util._TailTimestampCache(maxSize=2, ttlSec=60)
+    now = datetime.utcnow()
+
+    cache.put("uid1", now)
+    cache.put("uid2", now)
+    self.assertEqual(cache.get("uid1"), now)
+    cache.put("uid3", now)
+
+    self.assertEqual(len(cache), 2)
+    self.assertIsNone(cache.get("uid2"))
+    self.assertEqual(cache.get("uid1"), now)
+    self.assertEqual(cache.get("uid3"), now)
+
+
+  @patch.object(metric_streamer_util.time, "time", autospec=True)
+  def testTailTimestampCacheExpiration(self, timeMock):
+    cache = metric_streamer_util._TailTimestampCache(maxSize=10, ttlSec=60)
+    now = datetime.utcnow()
+
+    timeMock.return_value = 1000
+    cache.put("uid1", now)
+    cache.put("uid2", now)
+    cache.put("uid3", now)
+
+    timeMock.return_value = 1030
+    cache.put("uid2", now)
+
+    timeMock.return_value = 1061
+    self.assertIsNone(cache.get("uid1"))
+    self.assertEqual(cache.get("uid2"), now)
+    self.assertEqual(len(cache), 2)
+
+    # Expired entries are evicted incrementally as new ones are put
+    cache.put("uid4", now)
+    self.assertEqual(len(cache), 2)
+    self.assertIsNone(cache.get("uid3"))
+
+
   def testSendInputRowsToModel(self):
     """ Test MetricStreamer._sendInputRowsToModel """
     metricDataOutputChunkSize = metric_streamer_util.config.getint(
@@ -142,6 +303,9 @@ class MetricStreamerTestCase(unittest.TestCase):
       modelSwapper.submitRequests.call_args_list[2][0][1],
       expectedBatch3)
 
+    # Model Scheduler should have been notified once for all batches
+    modelSwapper.notifyModelScheduler.assert_called_once_with(metricID)
+
     # And one more time with just one input row
     modelSwapper = Mock(
       spec_set=model_swapper_interface.ModelSwapperInterface)
@@ -199,6 +363,9 @@ class MetricStreamerTestCase(unittest.TestCase):
       modelSwapper.submitRequests.call_args_list[0][0][1],
       inputRows[:metricDataOutputChunkSize])
 
+    # Nothing was submitted, so Model Scheduler shouldn't have been notified
+    self.assertEqual(modelSwapper.notifyModelScheduler.call_count, 0)
+
 
   def testSendInputRowsToModelSubmitRequestsOtherError(self):
     """ Test MetricStreamer._sendInputRowsToModel with error other than
@@ -242,6 +409,9 @@ class MetricStreamerTestCase(unittest.TestCase):
       modelSwapper.submitRequests.call_args_list[0][0][1],
       inputRows[:metricDataOutputChunkSize])
 
+    # Nothing was submitted, so Model Scheduler shouldn't have been notified
+    self.assertEqual(modelSwapper.notifyModelScheduler.call_count, 0)
+
     # And one more with just one row
     modelSwapper = Mock(
       spec_set=model_swapper_interface.ModelSwapperInterface)
@@ -264,5 +434,52 @@ class MetricStreamerTestCase(unittest.TestCase):
 
 
 
+  def testSendInputRowsToModelNotifyErrorDoesNotMaskSubmitError(self):
+    """ Test MetricStreamer._sendInputRowsToModel with an error from
+    ModelSwapperInterface.submitRequests after some batches were submitted,
+    followed by an error from notifyModelScheduler
+    """
+    metricDataOutputChunkSize = metric_streamer_util.config.getint(
+        "metric_streamer", "chunk_size")
+
+    now = datetime.utcnow()
+
+    inputRows = [
+      model_swapper_interface.ModelInputRow(
+        rowID=1+i,
+        data=(now + timedelta(seconds=60*i), i,))
+      for i in xrange(metricDataOutputChunkSize * 3)
+    ]
+
+    class SubmitError(Exception):
+      pass
+
+    class NotifyError(Exception):
+      pass
+
+    modelSwapper = Mock(
+      spec_set=model_swapper_interface.ModelSwapperInterface)
+
+    modelSwapper.submitRequests.side_effect = [Mock(), SubmitError]
+    modelSwapper.notifyModelScheduler.side_effect = NotifyError
+
+    metricID = "abcdef"
+
+    streamer = metric_streamer_util.MetricStreamer()
+
+    with self.assertRaises(SubmitError):
+      streamer._sendInputRowsToModel(
+        inputRows=inputRows,
+        metricID=metricID,
+        modelSwapper=modelSwapper)
+
+    self.assertEqual(modelSwapper.submitRequests.call_count, 2)
+
+    # The first batch was submitted, so Model Scheduler should have been
+    # notified
+    modelSwapper.notifyModelScheduler.assert_called_once_with(metricID)
+
+
+
 if __name__ == '__main__':
   unittest.main()
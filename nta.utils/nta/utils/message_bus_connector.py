@@ -217,20 +217,30 @@ class MessageBusConnector(object):
         raise
 
 
-  @_RETRY_ON_AMQP_ERROR
   def isEmpty(self, mqName):
     """
+    raises: MessageQueueNotFound
+    """
+    # NOTE: getMessageCount() already uses _RETRY_ON_AMQP_ERROR
+    return self.getMessageCount(mqName) == 0
+
+
+  @_RETRY_ON_AMQP_ERROR
+  def getMessageCount(self, mqName):
+    """
+    retval: number of messages in the message queue that are ready for delivery
+
     raises: MessageQueueNotFound
     """
     try:
       r = self._channelMgr.client.declareQueue(mqName,
                                                passive=True)
-      return r.messageCount == 0
+      return r.messageCount
     except amqp.exceptions.AmqpChannelError as e:
       if e.code == amqp.constants.AMQPErrorCodes.NOT_FOUND:
         self._channelMgr.reset()
         raise MessageQueueNotFound(
-          "isEmpty: mq=%s not found (%r)" % (mqName, e,))
+          "getMessageCount: mq=%s not found (%r)" % (mqName, e,))
       else:
         raise
 
@@ -241,8 +251,8 @@ class MessageBusConnector(object):
 
     TODO: need test for isMessageQeueuePresent (MER-948)
     """
-    # NOTE: we implement this on top of isEmpty(), which already uses
-    # _RETRY_ON_AMQP_ERROR, so we don't need retries on this method.
+    # NOTE: we implement this on top of isEmpty(), which already retries via
+    # getMessageCount(), so we don't need retries on this method.
 
     try:
       self.isEmpty(mqName)
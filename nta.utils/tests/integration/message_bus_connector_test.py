@@ -88,6 +88,7 @@ class MessageQueueManagementTestCase(_TestCaseBase):
     deleteMessageQueue
     purge
     isEmpty
+    getMessageCount
   """
 
   def testCreateDurableMessageQueue(self):
@@ -291,6 +292,34 @@ class MessageQueueManagementTestCase(_TestCaseBase):
         bus.isEmpty(mqName=mqName)
 
 
+  def testGetMessageCount(self):
+    mqName = self._getUniqueMessageQueueName()
+
+    with amqp_test_utils.managedQueueDeleter(mqName):
+      with MessageBusConnector() as bus:
+        # Create the queue
+        bus.createMessageQueue(mqName=mqName, durable=True)
+
+        self.assertEqual(bus.getMessageCount(mqName), 0)
+
+        # Now add some messages
+        bus.publish(mqName, "abc", persistent=True)
+        bus.publish(mqName, "def", persistent=True)
+
+        # Verify that the messages were added
+        self.assertEqual(_getQueueMessageCount(mqName), 2)
+
+        self.assertEqual(bus.getMessageCount(mqName), 2)
+
+
+  def testGetMessageCountWithQueueNotFound(self):
+    mqName = self._getUniqueMessageQueueName()
+
+    with MessageBusConnector() as bus:
+      with self.assertRaises(MessageQueueNotFound):
+        bus.getMessageCount(mqName=mqName)
+
+
   def testGetAllMessageQueues(self):
     durableMQ = self._getUniqueMessageQueueName()
     nonDurableMQ = self._getUniqueMessageQueueName()